@@ -262,12 +262,11 @@ def bounding_volume(img, target_img_size):
 def rescale_image(img_data):
     # Conform intensities
     src_min, scale = getscale(img_data, 0, 255)
-    mapped_data = img_data
     if not img_data.dtype == np.dtype(np.uint8):
         if np.max(img_data) > 255:
-            mapped_data = scalecrop(img_data, 0, 255, src_min, scale)
+            return scalecrop(img_data, 0, 255, src_min, scale, dtype=np.uint8)
 
-    new_data = np.uint8(np.rint(mapped_data))
+    new_data = np.uint8(np.rint(img_data))
     return new_data
 
 
@@ -30,7 +30,9 @@ from CerebNet.data_loader.dataset import SubjectDataset
 from CerebNet.datasets.utils import crop_transform
 from CerebNet.models.networks import build_model
 from CerebNet.utils import checkpoint as cp
+from FastSurferCNN.models.quantization import build_quantized_model
 from FastSurferCNN.utils import PLANES, Plane, logging
+from FastSurferCNN.utils.checkpoint import load_quantized_checkpoint
 from FastSurferCNN.utils.common import (
     SerialExecutor,
     SubjectDirectory,
@@ -63,6 +65,7 @@ class Inference:
         async_io: bool = False,
         device: str = "auto",
         viewagg_device: str = "auto",
+        quantized: bool = False,
     ):
         """
         Create the inference object to manage inferencing, batch processing, data
@@ -80,6 +83,9 @@ class Inference:
             Device to perform inference on.
         viewagg_device : str, default="auto"
             Device to aggregate views on.
+        quantized : bool, default=False
+            Whether to use the int8 models of the quantized checkpoints (cpu only, see
+            CerebNet/quantize.py).
         """
         self.pool = None
         self._threads = None
@@ -103,6 +109,10 @@ class Inference:
                 flag_name="viewagg_device",
                 min_memory=2 * (2**30),
             )
+        if quantized and _device.type != "cpu":
+            logger.warning(f"Quantized models only run on the cpu, using the float models on {_device}.")
+            quantized = False
+        self.quantized = quantized
 
         self.batch_size = cfg.TEST.BATCH_SIZE
         _models = self._load_model(cfg)
@@ -175,6 +185,13 @@ class Inference:
                 # if the checkpoint path is not a file, but a folder search in there for
                 # the newest checkpoint
                 checkpoint_path = cp.get_checkpoint_path(checkpoint_path).pop()
+            if self.quantized:
+                model_state, metadata = load_quantized_checkpoint(checkpoint_path)
+                logger.info(
+                    f"Loading quantized checkpoint of {checkpoint_path} "
+                    f"({metadata['backend']} backend)"
+                )
+                return build_quantized_model(model, model_state)
             cp.load_from_checkpoint(checkpoint_path, model)
             model.eval()
             return model
@@ -418,6 +435,32 @@ class Inference:
 
         seg, seg_data = seg.result()
         conf_file, conf_img, conf_data = conf_img.result()
+        subject_dataset = self.make_subject_dataset(conf_img, seg)
+        if norm is not None:
+            norm_file, _, norm_data = norm.result()
+        return norm_data, norm_file, subject_dataset
+
+    def make_subject_dataset(
+            self,
+            conf_img: nib.analyze.SpatialImage,
+            seg: nib.analyze.SpatialImage,
+    ) -> SubjectDataset:
+        """
+        Locate the cerebellum in the (1mm conformed) image by the aseg+DKT
+        segmentation and provide the localized patch.
+
+        Parameters
+        ----------
+        conf_img : nib.analyze.SpatialImage
+            The conformed image (1mm).
+        seg : nib.analyze.SpatialImage
+            The aseg+DKT segmentation.
+
+        Returns
+        -------
+        SubjectDataset
+            The dataset of the cerebellum patch.
+        """
         subject_dataset = SubjectDataset(
             img_org=conf_img,
             brain_seg=seg,
@@ -426,9 +469,93 @@ class Inference:
             primary_slice=self.cfg.DATA.PRIMARY_SLICE_DIR,
         )
         subject_dataset.transforms = ToTensorTest()
-        if norm is not None:
-            norm_file, _, norm_data = norm.result()
-        return norm_data, norm_file, subject_dataset
+        return subject_dataset
+
+    def run_subject(
+            self,
+            subject: SubjectDirectory,
+            subject_dataset: SubjectDataset,
+            norm: np.ndarray | None = None,
+            norm_file: Path | None = None,
+    ) -> list[Future]:
+        """
+        Segment the cerebellum of a subject and save the segmentation (and stats)
+        asynchronously.
+
+        Parameters
+        ----------
+        subject : SubjectDirectory
+            The subject (segfile and cereb_statsfile define the output files).
+        subject_dataset : SubjectDataset
+            The dataset of the cerebellum patch (see make_subject_dataset).
+        norm : np.ndarray, optional
+            The bias field corrected image (1mm), required for the stats file.
+        norm_file : Path, optional
+            The filename of the bias field corrected image (for the stats file).
+
+        Returns
+        -------
+        list[Future]
+            The futures of the saved files.
+        """
+        # predict CerebNet, returns logits
+        preds = self._predict_single_subject(subject_dataset)
+        # create the folder for the output file, if it does not exist
+        _mkdir = self.pool.submit(
+            subject.segfile.parent.mkdir, exist_ok=True, parents=True,
+        )
+
+        # postprocess logits (move axes, map sagittal to all classes)
+        preds_per_plane = self._post_process_preds(preds)
+        # view aggregation in logit space and find max label
+        cerebnet_seg = self._view_aggregation(preds_per_plane)
+
+        # map predictions into FreeSurfer Label space & move segmentation to cpu
+        cerebnet_seg = self.cereb_id2fs_id.map(cerebnet_seg).cpu()
+
+        # uncrop the segmentation
+        bounding_box = subject_dataset.get_bounding_offsets()
+        full_cereb_seg = crop_transform(
+            cerebnet_seg,
+            offsets=tuple(-o for o in bounding_box["offsets"]),
+            target_shape=bounding_box["source_shape"],
+        ).numpy()
+
+        # this is None, but synchronizes the creation of the directory
+        _ = _mkdir.result()
+        futures = [
+            self._save_cerebnet_seg(
+                full_cereb_seg, subject.segfile, subject_dataset.get_nibabel_img(),
+            )
+        ]
+
+        if subject.has_attribute("cereb_statsfile"):
+            # vox_vol = np.prod(norm.header.get_zooms()).item()
+            # CerebNet always has vox_vol 1
+            if norm is None:
+                raise RuntimeError("norm not loaded as expected!")
+            df = self._calc_segstats(full_cereb_seg, norm, vox_vol=1.0)
+            from FastSurferCNN.segstats import write_statsfile
+
+            # in batch processing, we are finished with this subject and the output of
+            # this data can be outsourced to a different process
+            futures.append(
+                self.pool.submit(
+                    write_statsfile,
+                    subject.filename_by_attribute("cereb_statsfile"),
+                    df,
+                    vox_vol=1.0,
+                    segfile=subject.segfile,
+                    normfile=norm_file,
+                    lut=self.freesurfer_lut_file,
+                    volume_precision="3",
+                    exclude=[0],
+                    pvfile=norm_file,
+                    report_empty=True,
+                    extra_header=[],
+                )
+            )
+        return futures
 
     def run(self, subject_dirs: SubjectList):
         logger.info(time.strftime("%y-%m-%d_%H:%M:%S"))
@@ -447,68 +574,10 @@ class Inference:
                 enumerate(iter_subjects), total=len(subject_dirs), desc="Subject",
             ):
                 try:
-                    # predict CerebNet, returns logits
-                    preds = self._predict_single_subject(subject_dataset)
-                    # create the folder for the output file, if it does not exist
-                    _mkdir = self.pool.submit(
-                        subject.segfile.parent.mkdir, exist_ok=True, parents=True,
+                    futures.extend(
+                        self.run_subject(subject, subject_dataset, norm, norm_file)
                     )
-
-                    # postprocess logits (move axes, map sagittal to all classes)
-                    preds_per_plane = self._post_process_preds(preds)
-                    # view aggregation in logit space and find max label
-                    cerebnet_seg = self._view_aggregation(preds_per_plane)
-
-                    # map predictions into FreeSurfer Label space & move segmentation to
-                    # cpu
-                    cerebnet_seg = self.cereb_id2fs_id.map(cerebnet_seg).cpu()
                     pred_time = time.time()
-
-                    # uncrop the segmentation
-                    bounding_box = subject_dataset.get_bounding_offsets()
-                    full_cereb_seg = crop_transform(
-                        cerebnet_seg,
-                        offsets=tuple(-o for o in bounding_box["offsets"]),
-                        target_shape=bounding_box["source_shape"],
-                    ).numpy()
-
-                    # this is None, but synchronizes the creation of the directory
-                    _ = _mkdir.result()
-                    futures.append(
-                        self._save_cerebnet_seg(
-                            full_cereb_seg,
-                            subject.segfile,
-                            subject_dataset.get_nibabel_img(),
-                        )
-                    )
-
-                    if subject.has_attribute("cereb_statsfile"):
-                        # vox_vol = np.prod(norm.header.get_zooms()).item()
-                        # CerebNet always has vox_vol 1
-                        if norm is None:
-                            raise RuntimeError("norm not loaded as expected!")
-                        df = self._calc_segstats(full_cereb_seg, norm, vox_vol=1.0)
-                        from FastSurferCNN.segstats import write_statsfile
-
-                        # in batch processing, we are finished with this subject and the
-                        # output of this data can be outsourced to a different process
-                        futures.append(
-                            self.pool.submit(
-                                write_statsfile,
-                                subject.filename_by_attribute("cereb_statsfile"),
-                                df,
-                                vox_vol=1.0,
-                                segfile=subject.segfile,
-                                normfile=norm_file,
-                                lut=self.freesurfer_lut_file,
-                                volume_precision="3",
-                                exclude=[0],
-                                pvfile=norm_file,
-                                report_empty=True,
-                                extra_header=[],
-                            )
-                        )
-
                     logger.info(
                         f"Subject {idx + 1}/{len(subject_dirs)} with id "
                         f"'{subject.id}' processed in {pred_time - start_time :.2f} "
@@ -0,0 +1,228 @@
+# Copyright 2024 Image Analysis Lab, German Center for Neurodegenerative Diseases (DZNE), Bonn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Static post-training quantization of the CerebNet networks (see
+FastSurferCNN/quantize.py).
+
+The networks are calibrated on cerebellum patches of a few subjects segmented by
+FastSurferVINN (the patch is located by the aseg+DKT segmentation), the quantized
+checkpoints are saved next to the float checkpoints and are used by
+CerebNet/run_prediction.py with --quantized. Finally, the int8 segmentations of the
+subjects are compared to the float32 segmentations (dice).
+
+Usage:
+`python3 CerebNet/quantize.py --subjects <subject directories> [--ckpt_cor <checkpoint> ...]`
+"""
+
+# IMPORTS
+import argparse
+import sys
+from collections.abc import Iterator, Sequence
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from CerebNet.data_loader.data_utils import slice_lia2ras
+from CerebNet.data_loader.dataset import SubjectDataset
+from CerebNet.inference import Inference
+from CerebNet.utils import checkpoint as cp
+from CerebNet.utils.checkpoint import YAML_DEFAULT as CHECKPOINT_PATHS_FILE
+from CerebNet.utils.load_config import get_config
+from FastSurferCNN.data_loader.data_utils import load_image, load_maybe_conform
+from FastSurferCNN.quantize import (
+    add_calibration_arguments,
+    calibration_indices,
+    quantize_checkpoint,
+    report_dice,
+)
+from FastSurferCNN.utils import PLANES, Plane, logging, parser_defaults
+from FastSurferCNN.utils.checkpoint import get_checkpoints, load_checkpoint_config_defaults
+from FastSurferCNN.utils.common import assert_no_root
+
+LOGGER = logging.getLogger(__name__)
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """
+    Create the argparse object.
+
+    Returns
+    -------
+    argparse.ArgumentParser
+        The parser object.
+    """
+    parser = argparse.ArgumentParser(
+        description="Static post-training quantization (int8) of the CerebNet networks "
+                    "for cpu inference."
+    )
+    parser.add_argument(
+        "--subjects",
+        dest="subjects",
+        type=Path,
+        nargs="+",
+        required=True,
+        help="Subject directories (segmented by FastSurferVINN) to calibrate the "
+             "quantization with. The int8 and float32 segmentations of these subjects "
+             "are compared.",
+    )
+    parser = add_calibration_arguments(parser)
+    parser = parser_defaults.add_arguments(
+        parser, ["conformed_name", "asegdkt_segfile", "batch_size", "threads", "allow_root"],
+    )
+    files: dict[Plane, str | Path] = {k: "default" for k in PLANES}
+    parser = parser_defaults.add_plane_flags(
+        parser, "checkpoint", files, CHECKPOINT_PATHS_FILE,
+    )
+    return parser
+
+
+def load_subjects(
+        model: Inference,
+        subjects: Sequence[Path],
+        conf_name: str = "mri/orig.mgz",
+        pred_name: str = "mri/aparc.DKTatlas+aseg.deep.mgz",
+) -> list[tuple[str, SubjectDataset]]:
+    """
+    Load the cerebellum patches of subjects.
+
+    Parameters
+    ----------
+    model : Inference
+        The CerebNet inference object.
+    subjects : Sequence[Path]
+        The subject directories.
+    conf_name : str, default="mri/orig.mgz"
+        The conformed image relative to the subject directory (conformed to 1mm if
+        necessary).
+    pred_name : str, default="mri/aparc.DKTatlas+aseg.deep.mgz"
+        The aseg+DKT segmentation relative to the subject directory.
+
+    Returns
+    -------
+    list[tuple[str, SubjectDataset]]
+        The name and the dataset of each subject.
+    """
+    datasets = []
+    for subject in subjects:
+        _, conf_img, _ = load_maybe_conform(subject / conf_name, subject / conf_name, vox_size=1.0)
+        seg, _ = load_image(subject / pred_name, "aseg+DKT segmentation")
+        datasets.append((subject.name, model.make_subject_dataset(conf_img, seg)))
+    return datasets
+
+
+def calibration_batches(
+        plane: Plane,
+        datasets: Sequence[tuple[str, SubjectDataset]],
+        num_slices: int = 32,
+        batch_size: int = 1,
+) -> Iterator[tuple[torch.Tensor]]:
+    """
+    Yield batches of evenly spaced, non-empty slices of the cerebellum patches.
+
+    Parameters
+    ----------
+    plane : Plane
+        The plane of the network.
+    datasets : Sequence[tuple[str, SubjectDataset]]
+        The name and dataset of each subject.
+    num_slices : int, default=32
+        The number of slices per subject.
+    batch_size : int, default=1
+        The batch size.
+
+    Yields
+    ------
+    tuple[torch.Tensor]
+        Batches of images (RAS+ as the networks are trained on RAS+ slices).
+    """
+    for name, dataset in datasets:
+        dataset.set_plane(plane)
+        indices = calibration_indices(dataset.images_per_plane[plane], num_slices)
+        LOGGER.info(f"Calibrating {plane} on {len(indices)} slices of {name}")
+        for img in DataLoader(Subset(dataset, indices), batch_size=batch_size):
+            yield (slice_lia2ras(plane, img, thick_slices=True),)
+
+
+def predict(model: Inference, dataset: SubjectDataset) -> np.ndarray:
+    """
+    Segment the cerebellum patch of a subject (CerebNet labels).
+    """
+    logits = model._post_process_preds(model._predict_single_subject(dataset))
+    return model._view_aggregation(logits).cpu().numpy()
+
+
+def main(
+        *,
+        subjects: list[Path],
+        ckpt_ax: Path,
+        ckpt_sag: Path,
+        ckpt_cor: Path,
+        conf_name: str = "mri/orig.mgz",
+        pred_name: str = "mri/aparc.DKTatlas+aseg.deep.mgz",
+        calibration_slices: int = 32,
+        dice: bool = True,
+        batch_size: int = 1,
+        threads: int = 1,
+        allow_root: bool = False,
+) -> int | str:
+    allow_root or assert_no_root()
+
+    urls = load_checkpoint_config_defaults("url", filename=CHECKPOINT_PATHS_FILE)
+    get_checkpoints(ckpt_ax, ckpt_cor, ckpt_sag, urls=urls)
+    args = argparse.Namespace(
+        opts=None, batch_size=batch_size, ckpt_ax=ckpt_ax, ckpt_cor=ckpt_cor, ckpt_sag=ckpt_sag,
+    )
+    cfg = get_config(args)
+    cfg.TEST.ENABLE = True
+    cfg.TRAIN.ENABLE = False
+    float_model = Inference(cfg, threads=threads, device="cpu", viewagg_device="cpu")
+    try:
+        datasets = load_subjects(float_model, subjects, conf_name, pred_name)
+    except (OSError, RuntimeError, ValueError) as e:
+        return e.args[0] if e.args else repr(e)
+
+    for plane in PLANES:
+        ckpt = Path(cfg.TEST[f"{plane.upper()}_CHECKPOINT_PATH"])
+        if not ckpt.is_file():
+            # the same checkpoint Inference loads
+            ckpt = cp.get_checkpoint_path(ckpt).pop()
+        LOGGER.info(f"Quantizing the {plane} network {ckpt}")
+        batches = calibration_batches(plane, datasets, calibration_slices, batch_size)
+        names = [name for name, _ in datasets]
+        quantize_checkpoint(float_model.models[plane], batches, ckpt, names, calibration_slices)
+
+    if not dice:
+        return 0
+
+    int8_model = Inference(
+        cfg, threads=threads, device="cpu", viewagg_device="cpu", quantized=True,
+    )
+    report_dice(
+        (name, predict(int8_model, dataset), predict(float_model, dataset))
+        for name, dataset in datasets
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    parser = make_parser()
+    _args = parser.parse_args()
+
+    from FastSurferCNN.utils.logging import setup_logging
+    setup_logging(None)
+
+    sys.exit(main(**vars(_args)))
@@ -81,7 +81,10 @@ def setup_options():
     advanced = parser.add_argument_group(title="Advanced options")
     parser_defaults.add_arguments(
         advanced,
-        ["device", "viewagg_device", "threads", "batch_size", "async_io", "allow_root"],
+        [
+            "device", "viewagg_device", "threads", "batch_size", "async_io", "allow_root",
+            "quantized",
+        ],
     )
 
     files: dict[Plane, str | Path] = {k: "default" for k in PLANES}
@@ -171,6 +174,7 @@ def main(args: argparse.Namespace) -> int | str:
             threads=getattr(args, "threads", 1),
             device=args.device,
             viewagg_device=args.viewagg_device,
+            quantized=args.quantized,
         )
         return tester.run(subjects)
     except Exception as e:
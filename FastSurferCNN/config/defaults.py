@@ -113,6 +113,22 @@ _C.TRAIN.EARLY_STOPPING_WAIT = 10
 # Delta = change below which early stopping starts (previous - current < delta = stop)
 _C.TRAIN.EARLY_STOPPING_DELTA = 0.00001
 
+# Flag to run forward passes with automatic mixed precision (with gradient scaling for float16)
+_C.TRAIN.AMP = False
+
+# Data type of the mixed precision operations ("float16" or "bfloat16")
+_C.TRAIN.AMP_DTYPE = "float16"
+
+# Flag to use the channels-last memory format for the model and the images
+_C.TRAIN.CHANNELS_LAST = False
+
+# Flag to keep losses on the device and only synchronize them every LOG_INTERVAL iterations
+_C.TRAIN.DEFERRED_METRICS = False
+
+# Flag to validate with the Dice of the full volume of each subject (the mean over
+# subjects selects the best checkpoint), requires hdf5 files with slice counts
+_C.TRAIN.VOLUME_METRICS = False
+
 # ---------------------------------------------------------------------------- #
 # Testing options
 # ---------------------------------------------------------------------------- #
@@ -147,8 +163,25 @@ _C.DATA.SIZES = [256, 311, 320]
 _C.DATA.PADDED_SIZE = 320
 
 # Augmentations
+# add "Batched" to apply them to whole batches on the training device instead of
+# per sample with torchio in the data loader workers
 _C.DATA.AUG = ["Scaling", "Translation"]
 
+# Read slices from the hdf5 file on demand (file opened once per worker process)
+# instead of loading the whole dataset into memory in every worker
+_C.DATA.LAZY_LOADING = False
+
+# With LAZY_LOADING, keep slices that have been read in a cache in shared memory,
+# which is shared by all worker processes (needs enough space in /dev/shm)
+_C.DATA.SHARED_CACHE = False
+
+# Flag to batch only slices of the same size and scale factor, padded per batch to their size
+# (rounded up to a multiple of BUCKET_PAD_MULTIPLE, at most PADDED_SIZE)
+_C.DATA.BUCKET_BATCHES = False
+
+# Multiple to round the padded size of bucketed batches up to
+_C.DATA.BUCKET_PAD_MULTIPLE = 16
+
 # ---------------------------------------------------------------------------- #
 # DataLoader options (common for test and train)
 # ---------------------------------------------------------------------------- #
@@ -233,6 +266,21 @@ _C.RNG_SEED = 1
 _C.SUMMARY_PATH = "FastSurferVINN/summary/FastSurferVINN_coronal"
 _C.CONFIG_LOG_PATH = "FastSurferVINN/config/FastSurferVINN_coronal"
 
+# ---------------------------------------------------------------------------- #
+# Distributed data-parallel options (one process per device, launched with torchrun)
+# ---------------------------------------------------------------------------- #
+
+_C.DISTRIBUTED = CN()
+
+# Flag to train with DistributedDataParallel (TRAIN.BATCH_SIZE is the batch size per process)
+_C.DISTRIBUTED.ENABLED = False
+
+# Backend of the process group ("nccl", "gloo" or "auto": nccl with cuda, else gloo)
+_C.DISTRIBUTED.BACKEND = "auto"
+
+# Initialization method of the process group (env:// uses MASTER_ADDR, MASTER_PORT, RANK, WORLD_SIZE)
+_C.DISTRIBUTED.INIT_METHOD = "env://"
+
 
 def get_cfg_defaults():
     """Get a yacs CfgNode object with default values for my_project."""
@@ -14,12 +14,15 @@
 
 
 # IMPORTS
+import math
+from collections.abc import Sequence
 from numbers import Number, Real
 from typing import Any
 
 import numpy as np
 import numpy.typing as npt
 import torch
+import torch.nn.functional as F
 
 
 ##
@@ -480,3 +483,276 @@ class AugmentationRandomCrop:
         weight = weight[top:bottom, left:right]
 
         return {"img": img, "label": label, "weight": weight, "scale_factor": sf}
+
+
+##
+# Batched transformations for training (applied to whole batches on the device)
+##
+class BatchAugmentation:
+    """
+    Apply the torchio training augmentations to whole batches of tensors.
+
+    The same transform families as the torchio pipeline in the loader (with the same
+    default parameters) are implemented with tensor operations on the device of the
+    batch: elastic deformation, scaling, rotation and translation are combined into
+    one sampling grid per sample (a single grid_sample call for the batch), random
+    anisotropy is a vectorised nearest-downsample/linear-upsample, and bias fields
+    are polynomial fields evaluated for all samples at once. As in the torchio
+    pipeline, all selected transforms are applied to a sample with probability p and
+    images are normalized to [0, 1] afterwards. The scaling is returned explicitly as
+    part of the scale factors.
+
+    Attributes
+    ----------
+    augs : set[str]
+        Selected transform families (names as in cfg.DATA.AUG).
+    p : float
+        Probability to augment a sample.
+
+    Methods
+    -------
+    __call__
+        Augment a batch.
+    """
+
+    FAMILIES = (
+        "Elastic", "Scaling", "Rotation", "Translation", "RAnisotropy", "BiasField",
+        "RGamma", "Gaussian",
+    )
+
+    def __init__(
+            self,
+            augs: Sequence[str],
+            p: float = 0.8,
+            scales: tuple[float, float] = (0.8, 1.15),
+            degrees: float = 10.0,
+            translation: float = 15.0,
+            num_control_points: int = 7,
+            max_displacement: float = 20.0,
+            locked_borders: int = 2,
+            downsampling: tuple[float, float] = (1.1, 1.5),
+            bias_coefficients: float = 0.5,
+            bias_order: int = 3,
+            log_gamma: tuple[float, float] = (-0.1, 0.1),
+            noise_std: float = 0.1,
+    ):
+        """
+        Construct object.
+
+        Parameters
+        ----------
+        augs : Sequence[str]
+            Transform families to apply, entries not in FAMILIES (e.g. "Batched") are
+            ignored.
+        p : float
+            Probability to augment a sample. Default = 0.8.
+        scales : tuple[float, float]
+            Range of the isotropic scaling factor. Default = (0.8, 1.15).
+        degrees : float
+            Maximum rotation angle in degrees. Default = 10.
+        translation : float
+            Maximum translation in voxels. Default = 15.
+        num_control_points : int
+            Number of control points of the elastic deformation grid. Default = 7.
+        max_displacement : float
+            Maximum displacement of the elastic control points in voxels. Default = 20.
+        locked_borders : int
+            Number of outer rings of control points without displacement. Default = 2.
+        downsampling : tuple[float, float]
+            Range of the downsampling factor of the anisotropy. Default = (1.1, 1.5).
+        bias_coefficients : float
+            Maximum magnitude of the bias field polynomial coefficients. Default = 0.5.
+        bias_order : int
+            Order of the bias field polynomial. Default = 3.
+        log_gamma : tuple[float, float]
+            Range of the logarithm of gamma. Default = (-0.1, 0.1).
+        noise_std : float
+            Standard deviation of the noise added to the scale factors. Default = 0.1.
+        """
+        self.augs = set(augs).intersection(self.FAMILIES)
+        self.p = p
+        self.scales = scales
+        self.degrees = degrees
+        self.translation = translation
+        self.num_control_points = num_control_points
+        self.max_displacement = max_displacement
+        self.locked_borders = locked_borders
+        self.downsampling = downsampling
+        self.bias_coefficients = bias_coefficients
+        self.bias_powers = [
+            (i, j) for i in range(bias_order + 1) for j in range(bias_order + 1 - i)
+        ]
+        self.log_gamma = log_gamma
+        self.noise_std = noise_std
+
+    @staticmethod
+    def _uniform(low: float, high: float, shape: tuple, active: torch.Tensor) -> torch.Tensor:
+        """
+        Sample uniform values, zero for inactive samples (first dimension).
+        """
+        values = torch.rand(shape, device=active.device) * (high - low) + low
+        return values * active.view((-1,) + (1,) * (len(shape) - 1))
+
+    def _sampling_grid(self, active: torch.Tensor, h: int, w: int) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Create the sampling grid of elastic deformation, scaling, rotation and translation.
+
+        Returns
+        -------
+        grid : torch.Tensor
+            Normalized sampling grid of shape (B, H, W, 2) for grid_sample.
+        scale : torch.Tensor
+            Scaling factor of each sample.
+        """
+        b = active.shape[0]
+        device = active.device
+        ys, xs = torch.meshgrid(
+            torch.arange(h, device=device, dtype=torch.float32),
+            torch.arange(w, device=device, dtype=torch.float32),
+            indexing="ij",
+        )
+        # output coordinates relative to the image center, shape (B, 2, H, W) as (y, x)
+        coords = torch.stack((ys - (h - 1) / 2, xs - (w - 1) / 2)).expand(b, 2, h, w)
+        if "Elastic" in self.augs:
+            n = self.num_control_points
+            coarse = self._uniform(
+                -self.max_displacement, self.max_displacement, (b, 2, n, n), active
+            )
+            k = self.locked_borders
+            if k > 0:
+                inner = torch.zeros_like(coarse)
+                inner[..., k:n - k, k:n - k] = 1
+                coarse = coarse * inner
+            coords = coords + F.interpolate(
+                coarse, size=(h, w), mode="bicubic", align_corners=True
+            )
+        scale = torch.ones(b, device=device)
+        if "Scaling" in self.augs:
+            scale = torch.where(
+                active, self._uniform(*self.scales, (b,), torch.ones_like(active)), scale
+            )
+        angle = torch.zeros(b, device=device)
+        if "Rotation" in self.augs:
+            angle = self._uniform(-self.degrees, self.degrees, (b,), active) * (math.pi / 180)
+        shift = torch.zeros(b, 2, device=device)
+        if "Translation" in self.augs:
+            shift = self._uniform(-self.translation, self.translation, (b, 2), active)
+        # input = R^-1 (output - shift) / scale
+        cos, sin = torch.cos(angle).view(b, 1, 1), torch.sin(angle).view(b, 1, 1)
+        y = coords[:, 0] - shift[:, 0].view(b, 1, 1)
+        x = coords[:, 1] - shift[:, 1].view(b, 1, 1)
+        inv_scale = (1 / scale).view(b, 1, 1)
+        y_in = (cos * y - sin * x) * inv_scale + (h - 1) / 2
+        x_in = (sin * y + cos * x) * inv_scale + (w - 1) / 2
+        # normalized coordinates for align_corners=False
+        grid = torch.stack(((2 * x_in + 1) / w - 1, (2 * y_in + 1) / h - 1), dim=-1)
+        return grid, scale
+
+    def _anisotropy(self, images: torch.Tensor, active: torch.Tensor) -> torch.Tensor:
+        """
+        Downsample (nearest) and upsample (linear) along a random axis per sample.
+        """
+        b, c, h, w = images.shape
+        device = images.device
+        factor = 1 + self._uniform(
+            self.downsampling[0] - 1, self.downsampling[1] - 1, (b,), active
+        )
+        axis_h = torch.rand(b, device=device) < 0.5
+        for dim, size, use in ((2, h, axis_h), (3, w, ~axis_h)):
+            f = torch.where(use, factor, torch.ones_like(factor)).view(b, 1)
+            u = torch.arange(size, device=device, dtype=torch.float32).view(1, -1) / f
+            k = torch.floor(u)
+            t = u - k
+            # positions of the coarse (downsampled) samples below and above
+            i0 = torch.round(k * f).clamp(max=size - 1).long()
+            i1 = torch.round((k + 1) * f).clamp(max=size - 1).long()
+            shape = [b, 1, 1, 1]
+            shape[dim] = size
+            expand = [b, c, h, w]
+            i0 = i0.view(shape).expand(expand)
+            i1 = i1.view(shape).expand(expand)
+            t = t.view(shape)
+            images = torch.gather(images, dim, i0) * (1 - t) + torch.gather(images, dim, i1) * t
+        return images
+
+    def _bias_field(self, images: torch.Tensor, active: torch.Tensor) -> torch.Tensor:
+        """
+        Multiply with a random exponentiated polynomial field per sample.
+        """
+        b, _, h, w = images.shape
+        device = images.device
+        ys = torch.linspace(-1, 1, h, device=device).view(h, 1)
+        xs = torch.linspace(-1, 1, w, device=device).view(1, w)
+        basis = torch.stack([ys ** i * xs ** j for i, j in self.bias_powers])
+        coeffs = self._uniform(
+            -self.bias_coefficients, self.bias_coefficients,
+            (b, len(self.bias_powers)), active,
+        )
+        field = torch.exp(torch.einsum("bk,khw->bhw", coeffs, basis))
+        return images * field.unsqueeze(1)
+
+    def __call__(
+            self,
+            images: torch.Tensor,
+            labels: torch.Tensor,
+            weights: torch.Tensor,
+            scale_factors: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Augment a batch.
+
+        Parameters
+        ----------
+        images : torch.Tensor
+            Images of shape (B, C, H, W) with intensities in [0, 1].
+        labels : torch.Tensor
+            Labels of shape (B, H, W).
+        weights : torch.Tensor
+            Weights of shape (B, H, W).
+        scale_factors : torch.Tensor
+            Scale factors of shape (B, 2).
+
+        Returns
+        -------
+        images : torch.Tensor
+            Augmented images normalized to [0, 1].
+        labels : torch.Tensor
+            Augmented labels.
+        weights : torch.Tensor
+            Augmented weights.
+        scale_factors : torch.Tensor
+            Scale factors including the scaling augmentation (and noise).
+        """
+        b, _, h, w = images.shape
+        active = torch.rand(b, device=images.device) < self.p
+        images = images.float()
+        scale = None
+        if self.augs.intersection(("Elastic", "Scaling", "Rotation", "Translation")):
+            grid, scale = self._sampling_grid(active, h, w)
+            images = F.grid_sample(
+                images, grid, mode="bilinear", padding_mode="zeros", align_corners=False
+            )
+            # labels and weights are label maps (nearest neighbor)
+            maps = torch.stack((labels.float(), weights.float()), dim=1)
+            maps = F.grid_sample(
+                maps, grid, mode="nearest", padding_mode="zeros", align_corners=False
+            )
+            labels = maps[:, 0].to(labels.dtype)
+            weights = maps[:, 1].to(weights.dtype)
+        if "RAnisotropy" in self.augs:
+            images = self._anisotropy(images, active)
+        if "BiasField" in self.augs:
+            images = self._bias_field(images, active)
+        if "RGamma" in self.augs:
+            gamma = torch.exp(self._uniform(*self.log_gamma, (b,), active)).view(b, 1, 1, 1)
+            images = images.clamp(min=0) ** gamma
+        # Normalize image and clamp between 0 and 1
+        img_max = images.amax(dim=(1, 2, 3), keepdim=True).clamp(min=1e-8)
+        images = torch.clamp(images / img_max, min=0.0, max=1.0)
+
+        if scale is not None:
+            scale_factors = scale_factors * scale.to(scale_factors).view(b, 1)
+        if "Gaussian" in self.augs:
+            noise = torch.randn(b, 1, device=scale_factors.device) * self.noise_std
+            scale_factors = torch.clamp(scale_factors + noise.to(scale_factors), min=0.1)
+        return images, labels, weights, scale_factors
@@ -18,7 +18,8 @@
 import argparse
 import logging
 import sys
-from collections.abc import Iterable
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from typing import cast
 
@@ -277,12 +278,77 @@ def map_image(
     )
 
 
+# number of voxels processed at once by getscale and scalecrop (8 MB of float64)
+CHUNK_SIZE = 1 << 20
+
+
+def _map_chunks(
+        func: Callable[[slice], object],
+        data: np.ndarray,
+        threads: int = 1,
+) -> list:
+    """
+    Apply func to chunks (slices along the first axis) of data.
+
+    Parameters
+    ----------
+    func : Callable[[slice], object]
+        Function to apply to the slice of each chunk.
+    data : np.ndarray
+        The data to split into chunks of about CHUNK_SIZE voxels.
+    threads : int, default=1
+        Number of threads to process the chunks with.
+
+    Returns
+    -------
+    list
+        The results of func for each chunk.
+    """
+    rows = max(1, CHUNK_SIZE // max(1, int(np.prod(data.shape[1:]))))
+    chunks = [slice(i, i + rows) for i in range(0, data.shape[0], rows)]
+    if threads > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(threads) as pool:
+            return list(pool.map(func, chunks))
+    return list(map(func, chunks))
+
+
+def _value_counts(data: np.ndarray, threads: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Count the occurrences of each value in 8 or 16 bit integer data (in one pass).
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image data of an integer type with at most 16 bits.
+    threads : int, default=1
+        Number of threads to count with.
+
+    Returns
+    -------
+    values : np.ndarray
+        The sorted (by their unsigned representation) values present in data.
+    counts : np.ndarray
+        The number of voxels of each value.
+    """
+    num_values = 1 << (8 * data.dtype.itemsize)
+    unsigned = np.dtype(f"u{data.dtype.itemsize}").newbyteorder(data.dtype.byteorder)
+
+    def _count(chunk: slice) -> np.ndarray:
+        return np.bincount(data[chunk].ravel().view(unsigned), minlength=num_values)
+
+    counts = np.sum(_map_chunks(_count, data, threads), axis=0)
+    present = np.flatnonzero(counts)
+    values = present.astype(unsigned.newbyteorder("="))
+    return values.view(data.dtype.newbyteorder("=")), counts[present]
+
+
 def getscale(
         data: np.ndarray,
         dst_min: float,
         dst_max: float,
         f_low: float = 0.0,
-        f_high: float = 0.999
+        f_high: float = 0.999,
+        threads: int = 1,
 ) -> tuple[float, float]:
     """
     Get offset and scale of image intensities to robustly rescale to dst_min..dst_max.
@@ -301,6 +367,8 @@ def getscale(
         Robust cropping at low end (0.0=no cropping).
     f_high : float, default=0.999
         Robust cropping at higher end (0.999=crop one thousandth of highest intensity).
+    threads : int, default=1
+        Number of threads to compute the statistics with.
 
     Returns
     -------
@@ -314,10 +382,37 @@ def getscale(
         raise ValueError(
             "Invalid values for f_low or f_high, must be within 0 and 1."
         )
+    data = np.asanyarray(data)
+    bins = 1000
+
+    if data.dtype.kind in "iu" and data.dtype.itemsize <= 2:
+        # count each value in one pass, the statistics follow from the counts
+        values, counts = _value_counts(data, threads)
+        data_min, data_max = values.min(), values.max()
+        num_nonzero_voxels = counts[values != 0].sum()
+
+        def _histogram() -> tuple[np.ndarray, np.ndarray]:
+            hist, bin_edges = np.histogram(
+                values, bins=bins, range=(data_min, data_max), weights=counts,
+            )
+            return hist.astype(np.int64), bin_edges
+    else:
+        # get min, max and non-zeros from source (in one pass over chunks of data)
+        def _stats(chunk: slice) -> tuple[np.number, np.number, int]:
+            _data = data[chunk]
+            return _data.min(), _data.max(), np.count_nonzero(np.abs(_data) >= 1e-15)
+
+        mins, maxs, nonzeros = zip(*_map_chunks(_stats, data, threads), strict=True)
+        data_min, data_max = np.min(mins), np.max(maxs)
+        num_nonzero_voxels = sum(nonzeros)
+
+        def _histogram() -> tuple[np.ndarray, np.ndarray]:
+            # the histograms of the chunks add up to the histogram of data
+            def _chunk_histogram(chunk: slice) -> tuple[np.ndarray, np.ndarray]:
+                return np.histogram(data[chunk], bins=bins, range=(data_min, data_max))
 
-    # get min and max from source
-    data_min = np.min(data)
-    data_max = np.max(data)
+            hists, edges = zip(*_map_chunks(_chunk_histogram, data, threads), strict=True)
+            return np.sum(hists, axis=0), edges[0]
 
     if data_min < 0.0:
         # logger. warning
@@ -328,13 +423,11 @@ def getscale(
     if f_low == 0.0 and f_high == 1.0:
         return data_min, 1.0
 
-    # compute non-zeros and total vox num
-    num_nonzero_voxels = (np.abs(data) >= 1e-15).sum()
+    # compute total vox num
     num_total_voxels = data.shape[0] * data.shape[1] * data.shape[2]
 
     # compute histogram (number of samples)
-    bins = 1000
-    hist, bin_edges = np.histogram(data, bins=bins, range=(data_min, data_max))
+    hist, bin_edges = _histogram()
 
     # compute cumulative histogram
     cum_hist = np.concatenate(([0], np.cumsum(hist)))
@@ -389,11 +482,17 @@ def scalecrop(
         dst_min: float,
         dst_max: float,
         src_min: float,
-        scale: float
+        scale: float,
+        dtype: npt.DTypeLike | None = None,
+        zero_background: bool = False,
+        threads: int = 1,
 ) -> np.ndarray:
     """
     Crop the intensity ranges to specific min and max values.
 
+    The data is rescaled in chunks, so no float copy of the whole image is created,
+    if dtype is passed.
+
     Parameters
     ----------
     data : np.ndarray
@@ -406,21 +505,43 @@ def scalecrop(
         Minimal value to consider from source (crops below).
     scale : float
         Scale value by which source will be shifted.
+    dtype : npt.DTypeLike, optional
+        The dtype of the scaled image data, integer data is rounded (default: the
+        float type of the scaling).
+    zero_background : bool, default=False
+        Whether to map zeros in data to zero (usually background).
+    threads : int, default=1
+        Number of threads to scale with.
 
     Returns
     -------
     np.ndarray
         Scaled image data.
     """
-    data_new = dst_min + scale * (data - src_min)
-
-    # clip
-    data_new = np.clip(data_new, dst_min, dst_max)
+    data = np.asanyarray(data)
+    out = None if dtype is None else np.empty(data.shape, dtype=dtype)
+    rint = dtype is not None and np.issubdtype(dtype, np.integer)
+
+    def _scalecrop(chunk: slice) -> tuple[np.ndarray, np.number, np.number]:
+        _data = data[chunk]
+        data_new = dst_min + scale * (_data - src_min)
+        # clip
+        np.clip(data_new, dst_min, dst_max, out=data_new)
+        _min, _max = data_new.min(), data_new.max()
+        if zero_background:
+            data_new[_data == 0] = 0
+        if rint:
+            np.rint(data_new, out=data_new)
+        if out is None:
+            return data_new, _min, _max
+        out[chunk] = data_new
+        return out[chunk], _min, _max
+
+    chunks, mins, maxs = zip(*_map_chunks(_scalecrop, data, threads), strict=True)
     print(
-        "Output:   min: " + format(data_new.min()) + "  max: " + format(data_new.max())
+        "Output:   min: " + format(np.min(mins)) + "  max: " + format(np.max(maxs))
     )
-
-    return data_new
+    return np.concatenate(chunks) if out is None else out
 
 
 def rescale(
@@ -428,7 +549,8 @@ def rescale(
         dst_min: float,
         dst_max: float,
         f_low: float = 0.0,
-        f_high: float = 0.999
+        f_high: float = 0.999,
+        threads: int = 1,
 ) -> np.ndarray:
     """
     Rescale image intensity values (0-255).
@@ -445,14 +567,16 @@ def rescale(
         Robust cropping at low end (0.0=no cropping).
     f_high : float, default=0.999
         Robust cropping at higher end (0.999=crop one thousandth of highest intensity).
+    threads : int, default=1
+        Number of threads to rescale with.
 
     Returns
     -------
     np.ndarray
         Scaled image data.
     """
-    src_min, scale = getscale(data, dst_min, dst_max, f_low, f_high)
-    data_new = scalecrop(data, dst_min, dst_max, src_min, scale)
+    src_min, scale = getscale(data, dst_min, dst_max, f_low, f_high, threads=threads)
+    data_new = scalecrop(data, dst_min, dst_max, src_min, scale, threads=threads)
     return data_new
 
 
@@ -659,12 +783,14 @@ def conform(
     mapped_data = map_image(img, affine, h1.get_data_shape(), order=order, **kwargs)
 
     if img_dtype != np.dtype(np.uint8) or (img_dtype != target_dtype and scale != 1.0):
-        scaled_data = scalecrop(mapped_data, 0, 255, src_min, scale)
-        # map zero in input to zero in output (usually background)
-        scaled_data[mapped_data == 0] = 0
-        mapped_data = scaled_data
-
-    if target_dtype == np.dtype(np.uint8):
+        # map zero in input to zero in output (usually background), scale and round
+        # directly to uint8 (without float copies)
+        mapped_data = scalecrop(
+            mapped_data, 0, 255, src_min, scale,
+            dtype=target_dtype if target_dtype == np.dtype(np.uint8) else None,
+            zero_background=True,
+        )
+    elif target_dtype == np.dtype(np.uint8):
         mapped_data = np.clip(np.rint(mapped_data), 0, 255)
     new_img = nib.MGHImage(sctype(mapped_data), affine, h1)
 
@@ -466,48 +466,92 @@ def create_weight_mask(
     Returns
     -------
     np.ndarray
-        Weights.
+        Weights (float32).
     """
-    unique, counts = np.unique(mapped_aseg, return_counts=True)
+    counts = np.bincount(np.asarray(mapped_aseg, dtype=np.intp).ravel())
+    present = counts > 0
 
-    # Median Frequency Balancing
-    class_wise_weights = np.median(counts) / counts
+    # Median Frequency Balancing (over the labels present)
+    class_wise_weights = np.zeros(counts.shape, dtype=np.float64)
+    class_wise_weights[present] = np.median(counts[present]) / counts[present]
     class_wise_weights[class_wise_weights > max_weight] = max_weight
-    (h, w, d) = mapped_aseg.shape
 
-    weights_mask = np.reshape(class_wise_weights[mapped_aseg.ravel()], (h, w, d))
+    weights_mask = class_wise_weights[mapped_aseg]
 
     # Gradient Weighting
     if gradient:
-        (gx, gy, gz) = np.gradient(mapped_aseg)
-        grad_weight = max_edge_weight * np.asarray(
-            np.power(np.power(gx, 2) + np.power(gy, 2) + np.power(gz, 2), 0.5) > 0,
-            dtype="float",
-        )
-
-        weights_mask += grad_weight
+        weights_mask[label_edges(mapped_aseg)] += max_edge_weight
 
     if max_hires_weight is not None:
         # High-res Weighting
-        print(
-            "Adding hires weight mask deep sulci and WM with weight ", max_hires_weight
+        LOGGER.info(
+            f"Adding hires weight mask deep sulci and WM with weight {max_hires_weight}"
         )
         mask1 = deep_sulci_and_wm_strand_mask(
             mapped_aseg, structure=np.ones((3, 3, 3)), ctx_thresh=ctx_thresh
         )
-        weights_mask += mask1 * max_hires_weight
+        weights_mask[mask1] += max_hires_weight
 
         if cortex_mask:
-            print("Adding cortex mask with weight ", max_hires_weight)
+            LOGGER.info(f"Adding cortex mask with weight {max_hires_weight}")
             mask2 = cortex_border_mask(
                 mapped_aseg, structure=np.ones((3, 3, 3)), ctx_thresh=ctx_thresh
             )
-            weights_mask += mask2 * (max_hires_weight) // 2
+            weights_mask[mask2] += max_hires_weight // 2
 
     if mean_filter:
         weights_mask = uniform_filter(weights_mask, size=3)
 
-    return weights_mask
+    # accumulate in float64 (as before), but store half the memory
+    return weights_mask.astype(np.float32)
+
+
+def label_edges(label: npt.NDArray) -> np.ndarray:
+    """
+    Find the voxels with a non-zero gradient of the label volume.
+
+    The result is identical to ``np.linalg.norm(np.gradient(label), axis=0) > 0``,
+    but only uses integer comparisons of the neighbors (central differences inside
+    the volume, one-sided differences at the borders).
+
+    Parameters
+    ----------
+    label : npt.NDArray
+        Label volume.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean edge mask.
+    """
+    edges = np.zeros(label.shape, dtype=bool)
+    for axis in range(label.ndim):
+        if label.shape[axis] < 2:
+            continue
+        lab = np.moveaxis(label, axis, 0)
+        edg = np.moveaxis(edges, axis, 0)
+        edg[1:-1] |= lab[2:] != lab[:-2]
+        edg[0] |= lab[1] != lab[0]
+        edg[-1] |= lab[-1] != lab[-2]
+    return edges
+
+
+def _bbox_slices(mask: npt.NDArray, margin: int) -> tuple[slice, ...] | None:
+    """
+    Get the bounding box of mask extended by margin (clipped to the volume).
+
+    Returns None for an empty mask.
+    """
+    bbox = []
+    for axis in range(mask.ndim):
+        other = tuple(i for i in range(mask.ndim) if i != axis)
+        idx = np.flatnonzero(np.any(mask, axis=other))
+        if idx.size == 0:
+            return None
+        bbox.append(
+            slice(max(idx[0] - margin, 0), min(idx[-1] + margin + 1, mask.shape[axis]))
+        )
+    return tuple(bbox)
 
 
 def cortex_border_mask(
@@ -532,14 +576,17 @@ def cortex_border_mask(
     np.ndarray
         Inner grey matter layer.
     """
-    # create aseg brainmask, erode it and subtract from itself
-    bm = np.clip(label, a_max=1, a_min=0)
-    eroded = binary_erosion(bm, structure=structure)
-    diff_im = np.logical_xor(eroded, bm)
-
-    # only keep values associated with the cortex
-    diff_im[(label <= ctx_thresh)] = 0  # > 33 (>19) = > 1002 in FS space (full (sag)),
-    print("Remaining voxels cortex border: ", np.unique(diff_im, return_counts=True))
+    diff_im = np.zeros(label.shape, dtype=bool)
+    # only values associated with the cortex are kept, so it is sufficient to
+    # process the bounding box of the cortex (plus the radius of the structure)
+    ctx = label > ctx_thresh  # > 33 (>19) = > 1002 in FS space (full (sag)),
+    bbox = _bbox_slices(ctx, max(structure.shape) // 2)
+    if bbox is not None:
+        # create aseg brainmask, erode it and subtract from itself
+        bm = label[bbox] > 0
+        eroded = binary_erosion(bm, structure=structure)
+        diff_im[bbox] = np.logical_xor(eroded, bm) & ctx[bbox]
+    LOGGER.info(f"Remaining voxels cortex border: {np.count_nonzero(diff_im)}")
     return diff_im
 
 
@@ -569,17 +616,17 @@ def deep_sulci_and_wm_strand_mask(
         Sulcus + wm mask.
     """
     # Binarize label image (cortex = 1, everything else = 0)
-    empty_im = np.zeros(shape=volume.shape)
-    empty_im[volume > ctx_thresh] = 1  # > 33 (>19) = >1002 in FS LUT (full (sag))
-
-    # Erode the image
-    eroded = binary_closing(empty_im, iterations=iteration, structure=structure)
-
-    # Get difference between eroded and original image
-    diff_image = np.logical_xor(empty_im, eroded)
-    print(
-        "Remaining voxels sulci/wm strand: ", np.unique(diff_image, return_counts=True)
-    )
+    ctx = volume > ctx_thresh  # > 33 (>19) = >1002 in FS LUT (full (sag))
+    diff_image = np.zeros(volume.shape, dtype=bool)
+    # the closing can only change voxels within dilation reach of the cortex
+    bbox = _bbox_slices(ctx, 2 * iteration * (max(structure.shape) // 2))
+    if bbox is not None:
+        # Erode the image
+        closed = binary_closing(ctx[bbox], iterations=iteration, structure=structure)
+
+        # Get difference between eroded and original image
+        diff_image[bbox] = np.logical_xor(ctx[bbox], closed)
+    LOGGER.info(f"Remaining voxels sulci/wm strand: {np.count_nonzero(diff_image)}")
     return diff_image
 
 
@@ -13,7 +13,9 @@
 # limitations under the License.
 
 # IMPORTS
+import os
 import time
+from collections.abc import Sequence
 from typing import Optional
 
 import h5py
@@ -24,12 +26,93 @@ import yacs.config
 from torch.utils.data import Dataset
 
 from FastSurferCNN.data_loader import data_utils as du
-from FastSurferCNN.utils import logging
+from FastSurferCNN.utils import Plane, logging
 
 logger = logging.getLogger(__name__)
 
 
 # Operator to load imaged for inference
+# axes of the conformed (coronal) volume in the order (height, width, slice) of each
+# plane (see data_utils.transform_axial and data_utils.transform_sagittal)
+PLANE_AXES: dict[Plane, tuple[int, int, int]] = {
+    "coronal": (0, 1, 2),
+    "sagittal": (2, 1, 0),
+    "axial": (2, 0, 1),
+}
+
+
+def normalize_volume(orig_data: npt.NDArray) -> torch.Tensor:
+    """
+    Convert a conformed volume to a float tensor in [0, 1] (same as ToTensorTest).
+
+    Parameters
+    ----------
+    orig_data : npt.NDArray
+        The conformed image data.
+
+    Returns
+    -------
+    torch.Tensor
+        The normalized volume (float32).
+    """
+    volume = torch.from_numpy(np.asarray(orig_data, dtype=np.float32).copy())
+    return volume.div_(255.0).clamp_(0.0, 1.0)
+
+
+def pad_volume(volume: torch.Tensor, slice_thickness: int) -> torch.Tensor:
+    """
+    Pad a volume by repeating the edge slices in all directions.
+
+    Parameters
+    ----------
+    volume : torch.Tensor
+        The (normalized) volume.
+    slice_thickness : int
+        The padding (number of neighboring slices on each side of thick slices).
+
+    Returns
+    -------
+    torch.Tensor
+        The padded volume, from which thick_slice_view creates the thick slices of all
+        planes.
+    """
+    if slice_thickness == 0:
+        return volume
+    pad = (slice_thickness,) * 6
+    return torch.nn.functional.pad(volume[None, None], pad, mode="replicate")[0, 0]
+
+
+def thick_slice_view(
+        padded: torch.Tensor, plane: Plane, slice_thickness: int
+) -> torch.Tensor:
+    """
+    Create the thick slices of a plane as a strided view into the padded volume.
+
+    The thick slices are identical to the images of MultiScaleOrigDataThickSlices (after
+    ToTensorTest), but no data is copied.
+
+    Parameters
+    ----------
+    padded : torch.Tensor
+        The volume padded by slice_thickness (see pad_volume).
+    plane : Plane
+        The plane to slice.
+    slice_thickness : int
+        The number of neighboring slices on each side.
+
+    Returns
+    -------
+    torch.Tensor
+        View of shape (num_slices, 2 * slice_thickness + 1, height, width).
+    """
+    t = slice_thickness
+    view = padded.permute(*PLANE_AXES[plane])
+    # remove the padding of the in-plane axes
+    view = view[t:view.shape[0] - t, t:view.shape[1] - t]
+    # (height, width, slices, thickness) -> (slices, thickness, height, width)
+    return view.unfold(2, 2 * t + 1, 1).permute(2, 3, 0, 1)
+
+
 class MultiScaleOrigDataThickSlices(Dataset):
     """
     Load MRI-Image and process it to correct format for network inference.
@@ -135,6 +218,333 @@ class MultiScaleOrigDataThickSlices(Dataset):
         return self.count
 
 
+class H5SliceStore:
+    """
+    Lazy access to the slices of the size groups of a FastSurfer hdf5 file.
+
+    Only subject names and zooms are read on construction. Images, labels and weights
+    are read slice by slice (each a contiguous read of one chunk or hyperslab) when
+    they are accessed. The file is opened on first access in each process, so every
+    DataLoader worker has its own handle. Optionally, slices that have been read are
+    kept in a cache in shared memory, which all worker processes use together. The
+    cache is disabled, if it does not fit into the free space of /dev/shm.
+    """
+
+    DATASETS = ("orig_dataset", "aseg_dataset", "weight_dataset")
+
+    def __init__(self, dataset_path: str, sizes: Sequence[int], shared_cache: bool = False):
+        """
+        Construct object.
+
+        Parameters
+        ----------
+        dataset_path : str
+            Path to the dataset.
+        sizes : Sequence[int]
+            Sizes (group names) to load.
+        shared_cache : bool
+            Whether to cache slices in shared memory (Default value = False).
+        """
+        self.dataset_path = dataset_path
+        self.keys = []
+        self.subjects = []
+        self.zooms = []
+        self.slice_sizes = []
+        slice_subjects = []
+        self._file = None
+        self._pid = None
+        offsets = [0]
+        shapes = []
+        with h5py.File(dataset_path, "r") as hf:
+            for size in sizes:
+                if f"{size}" not in hf:
+                    print(f"KeyError: Unable to open object (object {size} does not exist)")
+                    continue
+                group = hf[f"{size}"]
+                self.keys.append(f"{size}")
+                self.zooms.extend(list(group["zoom_dataset"][()]))
+                self.subjects.extend(list(group["subject"]))
+                self.slice_sizes.extend([size] * group["orig_dataset"].shape[0])
+                slice_subjects.append(
+                    _slice_subjects(group, len(self.subjects) - len(group["subject"]))
+                )
+                offsets.append(offsets[-1] + group["orig_dataset"].shape[0])
+                shapes.append({n: (group[n].shape, group[n].dtype) for n in self.DATASETS})
+        self.offsets = np.asarray(offsets)
+        self.slice_subjects = _concat_slice_subjects(slice_subjects)
+        self._shapes = shapes
+        self._shm = None
+        self._arrays = None
+        self._owner = os.getpid()
+        if shared_cache and not self._shm_fits(shapes):
+            shared_cache = False
+        if shared_cache:
+            from multiprocessing.shared_memory import SharedMemory
+
+            # one shared block per size group and dataset, plus flags for cached slices
+            # of each dataset; pages are only allocated when they are written
+            self._shm = [
+                {
+                    n: SharedMemory(create=True, size=max(1, int(np.prod(shp)) * dt.itemsize))
+                    for n, (shp, dt) in shape.items()
+                } | {"flags": SharedMemory(
+                    create=True, size=max(1, len(self.DATASETS) * shape[self.DATASETS[0]][0][0]),
+                )}
+                for shape in shapes
+            ]
+
+    @staticmethod
+    def _shm_fits(shapes: list[dict[str, tuple]]) -> bool:
+        """
+        Check, whether the shared cache fits into the free space of /dev/shm.
+
+        Writing to shared memory beyond the size of /dev/shm (e.g. 64 MB in docker by
+        default) crashes the process with SIGBUS instead of raising an error.
+        """
+        size = sum(int(np.prod(shp)) * dt.itemsize for shape in shapes for shp, dt in shape.values())
+        try:
+            stat = os.statvfs("/dev/shm")
+        except OSError:
+            # no /dev/shm (e.g. macOS), shared memory is not limited by a filesystem
+            return True
+        free = stat.f_bavail * stat.f_frsize
+        if size > free:
+            logger.warning(
+                f"The shared cache ({size / 2 ** 20:.0f} MB) does not fit into the free "
+                f"space of /dev/shm ({free / 2 ** 20:.0f} MB), disabling the cache. Increase "
+                f"the size of /dev/shm (e.g. docker run --shm-size) to use the cache."
+            )
+            return False
+        return True
+
+    def __del__(self):
+        """
+        Release the shared cache (it is removed by the process that created it).
+        """
+        for blocks in self._shm or []:
+            for shm in blocks.values():
+                shm.close()
+                if os.getpid() == self._owner:
+                    shm.unlink()
+        self._shm = None
+
+    def _cache_arrays(self) -> list[dict[str, np.ndarray]]:
+        """
+        Return numpy views of the shared cache in this process.
+        """
+        if self._arrays is None:
+            self._arrays = [
+                {
+                    n: np.ndarray(shp, dtype=dt, buffer=blocks[n].buf)
+                    for n, (shp, dt) in shape.items()
+                } | {"flags": np.ndarray(
+                    (len(self.DATASETS), shape[self.DATASETS[0]][0][0]), np.bool_, blocks["flags"].buf,
+                )}
+                for shape, blocks in zip(self._shapes, self._shm, strict=True)
+            ]
+        return self._arrays
+
+    def __len__(self) -> int:
+        """
+        Return the number of slices.
+        """
+        return int(self.offsets[-1])
+
+    def __getstate__(self) -> dict:
+        """
+        Drop the file handle and cache views when pickled (e.g. for spawned workers).
+        """
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_pid"] = None
+        state["_arrays"] = None
+        return state
+
+    def _get_file(self) -> h5py.File:
+        """
+        Return the file handle of this process (opened on first use).
+        """
+        if self._file is None or self._pid != os.getpid():
+            # handles must not be shared with forked processes
+            self._file = h5py.File(self.dataset_path, "r")
+            self._pid = os.getpid()
+        return self._file
+
+    def read(self, index: int, names: Sequence[str] = DATASETS) -> tuple[np.ndarray, ...]:
+        """
+        Read datasets of a slice (by default image, label and weight).
+
+        Parameters
+        ----------
+        index : int
+            Index of the slice.
+        names : Sequence[str]
+            The datasets to read (Default value = DATASETS).
+
+        Returns
+        -------
+        tuple[np.ndarray, ...]
+            The slice of each dataset in names.
+        """
+        if index < 0:
+            index += len(self)
+        group = int(np.searchsorted(self.offsets, index, side="right")) - 1
+        local = index - int(self.offsets[group])
+        if self._shm is not None:
+            cache = self._cache_arrays()[group]
+            for n in names:
+                flag = self.DATASETS.index(n)
+                if not cache["flags"][flag, local]:
+                    self._get_file()[self.keys[group]][n].read_direct(cache[n], np.s_[local], np.s_[local])
+                    # set the flag last, other workers may read as soon as it is set
+                    cache["flags"][flag, local] = True
+            return tuple(cache[n][local].copy() for n in names)
+        h5group = self._get_file()[self.keys[group]]
+        return tuple(h5group[n][local] for n in names)
+
+    def view(self, name: str) -> "H5SliceView":
+        """
+        Return a sequence of the slices of one dataset.
+
+        Parameters
+        ----------
+        name : str
+            One of "orig_dataset", "aseg_dataset" and "weight_dataset".
+
+        Returns
+        -------
+        H5SliceView
+            Lazy sequence of slices.
+        """
+        if name not in self.DATASETS:
+            raise ValueError(f"Invalid dataset {name}, must be one of {', '.join(self.DATASETS)}.")
+        return H5SliceView(self, name)
+
+
+class H5SliceView(Sequence):
+    """
+    Lazy sequence of the slices of one dataset of a H5SliceStore.
+    """
+
+    def __init__(self, store: H5SliceStore, name: str):
+        self.store = store
+        self.name = name
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        # only read this dataset
+        return self.store.read(index, (self.name,))[0]
+
+
+def _slice_subjects(group: h5py.Group, subject_offset: int) -> np.ndarray | None:
+    """
+    Get the subject index of each slice of a size group from its slice counts.
+
+    Returns None for files written without slice counts.
+    """
+    if "slice_count" not in group:
+        return None
+    counts = group["slice_count"][()]
+    return np.repeat(np.arange(len(counts)) + subject_offset, counts)
+
+
+def _concat_slice_subjects(slice_subjects: list[np.ndarray | None]) -> np.ndarray | None:
+    """
+    Concatenate the subject indices of size groups (None, if any group has none).
+    """
+    if any(s is None for s in slice_subjects):
+        return None
+    return np.concatenate(slice_subjects) if slice_subjects else np.zeros(0, dtype=int)
+
+
+def load_hdf5_slices(dataset, dataset_path: str, cfg: yacs.config.CfgNode, start: float):
+    """
+    Set images, labels, weights, zooms, subjects and sizes of a dataset from an hdf5 file.
+
+    The size (hdf5 group) of each slice is stored in dataset.slice_sizes and the index
+    of its subject (in dataset.subjects) in dataset.slice_subjects (None for files
+    without slice counts).
+
+    With cfg.DATA.LAZY_LOADING, slices are read on demand from a H5SliceStore.
+    Otherwise, all slices are loaded into lists in memory.
+
+    Parameters
+    ----------
+    dataset : MultiScaleDataset, MultiScaleDatasetVal
+        Dataset to set the attributes of.
+    dataset_path : str
+        Path to the dataset.
+    cfg : yacs.config.CfgNode
+        Configuration node.
+    start : float
+        Start time for logging.
+    """
+    if cfg.DATA.LAZY_LOADING:
+        store = H5SliceStore(dataset_path, cfg.DATA.SIZES, cfg.DATA.SHARED_CACHE)
+        dataset.images = store.view("orig_dataset")
+        dataset.labels = store.view("aseg_dataset")
+        dataset.weights = store.view("weight_dataset")
+        dataset.zooms = store.zooms
+        dataset.subjects = store.subjects
+        dataset.slice_sizes = store.slice_sizes
+        dataset.slice_subjects = store.slice_subjects
+        logger.info(
+            f"Indexed {len(store)} slices for lazy loading in {time.time() - start:.3f} "
+            f"seconds (shared cache: {cfg.DATA.SHARED_CACHE})"
+        )
+        return
+
+    # Load the h5 file and save it to the dataset
+    dataset.images = []
+    dataset.labels = []
+    dataset.weights = []
+    dataset.subjects = []
+    dataset.zooms = []
+    dataset.slice_sizes = []
+    slice_subjects = []
+
+    # Open file in reading mode
+    with h5py.File(dataset_path, "r") as hf:
+        for size in cfg.DATA.SIZES:
+            try:
+                logger.info(f"Processing images of size {size}.")
+                img_dset = list(hf[f"{size}"]["orig_dataset"])
+                logger.info(
+                    f"Processed origs of size {size} in {time.time() - start:.3f} seconds"
+                )
+                dataset.images.extend(img_dset)
+                dataset.slice_sizes.extend([size] * len(img_dset))
+                dataset.labels.extend(list(hf[f"{size}"]["aseg_dataset"]))
+                logger.info(
+                    f"Processed asegs of size {size} in {time.time() - start:.3f} seconds"
+                )
+                dataset.weights.extend(list(hf[f"{size}"]["weight_dataset"]))
+                logger.info(
+                    f"Processed weights of size {size} in {time.time() - start:.3f} seconds"
+                )
+                dataset.zooms.extend(list(hf[f"{size}"]["zoom_dataset"]))
+                logger.info(
+                    f"Processed zooms of size {size} in {time.time() - start:.3f} seconds"
+                )
+                slice_subjects.append(
+                    _slice_subjects(hf[f"{size}"], len(dataset.subjects))
+                )
+                dataset.subjects.extend(list(hf[f"{size}"]["subject"]))
+                logger.info(
+                    f"Processed subjects of size {size} in {time.time() - start:.3f} seconds"
+                )
+                logger.info(f"Number of slices for size {size} is {len(img_dset)}")
+
+            except KeyError:
+                print(
+                    f"KeyError: Unable to open object (object {size} does not exist)"
+                )
+                continue
+    dataset.slice_subjects = _concat_slice_subjects(slice_subjects)
+
+
 # Operator to load hdf5-file for training
 class MultiScaleDataset(Dataset):
     """
@@ -162,59 +572,20 @@ class MultiScaleDataset(Dataset):
         transforms : Optional
             Transformer to apply to the image (Default value = None).
         """
-        self.max_size = cfg.DATA.PADDED_SIZE
+        # with bucketed batches, slices are padded per batch by the loader (PadCollate)
+        self.max_size = None if cfg.DATA.BUCKET_BATCHES else cfg.DATA.PADDED_SIZE
         self.base_res = cfg.MODEL.BASE_RES
         self.gn_noise = gn_noise
 
-        # Load the h5 file and save it to the datase
-        self.images = []
-        self.labels = []
-        self.weights = []
-        self.subjects = []
-        self.zooms = []
-
-        # Open file in reading mode
         start = time.time()
-        with h5py.File(dataset_path, "r") as hf:
-            for size in cfg.DATA.SIZES:
-                try:
-                    logger.info(f"Processing images of size {size}.")
-                    img_dset = list(hf[f"{size}"]["orig_dataset"])
-                    logger.info(
-                        f"Processed origs of size {size} in {time.time() - start:.3f} seconds"
-                    )
-                    self.images.extend(img_dset)
-                    self.labels.extend(list(hf[f"{size}"]["aseg_dataset"]))
-                    logger.info(
-                        f"Processed asegs of size {size} in {time.time() - start:.3f} seconds"
-                    )
-                    self.weights.extend(list(hf[f"{size}"]["weight_dataset"]))
-                    self.zooms.extend(list(hf[f"{size}"]["zoom_dataset"]))
-                    logger.info(
-                        f"Processed zooms of size {size} in {time.time() - start:.3f} seconds"
-                    )
-                    logger.info(
-                        f"Processed weights of size {size} in {time.time() - start:.3f} seconds"
-                    )
-                    self.subjects.extend(list(hf[f"{size}"]["subject"]))
-                    logger.info(
-                        f"Processed subjects of size {size} in {time.time() - start:.3f} seconds"
-                    )
-                    logger.info(f"Number of slices for size {size} is {len(img_dset)}")
-
-                except KeyError:
-                    print(
-                        f"KeyError: Unable to open object (object {size} does not exist)"
-                    )
-                    continue
-
-            self.count = len(self.images)
-            self.transforms = transforms
+        load_hdf5_slices(self, dataset_path, cfg, start)
+        self.count = len(self.images)
+        self.transforms = transforms
 
-            logger.info(
-                f"Successfully loaded {self.count} data from {dataset_path} with plane {cfg.DATA.PLANE}" \
-                f" in {time.time() - start:.3f} seconds"
-            )
+        logger.info(
+            f"Successfully loaded {self.count} data from {dataset_path} with plane {cfg.DATA.PLANE}" \
+            f" in {time.time() - start:.3f} seconds"
+        )
 
     def get_subject_names(self):
         """
@@ -304,7 +675,7 @@ class MultiScaleDataset(Dataset):
             weight: npt.NDArray
     ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
         """
-        Pad img, label and weight.
+        Pad img, label and weight (unless max_size is None).
 
         Parameters
         ----------
@@ -324,6 +695,8 @@ class MultiScaleDataset(Dataset):
         np.ndarray
             Weight.
         """
+        if self.max_size is None:
+            return img, label, weight
         img = self._pad(img)
         label = self._pad(label)
         weight = self._pad(weight)
@@ -407,47 +780,8 @@ class MultiScaleDatasetVal(Dataset):
         self.max_size = cfg.DATA.PADDED_SIZE
         self.base_res = cfg.MODEL.BASE_RES
 
-        # Load the h5 file and save it to the dataset
-        self.images = []
-        self.labels = []
-        self.weights = []
-        self.subjects = []
-        self.zooms = []
-
-        # Open file in reading mode
         start = time.time()
-        with h5py.File(dataset_path, "r") as hf:
-            for size in cfg.DATA.SIZES:
-                try:
-                    logger.info(f"Processing images of size {size}.")
-                    img_dset = list(hf[f"{size}"]["orig_dataset"])
-                    logger.info(
-                        f"Processed origs of size {size} in {time.time() - start:.3f} seconds"
-                    )
-                    self.images.extend(img_dset)
-                    self.labels.extend(list(hf[f"{size}"]["aseg_dataset"]))
-                    logger.info(
-                        f"Processed asegs of size {size} in {time.time() - start:.3f} seconds"
-                    )
-                    self.weights.extend(list(hf[f"{size}"]["weight_dataset"]))
-                    logger.info(
-                        f"Processed weights of size {size} in {time.time() - start:.3f} seconds"
-                    )
-                    self.zooms.extend(list(hf[f"{size}"]["zoom_dataset"]))
-                    logger.info(
-                        f"Processed zooms of size {size} in {time.time() - start:.3f} seconds"
-                    )
-                    self.subjects.extend(list(hf[f"{size}"]["subject"]))
-                    logger.info(
-                        f"Processed subjects of size {size} in {time.time() - start:.3f} seconds"
-                    )
-                    logger.info(f"Number of slices for size {size} is {len(img_dset)}")
-
-                except KeyError:
-                    print(
-                        f"KeyError: Unable to open object (object {size} does not exist)"
-                    )
-                    continue
+        load_hdf5_slices(self, dataset_path, cfg, start)
 
         self.count = len(self.images)
         self.transforms = transforms
@@ -508,12 +842,16 @@ class MultiScaleDatasetVal(Dataset):
             weight = tx_sample["weight"]
             scale_factor = tx_sample["scale_factor"]
 
-        return {
+        sample = {
             "image": img,
             "label": label,
             "weight": weight,
             "scale_factor": scale_factor,
         }
+        if self.slice_subjects is not None:
+            # index into get_subject_names() to reassemble volumes
+            sample["subject"] = int(self.slice_subjects[index])
+        return sample
 
     def __len__(self):
         """
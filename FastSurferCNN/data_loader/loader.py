@@ -12,13 +12,19 @@
 # limitations under the License.
 
 # IMPORTS
+from collections.abc import Iterator, Sequence
+
+import numpy as np
+import torch
 import yacs.config
-from torch.utils.data import DataLoader
+from torch.nn import functional as F
+from torch.utils.data import DataLoader, DistributedSampler, Sampler, Subset, default_collate
 from torchvision import transforms
 
 from FastSurferCNN.data_loader import dataset as dset
 from FastSurferCNN.data_loader.augmentation import AddGaussianNoise, ToTensor, ZeroPad2D
 from FastSurferCNN.utils import logging
+from FastSurferCNN.utils.distributed import get_rank, get_world_size, is_distributed
 
 logger = logging.getLogger(__name__)
 
@@ -43,19 +49,27 @@ def get_dataloader(cfg: yacs.config.CfgNode, mode: str):
 
     padding_size = cfg.DATA.PADDED_SIZE
 
+    # with bucketed batches, slices are padded per batch (see PadCollate)
+    bucketed = cfg.DATA.BUCKET_BATCHES
+    pad_tfs = [] if bucketed else [ZeroPad2D((padding_size, padding_size))]
+
     if mode == "train":
 
-        if "None" in cfg.DATA.AUG:
-            tfs = [ZeroPad2D((padding_size, padding_size)), ToTensor()]
-            # old transform
-            if "Gaussian" in cfg.DATA.AUG:
+        if "None" in cfg.DATA.AUG or "Batched" in cfg.DATA.AUG:
+            tfs = pad_tfs + [ToTensor()]
+            # old transform (with Batched, the noise is added by BatchAugmentation)
+            if "Gaussian" in cfg.DATA.AUG and "Batched" not in cfg.DATA.AUG:
                 tfs.append(AddGaussianNoise(mean=0, std=0.1))
 
             data_path = cfg.DATA.PATH_HDF5_TRAIN
             shuffle = True
 
+            if "Batched" in cfg.DATA.AUG:
+                aug_name = "batched tensor Aug (on the training device)"
+            else:
+                aug_name = "standard Aug"
             logger.info(
-                f"Loading {mode.capitalize()} data ... from {data_path}. Using standard Aug"
+                f"Loading {mode.capitalize()} data ... from {data_path}. Using {aug_name}"
             )
 
             dataset = dset.MultiScaleDatasetVal(data_path, cfg, transforms.Compose(tfs))
@@ -155,22 +169,215 @@ def get_dataloader(cfg: yacs.config.CfgNode, mode: str):
     elif mode == "val":
         data_path = cfg.DATA.PATH_HDF5_VAL
         shuffle = False
-        transform = transforms.Compose(
-            [
-                ZeroPad2D((padding_size, padding_size)),
-                ToTensor(),
-            ]
-        )
+        transform = transforms.Compose(pad_tfs + [ToTensor()])
 
         logger.info(f"Loading {mode.capitalize()} data ... from {data_path}")
 
         dataset = dset.MultiScaleDatasetVal(data_path, cfg, transform)
 
+    if bucketed:
+        batch_sampler = BucketBatchSampler(
+            get_slice_buckets(dataset),
+            cfg.TRAIN.BATCH_SIZE,
+            shuffle=shuffle,
+            seed=cfg.RNG_SEED,
+            num_replicas=get_world_size(),
+            rank=get_rank(),
+            # all processes need the same number of training steps
+            even_replicas=mode == "train",
+        )
+        logger.info(
+            f"Using {len(np.unique(batch_sampler.buckets))} size/scale buckets with "
+            f"{len(batch_sampler)} batches"
+        )
+        return DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            num_workers=cfg.TRAIN.NUM_WORKERS,
+            collate_fn=PadCollate(padding_size, cfg.DATA.BUCKET_PAD_MULTIPLE),
+            pin_memory=True,
+        )
+
+    sampler = None
+    if is_distributed():
+        if mode == "train":
+            # every process gets a different (per epoch reshuffled) part of the slices,
+            # Trainer.train calls sampler.set_epoch()
+            sampler = DistributedSampler(dataset, shuffle=shuffle)
+            shuffle = False
+        else:
+            # disjoint shards without padding, so the reduced metrics count each slice once
+            dataset = Subset(dataset, range(get_rank(), len(dataset), get_world_size()))
+
     dataloader = DataLoader(
         dataset,
         batch_size=cfg.TRAIN.BATCH_SIZE,
         num_workers=cfg.TRAIN.NUM_WORKERS,
         shuffle=shuffle,
+        sampler=sampler,
         pin_memory=True,
     )
     return dataloader
+
+
+def get_slice_buckets(dataset) -> np.ndarray:
+    """
+    Get the bucket of every slice of a dataset from its size (hdf5 group) and zoom.
+
+    Parameters
+    ----------
+    dataset : MultiScaleDataset, MultiScaleDatasetVal
+        Dataset with the attributes slice_sizes and zooms.
+
+    Returns
+    -------
+    np.ndarray
+        Bucket index of each slice.
+    """
+    keys = np.column_stack(
+        [np.asarray(dataset.slice_sizes), np.round(np.asarray(dataset.zooms), 4)]
+    )
+    _, buckets = np.unique(keys, axis=0, return_inverse=True)
+    return buckets.reshape(-1)
+
+
+class BucketBatchSampler(Sampler[list[int]]):
+    """
+    Batch sampler, that only combines slices of the same bucket into a batch.
+
+    Batches are shuffled (within and across buckets) per epoch, see set_epoch. For
+    distributed training, the batches are split between the processes.
+    """
+
+    def __init__(
+            self,
+            buckets: Sequence[int],
+            batch_size: int,
+            shuffle: bool = True,
+            seed: int = 0,
+            num_replicas: int = 1,
+            rank: int = 0,
+            even_replicas: bool = True,
+    ):
+        """
+        Construct BucketBatchSampler object.
+
+        Parameters
+        ----------
+        buckets : Sequence[int]
+            Bucket of each slice of the dataset.
+        batch_size : int
+            Maximum number of slices per batch.
+        shuffle : bool
+            Whether to shuffle the slices and batches (Default value = True).
+        seed : int
+            Random seed, must be the same in all processes (Default value = 0).
+        num_replicas : int
+            Number of processes to split the batches between (Default value = 1).
+        rank : int
+            Rank of this process (Default value = 0).
+        even_replicas : bool
+            Whether to repeat batches so every process gets the same number of batches
+            (Default value = True).
+        """
+        self.buckets = np.asarray(buckets)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.even_replicas = even_replicas
+        self.epoch = 0
+        self._bucket_sizes = np.bincount(self.buckets) if self.buckets.size else np.zeros(0)
+
+    def set_epoch(self, epoch: int):
+        """
+        Set the epoch (seeds the shuffling).
+        """
+        self.epoch = epoch
+
+    def _num_batches(self) -> int:
+        """
+        Get the number of batches of all processes.
+        """
+        return int(np.sum(-(-self._bucket_sizes // self.batch_size)))
+
+    def __iter__(self) -> Iterator[list[int]]:
+        """
+        Iterate over the batches of this process.
+        """
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches = []
+        for bucket in np.flatnonzero(self._bucket_sizes):
+            indices = np.flatnonzero(self.buckets == bucket)
+            if self.shuffle:
+                indices = rng.permutation(indices)
+            batches.extend(
+                indices[i:i + self.batch_size].tolist()
+                for i in range(0, len(indices), self.batch_size)
+            )
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            if self.even_replicas and batches:
+                total = len(self) * self.num_replicas
+                batches = (batches * (-(-total // len(batches))))[:total]
+            batches = batches[self.rank::self.num_replicas]
+        yield from batches
+
+    def __len__(self) -> int:
+        """
+        Get the number of batches of this process.
+        """
+        num_batches = self._num_batches()
+        if self.even_replicas:
+            return -(-num_batches // self.num_replicas)
+        return len(range(self.rank, num_batches, self.num_replicas))
+
+
+class PadCollate:
+    """
+    Collate samples into a batch, padded to the largest slice of the batch.
+
+    The padded size is rounded up to a multiple of `multiple`, and images larger
+    than `max_size` are cropped (as ZeroPad2D and MultiScaleDataset._pad do).
+    """
+
+    KEYS = ("image", "label", "weight")
+
+    def __init__(self, max_size: int, multiple: int = 16):
+        """
+        Construct PadCollate object.
+
+        Parameters
+        ----------
+        max_size : int
+            Maximum size of the batch (PADDED_SIZE).
+        multiple : int
+            Round the padded size up to a multiple of this (Default value = 16).
+        """
+        self.max_size = max_size
+        self.multiple = multiple
+
+    def _target(self, size: int) -> int:
+        """
+        Get the padded size for slices of size `size`.
+        """
+        return min(-(-size // self.multiple) * self.multiple, self.max_size)
+
+    def __call__(self, samples: list[dict]) -> dict:
+        """
+        Pad the image, label and weight of the samples (top left) and collate them.
+        """
+        height = self._target(max(s["image"].shape[-2] for s in samples))
+        width = self._target(max(s["image"].shape[-1] for s in samples))
+        padded = []
+        for sample in samples:
+            sample = dict(sample)
+            for key in self.KEYS:
+                data = torch.as_tensor(sample[key])
+                h, w = data.shape[-2:]
+                # negative padding crops
+                sample[key] = F.pad(data, (0, width - w, 0, height - h))
+            padded.append(sample)
+        return default_collate(padded)
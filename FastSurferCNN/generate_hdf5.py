@@ -13,6 +13,8 @@
 # limitations under the License.
 
 import glob
+import hashlib
+import os
 
 # IMPORTS
 import time
@@ -130,6 +132,8 @@ class H5pyDataset:
             - sag_mask (tuple[str, str]): Suffixes of labels names to mask for final sagittal labels.
             - combi (str): Suffixes of labels names to combine.
             - pattern (str): Pattern to match files in the directory.
+            - weight_cache (str, optional): Directory to cache the weight masks of each
+                        subject in (reused, if subject and weight parameters match).
         processing : str, optional
             Use aseg (Default value = "aparc").
 
@@ -153,6 +157,7 @@ class H5pyDataset:
         self.hires_weight = params["hires_weight"]
         self.gradient = params["gradient"]
         self.gm_mask = params["gm_mask"]
+        self.weight_cache = params.get("weight_cache", None)
 
         self.lut = read_classes_from_lut(params["lut"])
         self.labels, self.labels_sag = get_labels_from_lut(self.lut, params["sag_mask"])
@@ -269,10 +274,134 @@ class H5pyDataset:
         padded_img[0:h, 0:w, 0:d] = img
         return padded_img
 
+    def _process_subject(
+        self, subject_path: str, blt: int
+    ) -> tuple[int, dict[str, np.ndarray]]:
+        """
+        Load and process one subject into thick slices, labels, weights and zooms.
+
+        Parameters
+        ----------
+        subject_path : str
+            Path to the subject directory.
+        blt : int
+            Blank slice threshold.
+
+        Returns
+        -------
+        int
+            Size of the image (first dimension).
+        dict[str, np.ndarray]
+            Dictionary with the arrays "orig", "aseg", "weight" and "zoom" (one entry per
+            slice along the first axis).
+        """
+        orig, aseg, aseg_nocc, zoom = self._load_volumes(subject_path)
+        size, _, _ = orig.shape
+
+        mapped_aseg, mapped_aseg_sag = map_aparc_aseg2label(
+            aseg,
+            self.labels,
+            self.labels_sag,
+            self.lateralization,
+            aseg_nocc,
+            processing=self.processing,
+        )
+
+        if self.plane == "sagittal":
+            mapped_aseg = mapped_aseg_sag
+            weights = self._weight_mask(mapped_aseg, 19, subject_path)
+        else:
+            weights = self._weight_mask(mapped_aseg, 33, subject_path)
+
+        print(
+            f"Created weights with max_w {self.max_weight}, gradient {self.gradient},"
+            f" edge_w {self.edge_weight}, hires_w {self.hires_weight}, gm_mask {self.gm_mask}"
+        )
+
+        # transform volumes to correct shape
+        [orig, mapped_aseg, weights], zoom = self.transform(
+            self.plane, [orig, mapped_aseg, weights], zoom
+        )
+
+        # Create Thick Slices, filter out blanks
+        orig_thick = get_thick_slices(orig, self.slice_thickness)
+
+        orig, mapped_aseg, weights = filter_blank_slices_thick(
+            orig_thick, mapped_aseg, weights, threshold=blt
+        )
+
+        num_batch = orig.shape[2]
+        data = {
+            "orig": np.ascontiguousarray(np.transpose(orig, (2, 0, 1, 3)), dtype=np.uint8),
+            "aseg": np.ascontiguousarray(np.transpose(mapped_aseg, (2, 0, 1)), dtype=np.uint8),
+            "weight": np.ascontiguousarray(np.transpose(weights, (2, 0, 1)), dtype=np.float32),
+            "zoom": np.tile(np.asarray(zoom), (num_batch, 1)),
+        }
+        return size, data
+
+    def _weight_mask(
+        self, mapped_aseg: npt.NDArray, ctx_thresh: int, subject_path: str
+    ) -> np.ndarray:
+        """
+        Create the weight mask of a subject or read it from the weight cache.
+
+        Cached masks are keyed by the subject name, the weight parameters and the
+        mapped segmentation itself, so changed labels or parameters are recomputed.
+
+        Parameters
+        ----------
+        mapped_aseg : npt.NDArray
+            Segmentation mapped to the training labels.
+        ctx_thresh : int
+            Label value of cortex (above = cortical parcels).
+        subject_path : str
+            Path to the subject directory.
+
+        Returns
+        -------
+        np.ndarray
+            Weight mask (float32).
+        """
+        cache_file = None
+        if self.weight_cache is not None:
+            params = (
+                self.max_weight, self.edge_weight, self.hires_weight, self.gm_mask,
+                self.gradient, ctx_thresh, mapped_aseg.shape, str(mapped_aseg.dtype),
+            )
+            key = hashlib.blake2b(repr(params).encode(), digest_size=16)
+            key.update(np.ascontiguousarray(mapped_aseg).tobytes())
+            sub_name = Path(subject_path).name
+            cache_file = Path(self.weight_cache) / f"{sub_name}_{key.hexdigest()}.npz"
+            if cache_file.is_file():
+                LOGGER.info(f"Reading cached weight mask {cache_file}")
+                with np.load(cache_file) as cached:
+                    return cached["weight"]
+
+        weights = create_weight_mask(
+            mapped_aseg,
+            max_weight=self.max_weight,
+            ctx_thresh=ctx_thresh,
+            max_edge_weight=self.edge_weight,
+            max_hires_weight=self.hires_weight,
+            cortex_mask=self.gm_mask,
+            gradient=self.gradient,
+        )
+
+        if cache_file is not None:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file first, so parallel workers never read partial files
+            tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp.npz")
+            np.savez_compressed(tmp_file, weight=weights)
+            os.replace(tmp_file, cache_file)
+        return weights
+
     def create_hdf5_dataset(self, blt: int):
         """
         Create a hdf5 dataset.
 
+        All subjects are processed serially and kept in memory until the file is
+        written, see create_hdf5_dataset_streaming for large cohorts.
+
         Parameters
         ----------
         blt : int
@@ -289,71 +418,15 @@ class H5pyDataset:
                     f"Volume Nr: {idx + 1} Processing MRI Data from {current_subject}/{self.orig_name}"
                 )
 
-                orig, aseg, aseg_nocc, zoom = self._load_volumes(current_subject)
-                size, _, _ = orig.shape
-
-                mapped_aseg, mapped_aseg_sag = map_aparc_aseg2label(
-                    aseg,
-                    self.labels,
-                    self.labels_sag,
-                    self.lateralization,
-                    aseg_nocc,
-                    processing=self.processing,
-                )
-
-                if self.plane == "sagittal":
-                    mapped_aseg = mapped_aseg_sag
-                    weights = create_weight_mask(
-                        mapped_aseg,
-                        max_weight=self.max_weight,
-                        ctx_thresh=19,
-                        max_edge_weight=self.edge_weight,
-                        max_hires_weight=self.hires_weight,
-                        cortex_mask=self.gm_mask,
-                        gradient=self.gradient,
-                    )
-
-                else:
-                    weights = create_weight_mask(
-                        mapped_aseg,
-                        max_weight=self.max_weight,
-                        ctx_thresh=33,
-                        max_edge_weight=self.edge_weight,
-                        max_hires_weight=self.hires_weight,
-                        cortex_mask=self.gm_mask,
-                        gradient=self.gradient,
-                    )
-
-                print(
-                    f"Created weights with max_w {self.max_weight}, gradient {self.gradient},"
-                    f" edge_w {self.edge_weight}, hires_w {self.hires_weight}, gm_mask {self.gm_mask}"
-                )
-
-                # transform volumes to correct shape
-                [orig, mapped_aseg, weights], zoom = self.transform(
-                    [orig, mapped_aseg, weights], zoom
-                )
-
-                # Create Thick Slices, filter out blanks
-                orig_thick = get_thick_slices(orig, self.slice_thickness)
-
-                orig, mapped_aseg, weights = filter_blank_slices_thick(
-                    orig_thick, mapped_aseg, weights, threshold=blt
-                )
+                size, data = self._process_subject(current_subject, blt)
 
-                num_batch = orig.shape[2]
-                orig = np.transpose(orig, (2, 0, 1, 3))
-                mapped_aseg = np.transpose(mapped_aseg, (2, 0, 1))
-                weights = np.transpose(weights, (2, 0, 1))
-
-                data_per_size[f"{size}"]["orig"].extend(orig)
-                data_per_size[f"{size}"]["aseg"].extend(mapped_aseg)
-                data_per_size[f"{size}"]["weight"].extend(weights)
-                data_per_size[f"{size}"]["zoom"].extend((zoom,) * num_batch)
+                for name in ("orig", "aseg", "weight", "zoom"):
+                    data_per_size[f"{size}"][name].extend(data[name])
                 sub_name = current_subject.split("/")[-1]
                 data_per_size[f"{size}"]["subject"].append(
                     sub_name.encode("ascii", "ignore")
                 )
+                data_per_size[f"{size}"]["slice_count"].append(data["orig"].shape[0])
 
             except Exception as e:
                 LOGGER.info(f"Volume: {idx} Failed Reading Data. Error: {e}")
@@ -362,7 +435,7 @@ class H5pyDataset:
         for key, data_dict in data_per_size.items():
             data_per_size[key]["orig"] = np.asarray(data_dict["orig"], dtype=np.uint8)
             data_per_size[key]["aseg"] = np.asarray(data_dict["aseg"], dtype=np.uint8)
-            data_per_size[key]["weight"] = np.asarray(data_dict["weight"], dtype=float)
+            data_per_size[key]["weight"] = np.asarray(data_dict["weight"], dtype=np.float32)
 
         with h5py.File(self.dataset_name, "w") as hf:
             dt = h5py.special_dtype(vlen=str)
@@ -373,12 +446,208 @@ class H5pyDataset:
                 group.create_dataset("weight_dataset", data=data_dict["weight"])
                 group.create_dataset("zoom_dataset", data=data_dict["zoom"])
                 group.create_dataset("subject", data=data_dict["subject"], dtype=dt)
+                group.create_dataset(
+                    "slice_count", data=np.asarray(data_dict["slice_count"], dtype=np.int32)
+                )
 
         end_d = time.time() - start_d
         LOGGER.info(
             f"Successfully written {self.dataset_name} in {end_d:.3f} seconds."
         )
 
+    def create_hdf5_dataset_streaming(
+        self,
+        blt: int,
+        num_workers: int = 1,
+        compression: str | None = None,
+        resume: bool = False,
+    ):
+        """
+        Create a hdf5 dataset by appending each subject as soon as it is processed.
+
+        Subjects are processed in a pool of worker processes, and their slices are
+        appended to resizable, chunked (one slice per chunk) datasets. Memory therefore
+        only depends on the number of subjects in flight, not on the cohort size. The
+        file is flushed after every subject, and each size group stores the number of
+        committed slices and subjects in its attributes. With resume, an existing file
+        is truncated to these counts (dropping a partially written subject) and all
+        subjects already in the file are skipped.
+
+        Parameters
+        ----------
+        blt : int
+            Blank slice threshold.
+        num_workers : int, default=1
+            Number of worker processes (1 processes the subjects in this process).
+        compression : str, optional
+            HDF5 compression filter for the image datasets, e.g. "gzip" or "lzf".
+        resume : bool, default=False
+            Continue writing an existing file instead of overwriting it.
+        """
+        start_d = time.time()
+        mode = "a" if resume and Path(self.dataset_name).exists() else "w"
+        with h5py.File(self.dataset_name, mode) as hf:
+            done = set()
+            for group in hf.values():
+                _truncate_group(group)
+                done.update(
+                    s.decode() if isinstance(s, bytes) else s for s in group["subject"]
+                )
+            todo = [
+                (idx, s) for idx, s in enumerate(self.subject_dirs)
+                if s.split("/")[-1] not in done
+            ]
+            if done:
+                LOGGER.info(
+                    f"Resuming {self.dataset_name}: skipping {len(done)} subjects already "
+                    f"written, {len(todo)} subjects left."
+                )
+
+            for idx, current_subject, result in self._imap_subjects(todo, blt, num_workers):
+                if isinstance(result, Exception):
+                    LOGGER.info(f"Volume: {idx} Failed Reading Data. Error: {result}")
+                    continue
+                size, data = result
+                sub_name = current_subject.split("/")[-1]
+                _append_subject(
+                    hf, f"{size}", data, sub_name.encode("ascii", "ignore"), compression
+                )
+                hf.flush()
+                LOGGER.info(
+                    f"Volume Nr: {idx + 1} written {data['orig'].shape[0]} slices of "
+                    f"{current_subject}"
+                )
+
+        end_d = time.time() - start_d
+        LOGGER.info(
+            f"Successfully written {self.dataset_name} in {end_d:.3f} seconds."
+        )
+
+    def _imap_subjects(self, subjects: list[tuple[int, str]], blt: int, num_workers: int):
+        """
+        Process subjects (in worker processes) and yield results as they finish.
+
+        At most two subjects per worker are in flight, so finished subjects do not
+        pile up in memory if writing is slower than processing.
+
+        Yields
+        ------
+        tuple[int, str, tuple[int, dict] | Exception]
+            Index, subject path and result of _process_subject (or the exception).
+        """
+        if num_workers <= 1:
+            for idx, subject in subjects:
+                LOGGER.info(
+                    f"Volume Nr: {idx + 1} Processing MRI Data from {subject}/{self.orig_name}"
+                )
+                try:
+                    yield idx, subject, self._process_subject(subject, blt)
+                except Exception as e:
+                    yield idx, subject, e
+            return
+
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+        pending = {}
+        queue = iter(subjects)
+        with ProcessPoolExecutor(
+            num_workers, initializer=_init_worker, initargs=(self, blt)
+        ) as executor:
+            while True:
+                for idx, subject in queue:
+                    pending[executor.submit(_process_subject_worker, subject)] = idx, subject
+                    if len(pending) >= 2 * num_workers:
+                        break
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    idx, subject = pending.pop(future)
+                    try:
+                        yield idx, subject, future.result()
+                    except Exception as e:
+                        yield idx, subject, e
+
+
+_WORKER_DATASET: tuple[H5pyDataset, int] | None = None
+
+
+def _init_worker(dataset: H5pyDataset, blt: int):
+    """Store the dataset generator in the worker process."""
+    global _WORKER_DATASET
+    _WORKER_DATASET = dataset, blt
+
+
+def _process_subject_worker(subject_path: str) -> tuple[int, dict[str, np.ndarray]]:
+    """Process one subject with the dataset generator of this worker process."""
+    dataset, blt = _WORKER_DATASET
+    return dataset._process_subject(subject_path, blt)
+
+
+def _truncate_group(group: h5py.Group):
+    """Drop slices and subjects beyond the committed counts of a size group."""
+    if "num_slices" not in group.attrs:
+        raise ValueError(
+            f"Cannot resume {group.file.filename}, it was not written in stream mode."
+        )
+    num_slices = group.attrs.get("num_slices", 0)
+    num_subjects = group.attrs.get("num_subjects", 0)
+    for name in ("orig_dataset", "aseg_dataset", "weight_dataset", "zoom_dataset"):
+        if name in group:
+            group[name].resize(num_slices, axis=0)
+    group["subject"].resize(num_subjects, axis=0)
+    if "slice_count" in group:
+        group["slice_count"].resize(num_subjects, axis=0)
+
+
+def _append_subject(
+    hf: h5py.File,
+    key: str,
+    data: dict[str, np.ndarray],
+    subject: bytes,
+    compression: str | None,
+):
+    """
+    Append the slices of one subject to the resizable datasets of a size group.
+
+    The counts in the group attributes are only updated after all datasets have been
+    written, so they always describe complete subjects.
+    """
+    if key not in hf:
+        group = hf.create_group(key)
+        for name in ("orig", "aseg", "weight", "zoom"):
+            arr = data[name]
+            image = arr.ndim > 2
+            group.create_dataset(
+                f"{name}_dataset",
+                shape=(0,) + arr.shape[1:],
+                maxshape=(None,) + arr.shape[1:],
+                dtype=arr.dtype,
+                chunks=(1,) + arr.shape[1:] if image else (1024,) + arr.shape[1:],
+                compression=compression if image else None,
+            )
+        group.create_dataset(
+            "subject", shape=(0,), maxshape=(None,), dtype=h5py.special_dtype(vlen=str)
+        )
+        group.create_dataset("slice_count", shape=(0,), maxshape=(None,), dtype=np.int32)
+        group.attrs["num_slices"] = 0
+        group.attrs["num_subjects"] = 0
+    group = hf[key]
+    num_slices = int(group.attrs["num_slices"])
+    num_new = data["orig"].shape[0]
+    for name in ("orig", "aseg", "weight", "zoom"):
+        dset = group[f"{name}_dataset"]
+        dset.resize(num_slices + num_new, axis=0)
+        dset[num_slices:] = data[name]
+    num_subjects = int(group.attrs["num_subjects"])
+    group["subject"].resize(num_subjects + 1, axis=0)
+    group["subject"][num_subjects] = subject
+    if "slice_count" in group:
+        group["slice_count"].resize(num_subjects + 1, axis=0)
+        group["slice_count"][num_subjects] = num_new
+    group.attrs["num_slices"] = num_slices + num_new
+    group.attrs["num_subjects"] = num_subjects + 1
+
 
 def make_parser():
     import argparse
@@ -510,6 +779,43 @@ def make_parser():
         default=256,
         help="Sizes of images in the dataset. Default: 256",
     )
+    parser.add_argument(
+        "--weight_cache",
+        type=str,
+        default=None,
+        help="Directory to cache the weight masks of each subject in. Cached masks "
+        "are reused, if the segmentation and the weight parameters did not change. "
+        "Default: no cache",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="Append each subject to the hdf5 file as soon as it is processed instead of "
+        "keeping the whole dataset in memory (required for --workers, --compression and "
+        "--resume).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes to process subjects with in --stream mode. "
+        "Default: 1",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default=None,
+        choices=["gzip", "lzf"],
+        help="Compression of the image datasets in --stream mode. Default: None",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="In --stream mode, continue an existing hdf5 file and skip subjects already "
+        "written to it.",
+    )
     return parser
 
 
@@ -533,10 +839,19 @@ def main(args):
         "hires_weight": args.hires_w,
         "gm_mask": args.gm,
         "gradient": not args.no_grad,
+        "weight_cache": args.weight_cache,
     }
 
     dataset_generator = H5pyDataset(params=dataset_params, processing=args.processing)
-    dataset_generator.create_hdf5_dataset(args.blank_slice_thresh)
+    if args.stream:
+        dataset_generator.create_hdf5_dataset_streaming(
+            args.blank_slice_thresh,
+            num_workers=args.workers,
+            compression=args.compression,
+            resume=args.resume,
+        )
+    else:
+        dataset_generator.create_hdf5_dataset(args.blank_slice_thresh)
 
 
 if __name__ == "__main__":
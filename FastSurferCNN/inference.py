@@ -15,7 +15,11 @@
 import os
 
 # IMPORTS
+import threading
 import time
+from collections.abc import Iterator, Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import chain, count
 from typing import Optional
 
 import numpy as np
@@ -28,9 +32,17 @@ from torchvision import transforms
 
 from FastSurferCNN.data_loader.augmentation import ToTensorTest
 from FastSurferCNN.data_loader.data_utils import map_prediction_sagittal2full
-from FastSurferCNN.data_loader.dataset import MultiScaleOrigDataThickSlices
+from FastSurferCNN.data_loader.dataset import (
+    MultiScaleOrigDataThickSlices,
+    normalize_volume,
+    pad_volume,
+    thick_slice_view,
+)
+from FastSurferCNN.models.engine import Engine, build_engine
 from FastSurferCNN.models.networks import build_model
-from FastSurferCNN.utils import logging
+from FastSurferCNN.models.quantization import build_quantized_model
+from FastSurferCNN.utils import Plane, logging
+from FastSurferCNN.utils.checkpoint import load_model_state, load_quantized_checkpoint
 
 logger = logging.getLogger(__name__)
 
@@ -85,6 +97,8 @@ class Inference:
         device: torch.device,
         ckpt: str = "",
         lut: None | str | np.ndarray | DataFrame = None,
+        engine: Engine = "eager",
+        quantized: bool = False,
     ):
         """
         Construct Inference object.
@@ -99,6 +113,12 @@ class Inference:
             String or os.PathLike object containing the name to the checkpoint file (Default value = "").
         lut : str, np.ndarray, DataFrame, optional
              Lookup table for mapping (Default value = None).
+        engine : "eager", "torchscript", "onnx", default="eager"
+            Inference engine, torchscript and onnx run an exported graph with folded
+            batch normalization (see FastSurferCNN.models.engine).
+        quantized : bool, default=False
+            Whether to run the int8 model of the quantized checkpoint (cpu only, see
+            FastSurferCNN/quantize.py).
         """
         # Set random seed from configs.
         np.random.seed(cfg.RNG_SEED)
@@ -118,6 +138,23 @@ class Inference:
             and self.default_device.index is None
         )
 
+        if engine != "eager" and self.model_parallel:
+            logger.warning(
+                f"The {engine} engine does not support multi-device models, using eager."
+            )
+            engine = "eager"
+        if quantized and self.default_device.type != "cpu":
+            logger.warning(
+                f"Quantized models only run on the cpu, using the float model on "
+                f"{self.default_device}."
+            )
+            quantized = False
+        if quantized and engine == "onnx":
+            logger.warning("Quantized models cannot be exported to onnx, using torchscript.")
+            engine = "torchscript"
+        self.engine = engine
+        self.quantized = quantized
+
         # Initial model setup
         self.model = None
         self._model_not_init = None
@@ -184,6 +221,8 @@ class Inference:
             raise RuntimeError(
                 "Moving the model to other devices is not supported for multi-device models."
             )
+        if self.quantized and device is not None and torch.device(device).type != "cpu":
+            raise RuntimeError("Quantized models only run on the cpu.")
         _device = self.default_device if device is None else device
         self.device = _device
         self.model.to(device=_device)
@@ -204,6 +243,13 @@ class Inference:
         if self.device is None:
             self.device = self.default_device
 
+        if self.quantized:
+            model_state, metadata = load_quantized_checkpoint(ckpt)
+            logger.info(f"Using the quantized model ({metadata['backend']} backend)")
+            self.model = build_quantized_model(self.model, model_state)
+            self.model = build_engine(self.model, self.engine)
+            return
+
         # workaround for mps (directly loading to map_location=mps results in zeros)
         device = self.device
         if self.device.type == "mps":
@@ -213,10 +259,10 @@ class Inference:
             # make sure the model is, where it is supposed to be
             self.model.to(self.device)
 
-        # WARNING: weights_only=False can cause unsafe code execution, but here the
-        # checkpoint can be considered to be from a safe source
-        model_state = torch.load(ckpt, map_location=device, weights_only=False)
-        self.model.load_state_dict(model_state["model_state"])
+        model_state, mapped = load_model_state(ckpt, map_location=device)
+        # memory-mapped weights are used in-place on the cpu (shared between processes)
+        assign = mapped and torch.device(device).type == "cpu"
+        self.model.load_state_dict(model_state, assign=assign)
 
         # workaround for mps (move the model back to mps)
         if self.device.type == "mps":
@@ -224,6 +270,8 @@ class Inference:
 
         if self.model_parallel:
             self.model = torch.nn.DataParallel(self.model)
+        else:
+            self.model = build_engine(self.model, self.engine)
 
     def get_modelname(self) -> str:
         """
@@ -353,10 +401,6 @@ class Inference:
 
         start_index = 0
         plane = self.cfg.DATA.PLANE
-        index_of_current_plane = self.permute_order[plane].index(0)
-        target_shape = init_pred.shape
-        ii = [slice(None) for _ in range(4)]
-        pred_ii = tuple(slice(i) for i in target_shape[:3])
 
         from tqdm import tqdm
         from tqdm.contrib.logging import logging_redirect_tqdm
@@ -377,27 +421,7 @@ class Inference:
 
                     # predict the current batch, outputs logits
                     pred = self.model(images, scale_factors, out_scale)
-                    batch_size = pred.shape[0]
-                    end_index = start_index + batch_size
-
-                    # check if we need a special mapping (e.g. as for sagittal)
-                    if self.get_plane() == "sagittal":
-                        pred = map_prediction_sagittal2full(
-                            pred, num_classes=self.get_num_classes(), lut=self.lut
-                        )
-
-                    # permute the prediction into the out slice order
-                    pred = pred.permute(*self.permute_order[plane]).to(
-                        out.device
-                    )  # the to-operation is implicit
-
-                    # cut prediction to the image size
-                    pred = pred[pred_ii]
-
-                    # add prediction logits into the output (same as multiplying probabilities)
-                    ii[index_of_current_plane] = slice(start_index, end_index)
-                    out[tuple(ii)].add_(pred, alpha=self.alpha.get(plane, 0.4))
-                    start_index = end_index
+                    start_index = self.add_prediction(out, pred, start_index)
 
             except:
                 logger.exception(
@@ -411,6 +435,48 @@ class Inference:
 
         return out
 
+    def add_prediction(
+        self, out: torch.Tensor, pred: torch.Tensor, start_index: int
+    ) -> int:
+        """
+        Add the logits of a batch of slices to the view aggregation (inplace).
+
+        Parameters
+        ----------
+        out : torch.Tensor
+            The aggregated logits of the volume.
+        pred : torch.Tensor
+            The logits of the batch of slices.
+        start_index : int
+            The index of the first slice of the batch.
+
+        Returns
+        -------
+        int
+            The index after the last slice of the batch.
+        """
+        plane = self.cfg.DATA.PLANE
+        end_index = start_index + pred.shape[0]
+
+        # check if we need a special mapping (e.g. as for sagittal)
+        if plane == "sagittal":
+            pred = map_prediction_sagittal2full(
+                pred, num_classes=self.get_num_classes(), lut=self.lut
+            )
+
+        # permute the prediction into the out slice order
+        # (the to-operation is implicit)
+        pred = pred.permute(*self.permute_order[plane]).to(out.device)
+
+        # cut prediction to the image size
+        pred = pred[tuple(slice(i) for i in out.shape[:3])]
+
+        # add prediction logits into the output (same as multiplying probabilities)
+        ii = [slice(None) for _ in range(4)]
+        ii[self.permute_order[plane].index(0)] = slice(start_index, end_index)
+        out[tuple(ii)].add_(pred, alpha=self.alpha.get(plane, 0.4))
+        return end_index
+
     @torch.no_grad()
     def run(
         self,
@@ -472,3 +538,217 @@ class Inference:
         )
 
         return out
+
+
+class MultiPlaneScheduler:
+    """
+    Run the networks of all planes on one shared, normalized copy of the volume.
+
+    The volume is normalized and padded once and the thick slices of each plane are
+    strided views into it (instead of one MultiScaleOrigDataThickSlices per plane).
+    With more than one worker, the batches of all planes are interleaved across a pool
+    of worker threads, which each use an equal share of the threads (optionally pinned
+    to disjoint sets of cores), so the plane networks run concurrently. Each network
+    runs one batch at a time (the forward pass of FastSurferVINN is not thread-safe),
+    so there are at most as many workers as planes. The order, in which the planes are
+    added to the (float16) view aggregation, then varies between runs, which can change
+    the last bit of the aggregated logits.
+
+    Methods
+    -------
+    run
+        Run all plane networks and aggregate their logits.
+    """
+
+    def __init__(
+        self,
+        models: Mapping[Plane, Inference],
+        threads: int = 1,
+        workers: int = 1,
+        pin_cores: bool = False,
+    ):
+        """
+        Construct MultiPlaneScheduler object.
+
+        Parameters
+        ----------
+        models : Mapping[Plane, Inference]
+            The networks of the planes (with their checkpoints loaded), the order of
+            the planes is the order of the view aggregation with one worker.
+        threads : int, default=1
+            The total number of threads.
+        workers : int, default=1
+            The number of batches to run concurrently (at most one per plane).
+        pin_cores : bool, default=False
+            Pin each worker to a disjoint set of cores (linux only).
+        """
+        self.models = models
+        self.threads = max(threads, 1)
+        self.workers = min(max(workers, 1), self.threads, max(len(models), 1))
+        self.pin_cores = pin_cores
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def threads_per_worker(self) -> int:
+        """
+        Return the number of threads of each worker.
+        """
+        return max(self.threads // self.workers, 1)
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        """
+        Return, and maybe create the pool of worker threads.
+        """
+        if self._pool is None:
+            core_sets = None
+            if self.pin_cores and hasattr(os, "sched_setaffinity"):
+                cores = sorted(os.sched_getaffinity(0))
+                n, w = len(cores), self.workers
+                core_sets = [cores[i * n // w:(i + 1) * n // w] or cores for i in range(w)]
+            elif self.pin_cores:
+                logger.warning("Pinning workers to cores is not supported on this system.")
+            self._pool = ThreadPoolExecutor(
+                self.workers,
+                thread_name_prefix="inference",
+                initializer=self._init_worker,
+                initargs=(count(), core_sets),
+            )
+        return self._pool
+
+    def _init_worker(self, worker_ids: Iterator[int], core_sets: list[list[int]] | None):
+        """
+        Set the cores and threads of a new worker thread.
+        """
+        worker = next(worker_ids)
+        if core_sets is not None:
+            # the threads of the worker's parallel regions inherit the affinity
+            os.sched_setaffinity(0, core_sets[worker])
+        torch.set_num_threads(self.threads_per_worker)
+
+    @torch.no_grad()
+    def run(
+        self,
+        out: torch.Tensor,
+        img_filename: str,
+        orig_data: npt.NDArray,
+        orig_zoom: npt.NDArray,
+    ) -> torch.Tensor:
+        """
+        Run the networks of all planes on the data and add their logits to out.
+
+        Parameters
+        ----------
+        out : torch.Tensor
+            The aggregated logits (updated inplace).
+        img_filename : str
+            Original image filename (for messages only).
+        orig_data : npt.NDArray
+            The conformed image data.
+        orig_zoom : npt.NDArray
+            The voxel sizes of the image.
+
+        Returns
+        -------
+        torch.Tensor
+            The aggregated logits (out).
+        """
+        start = time.time()
+        volume = normalize_volume(orig_data)
+        padded = {}
+        batches = []
+        for plane, model in self.models.items():
+            model.model.eval()
+            thickness = model.cfg.MODEL.NUM_CHANNELS // 2
+            if thickness not in padded:
+                padded[thickness] = pad_volume(volume, thickness)
+            view = thick_slice_view(padded[thickness], plane, thickness)
+            # see MultiScaleOrigDataThickSlices._get_scale_factor
+            zoom = np.asarray(orig_zoom)
+            zoom = zoom[:2] if plane == "coronal" else zoom[::-1][:2]
+            scale_factor = torch.from_numpy(model.cfg.MODEL.BASE_RES / zoom)
+            batch_size = model.cfg.TEST.BATCH_SIZE
+            batches.append([
+                (model, view, scale_factor, i, min(i + batch_size, len(view)))
+                for i in range(0, len(view), batch_size)
+            ])
+
+        from tqdm import tqdm
+        from tqdm.contrib.logging import logging_redirect_tqdm
+
+        total = sum(map(len, batches))
+        with logging_redirect_tqdm(), tqdm(total=total, unit="batch") as progress:
+            if self.workers == 1:
+                for batch in chain.from_iterable(batches):
+                    self._run_batch(out, *batch)
+                    progress.update()
+            else:
+                threads = torch.get_num_threads()
+                # the number of threads is shared by all threads of the process
+                torch.set_num_threads(self.threads_per_worker)
+                try:
+                    self._run_concurrent(out, batches, progress)
+                finally:
+                    torch.set_num_threads(threads)
+
+        logger.info(
+            f"Inference of {', '.join(self.models)} on {img_filename} with "
+            f"{self.workers} worker(s) finished in {time.time() - start:0.4f} seconds"
+        )
+        return out
+
+    def _run_concurrent(self, out: torch.Tensor, batches: list[list[tuple]], progress):
+        """
+        Run the batches of each plane in order, but the planes concurrently.
+        """
+        queues = [iter(plane_batches) for plane_batches in batches]
+        running = {}
+
+        def _submit(queue: Iterator[tuple]):
+            batch = next(queue, None)
+            if batch is not None:
+                running[self.pool.submit(self._run_batch, out, *batch)] = queue
+
+        try:
+            for queue in queues:
+                _submit(queue)
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    progress.update()
+                    # the next batch of this plane
+                    _submit(running.pop(future))
+        except BaseException:
+            for future in running:
+                future.cancel()
+            wait(running)
+            raise
+
+    def _run_batch(
+        self,
+        out: torch.Tensor,
+        model: Inference,
+        view: torch.Tensor,
+        scale_factor: torch.Tensor,
+        start_index: int,
+        end_index: int,
+    ):
+        """
+        Run the network of a plane on the slices start_index to end_index of view.
+        """
+        device = model.get_device()
+        images = view[start_index:end_index].contiguous().to(device)
+        # the networks modify the scale factors inplace
+        scale_factors = scale_factor.repeat(end_index - start_index, 1).to(device)
+        try:
+            pred = model.model(images, scale_factors, None)
+            with self._lock:
+                model.add_prediction(out, pred, start_index)
+        except Exception:
+            logger.exception(
+                f"Exception in batch {start_index}:{end_index} of {model.get_plane()} "
+                f"inference."
+            )
+            raise
@@ -0,0 +1,308 @@
+# Copyright 2024 Image Analysis Lab, German Center for Neurodegenerative Diseases (DZNE), Bonn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# IMPORTS
+import copy
+import io
+import warnings
+from typing import Literal, get_args
+
+import numpy as np
+import torch
+from torch import Tensor, nn
+
+from FastSurferCNN.models import sub_module as sm
+from FastSurferCNN.utils import logging
+
+LOGGER = logging.getLogger(__name__)
+
+Engine = Literal["eager", "torchscript", "onnx"]
+ENGINES: tuple[str, ...] = get_args(Engine)
+
+# blocks, in which the convolution convX is always directly followed by the batch
+# normalization bnX+1 (or gnX+1)
+_FOLDABLE_BLOCKS = (
+    sm.InputDenseBlock,
+    sm.CompetitiveDenseBlock,
+    sm.CompetitiveDenseBlockInput,
+    sm.OutputDenseBlock,
+)
+
+
+def fold_batchnorm(model: nn.Module) -> nn.Module:
+    """
+    Fold the batch normalizations of the dense blocks into the preceding convolutions.
+
+    The folded batch normalizations are replaced by nn.Identity, so the model computes
+    the same function (in eval mode) with fewer operations. The model is modified
+    in-place.
+
+    Parameters
+    ----------
+    model : nn.Module
+        The model (in eval mode).
+
+    Returns
+    -------
+    nn.Module
+        The same model.
+    """
+    if model.training:
+        raise ValueError("Batch normalization can only be folded in eval mode.")
+    for block in model.modules():
+        if not isinstance(block, _FOLDABLE_BLOCKS):
+            continue
+        for i in range(4):
+            # the last convolution of the output block is not normalized
+            if i == 3 and getattr(block, "outblock", False):
+                continue
+            conv = getattr(block, f"conv{i}")
+            for prefix in ("bn", "gn"):
+                name = f"{prefix}{i + 1}"
+                norm = getattr(block, name, None)
+                if isinstance(norm, nn.BatchNorm2d):
+                    _fold_conv_bn(conv, norm)
+                    setattr(block, name, nn.Identity())
+                    break
+    return model
+
+
+@torch.no_grad()
+def _fold_conv_bn(conv: nn.Conv2d, norm: nn.BatchNorm2d):
+    """
+    Merge the (eval mode) batch normalization norm into the weights of conv.
+    """
+    scale = torch.rsqrt(norm.running_var + norm.eps)
+    if norm.affine:
+        scale = scale * norm.weight
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(norm.running_mean)
+    bias = (bias - norm.running_mean) * scale
+    if norm.affine:
+        bias = bias + norm.bias
+    conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+    conv.bias = nn.Parameter(bias)
+
+
+class _ScatterMaxUnpool2d(nn.Module):
+    """
+    MaxUnpool2d as a scatter into the flattened output planes.
+
+    nn.MaxUnpool2d can neither be traced (output size checks) nor exported to onnx.
+    """
+
+    def __init__(self, unpool: nn.MaxUnpool2d):
+        super().__init__()
+        self.kernel_size = nn.modules.utils._pair(unpool.kernel_size)
+        self.stride = nn.modules.utils._pair(unpool.stride)
+        self.padding = nn.modules.utils._pair(unpool.padding)
+
+    def forward(self, x: Tensor, indices: Tensor) -> Tensor:
+        n, c, h, w = x.shape
+        out_h = (h - 1) * self.stride[0] - 2 * self.padding[0] + self.kernel_size[0]
+        out_w = (w - 1) * self.stride[1] - 2 * self.padding[1] + self.kernel_size[1]
+        out = x.new_zeros((n, c, out_h * out_w))
+        out = out.scatter(2, indices.flatten(2), x.flatten(2))
+        return out.view(n, c, out_h, out_w)
+
+
+class _StaticScaleModel(nn.Module):
+    """
+    Model with fixed scale factors, so the image is its only input.
+    """
+
+    def __init__(self, model: nn.Module, scale_factor: Tensor, scale_factor_out=None):
+        super().__init__()
+        self.model = model
+        self.scale_factor = scale_factor
+        self.scale_factor_out = scale_factor_out
+
+    def forward(self, x: Tensor) -> Tensor:
+        # the interpolation layers modify the scale factors in-place
+        return self.model(x, self.scale_factor.clone(), copy.copy(self.scale_factor_out))
+
+
+def prepare_model(model: nn.Module) -> nn.Module:
+    """
+    Create a copy of a model for export: eval mode, folded batch normalization and
+    traceable unpooling.
+
+    Parameters
+    ----------
+    model : nn.Module
+        The model.
+
+    Returns
+    -------
+    nn.Module
+        The prepared copy.
+    """
+    model = fold_batchnorm(copy.deepcopy(model).eval())
+    for name, module in list(model.named_modules()):
+        if isinstance(module, nn.MaxUnpool2d):
+            parent, _, attr = name.rpartition(".")
+            setattr(model.get_submodule(parent), attr, _ScatterMaxUnpool2d(module))
+    return model
+
+
+class ExportedModel:
+    """
+    Run a model as an optimized TorchScript graph or with onnxruntime.
+
+    The dynamic parts of the model (the scale factor dependent zoom of VINN, which
+    splits the batch by scale factor) are resolved when the model is traced, so a
+    graph is created (and cached) for each combination of input shape and scale
+    factors. Batch normalization is folded into the convolutions before tracing.
+    Smaller batches (e.g. the last batch of a volume) are padded to the size of the
+    traced graph.
+
+    Methods
+    -------
+    eval
+        No-op for compatibility with nn.Module.
+    to
+        Move the model to another device (clears the cached graphs).
+    """
+
+    def __init__(self, model: nn.Module, engine: Engine = "torchscript"):
+        """
+        Construct ExportedModel object.
+
+        Parameters
+        ----------
+        model : nn.Module
+            The (eager) model with its weights loaded.
+        engine : "torchscript", "onnx", default="torchscript"
+            TorchScript runs a frozen, traced graph on the device of the model. Onnx
+            runs an onnxruntime session (CPU).
+        """
+        if engine == "onnx":
+            try:
+                import onnxruntime  # noqa: F401
+            except ImportError as e:
+                raise ImportError(
+                    "The onnx engine requires the onnx and onnxruntime packages, install "
+                    "them with 'pip install onnx onnxruntime'."
+                ) from e
+        elif engine != "torchscript":
+            raise ValueError(f"Invalid engine {engine}, must be torchscript or onnx.")
+        self.engine = engine
+        self.model = prepare_model(model)
+        self._graphs = {}
+
+    def eval(self) -> "ExportedModel":
+        """
+        Return self (the exported model is always in eval mode).
+        """
+        return self
+
+    def to(self, device: torch.device | str | None = None) -> "ExportedModel":
+        """
+        Move the model to device and clear the cached graphs.
+        """
+        self.model.to(device)
+        self._graphs.clear()
+        return self
+
+    @torch.no_grad()
+    def __call__(
+        self, x: Tensor, scale_factor: Tensor, scale_factor_out: Tensor | None = None
+    ) -> Tensor:
+        """
+        Run the model (see FastSurferVINN.forward).
+        """
+        sf = torch.as_tensor(scale_factor).cpu()
+        # uniform scale factors (the usual case in inference) allow padded batches
+        uniform = bool((sf == sf[:1]).all()) if sf.dim() > 0 and len(sf) > 0 else True
+        sf_key = tuple(np.asarray(sf[:1] if uniform else sf).ravel().tolist())
+        sf_out_key = None if scale_factor_out is None else repr(scale_factor_out)
+        key = (tuple(x.shape[1:]), x.device, x.dtype, uniform, sf_key, sf_out_key)
+        if not uniform:
+            key += (x.shape[0],)
+
+        batch_size = x.shape[0]
+        graph_size, graph = self._graphs.get(key, (0, None))
+        if graph is None or batch_size > graph_size:
+            graph_size = batch_size
+            graph = self._build(x, sf, scale_factor_out)
+            self._graphs[key] = (graph_size, graph)
+        if batch_size < graph_size:
+            padding = x.new_zeros((graph_size - batch_size,) + x.shape[1:])
+            x = torch.cat([x, padding], dim=0)
+        return self._run(graph, x)[:batch_size]
+
+    def _build(self, x: Tensor, scale_factor: Tensor, scale_factor_out):
+        """
+        Trace the model for the shape of x and the scale factors.
+        """
+        LOGGER.info(
+            f"Creating {self.engine} graph for input {tuple(x.shape)} and scale factor "
+            f"{scale_factor[0].tolist() if scale_factor.dim() > 0 else scale_factor}"
+        )
+        static = _StaticScaleModel(self.model, scale_factor, scale_factor_out).eval()
+        with warnings.catch_warnings():
+            # the scale factors and shapes are expected to be constants in the graph
+            warnings.simplefilter("ignore", torch.jit.TracerWarning)
+            if self.engine == "torchscript":
+                return torch.jit.freeze(torch.jit.trace(static, x, check_trace=False))
+
+            import onnxruntime as ort
+
+            buffer = io.BytesIO()
+            warnings.simplefilter("ignore", DeprecationWarning)
+            torch.onnx.export(
+                static.cpu(),
+                (x.cpu(),),
+                buffer,
+                input_names=["image"],
+                output_names=["logits"],
+                opset_version=17,
+                dynamo=False,
+            )
+        static.to(x.device)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return ort.InferenceSession(
+            buffer.getvalue(), options, providers=["CPUExecutionProvider"]
+        )
+
+    def _run(self, graph, x: Tensor) -> Tensor:
+        """
+        Run a graph created by _build.
+        """
+        if self.engine == "torchscript":
+            return graph(x)
+        (logits,) = graph.run(None, {"image": x.cpu().numpy()})
+        return torch.from_numpy(logits).to(x.device)
+
+
+def build_engine(model: nn.Module, engine: Engine = "eager") -> nn.Module | ExportedModel:
+    """
+    Wrap a model for inference with engine.
+
+    Parameters
+    ----------
+    model : nn.Module
+        The model with its weights loaded.
+    engine : "eager", "torchscript", "onnx", default="eager"
+        The inference engine ("eager" returns the model itself).
+
+    Returns
+    -------
+    nn.Module, ExportedModel
+        The model to call for inference.
+    """
+    if engine == "eager":
+        return model
+    return ExportedModel(model, engine)
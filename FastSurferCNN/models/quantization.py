@@ -0,0 +1,177 @@
+# Copyright 2024 Image Analysis Lab, German Center for Neurodegenerative Diseases (DZNE), Bonn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# IMPORTS
+import warnings
+from collections.abc import Iterable
+
+import torch
+import torch.ao.quantization as tq
+from torch import Tensor, nn
+
+from FastSurferCNN.models.engine import prepare_model
+from FastSurferCNN.utils import logging
+
+LOGGER = logging.getLogger(__name__)
+
+
+class QuantizedConv(nn.Module):
+    """
+    Convolution with int8 weights and activations (float input and output).
+
+    The blocks of the networks combine the convolutions with operations that have no
+    quantized implementation (maxout, interpolation, unpooling), so each convolution
+    quantizes its input and dequantizes its output.
+    """
+
+    def __init__(self, conv: nn.Conv2d):
+        """
+        Construct QuantizedConv object.
+
+        Parameters
+        ----------
+        conv : nn.Conv2d
+            The float convolution (replaced by its quantized version in convert).
+        """
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x: Tensor) -> Tensor:
+        """
+        Quantize x, convolve and dequantize.
+        """
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def set_quantized_backend() -> str:
+    """
+    Select the quantized backend for this cpu (x86 or qnnpack on arm).
+
+    Returns
+    -------
+    str
+        The name of the backend.
+    """
+    engines = torch.backends.quantized.supported_engines
+    backend = next((e for e in ("x86", "fbgemm", "qnnpack") if e in engines), None)
+    if backend is None:
+        raise RuntimeError("This build of torch does not support quantized operations.")
+    torch.backends.quantized.engine = backend
+    return backend
+
+
+def prepare_quantization(model: nn.Module) -> nn.Module:
+    """
+    Create a copy of model with batch normalization folded and observers attached to
+    all convolutions.
+
+    Parameters
+    ----------
+    model : nn.Module
+        The float model with its weights loaded.
+
+    Returns
+    -------
+    nn.Module
+        The prepared copy (on the cpu), to run the calibration data through.
+    """
+    backend = set_quantized_backend()
+    model = prepare_model(model).cpu()
+    for name, module in list(model.named_modules()):
+        if isinstance(module, nn.Conv2d):
+            parent, _, attr = name.rpartition(".")
+            setattr(model.get_submodule(parent), attr, QuantizedConv(module))
+    qconfig = tq.get_default_qconfig(backend)
+    for module in model.modules():
+        if isinstance(module, QuantizedConv):
+            module.qconfig = qconfig
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        return tq.prepare(model)
+
+
+def convert_quantization(model: nn.Module) -> nn.Module:
+    """
+    Replace the observed convolutions of a prepared model by quantized convolutions.
+
+    Parameters
+    ----------
+    model : nn.Module
+        Model returned by prepare_quantization (after calibration).
+
+    Returns
+    -------
+    nn.Module
+        The quantized model.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        # uncalibrated observers warn, if the state is loaded afterward
+        warnings.simplefilter("ignore", UserWarning)
+        return tq.convert(model.eval())
+
+
+@torch.no_grad()
+def quantize_model(model: nn.Module, calibration_data: Iterable[tuple]) -> nn.Module:
+    """
+    Quantize model statically (post-training) with calibration data.
+
+    Parameters
+    ----------
+    model : nn.Module
+        The float model with its weights loaded.
+    calibration_data : Iterable[tuple]
+        The arguments to call the model with, e.g. (image, scale_factor) for
+        FastSurferVINN.
+
+    Returns
+    -------
+    nn.Module
+        The quantized model (cpu only).
+    """
+    prepared = prepare_quantization(model)
+    num_batches = 0
+    for args in calibration_data:
+        prepared(*(arg.cpu() if isinstance(arg, Tensor) else arg for arg in args))
+        num_batches += 1
+    if num_batches == 0:
+        raise ValueError("Static quantization requires calibration data.")
+    LOGGER.info(f"Calibrated the quantization with {num_batches} batches.")
+    return convert_quantization(prepared)
+
+
+def build_quantized_model(
+        model: nn.Module, model_state: dict[str, Tensor] | None = None
+) -> nn.Module:
+    """
+    Create the quantized structure of model to load a quantized state into.
+
+    Parameters
+    ----------
+    model : nn.Module
+        The float model (the weights are replaced by model_state).
+    model_state : dict[str, Tensor], optional
+        The state of the quantized model (see save_quantized_checkpoint).
+
+    Returns
+    -------
+    nn.Module
+        The quantized model (cpu only).
+    """
+    quantized = convert_quantization(prepare_quantization(model))
+    if model_state is not None:
+        quantized.load_state_dict(model_state)
+    return quantized
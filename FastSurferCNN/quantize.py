@@ -0,0 +1,390 @@
+# Copyright 2024 Image Analysis Lab, German Center for Neurodegenerative Diseases (DZNE), Bonn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Static post-training quantization of the FastSurferCNN/FastSurferVINN networks (see
+CerebNet/quantize.py and HypVINN/quantize.py for the other networks).
+
+The networks are calibrated on slices of a few (conformed) images, the quantized
+checkpoints are saved next to the float checkpoints (see
+FastSurferCNN.utils.checkpoint.quantized_checkpoint_path) and are used by
+run_prediction.py with --quantized. Finally, the int8 segmentations of the images are
+compared to the float32 segmentations (dice).
+
+Usage:
+`python3 FastSurferCNN/quantize.py --images <T1w images> [--ckpt_cor <checkpoint> ...]`
+"""
+
+# IMPORTS
+import argparse
+import sys
+from collections.abc import Iterable, Iterator, Sequence
+from pathlib import Path
+
+import numpy as np
+import torch
+import yacs.config
+from torch.utils.data import DataLoader, Subset
+from torchvision import transforms
+
+from FastSurferCNN.data_loader import conform as conf
+from FastSurferCNN.data_loader import data_utils as du
+from FastSurferCNN.data_loader.augmentation import ToTensorTest
+from FastSurferCNN.data_loader.dataset import MultiScaleOrigDataThickSlices
+from FastSurferCNN.models.networks import build_model
+from FastSurferCNN.models.quantization import quantize_model
+from FastSurferCNN.run_prediction import CHECKPOINT_PATHS_FILE, RunModelOnData, args2cfg
+from FastSurferCNN.utils import PLANES, Plane, logging, parser_defaults
+from FastSurferCNN.utils.arg_types import VoxSizeOption
+from FastSurferCNN.utils.checkpoint import (
+    get_checkpoints,
+    load_checkpoint_config_defaults,
+    load_model_state,
+    save_quantized_checkpoint,
+)
+from FastSurferCNN.utils.common import assert_no_root
+from FastSurferCNN.utils.metrics import confusion_matrix, dice_score
+
+LOGGER = logging.getLogger(__name__)
+
+Volume = tuple[str, np.ndarray, np.ndarray]
+
+
+def add_calibration_arguments(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    """
+    Add the calibration and comparison flags shared by the quantization scripts.
+
+    Parameters
+    ----------
+    parser : argparse.ArgumentParser
+        The parser to add the flags to.
+
+    Returns
+    -------
+    argparse.ArgumentParser
+        The parser object.
+    """
+    parser.add_argument(
+        "--calibration_slices",
+        dest="calibration_slices",
+        type=int,
+        default=32,
+        help="Number of (evenly spaced, non-empty) slices per image and plane to "
+             "calibrate with (default: 32).",
+    )
+    parser.add_argument(
+        "--no_dice",
+        dest="dice",
+        action="store_false",
+        help="Skip the comparison of the int8 and float32 segmentations.",
+    )
+    return parser
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """
+    Create the argparse object.
+
+    Returns
+    -------
+    argparse.ArgumentParser
+        The parser object.
+    """
+    parser = argparse.ArgumentParser(
+        description="Static post-training quantization (int8) of the FastSurferVINN "
+                    "networks for cpu inference."
+    )
+    parser.add_argument(
+        "--images",
+        dest="images",
+        type=Path,
+        nargs="+",
+        required=True,
+        help="T1w images to calibrate the quantization with (conformed if necessary). "
+             "The int8 and float32 segmentations of these images are compared.",
+    )
+    parser = add_calibration_arguments(parser)
+    files: dict[Plane, str | Path] = {k: "default" for k in PLANES}
+    parser = parser_defaults.add_plane_flags(
+        parser, "checkpoint", files, CHECKPOINT_PATHS_FILE
+    )
+    parser = parser_defaults.add_plane_flags(parser, "config", files, CHECKPOINT_PATHS_FILE)
+    parser = parser_defaults.add_arguments(
+        parser,
+        [
+            "lut",
+            "vox_size",
+            "conform_to_1mm_threshold",
+            "batch_size",
+            "threads",
+            "allow_root",
+        ],
+    )
+    return parser
+
+
+def load_volumes(
+        images: Sequence[Path],
+        vox_size: VoxSizeOption = "min",
+        conform_to_1mm_threshold: float = 0.95,
+) -> list[Volume]:
+    """
+    Load and (if necessary) conform images.
+
+    Parameters
+    ----------
+    images : Sequence[Path]
+        Paths to the images.
+    vox_size : VoxSizeOption, default="min"
+        The voxel size to conform to.
+    conform_to_1mm_threshold : float, default=0.95
+        See conform.conform.
+
+    Returns
+    -------
+    list[tuple[str, np.ndarray, np.ndarray]]
+        The name, data and zooms of each conformed image.
+    """
+    volumes = []
+    for image in images:
+        img, data = du.load_image(image, "calibration image")
+        kwargs = dict(
+            conform_vox_size=vox_size, conform_to_1mm_threshold=conform_to_1mm_threshold,
+        )
+        if not conf.is_conform(img, check_dtype=True, verbose=False, **kwargs):
+            img = conf.conform(img, **kwargs)
+            data = np.asanyarray(img.dataobj)
+        volumes.append((str(image), data, np.asarray(img.header.get_zooms())))
+    return volumes
+
+
+def calibration_indices(images: np.ndarray, num_slices: int = 32) -> list[int]:
+    """
+    Select evenly spaced, non-empty slices of a volume.
+
+    Parameters
+    ----------
+    images : np.ndarray
+        The (thick) slices of the volume, slices first.
+    num_slices : int, default=32
+        The number of slices to select.
+
+    Returns
+    -------
+    list[int]
+        The indices of the selected slices.
+    """
+    non_empty = np.flatnonzero(images.reshape(len(images), -1).max(1) > 0)
+    picks = np.linspace(0, len(non_empty) - 1, min(num_slices, len(non_empty)))
+    return non_empty[np.round(picks).astype(int)].tolist()
+
+
+def calibration_batches(
+        cfg: yacs.config.CfgNode,
+        volumes: Sequence[Volume],
+        num_slices: int = 32,
+        batch_size: int = 1,
+) -> Iterator[tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Yield batches of evenly spaced, non-empty slices of the volumes.
+
+    Parameters
+    ----------
+    cfg : yacs.config.CfgNode
+        The configuration of the network (plane and thickness of the slices).
+    volumes : Sequence[tuple[str, np.ndarray, np.ndarray]]
+        The name, data and zooms of the conformed images.
+    num_slices : int, default=32
+        The number of slices per volume.
+    batch_size : int, default=1
+        The batch size.
+
+    Yields
+    ------
+    tuple[torch.Tensor, torch.Tensor]
+        Batches of images and scale factors.
+    """
+    for name, data, zoom in volumes:
+        dataset = MultiScaleOrigDataThickSlices(
+            data, zoom, cfg, transforms=transforms.Compose([ToTensorTest()]),
+        )
+        indices = calibration_indices(dataset.images, num_slices)
+        LOGGER.info(f"Calibrating {cfg.DATA.PLANE} on {len(indices)} slices of {name}")
+        loader = DataLoader(Subset(dataset, indices), batch_size=batch_size)
+        for batch in loader:
+            yield batch["image"], batch["scale_factor"]
+
+
+def segmentation_dice(pred: np.ndarray, ref: np.ndarray) -> dict[int, float]:
+    """
+    Compute the dice score of each label (except 0) of two segmentations.
+
+    Parameters
+    ----------
+    pred : np.ndarray
+        The segmentation to evaluate.
+    ref : np.ndarray
+        The reference segmentation.
+
+    Returns
+    -------
+    dict[int, float]
+        The dice score per label.
+    """
+    # dice_score excludes the first label, which is the background (0)
+    labels = np.union1d(np.union1d(ref, pred), [0])
+    index = torch.from_numpy(np.searchsorted(labels, np.stack([ref, pred]).reshape(2, -1)))
+    cm = confusion_matrix(index[1], index[0], len(labels))
+    return dict(zip(labels[1:].tolist(), dice_score(cm).tolist(), strict=True))
+
+
+def quantize_checkpoint(
+        model: torch.nn.Module,
+        calibration_data: Iterable[tuple],
+        checkpoint: Path | str,
+        calibration_images: Sequence[str],
+        calibration_slices: int,
+        **metadata,
+) -> torch.nn.Module:
+    """
+    Quantize a float model and save it next to its checkpoint.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The float model with the weights of checkpoint loaded.
+    calibration_data : Iterable[tuple]
+        The arguments to call the model with (see quantize_model).
+    checkpoint : Path, str
+        The (float) checkpoint of the model.
+    calibration_images : Sequence[str]
+        The names of the calibration images (saved in the metadata).
+    calibration_slices : int
+        The number of calibration slices per image (saved in the metadata).
+    **metadata
+        Additional metadata to save.
+
+    Returns
+    -------
+    torch.nn.Module
+        The quantized model.
+    """
+    quantized = quantize_model(model.eval(), calibration_data)
+    metadata = {
+        "calibration_images": list(calibration_images),
+        "calibration_slices": calibration_slices,
+        **metadata,
+    }
+    save_quantized_checkpoint(quantized.state_dict(), checkpoint, metadata)
+    return quantized
+
+
+def report_dice(segmentations: Iterable[tuple[str, np.ndarray, np.ndarray]]) -> float:
+    """
+    Log the dice scores of int8 segmentations compared to the float32 segmentations.
+
+    Parameters
+    ----------
+    segmentations : Iterable[tuple[str, np.ndarray, np.ndarray]]
+        The name, int8 segmentation and float32 segmentation of each image (may be a
+        generator, so only one pair of segmentations is in memory).
+
+    Returns
+    -------
+    float
+        The mean dice over all images.
+    """
+    mean_dice = []
+    for name, pred, ref in segmentations:
+        scores = np.asarray(list(segmentation_dice(pred, ref).values()))
+        mean_dice.append(np.nanmean(scores))
+        LOGGER.info(
+            f"Dice int8 vs. float32 of {name}: mean {mean_dice[-1]:.4f}, "
+            f"min {np.nanmin(scores):.4f}, voxels changed {np.mean(pred != ref):.4%}"
+        )
+    LOGGER.info(f"Mean dice int8 vs. float32: {np.mean(mean_dice):.4f}")
+    return float(np.mean(mean_dice))
+
+
+def main(
+        *,
+        images: list[Path],
+        ckpt_ax: Path,
+        ckpt_sag: Path,
+        ckpt_cor: Path,
+        cfg_ax: Path,
+        cfg_sag: Path,
+        cfg_cor: Path,
+        lut: Path,
+        calibration_slices: int = 32,
+        dice: bool = True,
+        vox_size: VoxSizeOption = "min",
+        conform_to_1mm_threshold: float = 0.95,
+        batch_size: int = 1,
+        threads: int = 1,
+        allow_root: bool = False,
+) -> int | str:
+    allow_root or assert_no_root()
+    torch.set_num_threads(threads)
+
+    urls = load_checkpoint_config_defaults("url", filename=CHECKPOINT_PATHS_FILE)
+    get_checkpoints(ckpt_ax, ckpt_cor, ckpt_sag, urls=urls)
+    try:
+        volumes = load_volumes(images, vox_size, conform_to_1mm_threshold)
+        _, *cfgs = args2cfg(cfg_ax, cfg_cor, cfg_sag, batch_size)
+    except (OSError, RuntimeError, ValueError) as e:
+        return e.args[0] if e.args else repr(e)
+    ckpts = (ckpt_cor, ckpt_sag, ckpt_ax)
+    view_ops = dict(zip(("coronal", "sagittal", "axial"), zip(cfgs, ckpts, strict=True), strict=True))
+
+    for plane, (cfg, ckpt) in view_ops.items():
+        if cfg is None or ckpt is None:
+            continue
+        LOGGER.info(f"Quantizing the {plane} network {ckpt}")
+        model = build_model(cfg)
+        model.load_state_dict(load_model_state(ckpt)[0])
+        batches = calibration_batches(cfg, volumes, calibration_slices, batch_size)
+        names = [name for name, _, _ in volumes]
+        quantize_checkpoint(model, batches, ckpt, names, calibration_slices)
+
+    if not dice:
+        return 0
+
+    kwargs = dict(
+        lut=lut, ckpt_ax=ckpt_ax, ckpt_sag=ckpt_sag, ckpt_cor=ckpt_cor, cfg_ax=cfg_ax,
+        cfg_sag=cfg_sag, cfg_cor=cfg_cor, device="cpu", viewagg_device="cpu",
+        threads=threads, batch_size=batch_size, vox_size=vox_size,
+        conform_to_1mm_threshold=conform_to_1mm_threshold,
+    )
+    float_model = RunModelOnData(**kwargs)
+    int8_model = RunModelOnData(quantized=True, **kwargs)
+    report_dice(
+        (
+            name,
+            int8_model.get_prediction(name, data, zoom),
+            float_model.get_prediction(name, data, zoom),
+        )
+        for name, data, zoom in volumes
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    parser = make_parser()
+    _args = parser.parse_args()
+
+    from FastSurferCNN.utils.logging import setup_logging
+    setup_logging(None)
+
+    sys.exit(main(**vars(_args)))
@@ -13,7 +13,6 @@
 # limitations under the License.
 
 # IMPORTS
-import copy
 import optparse
 import sys
 
@@ -117,55 +116,79 @@ def create_mask(aseg_data, dnum, enum):
     """
     Create dilated mask.
 
+    The dilation and erosion are equivalent to dnum binary dilations and enum binary
+    erosions with a 3x3x3 structuring element, but are computed by a chessboard
+    distance transform of the bounding box of the brain (padded by dnum).
+
+    Note, dnum=0 or enum=0 skip the dilation or erosion, while scipy (iterations=0)
+    repeated them until the mask did not change anymore.
+
     Parameters
     ----------
     aseg_data : npt.NDArray[int]
-        The input segmentation data.
+        The input segmentation data (not modified).
     dnum : int
-        The number of iterations for the dilation operation.
+        The number of iterations for the dilation operation (0 for no dilation).
     enum : int
-        The number of iterations for the erosion operation.
+        The number of iterations for the erosion operation (0 for no erosion).
 
     Returns
     -------
-    -
-        Returns aseg_data.
+    npt.NDArray[np.uint8]
+        The mask (1 inside the brain, else 0).
     """
     print("Creating dilated mask ...")
 
     # treat lateral orbital frontal and parsorbitalis special to avoid capturing too much of eye nerve
-    lat_orb_front_mask = np.logical_or(aseg_data == 2012, aseg_data == 1012)
-    parsorbitalis_mask = np.logical_or(aseg_data == 2019, aseg_data == 1019)
-    frontal_mask = np.logical_or(lat_orb_front_mask, parsorbitalis_mask)
+    frontal_mask = np.isin(aseg_data, (1012, 1019, 2012, 2019))
     print("Frontal region special treatment: ", format(np.sum(frontal_mask)))
 
     # reduce to binary
     datab = aseg_data > 0
     datab[frontal_mask] = 0
+
+    # bounding box of the brain padded by dnum (the dilation does not reach further)
+    bbox = []
+    for axis, size in enumerate(datab.shape):
+        other_axes = tuple(a for a in range(datab.ndim) if a != axis)
+        nonzero = np.flatnonzero(datab.any(axis=other_axes))
+        assert nonzero.size != 0  # assume at least 1 real connected component
+        bbox.append(slice(max(nonzero[0] - dnum, 0), min(nonzero[-1] + dnum + 1, size)))
+    bbox = tuple(bbox)
+    # the zero border is the background outside the bounding box and the image
+    box = np.pad(datab[bbox], 1)
+    border = tuple(slice(1, -1) for _ in range(box.ndim))
     # dilate and erode
-    datab = scipy.ndimage.binary_dilation(datab, np.ones((3, 3, 3)), iterations=dnum)
-    datab = scipy.ndimage.binary_erosion(datab, np.ones((3, 3, 3)), iterations=enum)
-    # for x in range(dnum):
-    #    datab = binary_dilation(datab, np.ones((3, 3, 3)))
-    # for x in range(enum):
-    #    datab = binary_erosion(datab, np.ones((3, 3, 3)))
+    dilated = np.zeros_like(box)
+    if dnum > 0:
+        dilation = scipy.ndimage.distance_transform_cdt(~box, metric="chessboard")
+        dilated[border] = dilation[border] <= dnum
+    else:
+        dilated[border] = box[border]
+    if enum > 0:
+        box = scipy.ndimage.distance_transform_cdt(dilated, metric="chessboard") > enum
+    else:
+        box = dilated
 
     # extract largest component
-    labels = label(datab)
+    labels = label(box[border])
     assert labels.max() != 0  # assume at least 1 real connected component
     print(f"  Found {labels.max()} connected component(s)!")
 
+    mask = np.zeros(aseg_data.shape, dtype=np.uint8)
     if labels.max() > 1:
         print("  Selecting largest component!")
-        datab = labels == np.argmax(np.bincount(labels.flat)[1:]) + 1
+        mask[bbox] = labels == np.argmax(np.bincount(labels.flat)[1:]) + 1
+    else:
+        mask[bbox] = labels > 0
 
     # add frontal regions back to mask
-    datab[frontal_mask] = 1
+    mask[frontal_mask] = 1
+    return mask
+
 
-    # set mask
-    aseg_data[~datab] = 0
-    aseg_data[datab] = 1
-    return aseg_data
+# label ids of the white and gray matter of the hemispheres
+LH_WM, LH_GM, RH_WM, RH_GM = 2, 3, 41, 42
 
 
 def flip_wm_islands(aseg_data : np.ndarray) -> np.ndarray:
@@ -186,46 +209,85 @@ def flip_wm_islands(aseg_data : np.ndarray) -> np.ndarray:
     # These are usually islands, not connected to the main hemi WM component
     # Here we decide to flip assignment based on proximity to other WM and GM labels
 
-    # label ids
-    lh_wm = 2
-    lh_gm = 3
-    rh_wm = 41
-    rh_gm = 42
-
-    # for lh get largest component and islands
-    mask = aseg_data == lh_wm
-    labels = label(mask, background=0)
-    assert labels.max() != 0  # assume at least 1 connected component
-    bc = np.bincount(labels.flat)[1:]
-    largestID = np.argmax(bc) + 1
-    largestCC = labels == largestID
-    lh_islands = (~largestCC) & (labels > 0)
-
-    # same for rh
-    mask = aseg_data == rh_wm
-    labels = label(mask, background=0)
-    assert labels.max() != 0  # assume at least 1 CC
-    bc = np.bincount(labels.flat)[1:]
-    largestID = np.argmax(bc) + 1
-    largestCC = labels == largestID
-    rh_islands = (labels != largestID) & (labels > 0)
-
-    # get signed probability for lh and rh (by smoothing joined GM+WM labels)
-    lhmask = (aseg_data == lh_wm) | (aseg_data == lh_gm)
-    rhmask = (aseg_data == rh_wm) | (aseg_data == rh_gm)
-    ii = gaussian(lhmask.astype(float) * (-1) + rhmask.astype(float), sigma=1.5)
+    # get the components of lh (1) and rh (2) WM in one pass (label does not connect
+    # neighbors with different values)
+    wm = np.zeros(aseg_data.shape, dtype=np.uint8)
+    wm[aseg_data == LH_WM] = 1
+    wm[aseg_data == RH_WM] = 2
+    labels = label(wm, background=0)
+    sizes = np.bincount(labels.flat)
+    hemi = np.zeros(sizes.size, dtype=np.uint8)
+    hemi[labels.flat] = wm.flat
+
+    # islands are all but the largest component of each hemi
+    is_island = hemi > 0
+    for h in (1, 2):
+        assert np.any(hemi == h)  # assume at least 1 connected component
+        is_island[np.argmax(np.where(hemi == h, sizes, -1))] = False
+    islands = np.nonzero(is_island[labels])
+    island_hemi = hemi[labels[islands]]
+
+    # get signed probability for lh and rh (by smoothing joined GM+WM labels) at the
+    # islands, recompute values close to 0 in double precision
+    ii = _hemisphere_vote(aseg_data, islands, np.float32)
+    uncertain = np.abs(ii) < 1e-5
+    if np.any(uncertain):
+        uncertain_voxels = tuple(index[uncertain] for index in islands)
+        ii[uncertain] = _hemisphere_vote(aseg_data, uncertain_voxels, np.float64)
 
     # flip island
-    rhswap = rh_islands & (ii < 0.0)
-    lhswap = lh_islands & (ii > 0.0)
+    rhswap = (island_hemi == 2) & (ii < 0.0)
+    lhswap = (island_hemi == 1) & (ii > 0.0)
     flip_data = aseg_data.copy()
-    flip_data[rhswap] = lh_wm
-    flip_data[lhswap] = rh_wm
+    flip_data[tuple(index[rhswap] for index in islands)] = LH_WM
+    flip_data[tuple(index[lhswap] for index in islands)] = RH_WM
     print(f"FlipWM: rh {rhswap.sum()} and lh {lhswap.sum()} flipped.")
 
     return flip_data
 
 
+def _hemisphere_vote(
+        aseg_data: np.ndarray,
+        voxels: tuple[np.ndarray, ...],
+        dtype: type[np.floating],
+        sigma: float = 1.5,
+) -> np.ndarray:
+    """
+    Smooth the hemisphere labels (lh GM+WM -1, rh GM+WM 1) and sample them at voxels.
+
+    Only the bounding box of voxels padded by the radius of the gaussian kernel is
+    smoothed, which (in double precision) is bit-identical to smoothing the whole
+    image.
+
+    Parameters
+    ----------
+    aseg_data : numpy.ndarray
+        The segmentation data.
+    voxels : tuple[numpy.ndarray, ...]
+        The indices of the voxels (as returned by numpy.nonzero).
+    dtype : type[numpy.floating]
+        The float type to smooth in.
+    sigma : float, default=1.5
+        The standard deviation of the gaussian kernel.
+
+    Returns
+    -------
+    numpy.ndarray
+        The smoothed labels at voxels.
+    """
+    if voxels[0].size == 0:
+        return np.zeros(0, dtype=dtype)
+    # radius of the kernel of skimage.filters.gaussian (truncate=4)
+    radius = int(4.0 * sigma + 0.5)
+    window = tuple(
+        slice(max(int(i.min()) - radius, 0), int(i.max()) + radius + 1) for i in voxels
+    )
+    data = aseg_data[window]
+    vote = np.isin(data, (RH_WM, RH_GM)).astype(dtype) - np.isin(data, (LH_WM, LH_GM))
+    smoothed = gaussian(vote, sigma=sigma)
+    return smoothed[tuple(i - w.start for i, w in zip(voxels, window, strict=True))]
+
+
 if __name__ == "__main__":
     # Command Line options are error checking done here
     options = options_parse()
@@ -241,7 +303,7 @@ if __name__ == "__main__":
 
     # get mask
     if options.output_mask:
-        bm = create_mask(copy.deepcopy(inseg_data), 5, 4)
+        bm = create_mask(inseg_data, 5, 4)
         print(f"Outputting mask: {options.output_mask}")
         mask = nib.MGHImage(bm, inseg_affine, inseg_header)
         mask.to_filename(options.output_mask)
@@ -0,0 +1,676 @@
+# Copyright 2024 Image Analysis Lab, German Center for Neurodegenerative Diseases (DZNE), Bonn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Run FastSurfer on many subjects on one node (alternative to brun_fastsurfer.sh).
+
+Each subject passes three stages:
+1. asegdkt: the asegdkt segmentation runs in this process, so the models are loaded
+   only once for all subjects (one subject at a time).
+2. seg: the other segmentation modules (biasfield correction, talairach registration,
+   CerebNet, HypVINN, ...) by `run_fastsurfer.sh --seg_only --no_asegdkt`.
+3. surf: the surface pipeline by `run_fastsurfer.sh --surf_only`.
+
+The jobs are started as soon as their cores and memory fit into the budget of the node
+and the status of each subject and stage is stored in a SQLite database, so an
+interrupted batch resumes with the stages that did not finish.
+
+Usage:
+`python3 FastSurferCNN/run_batch.py --sd <subjects dir> --csv_file <subject list>
+[--cores <n>] [--memory <GB>] [<additional run_fastsurfer.sh options>]`
+"""
+
+# IMPORTS
+import argparse
+import contextlib
+import os
+import shlex
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections.abc import Callable, Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal
+
+from FastSurferCNN.utils import PLANES, Plane, logging, parser_defaults
+from FastSurferCNN.utils.common import SubjectDirectory, SubjectList, assert_no_root
+from FastSurferCNN.utils.parser_defaults import FASTSURFER_ROOT, SubjectDirectoryConfig
+from FastSurferCNN.utils.threads import get_num_threads
+
+LOGGER = logging.getLogger(__name__)
+
+Stage = Literal["asegdkt", "seg", "surf"]
+State = Literal["pending", "running", "done", "failed"]
+
+
+@dataclass(frozen=True)
+class Resources:
+    """
+    Cores and memory (in GB) of a job or a node.
+    """
+
+    cores: int
+    memory: float
+
+    def __add__(self, other: "Resources") -> "Resources":
+        return Resources(self.cores + other.cores, self.memory + other.memory)
+
+    def __sub__(self, other: "Resources") -> "Resources":
+        return Resources(self.cores - other.cores, self.memory - other.memory)
+
+    def fits(self, other: "Resources") -> bool:
+        """
+        Check, whether other fits into these resources.
+        """
+        return other.cores <= self.cores and other.memory <= self.memory
+
+
+def available_memory() -> float:
+    """
+    Get the memory available for new processes in GB (total memory, if unknown).
+    """
+    try:
+        import psutil
+
+        return psutil.virtual_memory().available / 2 ** 30
+    except ImportError:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2 ** 30
+
+
+class BatchStatus:
+    """
+    Status of each subject and stage of a batch in a SQLite database.
+
+    Stages that were running, when the batch was interrupted, are pending again, when
+    the database is opened.
+    """
+
+    def __init__(self, filename: Path | str):
+        """
+        Open (or create) the status database.
+
+        Parameters
+        ----------
+        filename : Path, str
+            The SQLite file.
+        """
+        self._lock = threading.Lock()
+        # autocommit, every update is written immediately
+        self._db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS status (subject TEXT NOT NULL, "
+            "stage TEXT NOT NULL, state TEXT NOT NULL, started REAL, finished REAL, "
+            "message TEXT, PRIMARY KEY (subject, stage))"
+        )
+        self._db.execute("UPDATE status SET state = 'pending' WHERE state = 'running'")
+
+    def get(self, subject: str, stage: Stage) -> State:
+        """
+        Get the state of the stage of subject (pending, if unknown).
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state FROM status WHERE subject = ? AND stage = ?",
+                (subject, stage),
+            ).fetchone()
+        return "pending" if row is None else row[0]
+
+    def set(self, subject: str, stage: Stage, state: State, message: str = ""):
+        """
+        Set the state of the stage of subject (and the start or end time).
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO status (subject, stage, state, started, finished, message) "
+                "VALUES (?, ?, ?, ?, NULL, ?) ON CONFLICT (subject, stage) DO UPDATE "
+                "SET state = excluded.state, message = excluded.message, "
+                "started = CASE WHEN excluded.state = 'running' THEN excluded.started "
+                "ELSE started END, finished = CASE WHEN excluded.state IN "
+                "('done', 'failed') THEN ? ELSE NULL END",
+                (subject, stage, state, now, message, now),
+            )
+
+    def summary(self) -> dict[tuple[Stage, State], int]:
+        """
+        Count the subjects per stage and state.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT stage, state, COUNT(*) FROM status GROUP BY stage, state"
+            ).fetchall()
+        return {(stage, state): count for stage, state, count in rows}
+
+    def close(self):
+        """
+        Close the database.
+        """
+        self._db.close()
+
+
+@dataclass(frozen=True)
+class Job:
+    """
+    A stage of a subject and the resources it requires.
+    """
+
+    subject: SubjectDirectory
+    stage: Stage
+    resources: Resources
+
+
+class BatchScheduler:
+    """
+    Run the stages of all subjects without exceeding a budget of cores and memory.
+
+    Free resources are filled greedily with the next stage of the subjects in order,
+    earlier stages first (asegdkt feeds the other stages). Stages with a limit of
+    concurrent jobs (asegdkt, which shares one set of models) queue up.
+    """
+
+    def __init__(
+            self,
+            subjects: Sequence[SubjectDirectory],
+            status: BatchStatus,
+            budget: Resources,
+            requirements: dict[Stage, Resources],
+            runners: dict[Stage, Callable[[SubjectDirectory, Resources], None]],
+            max_jobs: dict[Stage, int] | None = None,
+            retry_failed: bool = False,
+    ):
+        """
+        Construct BatchScheduler object.
+
+        Parameters
+        ----------
+        subjects : Sequence[SubjectDirectory]
+            The subjects to process.
+        status : BatchStatus
+            The status database (stages that are done are skipped).
+        budget : Resources
+            The cores and memory of the node to use.
+        requirements : dict[Stage, Resources]
+            The resources of a job of each stage (capped at the budget).
+        runners : dict[Stage, Callable[[SubjectDirectory, Resources], None]]
+            The function to run each stage with (raises an exception on failure).
+            The order of the runners defines the order of the stages.
+        max_jobs : dict[Stage, int], optional
+            The maximum number of concurrent jobs of a stage (default: no limit).
+        retry_failed : bool, default=False
+            Whether to run failed stages again.
+        """
+        self.subjects = list(subjects)
+        self.status = status
+        self.budget = budget
+        self.requirements = {
+            stage: Resources(min(r.cores, budget.cores), min(r.memory, budget.memory))
+            for stage, r in requirements.items()
+        }
+        self.runners = runners
+        self.stages = tuple(runners.keys())
+        self.max_jobs = max_jobs or {}
+        self.retry_failed = retry_failed
+
+    def _next_stage(self, subject: SubjectDirectory) -> Stage | None:
+        """
+        Get the first stage of subject, that is not done (None, if all are done or a
+        stage failed).
+        """
+        for stage in self.stages:
+            state = self.status.get(subject.id, stage)
+            if state == "failed" and not self.retry_failed:
+                return None
+            if state != "done":
+                return stage
+        return None
+
+    def run(self) -> int:
+        """
+        Run all stages of all subjects.
+
+        Returns
+        -------
+        int
+            The number of subjects with a failed stage.
+        """
+        queue = {s.id: stage for s in self.subjects if (stage := self._next_stage(s))}
+        subjects = {s.id: s for s in self.subjects if s.id in queue}
+        LOGGER.info(
+            f"Processing {len(queue)} of {len(self.subjects)} subjects with "
+            f"{self.budget.cores} cores and {self.budget.memory:.1f} GB of memory."
+        )
+        running: dict[Future, Job] = {}
+        available = self.budget
+        failed = set()
+        # each job occupies at least one core, so this many jobs can run at once
+        pool = ThreadPoolExecutor(max(1, self.budget.cores))
+        try:
+            while queue or running:
+                busy = {job.subject.id for job in running.values()}
+                for stage in self.stages:
+                    jobs_of_stage = sum(j.stage == stage for j in running.values())
+                    for sid, next_stage in queue.items():
+                        if next_stage != stage or sid in busy:
+                            continue
+                        if jobs_of_stage >= self.max_jobs.get(stage, len(queue)):
+                            break
+                        job = Job(subjects[sid], stage, self.requirements[stage])
+                        if not available.fits(job.resources):
+                            continue
+                        available -= job.resources
+                        busy.add(sid)
+                        jobs_of_stage += 1
+                        self.status.set(sid, stage, "running")
+                        LOGGER.info(f"{sid}: starting {stage}")
+                        future = pool.submit(
+                            self.runners[stage], job.subject, job.resources
+                        )
+                        running[future] = job
+                if not running:
+                    raise RuntimeError("No job fits into the resource budget.")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    available += job.resources
+                    sid = job.subject.id
+                    if (error := future.exception()) is not None:
+                        LOGGER.error(f"{sid}: {job.stage} failed: {error}")
+                        self.status.set(sid, job.stage, "failed", str(error))
+                        failed.add(sid)
+                        del queue[sid]
+                        continue
+                    LOGGER.info(f"{sid}: {job.stage} done")
+                    self.status.set(sid, job.stage, "done")
+                    index = self.stages.index(job.stage) + 1
+                    if index < len(self.stages):
+                        queue[sid] = self.stages[index]
+                    else:
+                        del queue[sid]
+        except KeyboardInterrupt:
+            LOGGER.warning(
+                "Interrupted, running stages are rerun, when the batch is resumed."
+            )
+            for future, job in running.items():
+                self.status.set(job.subject.id, job.stage, "pending", "interrupted")
+                future.cancel()
+            # the in-process stage cannot be stopped, it finishes in the background
+            FastSurferStage.terminate_all()
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        pool.shutdown()
+        return len(failed)
+
+
+class FastSurferStage:
+    """
+    Run a stage of run_fastsurfer.sh for a subject (in a subprocess).
+    """
+
+    _processes: set[subprocess.Popen] = set()
+
+    def __init__(
+            self,
+            name: str,
+            stage_flags: Sequence[str],
+            run_fastsurfer: Sequence[str],
+            files: dict[str, str] | None = None,
+            extra_args: Sequence[str] = (),
+    ):
+        """
+        Construct FastSurferStage object.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage (for the log file scripts/batch_<name>.log).
+        stage_flags : Sequence[str]
+            The flags to select the stage, e.g. ("--surf_only",).
+        run_fastsurfer : Sequence[str]
+            The command to run run_fastsurfer.sh.
+        files : dict[str, str], optional
+            Flags of run_fastsurfer.sh and filenames (relative to the subject
+            directory), e.g. {"--mask_name": "mri/mask.mgz"}.
+        extra_args : Sequence[str], optional
+            Additional arguments to run_fastsurfer.sh.
+        """
+        self.name = name
+        self.stage_flags = list(stage_flags)
+        self.run_fastsurfer = list(run_fastsurfer)
+        self.files = files or {}
+        self.extra_args = list(extra_args)
+
+    def __call__(self, subject: SubjectDirectory, resources: Resources):
+        """
+        Run the stage for subject with resources.cores threads.
+        """
+        cmd = self.run_fastsurfer + [
+            "--sid", subject.id,
+            "--sd", str(subject.subject_dir),
+            "--t1", str(subject.orig_name),
+            "--threads", str(resources.cores),
+            *self.stage_flags,
+        ]
+        for flag, filename in self.files.items():
+            cmd += [flag, str(subject.filename_in_subject_folder(filename))]
+        cmd += self.extra_args
+        log_file = subject.filename_in_subject_folder(f"scripts/batch_{self.name}.log")
+        log_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(log_file, "a") as log:
+            log.write(shlex.join(cmd) + "\n")
+            log.flush()
+            # a process group per stage, so terminate_all stops all child processes
+            process = subprocess.Popen(
+                cmd, stdout=log, stderr=subprocess.STDOUT, start_new_session=True,
+            )
+            self._processes.add(process)
+            try:
+                returncode = process.wait()
+            finally:
+                self._processes.discard(process)
+        if returncode != 0:
+            raise RuntimeError(f"exit code {returncode}, see {log_file}")
+
+    @classmethod
+    def terminate_all(cls):
+        """
+        Terminate all running stages.
+        """
+        for process in list(cls._processes):
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(process.pid, signal.SIGTERM)
+
+
+class AsegdktStage:
+    """
+    Segment subjects with the asegdkt models of this process (see run_prediction.py).
+    """
+
+    def __init__(self, brainmask_name: str, aseg_name: str, **kwargs):
+        """
+        Construct AsegdktStage object.
+
+        Parameters
+        ----------
+        brainmask_name : str
+            The filename of the brainmask.
+        aseg_name : str
+            The filename of the reduced aseg.
+        **kwargs
+            Arguments to RunModelOnData.
+        """
+        from FastSurferCNN.run_prediction import RunModelOnData
+
+        self.brainmask_name = brainmask_name
+        self.aseg_name = aseg_name
+        # files have to be written, before the next stage starts
+        self.model = RunModelOnData(async_io=False, **kwargs)
+
+    def __call__(self, subject: SubjectDirectory, resources: Resources):
+        """
+        Segment subject with resources.cores threads.
+        """
+        import torch
+
+        from FastSurferCNN.run_prediction import segment_subject
+
+        torch.set_num_threads(resources.cores)
+        orig_img, data_array = self.model.conform_and_save_orig(subject)
+        segmentation = segment_subject(
+            self.model,
+            subject,
+            orig_img,
+            data_array,
+            brainmask_name=self.brainmask_name,
+            aseg_name=self.aseg_name,
+        )
+        for future in segmentation.futures:
+            future.result()
+        if not segmentation.qc_passed:
+            raise RuntimeError("FastSurfer asegdkt segmentation failed QC checks.")
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """
+    Create the argparse object.
+
+    Returns
+    -------
+    argparse.ArgumentParser
+        The parser object.
+    """
+    parser = argparse.ArgumentParser(
+        description="Run FastSurfer on many subjects, sharing the segmentation models "
+                    "and scheduling the stages against the cores and memory of the "
+                    "node. Unknown arguments are passed to run_fastsurfer.sh.",
+    )
+    parser = parser_defaults.add_arguments(
+        parser, ["t1", "in_dir", "tag", "csv_file", "remove_suffix", "sd", "lut"],
+    )
+    parser = parser_defaults.add_arguments(
+        parser,
+        ["asegdkt_segfile", "conformed_name", "brainmask_name", "aseg_name"],
+    )
+    files: dict[Plane, str | Path] = {k: "default" for k in PLANES}
+    from FastSurferCNN.run_prediction import CHECKPOINT_PATHS_FILE
+
+    parser = parser_defaults.add_plane_flags(
+        parser, "checkpoint", files, CHECKPOINT_PATHS_FILE
+    )
+    parser = parser_defaults.add_plane_flags(parser, "config", files, CHECKPOINT_PATHS_FILE)
+    parser = parser_defaults.add_arguments(
+        parser,
+        [
+            "vox_size",
+            "conform_to_1mm_threshold",
+            "device",
+            "viewagg_device",
+            "batch_size",
+            "engine",
+            "quantized",
+            "allow_root",
+        ],
+    )
+    batch = parser.add_argument_group("batch")
+    batch.add_argument(
+        "--cores",
+        type=int,
+        default=get_num_threads(),
+        help="Number of cores to use (default: all cores available to this process).",
+    )
+    batch.add_argument(
+        "--memory",
+        type=float,
+        default=None,
+        help="Memory to use in GB (default: the currently available memory).",
+    )
+    batch.add_argument(
+        "--seg_threads",
+        type=int,
+        default=4,
+        help="Cores of the segmentation stages (asegdkt and seg) of a subject "
+             "(default: 4).",
+    )
+    batch.add_argument(
+        "--seg_memory",
+        type=float,
+        default=8.,
+        help="Memory of the segmentation stages of a subject in GB (default: 8).",
+    )
+    batch.add_argument(
+        "--surf_threads",
+        type=int,
+        default=1,
+        help="Cores of the surface pipeline of a subject (default: 1).",
+    )
+    batch.add_argument(
+        "--surf_memory",
+        type=float,
+        default=3.,
+        help="Memory of the surface pipeline of a subject in GB (default: 3).",
+    )
+    batch.add_argument(
+        "--statusdb",
+        type=Path,
+        default=None,
+        help="SQLite file to store the status of the subjects in, an existing file "
+             "resumes the batch (default: <sd>/batch_status.sqlite).",
+    )
+    batch.add_argument(
+        "--retry_failed",
+        action="store_true",
+        help="Rerun stages that failed in a previous run of the batch.",
+    )
+    only = batch.add_mutually_exclusive_group()
+    only.add_argument(
+        "--seg_only",
+        action="store_true",
+        help="Run only the segmentation stages.",
+    )
+    only.add_argument(
+        "--surf_only",
+        action="store_true",
+        help="Run only the surface pipeline (requires a previous segmentation).",
+    )
+    batch.add_argument(
+        "--run_fastsurfer",
+        type=shlex.split,
+        default=[str(FASTSURFER_ROOT / "run_fastsurfer.sh")],
+        help="Command to run run_fastsurfer.sh with (default: run_fastsurfer.sh of "
+             "this FastSurfer).",
+    )
+    return parser
+
+
+def main(
+        *,
+        orig_name: str,
+        out_dir: Path,
+        pred_name: str,
+        conf_name: str,
+        brainmask_name: str,
+        aseg_name: str,
+        run_fastsurfer: list[str],
+        extra_args: Sequence[str] = (),
+        in_dir: Path | None = None,
+        search_tag: str | None = None,
+        csv_file: Path | None = None,
+        remove_suffix: str = "",
+        cores: int = 1,
+        memory: float | None = None,
+        seg_threads: int = 4,
+        seg_memory: float = 8.,
+        surf_threads: int = 1,
+        surf_memory: float = 3.,
+        statusdb: Path | None = None,
+        retry_failed: bool = False,
+        seg_only: bool = False,
+        surf_only: bool = False,
+        allow_root: bool = False,
+        **model_kwargs,
+) -> int | str:
+    allow_root or assert_no_root()
+    if out_dir is None:
+        return "The batch requires a subjects directory (--sd)."
+
+    config = SubjectDirectoryConfig(
+        orig_name=orig_name,
+        pred_name=pred_name,
+        conf_name=conf_name,
+        in_dir=in_dir,
+        csv_file=csv_file,
+        sid=None,
+        search_tag=search_tag,
+        brainmask_name=brainmask_name,
+        remove_suffix=remove_suffix,
+        out_dir=out_dir,
+    )
+    config.copy_orig_name = "mri/orig/001.mgz"
+    try:
+        subjects = SubjectList(config, segfile="pred_name", copy_orig_name="copy_orig_name")
+        subjects.make_subjects_dir()
+    except RuntimeError as e:
+        return e.args[0]
+
+    files = {
+        "--asegdkt_segfile": pred_name,
+        "--conformed_name": conf_name,
+        "--mask_name": brainmask_name,
+        "--aseg_segfile": aseg_name,
+    }
+    fastsurfer_args = list(extra_args) + (["--allow_root"] if allow_root else [])
+
+    runners = {}
+    if not surf_only:
+        from FastSurferCNN.run_prediction import CHECKPOINT_PATHS_FILE
+        from FastSurferCNN.utils.checkpoint import (
+            get_checkpoints,
+            load_checkpoint_config_defaults,
+        )
+
+        urls = load_checkpoint_config_defaults("url", filename=CHECKPOINT_PATHS_FILE)
+        get_checkpoints(*(model_kwargs[f"ckpt_{p}"] for p in ("ax", "cor", "sag")), urls=urls)
+        runners["asegdkt"] = AsegdktStage(
+            brainmask_name, aseg_name, threads=seg_threads, **model_kwargs,
+        )
+        runners["seg"] = FastSurferStage(
+            "seg", ["--seg_only", "--no_asegdkt"], run_fastsurfer, files, fastsurfer_args,
+        )
+    if not seg_only:
+        runners["surf"] = FastSurferStage(
+            "surf", ["--surf_only"], run_fastsurfer, files, fastsurfer_args,
+        )
+
+    statusdb = statusdb or Path(out_dir) / "batch_status.sqlite"
+    status = BatchStatus(statusdb)
+    scheduler = BatchScheduler(
+        [subjects[i] for i in range(len(subjects))],
+        status,
+        budget=Resources(cores, available_memory() if memory is None else memory),
+        requirements={
+            "asegdkt": Resources(seg_threads, seg_memory),
+            "seg": Resources(seg_threads, seg_memory),
+            "surf": Resources(surf_threads, surf_memory),
+        },
+        runners=runners,
+        # all subjects share the models of this process
+        max_jobs={"asegdkt": 1},
+        retry_failed=retry_failed,
+    )
+    try:
+        num_failed = scheduler.run()
+    except KeyboardInterrupt:
+        return "The batch was interrupted, run the same command again to resume."
+    finally:
+        summary = ", ".join(f"{st} {s}: {n}" for (st, s), n in status.summary().items())
+        LOGGER.info(f"Status: {summary}")
+        status.close()
+    if num_failed > 0:
+        return f"{num_failed} subject(s) failed, see {statusdb}."
+    return 0
+
+
+if __name__ == "__main__":
+    parser = make_parser()
+    _args, _extra_args = parser.parse_known_args()
+
+    from FastSurferCNN.utils.logging import setup_logging
+    setup_logging(None)
+
+    sys.exit(main(extra_args=_extra_args, **vars(_args)))
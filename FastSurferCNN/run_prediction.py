@@ -27,12 +27,11 @@ See Also
 
 # IMPORTS
 import argparse
-import copy
 import sys
 from collections.abc import Iterator, Sequence
 from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Literal
+from typing import Any, Literal, NamedTuple
 
 import nibabel as nib
 import numpy as np
@@ -42,7 +41,8 @@ import yacs.config
 import FastSurferCNN.reduce_to_aseg as rta
 from FastSurferCNN.data_loader import conform as conf
 from FastSurferCNN.data_loader import data_utils as du
-from FastSurferCNN.inference import Inference
+from FastSurferCNN.inference import Inference, MultiPlaneScheduler
+from FastSurferCNN.models.engine import Engine
 from FastSurferCNN.quick_qc import check_volume
 from FastSurferCNN.utils import PLANES, Plane, logging, parser_defaults
 from FastSurferCNN.utils.arg_types import VoxSizeOption
@@ -214,6 +214,10 @@ class RunModelOnData:
             vox_size: VoxSizeOption = "min",
             async_io: bool = False,
             conform_to_1mm_threshold: float = 0.95,
+            engine: Engine = "eager",
+            quantized: bool = False,
+            inference_workers: int = 1,
+            pin_cores: bool = False,
     ):
         """
         Construct RunModelOnData object.
@@ -222,6 +226,15 @@ class RunModelOnData:
         ----------
         viewagg_device : str, default="auto"
             Device to run viewagg on. Can be auto, cuda or cpu.
+        engine : "eager", "torchscript", "onnx", default="eager"
+            Inference engine for the networks (see FastSurferCNN.models.engine).
+        quantized : bool, default=False
+            Whether to use the int8 models of the quantized checkpoints (cpu only).
+        inference_workers : int, default=1
+            Number of batches (of all planes) to run concurrently, see
+            MultiPlaneScheduler.
+        pin_cores : bool, default=False
+            Pin the inference workers to disjoint sets of cores.
         """
         # TODO Fix docstring of RunModelOnData.__init__
         self._threads = threads
@@ -272,7 +285,12 @@ class RunModelOnData:
             if all(view[key] is not None for key in ("cfg", "ckpt")):
                 self.models[plane] = Inference(
                     view["cfg"], ckpt=view["ckpt"], device=self.device, lut=self.lut,
+                    engine=engine, quantized=quantized,
                 )
+        self.scheduler = MultiPlaneScheduler(
+            self.models, threads=torch.get_num_threads(), workers=inference_workers,
+            pin_cores=pin_cores,
+        )
 
         if vox_size == "min":
             self.vox_size = "min"
@@ -396,12 +414,10 @@ class RunModelOnData:
 
         pred_prob = torch.zeros(shape, **kwargs)
 
-        # inference and view aggregation
-        for plane, model in self.models.items():
-            LOGGER.info(f"Run {plane} prediction")
-            self.set_model(plane)
-            # pred_prob is updated inplace to conserve memory
-            pred_prob = model.run(pred_prob, image_name, orig_data, zoom, out=pred_prob)
+        # inference and view aggregation (all planes on one normalized volume)
+        LOGGER.info(f"Run {', '.join(self.models)} prediction")
+        # pred_prob is updated inplace to conserve memory
+        pred_prob = self.scheduler.run(pred_prob, image_name, orig_data, zoom)
 
         # Get hard predictions
         pred_classes = torch.argmax(pred_prob, 3)
@@ -536,6 +552,114 @@ class RunModelOnData:
             yield from pipeline(self.pool, self.conform_and_save_orig, subjects)
 
 
+class SubjectSegmentation(NamedTuple):
+    """
+    The segmentation of a subject (see segment_subject).
+    """
+
+    qc_passed: bool
+    futures: list[Future]
+    asegdkt: np.ndarray
+    brainmask: np.ndarray | None
+    aseg: np.ndarray | None
+
+
+def segment_subject(
+        model: RunModelOnData,
+        subject: SubjectDirectory,
+        orig_img: nib.analyze.SpatialImage,
+        data_array: np.ndarray,
+        brainmask_name: str = "mri/mask.mgz",
+        aseg_name: str = "mri/aseg.auto_noCCseg.mgz",
+        flags: dict[str, dict] = SubjectList.DEFAULT_FLAGS,
+) -> SubjectSegmentation:
+    """
+    Segment a (conformed) image and save the segmentation, brainmask and aseg.
+
+    Parameters
+    ----------
+    model : RunModelOnData
+        The models to segment with.
+    subject : SubjectDirectory
+        The subject (defines the output files).
+    orig_img : nib.analyze.SpatialImage
+        The conformed image.
+    data_array : np.ndarray
+        The data of the conformed image.
+    brainmask_name : str, default="mri/mask.mgz"
+        The filename of the brainmask (relative to the subject directory).
+    aseg_name : str, default="mri/aseg.auto_noCCseg.mgz"
+        The filename of the reduced aseg (relative to the subject directory).
+    flags : dict[str, dict], optional
+        The flags to populate messages with.
+
+    Returns
+    -------
+    SubjectSegmentation
+        Whether the segmentation passed the volume-based QC check, the futures of the
+        (asynchronously) saved images and the asegdkt segmentation, brainmask and aseg
+        (None, if not created).
+    """
+    # The orig_t1_file is only used to populate verbose messages here
+    pred_data = model.get_prediction(
+        subject.orig_name, data_array, orig_img.header.get_zooms()
+    )
+    futures = [
+        model.async_save_img(subject.segfile, pred_data, orig_img, dtype=np.int16)
+    ]
+
+    # Create aseg and brainmask
+
+    # There is a funny edge case in legacy FastSurfer 2.0, where the behavior is
+    # not well-defined, if orig_name is an absolute path, but out_dir is not
+    # set. Then, we would create a sub-folder in the folder of orig_name using
+    # the subject_id (passed by --sid or extracted from the orig_name) and use
+    # that as the subject folder.
+    bm, aseg = None, None
+    store_brainmask = subject.can_resolve_filename(brainmask_name)
+    store_aseg = subject.can_resolve_filename(aseg_name)
+    if store_brainmask or store_aseg:
+        LOGGER.info("Creating brainmask based on segmentation...")
+        bm = rta.create_mask(pred_data, 5, 4)
+    if store_brainmask:
+        # get mask
+        mask_name = subject.filename_in_subject_folder(brainmask_name)
+        futures.append(model.async_save_img(mask_name, bm, orig_img, dtype=np.uint8))
+    else:
+        LOGGER.info(
+            "Not saving the brainmask, because we could not figure out where "
+            "to store it. Please specify a subject id with {sid[flag]}, or an "
+            "absolute brainmask path with {brainmask_name[flag]}.".format(**flags)
+        )
+
+    if store_aseg:
+        # reduce aparc to aseg and mask regions (reduce_to_aseg works in-place, but
+        # pred_data is returned and saved asynchronously)
+        LOGGER.info("Creating aseg based on segmentation...")
+        aseg = rta.reduce_to_aseg(pred_data.copy())
+        aseg[bm == 0] = 0
+        aseg = rta.flip_wm_islands(aseg)
+        aseg_name = subject.filename_in_subject_folder(aseg_name)
+        # Change datatype to np.uint8, else mri_cc will fail!
+        futures.append(model.async_save_img(aseg_name, aseg, orig_img, dtype=np.uint8))
+    else:
+        LOGGER.info(
+            "Not saving the aseg file, because we could not figure out where "
+            "to store it. Please specify a subject id with {sid[flag]}, or an "
+            "absolute aseg path with {aseg_name[flag]}.".format(**flags)
+        )
+
+    # Run QC check
+    LOGGER.info("Running volume-based QC check on segmentation...")
+    seg_voxvol = np.prod(orig_img.header.get_zooms())
+    qc_passed = check_volume(pred_data, seg_voxvol)
+    if not qc_passed:
+        LOGGER.warning(
+            "Total segmentation volume is too small. Segmentation may be corrupted."
+        )
+    return SubjectSegmentation(qc_passed, futures, pred_data, bm, aseg)
+
+
 def make_parser():
     """
     Create the argparse object.
@@ -594,6 +718,10 @@ def make_parser():
             "batch_size",
             "async_io",
             "threads",
+            "engine",
+            "quantized",
+            "inference_workers",
+            "pin_cores",
             "allow_root",
         ],
     )
@@ -629,6 +757,10 @@ def main(
         async_io: bool = True,
         threads: int = -1,
         conform_to_1mm_threshold: float = 0.95,
+        engine: Engine = "eager",
+        quantized: bool = False,
+        inference_workers: int = 1,
+        pin_cores: bool = False,
         **kwargs,
 ) -> Literal[0] | str:
     # Warning if run as root user
@@ -694,6 +826,10 @@ def main(
             vox_size=vox_size,
             async_io=async_io,
             conform_to_1mm_threshold=conform_to_1mm_threshold,
+            engine=engine,
+            quantized=quantized,
+            inference_workers=inference_workers,
+            pin_cores=pin_cores,
         )
     except RuntimeError as e:
         return e.args[0]
@@ -705,72 +841,17 @@ def main(
     for subject, (orig_img, data_array) in iter_subjects:
         # Run model
         try:
-            # The orig_t1_file is only used to populate verbose messages here
-            pred_data = eval.get_prediction(
-                subject.orig_name, data_array, orig_img.header.get_zooms()
-            )
-            futures.append(
-                eval.async_save_img(
-                    subject.segfile, pred_data, orig_img, dtype=np.int16
-                )
+            segmentation = segment_subject(
+                eval,
+                subject,
+                orig_img,
+                data_array,
+                brainmask_name=brainmask_name,
+                aseg_name=aseg_name,
+                flags=subjects.flags,
             )
-
-            # Create aseg and brainmask
-
-            # There is a funny edge case in legacy FastSurfer 2.0, where the behavior is
-            # not well-defined, if orig_name is an absolute path, but out_dir is not
-            # set. Then, we would create a sub-folder in the folder of orig_name using
-            # the subject_id (passed by --sid or extracted from the orig_name) and use
-            # that as the subject folder.
-            bm = None
-            store_brainmask = subject.can_resolve_filename(brainmask_name)
-            store_aseg = subject.can_resolve_filename(aseg_name)
-            if store_brainmask or store_aseg:
-                LOGGER.info("Creating brainmask based on segmentation...")
-                bm = rta.create_mask(copy.deepcopy(pred_data), 5, 4)
-            if store_brainmask:
-                # get mask
-                mask_name = subject.filename_in_subject_folder(brainmask_name)
-                futures.append(
-                    eval.async_save_img(mask_name, bm, orig_img, dtype=np.uint8)
-                )
-            else:
-                LOGGER.info(
-                    "Not saving the brainmask, because we could not figure out where "
-                    "to store it. Please specify a subject id with {sid[flag]}, or an "
-                    "absolute brainmask path with {brainmask_name[flag]}.".format(
-                        **subjects.flags,
-                    )
-                )
-
-            if store_aseg:
-                # reduce aparc to aseg and mask regions
-                LOGGER.info("Creating aseg based on segmentation...")
-                aseg = rta.reduce_to_aseg(pred_data)
-                aseg[bm == 0] = 0
-                aseg = rta.flip_wm_islands(aseg)
-                aseg_name = subject.filename_in_subject_folder(aseg_name)
-                # Change datatype to np.uint8, else mri_cc will fail!
-                futures.append(
-                    eval.async_save_img(aseg_name, aseg, orig_img, dtype=np.uint8)
-                )
-            else:
-                LOGGER.info(
-                    "Not saving the aseg file, because we could not figure out where "
-                    "to store it. Please specify a subject id with {sid[flag]}, or an "
-                    "absolute aseg path with {aseg_name[flag]}.".format(
-                        **subjects.flags,
-                    )
-                )
-
-            # Run QC check
-            LOGGER.info("Running volume-based QC check on segmentation...")
-            seg_voxvol = np.prod(orig_img.header.get_zooms())
-            if not check_volume(pred_data, seg_voxvol):
-                LOGGER.warning(
-                    "Total segmentation volume is too small. Segmentation may be "
-                    "corrupted."
-                )
+            futures.extend(segmentation.futures)
+            if not segmentation.qc_passed:
                 if qc_file_handle is not None:
                     qc_file_handle.write(subject.id + "\n")
                     qc_file_handle.flush()
@@ -0,0 +1,683 @@
+# Copyright 2024 Image Analysis Lab, German Center for Neurodegenerative Diseases (DZNE), Bonn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Run the segmentation modules of FastSurfer (asegdkt, bias field correction, CerebNet
+and HypVINN) for one subject in one process.
+
+The conformed image, the asegdkt segmentation and the bias field corrected image are
+kept in memory and passed directly to the next module, while all outputs are written
+asynchronously. The output files are the same as those of FastSurferCNN/run_prediction.py,
+recon_surf/N4_bias_correct.py (with --aseg), CerebNet/run_prediction.py and
+HypVINN/run_prediction.py.
+
+Usage:
+`python3 FastSurferCNN/run_segmentation.py --t1 <T1w image> --sid <subject id> --sd <subjects dir>`
+"""
+
+# IMPORTS
+import argparse
+import sys
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Literal
+
+import nibabel as nib
+import numpy as np
+
+from CerebNet.run_prediction import DEFAULT_CEREBELLUM_STATSFILE
+from FastSurferCNN.data_loader import conform as conf
+from FastSurferCNN.models.engine import Engine
+from FastSurferCNN.run_prediction import (
+    CHECKPOINT_PATHS_FILE,
+    RunModelOnData,
+    segment_subject,
+)
+from FastSurferCNN.utils import PLANES, Plane, logging, parser_defaults
+from FastSurferCNN.utils.arg_types import VoxSizeOption
+from FastSurferCNN.utils.checkpoint import (
+    get_checkpoints,
+    load_checkpoint_config_defaults,
+)
+from FastSurferCNN.utils.common import (
+    SubjectDirectory,
+    SubjectList,
+    assert_no_root,
+    handle_cuda_memory_exception,
+)
+from FastSurferCNN.utils.parser_defaults import FASTSURFER_ROOT, SubjectDirectoryConfig
+from HypVINN.config.hypvinn_files import HYPVINN_MASK_NAME, HYPVINN_SEG_NAME
+
+LOGGER = logging.getLogger(__name__)
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """
+    Create the argparse object.
+
+    Returns
+    -------
+    argparse.ArgumentParser
+        The parser object.
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the asegdkt segmentation, the bias field correction, CerebNet "
+                    "and HypVINN for one subject, passing images in memory."
+    )
+
+    # 1. Options for input and output files
+    parser = parser_defaults.add_arguments(parser, ["t1", "sid", "sd", "lut"])
+    parser = parser_defaults.add_arguments(
+        parser,
+        [
+            "asegdkt_segfile",
+            "conformed_name",
+            "brainmask_name",
+            "aseg_name",
+            "seg_log",
+        ],
+    )
+    parser_defaults.ALL_FLAGS["norm_name"](
+        parser,
+        default="mri/orig_nu.mgz",
+        help="Name under which the bias field corrected image is stored (as in "
+             "run_fastsurfer.sh). Default: mri/orig_nu.mgz.",
+    )
+    parser.add_argument(
+        "--cereb_segfile",
+        dest="cereb_segfile",
+        default=Path("mri/cerebellum.CerebNet.nii.gz"),
+        type=Path,
+        help="Name under which the cerebellum segmentation will be saved. "
+             "Default: mri/cerebellum.CerebNet.nii.gz.",
+    )
+    parser.add_argument(
+        "--cereb_statsfile",
+        dest="cereb_statsfile",
+        default=DEFAULT_CEREBELLUM_STATSFILE,
+        type=Path,
+        help=f"Name under which the statsfile for the cerebellum will be saved. "
+             f"Default: {DEFAULT_CEREBELLUM_STATSFILE}.",
+    )
+    parser.add_argument(
+        "--hypo_segfile",
+        dest="hypo_segfile",
+        default=HYPVINN_SEG_NAME,
+        help=f"Name under which the hypothalamus segmentation will be saved (relative "
+             f"to <sd>/<sid>/mri). Default: {HYPVINN_SEG_NAME}.",
+    )
+    parser.add_argument(
+        "--t2",
+        dest="t2",
+        type=Path,
+        default=None,
+        help="The (bias field corrected) T2 image for HypVINN, see the t2 handling of "
+             "run_fastsurfer.sh. Default: None, run HypVINN on the T1 image only.",
+    )
+    parser.add_argument(
+        "--reg_mode",
+        dest="reg_mode",
+        default="coreg",
+        choices=["none", "coreg", "robust"],
+        help="Registration of the T2 to the T1 image (see HypVINN). Default: coreg.",
+    )
+
+    # 2. Modules to run
+    modules = parser.add_argument_group(title="Modules")
+    modules.add_argument(
+        "--no_biasfield",
+        dest="biasfield",
+        action="store_false",
+        help="Skip the bias field correction (and the cerebellum stats file), HypVINN "
+             "segments the T1 image.",
+    )
+    modules.add_argument(
+        "--no_cereb",
+        dest="cereb",
+        action="store_false",
+        help="Skip the cerebellum segmentation with CerebNet.",
+    )
+    modules.add_argument(
+        "--no_hypothal",
+        dest="hypothal",
+        action="store_false",
+        help="Skip the hypothalamus segmentation with HypVINN.",
+    )
+
+    # 3. Checkpoints and configs of the asegdkt networks
+    files: dict[Plane, str | Path] = {k: "default" for k in PLANES}
+    parser = parser_defaults.add_plane_flags(
+        parser, "checkpoint", files, CHECKPOINT_PATHS_FILE
+    )
+    parser = parser_defaults.add_plane_flags(parser, "config", files, CHECKPOINT_PATHS_FILE)
+
+    # 4. technical parameters
+    parser = parser_defaults.add_arguments(
+        parser,
+        [
+            "vox_size",
+            "conform_to_1mm_threshold",
+            "device",
+            "viewagg_device",
+            "batch_size",
+            "threads",
+            "engine",
+            "quantized",
+            "allow_root",
+        ],
+    )
+    return parser
+
+
+def default_files(
+        configtype: Literal["checkpoint", "config"],
+        filename: Path,
+) -> dict[Plane, Path]:
+    """
+    Get the default checkpoints or configs of a module (absolute paths).
+
+    Parameters
+    ----------
+    configtype : "checkpoint", "config"
+        Type of file.
+    filename : Path
+        The checkpoint_paths.yaml file of the module.
+
+    Returns
+    -------
+    dict[Plane, Path]
+        The path for each plane.
+    """
+    defaults = load_checkpoint_config_defaults(configtype, filename)
+    return {plane: FASTSURFER_ROOT / path for plane, path in defaults.items()}
+
+
+def bias_field_correct(
+        conf_img: nib.MGHImage,
+        aseg: np.ndarray,
+        threads: int = 1,
+) -> nib.MGHImage:
+    """
+    Bias field correct the conformed image and normalize its white matter to 105 (as
+    recon_surf/N4_bias_correct.py with --rescale and --aseg).
+
+    Parameters
+    ----------
+    conf_img : nib.MGHImage
+        The conformed image.
+    aseg : np.ndarray
+        The reduced aseg segmentation (to find the white matter, as run_fastsurfer.sh
+        passes the aseg_segfile to N4_bias_correct.py).
+    threads : int, default=1
+        The number of threads.
+
+    Returns
+    -------
+    nib.MGHImage
+        The bias field corrected uchar image.
+    """
+    import SimpleITK as sitk
+
+    # recon_surf is not a package
+    recon_surf = str(FASTSURFER_ROOT / "recon_surf")
+    if recon_surf not in sys.path:
+        sys.path.append(recon_surf)
+    import image_io as iio
+    import N4_bias_correct as n4
+
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+    itk_image = sitk.Cast(iio.sitk_from_mgh(conf_img), sitk.sitkFloat32)
+    aseg_header = conf_img.header.copy()
+    aseg_header.set_data_dtype(np.int16)
+    aseg_img = nib.MGHImage(aseg.astype(np.int16), conf_img.affine, aseg_header)
+    itk_bfcorr_image = n4.n4_bias_correct(itk_image, threads=threads)
+    itk_norm = n4.normalize_wm(itk_bfcorr_image, itk_aseg=iio.sitk_from_mgh(aseg_img))
+    return iio.mgh_from_sitk(itk_norm, conf_img.header)
+
+
+def segment_cerebellum(
+        subject: SubjectDirectory,
+        conf_img: nib.MGHImage,
+        asegdkt: np.ndarray,
+        norm_img: nib.MGHImage | None,
+        wait_for: list[Future],
+        batch_size: int = 1,
+        threads: int = 1,
+        device: str = "auto",
+        viewagg_device: str = "auto",
+        quantized: bool = False,
+) -> list[Future]:
+    """
+    Segment the cerebellum with CerebNet (see CerebNet/run_prediction.py).
+
+    Parameters
+    ----------
+    subject : SubjectDirectory
+        The subject (with the CerebNet attributes, segfile is the cerebellum
+        segmentation).
+    conf_img : nib.MGHImage
+        The conformed image.
+    asegdkt : np.ndarray
+        The asegdkt segmentation.
+    norm_img : nib.MGHImage, optional
+        The bias field corrected image (required for the stats file).
+    wait_for : list[Future]
+        The futures of the files CerebNet reads, if the images are not conformed to
+        1mm (CerebNet conforms and reads them from file then).
+    batch_size : int, default=1
+        The batch size.
+    threads : int, default=1
+        The number of threads.
+    device : str, default="auto"
+        The device to run CerebNet on.
+    viewagg_device : str, default="auto"
+        The device to aggregate the views on.
+    quantized : bool, default=False
+        Whether to use the int8 models of the quantized checkpoints (cpu only).
+
+    Returns
+    -------
+    list[Future]
+        The futures of the saved files.
+    """
+    from CerebNet.inference import Inference
+    from CerebNet.utils.checkpoint import YAML_DEFAULT as CEREBNET_CHECKPOINTS_FILE
+    from CerebNet.utils.load_config import get_config
+
+    ckpts = default_files("checkpoint", CEREBNET_CHECKPOINTS_FILE)
+    urls = load_checkpoint_config_defaults("url", filename=CEREBNET_CHECKPOINTS_FILE)
+    get_checkpoints(ckpts["axial"], ckpts["coronal"], ckpts["sagittal"], urls=urls)
+    args = argparse.Namespace(
+        opts=None,
+        batch_size=batch_size,
+        ckpt_ax=ckpts["axial"],
+        ckpt_cor=ckpts["coronal"],
+        ckpt_sag=ckpts["sagittal"],
+    )
+    cfg = get_config(args)
+    cfg.TEST.ENABLE = True
+    cfg.TRAIN.ENABLE = False
+    model = Inference(
+        cfg,
+        threads=threads,
+        async_io=True,
+        device=device,
+        viewagg_device=viewagg_device,
+        quantized=quantized,
+    )
+
+    if conf.is_conform(conf_img, conform_vox_size=1.0, verbose=False):
+        seg_img = nib.MGHImage(asegdkt, conf_img.affine, conf_img.header)
+        subject_dataset = model.make_subject_dataset(conf_img, seg_img)
+        norm, norm_file = None, None
+        if norm_img is not None:
+            norm = np.asarray(norm_img.dataobj)
+            norm_file = subject.filename_by_attribute("norm_name")
+    else:
+        LOGGER.info("CerebNet requires 1mm images, conforming the written images...")
+        for future in wait_for:
+            future.result()
+        norm, norm_file, subject_dataset = model._get_subject_dataset(subject)
+    return model.run_subject(subject, subject_dataset, norm, norm_file)
+
+
+def segment_hypothalamus(
+        pool: Executor,
+        subject_dir: Path,
+        t1: nib.analyze.SpatialImage | Path,
+        t1_file: Path,
+        t1_future: Future | None = None,
+        t2: Path | None = None,
+        hypo_segfile: str = HYPVINN_SEG_NAME,
+        reg_mode: Literal["coreg", "robust", "none"] = "coreg",
+        batch_size: int = 1,
+        threads: int = 1,
+        device: str = "auto",
+        viewagg_device: str = "auto",
+        quantized: bool = False,
+) -> list[Future]:
+    """
+    Segment the hypothalamus with HypVINN (see HypVINN/run_prediction.py).
+
+    Parameters
+    ----------
+    pool : Executor
+        The executor to save the segmentation and compute the stats with.
+    subject_dir : Path
+        The subject directory.
+    t1 : nib.analyze.SpatialImage, Path
+        The T1 image (usually the bias field corrected image).
+    t1_file : Path
+        The file of the T1 image (for the registration of the T2 and the stats).
+    t1_future : Future, optional
+        The future of writing t1_file.
+    t2 : Path, optional
+        The T2 image.
+    hypo_segfile : str, default="{HYPVINN_SEG_NAME}"
+        The filename of the hypothalamus segmentation (relative to subject_dir/mri).
+    reg_mode : "coreg", "robust", "none", default="coreg"
+        The registration mode of the T2 to the T1.
+    batch_size : int, default=1
+        The batch size.
+    threads : int, default=1
+        The number of threads.
+    device : str, default="auto"
+        The device to run HypVINN on.
+    viewagg_device : str, default="auto"
+        The device to aggregate the views on.
+    quantized : bool, default=False
+        Whether to use the int8 models of the quantized checkpoints (cpu only).
+
+    Returns
+    -------
+    list[Future]
+        The futures of saving the segmentation and computing the stats.
+    """
+    from HypVINN.inference import Inference
+    from HypVINN.run_prediction import (
+        get_prediction,
+        load_volumes,
+        prepare_checkpoints,
+        set_up_cfgs,
+    )
+    from HypVINN.utils.checkpoint import YAML_DEFAULT as HYPVINN_CHECKPOINTS_FILE
+    from HypVINN.utils.img_processing_utils import save_segmentation
+    from HypVINN.utils.misc import create_expand_output_directory
+    from HypVINN.utils.preproc import hypvinn_preproc
+    from HypVINN.utils.stats_utils import compute_stats
+
+    mode = "t1" if t2 is None else "t1t2"
+    create_expand_output_directory(subject_dir)
+    ckpts = default_files("checkpoint", HYPVINN_CHECKPOINTS_FILE)
+    cfgs = default_files("config", HYPVINN_CHECKPOINTS_FILE)
+    prepare_checkpoints(ckpts["axial"], ckpts["coronal"], ckpts["sagittal"])
+    view_ops = {
+        plane: {"cfg": set_up_cfgs(cfgs[plane], subject_dir, batch_size), "ckpt": ckpts[plane]}
+        for plane in PLANES
+    }
+    for plane, view_op in view_ops.items():
+        model = view_op["cfg"].MODEL
+        if mode != model.MODE and "HypVinn" not in model.MODEL_NAME:
+            raise RuntimeError(
+                f"Modality mode different between input arg: {mode} and {plane} train "
+                f"cfg: {model.MODE}"
+            )
+
+    if mode == "t1t2":
+        # the registration reads the t1 from file
+        if t1_future is not None:
+            t1_future.result()
+        t2 = hypvinn_preproc(mode, reg_mode, t1_file, t2, subject_dir, threads=threads)
+
+    model = Inference(
+        cfg=view_ops["coronal"]["cfg"],
+        async_io=True,
+        threads=threads,
+        viewagg_device=viewagg_device,
+        device=device,
+        quantized=quantized,
+    )
+    image_data, affine, header, orig_zoom, orig_size = load_volumes(mode, t1, t2)
+    pred_classes = get_prediction(
+        subject_dir.name,
+        image_data,
+        orig_zoom,
+        model,
+        target_shape=orig_size,
+        view_opts=view_ops,
+        out_scale=None,
+        mode=mode,
+    )
+
+    def _save_and_compute_stats():
+        save_segmentation(
+            pred_classes,
+            orig_path=t1,
+            ras_affine=affine,
+            ras_header=header,
+            subject_dir=subject_dir,
+            seg_file=hypo_segfile,
+            mask_file=HYPVINN_MASK_NAME,
+            save_mask=True,
+        )
+        # the stats are computed from the t1 file
+        if t1_future is not None:
+            t1_future.result()
+        return_value = compute_stats(
+            orig_path=t1_file,
+            prediction_path=subject_dir / "mri" / hypo_segfile,
+            stats_dir=subject_dir / "stats",
+            threads=threads,
+        )
+        if return_value != 0:
+            raise RuntimeError(return_value)
+
+    return [pool.submit(_save_and_compute_stats)]
+
+
+def main(
+        *,
+        orig_name: Path | str,
+        out_dir: Path,
+        sid: str | None,
+        pred_name: str,
+        ckpt_ax: Path,
+        ckpt_sag: Path,
+        ckpt_cor: Path,
+        cfg_ax: Path,
+        cfg_sag: Path,
+        cfg_cor: Path,
+        lut: Path | str | None = None,
+        log_name: str = "",
+        conf_name: str = "mri/orig.mgz",
+        brainmask_name: str = "mri/mask.mgz",
+        aseg_name: str = "mri/aseg.auto_noCCseg.mgz",
+        norm_name: str = "mri/orig_nu.mgz",
+        cereb_segfile: Path = Path("mri/cerebellum.CerebNet.nii.gz"),
+        cereb_statsfile: Path = DEFAULT_CEREBELLUM_STATSFILE,
+        hypo_segfile: str = HYPVINN_SEG_NAME,
+        t2: Path | None = None,
+        reg_mode: Literal["coreg", "robust", "none"] = "coreg",
+        biasfield: bool = True,
+        cereb: bool = True,
+        hypothal: bool = True,
+        vox_size: VoxSizeOption = "min",
+        conform_to_1mm_threshold: float = 0.95,
+        device: str = "auto",
+        viewagg_device: str = "auto",
+        batch_size: int = 1,
+        threads: int = 1,
+        engine: Engine = "eager",
+        quantized: bool = False,
+        allow_root: bool = False,
+        **kwargs,
+) -> int | str:
+    # Warning if run as root user
+    allow_root or assert_no_root()
+
+    if len(kwargs) > 0:
+        LOGGER.warning(f"Unknown arguments {list(kwargs.keys())} in {__file__}:main.")
+
+    LOGGER.info("Checking or downloading default checkpoints ...")
+    urls = load_checkpoint_config_defaults("url", filename=CHECKPOINT_PATHS_FILE)
+    get_checkpoints(ckpt_ax, ckpt_cor, ckpt_sag, urls=urls)
+
+    config = SubjectDirectoryConfig(
+        orig_name=orig_name,
+        pred_name=pred_name,
+        conf_name=conf_name,
+        sid=sid,
+        brainmask_name=brainmask_name,
+        out_dir=out_dir,
+    )
+    config.copy_orig_name = "mri/orig/001.mgz"
+    config.norm_name = norm_name
+    config.cereb_segfile = cereb_segfile
+    config.cereb_statsfile = cereb_statsfile if biasfield else None
+
+    try:
+        subjects = SubjectList(
+            config, segfile="pred_name", copy_orig_name="copy_orig_name",
+        )
+        if len(subjects) != 1:
+            return "run_segmentation.py segments exactly one subject, pass --t1 and --sid."
+        subjects.make_subjects_dir()
+        subject = subjects[0]
+        # the same subject with the files of CerebNet
+        cereb_kwargs = {"cereb_statsfile": "cereb_statsfile"} if biasfield else {}
+        cereb_subject = SubjectList(
+            config,
+            asegdkt_segfile="pred_name",
+            segfile="cereb_segfile",
+            norm_name="norm_name",
+            **cereb_kwargs,
+        )[0]
+
+        model = RunModelOnData(
+            lut=lut,
+            ckpt_ax=ckpt_ax,
+            ckpt_sag=ckpt_sag,
+            ckpt_cor=ckpt_cor,
+            cfg_ax=cfg_ax,
+            cfg_sag=cfg_sag,
+            cfg_cor=cfg_cor,
+            device=device,
+            viewagg_device=viewagg_device,
+            threads=threads,
+            batch_size=batch_size,
+            vox_size=vox_size,
+            async_io=True,
+            conform_to_1mm_threshold=conform_to_1mm_threshold,
+            engine=engine,
+            quantized=quantized,
+        )
+    except RuntimeError as e:
+        return e.args[0]
+
+    # the outputs are written by this pool (and the pools of the models)
+    pool = ThreadPoolExecutor(threads if threads > 0 else None)
+    futures: list[Future] = []
+    try:
+        # 1. asegdkt segmentation
+        start = time.time()
+        orig_img, data_array = model.conform_and_save_orig(subject)
+        segmentation = segment_subject(
+            model,
+            subject,
+            orig_img,
+            data_array,
+            brainmask_name=brainmask_name,
+            aseg_name=aseg_name,
+            flags=subjects.flags,
+        )
+        futures.extend(segmentation.futures)
+        if not segmentation.qc_passed:
+            LOGGER.error("FastSurfer asegdkt segmentation failed QC checks.")
+            for future in futures:
+                future.result()
+            return 2
+        LOGGER.info(f"Segmentation finished in {time.time() - start:0.4f} seconds.")
+
+        # the conformed image as it is saved in conf_name
+        conf_header = orig_img.header.copy()
+        conf_header.set_data_dtype(np.uint8)
+        conf_img = nib.MGHImage(data_array.astype(np.uint8), orig_img.affine, conf_header)
+        asegdkt = segmentation.asegdkt.astype(np.int16)
+
+        # 2. bias field correction
+        norm_img, norm_future = None, None
+        norm_file = subject.filename_in_subject_folder(norm_name)
+        if biasfield:
+            start = time.time()
+            LOGGER.info("Running N4 bias-field correction...")
+            norm_img = bias_field_correct(conf_img, segmentation.aseg, threads=max(threads, 1))
+            norm_future = pool.submit(nib.save, norm_img, norm_file)
+            futures.append(norm_future)
+            LOGGER.info(
+                f"Bias field correction finished in {time.time() - start:0.4f} seconds."
+            )
+
+        # 3. cerebellum segmentation
+        if cereb:
+            start = time.time()
+            LOGGER.info("Running CerebNet...")
+            futures.extend(
+                segment_cerebellum(
+                    cereb_subject,
+                    conf_img,
+                    asegdkt,
+                    norm_img,
+                    wait_for=futures.copy(),
+                    batch_size=batch_size,
+                    threads=threads,
+                    device=device,
+                    viewagg_device=viewagg_device,
+                    quantized=quantized,
+                )
+            )
+            LOGGER.info(f"CerebNet finished in {time.time() - start:0.4f} seconds.")
+
+        # 4. hypothalamus segmentation
+        if hypothal:
+            start = time.time()
+            LOGGER.info("Running HypVINN...")
+            if biasfield:
+                hypvinn_t1, hypvinn_t1_file = norm_img, norm_file
+            else:
+                LOGGER.warning(
+                    "HypVINN segments the T1 image without bias field correction, "
+                    "this may reduce the quality of the segmentation."
+                )
+                hypvinn_t1 = hypvinn_t1_file = Path(subject.orig_name)
+            futures.extend(
+                segment_hypothalamus(
+                    pool,
+                    subject.subject_dir / subject.id,
+                    hypvinn_t1,
+                    hypvinn_t1_file,
+                    t1_future=norm_future,
+                    t2=t2,
+                    hypo_segfile=hypo_segfile,
+                    reg_mode=reg_mode,
+                    batch_size=batch_size,
+                    threads=threads,
+                    device=device,
+                    viewagg_device=viewagg_device,
+                    quantized=quantized,
+                )
+            )
+            LOGGER.info(f"HypVINN finished in {time.time() - start:0.4f} seconds.")
+
+        # wait for async processes to finish
+        for future in futures:
+            future.result()
+    except RuntimeError as e:
+        if not handle_cuda_memory_exception(e):
+            LOGGER.exception(e)
+        return e.args[0]
+    finally:
+        pool.shutdown(wait=True)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = make_parser()
+    _args = parser.parse_args()
+
+    # Set up logging
+    from FastSurferCNN.utils.logging import setup_logging
+    setup_logging(_args.log_name)
+
+    sys.exit(main(**vars(_args)))
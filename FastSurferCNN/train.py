@@ -18,25 +18,42 @@ import os
 import pprint
 import time
 from collections import defaultdict
+from contextlib import nullcontext
 
 import numpy as np
 import torch
 import torch.optim.lr_scheduler as scheduler
 import yacs.config
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
 from FastSurferCNN.config.global_var import get_class_names
 from FastSurferCNN.data_loader import loader
+from FastSurferCNN.data_loader.augmentation import BatchAugmentation
 from FastSurferCNN.models.losses import get_loss_func
 from FastSurferCNN.models.networks import build_model
 from FastSurferCNN.models.optimizer import get_optimizer
 from FastSurferCNN.utils import checkpoint as cp
 from FastSurferCNN.utils import logging
+from FastSurferCNN.utils.distributed import (
+    all_reduce_stats,
+    cleanup_distributed,
+    get_rank,
+    init_distributed,
+    is_main_process,
+)
 from FastSurferCNN.utils.lr_scheduler import get_lr_scheduler
 from FastSurferCNN.utils.meters import Meter
-from FastSurferCNN.utils.metrics import iou_score, precision_recall
-from FastSurferCNN.utils.misc import plot_predictions, update_num_steps
+from FastSurferCNN.utils.metrics import (
+    VolumeConfusion,
+    confusion_matrix,
+    dice_score,
+    iou_from_confusion,
+    precision_recall_from_confusion,
+)
+from FastSurferCNN.utils.misc import AsyncPlotter, update_num_steps
 
 logger = logging.getLogger(__name__)
 
@@ -66,17 +83,30 @@ class Trainer:
         cfg : yacs.config.CfgNode
             Node of configs to be used.
         """
-        # Set random seed from configs.
-        np.random.seed(cfg.RNG_SEED)
-        torch.manual_seed(cfg.RNG_SEED)
         self.cfg = cfg
+        # one process per device in distributed data-parallel training
+        self.distributed = cfg.DISTRIBUTED.ENABLED
+        if self.distributed:
+            self.device = init_distributed(cfg)
+        else:
+            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.is_main = is_main_process()
+
+        # Set random seed from configs (different augmentations per process, the model
+        # weights are broadcast from the main process by DistributedDataParallel).
+        np.random.seed(cfg.RNG_SEED + get_rank())
+        torch.manual_seed(cfg.RNG_SEED + get_rank())
 
         # Create the checkpoint dir.
         self.checkpoint_dir = cp.create_checkpoint_dir(cfg.LOG_DIR, cfg.EXPR_NUM)
-        logging.setup_logging(os.path.join(cfg.LOG_DIR, "logs", cfg.EXPR_NUM + ".log"))
+        if self.is_main:
+            logging.setup_logging(
+                os.path.join(cfg.LOG_DIR, "logs", cfg.EXPR_NUM + ".log")
+            )
+        else:
+            logging.setup_logging(None)
         logger.info("Training with config:")
         logger.info(pprint.pformat(cfg))
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.model = build_model(cfg)
         self.loss_func = get_loss_func(cfg)
 
@@ -88,9 +118,56 @@ class Trainer:
         self.num_classes = cfg.MODEL.NUM_CLASSES
         self.plot_dir = os.path.join(cfg.LOG_DIR, "pred", str(cfg.EXPR_NUM))
         os.makedirs(self.plot_dir, exist_ok=True)
+        # plots are written in a background thread
+        self.plotter = AsyncPlotter()
+        # validate with the dice of whole volumes (reassembled per subject)
+        self.volume_metrics = cfg.TRAIN.VOLUME_METRICS
 
         self.subepoch = False if self.cfg.TRAIN.BATCH_SIZE == 16 else True
 
+        # augmentations applied to whole batches on the device (see BatchAugmentation)
+        if "Batched" in cfg.DATA.AUG:
+            self.batch_aug = BatchAugmentation(cfg.DATA.AUG)
+        else:
+            self.batch_aug = None
+
+        # mixed precision (the losses are always computed in float32)
+        self.amp = cfg.TRAIN.AMP
+        amp_dtype = getattr(torch, cfg.TRAIN.AMP_DTYPE)
+        self.scaler = torch.amp.GradScaler(
+            self.device.type,
+            enabled=self.amp and amp_dtype == torch.float16 and self.device.type == "cuda",
+        )
+        self.amp_dtype = amp_dtype
+        self.memory_format = (
+            torch.channels_last if cfg.TRAIN.CHANNELS_LAST else torch.contiguous_format
+        )
+
+    def _forward(self, images: torch.Tensor, scale_factors: torch.Tensor) -> torch.Tensor:
+        """
+        Run the model (in mixed precision, if enabled) and return float32 logits.
+
+        Parameters
+        ----------
+        images : torch.Tensor
+            Batch of images.
+        scale_factors : torch.Tensor
+            Scale factors of the images.
+
+        Returns
+        -------
+        torch.Tensor
+            Prediction of the model (float32).
+        """
+        images = images.contiguous(memory_format=self.memory_format)
+        if self.amp:
+            autocast = torch.autocast(self.device.type, dtype=self.amp_dtype)
+        else:
+            autocast = nullcontext()
+        with autocast:
+            pred = self.model(images, scale_factors)
+        return pred.float()
+
     def train(
         self,
         train_loader: loader.DataLoader,
@@ -119,20 +196,29 @@ class Trainer:
         self.model.train()
         logger.info("Training started ")
         epoch_start = time.time()
-        loss_batch = np.zeros(1)
-
-        for curr_iter, batch in tqdm(enumerate(train_loader), total=len(train_loader)):
+        for sampler in (train_loader.sampler, train_loader.batch_sampler):
+            if isinstance(sampler, DistributedSampler | loader.BucketBatchSampler):
+                # reshuffle the slices (and their distribution to the processes)
+                sampler.set_epoch(epoch)
+
+        for curr_iter, batch in tqdm(
+            enumerate(train_loader), total=len(train_loader), disable=not self.is_main
+        ):
             images, labels, weights, scale_factors = (
                 batch["image"].to(self.device),
                 batch["label"].to(self.device),
                 batch["weight"].float().to(self.device),
                 batch["scale_factor"],
             )
+            if self.batch_aug is not None:
+                images, labels, weights, scale_factors = self.batch_aug(
+                    images, labels, weights, scale_factors
+                )
 
             if not self.subepoch or (curr_iter) % (16 / self.cfg.TRAIN.BATCH_SIZE) == 0:
                 optimizer.zero_grad()  # every second epoch to get batchsize of 16 if using 8
 
-            pred = self.model(images, scale_factors)
+            pred = self._forward(images, scale_factors)
             loss_total, loss_dice, loss_ce = self.loss_func(pred, labels, weights)
 
             train_meter.update_stats(pred, labels, loss_total)
@@ -146,19 +232,20 @@ class Trainer:
                     loss_total, [self.cfg.OPTIMIZER.BASE_LR], loss_ce, loss_dice
                 )
 
-            loss_total.backward()
+            # the scaler is a no-op without float16 mixed precision
+            self.scaler.scale(loss_total).backward()
             if (
                 not self.subepoch
                 or (curr_iter + 1) % (16 / self.cfg.TRAIN.BATCH_SIZE) == 0
             ):
-                optimizer.step()  # every second epoch to get batchsize of 16 if using 8
+                # every second epoch to get batchsize of 16 if using 8
+                self.scaler.step(optimizer)
+                self.scaler.update()
                 if scheduler is not None:
                     scheduler.step(epoch + curr_iter / len(train_loader))
 
-            loss_batch += loss_total.item()
-
             # Plot sample predictions
-            if curr_iter == len(train_loader) - 2:
+            if curr_iter == len(train_loader) - 2 and self.is_main:
                 plt_title = "Training Results Epoch " + str(epoch)
 
                 file_save_name = os.path.join(
@@ -166,7 +253,7 @@ class Trainer:
                 )
 
                 _, batch_output = torch.max(pred, dim=1)
-                plot_predictions(
+                self.plotter.plot_predictions(
                     images, labels, batch_output, plt_title, file_save_name
                 )
 
@@ -194,14 +281,21 @@ class Trainer:
         Returns
         -------
         int, float, ndarray
-            median miou [value].
+            median miou [value] (or the mean volume dice, if TRAIN.VOLUME_METRICS).
         """
         logger.info(f"Evaluating model at epoch {epoch}")
         self.model.eval()
 
+        subject_names = self._val_subject_names(val_loader) if self.volume_metrics else None
+        volume_confusion = None
+        if subject_names is not None:
+            volume_confusion = VolumeConfusion(self.num_classes)
+            volume_confusion.start()
+
         val_loss_total = defaultdict(float)
         val_loss_dice = defaultdict(float)
         val_loss_ce = defaultdict(float)
+        num_batches = defaultdict(int)
 
         ints_ = defaultdict(lambda: np.zeros(self.num_classes - 1))
         unis_ = defaultdict(lambda: np.zeros(self.num_classes - 1))
@@ -213,7 +307,9 @@ class Trainer:
         )  # -1 to exclude background (still included in val loss)
 
         val_start = time.time()
-        for curr_iter, batch in tqdm(enumerate(val_loader), total=len(val_loader)):
+        for curr_iter, batch in tqdm(
+            enumerate(val_loader), total=len(val_loader), disable=not self.is_main
+        ):
             images, labels, weights, scale_factors = (
                 batch["image"].to(self.device),
                 batch["label"].to(self.device),
@@ -221,32 +317,48 @@ class Trainer:
                 batch["scale_factor"],
             )
 
-            pred = self.model(images, scale_factors)
-            loss_total, loss_dice, loss_ce = self.loss_func(pred, labels, weights)
+            # Group the slices by scale factor (a single group with bucketed batches),
+            # before the model adapts scale_factors to the interpolated sizes
+            sfs, groups = np.unique(
+                torch.as_tensor(scale_factors).cpu().numpy(), axis=0, return_inverse=True
+            )
+            groups = groups.reshape(-1)
 
-            sf = torch.unique(scale_factors)
-            if len(sf) == 1:
-                sf = sf.item()
-                val_loss_total[sf] += loss_total.item()
-                val_loss_dice[sf] += loss_dice.item()
-                val_loss_ce[sf] += loss_ce.item()
+            pred = self._forward(images, scale_factors)
+            loss_total, loss_dice, loss_ce = self.loss_func(pred, labels, weights)
 
-                _, batch_output = torch.max(pred, dim=1)
+            _, batch_output = torch.max(pred, dim=1)
+            if volume_confusion is not None:
+                volume_confusion.submit(batch_output, labels, batch["subject"])
+
+            for i, sf in enumerate(sfs):
+                # isotropic scale factors are keyed by a single value
+                sf = float(sf[0]) if np.all(sf == sf[0]) else tuple(sf.tolist())
+                if len(sfs) == 1:
+                    group_losses = loss_total, loss_dice, loss_ce
+                    group_output, group_labels = batch_output, labels
+                else:
+                    mask = torch.from_numpy(groups == i).to(self.device)
+                    group_losses = self.loss_func(pred[mask], labels[mask], weights[mask])
+                    group_output, group_labels = batch_output[mask], labels[mask]
+                val_loss_total[sf] += group_losses[0].item()
+                val_loss_dice[sf] += group_losses[1].item()
+                val_loss_ce[sf] += group_losses[2].item()
+                num_batches[sf] += 1
 
                 # Calculate iou_scores, accuracy and dice confusion matrix + sum over previous batches
-                int_, uni_ = iou_score(batch_output, labels, self.num_classes)
+                cm = confusion_matrix(group_output, group_labels, self.num_classes)
+                int_, uni_ = iou_from_confusion(cm)
                 ints_[sf] += int_
                 unis_[sf] += uni_
 
-                tpos, pcc_gt, pcc_pred = precision_recall(
-                    batch_output, labels, self.num_classes
-                )
+                tpos, pcc_gt, pcc_pred = precision_recall_from_confusion(cm)
                 accs[sf] += tpos
                 per_cls_counts_gt[sf] += pcc_gt
                 per_cls_counts_pred[sf] += pcc_pred
 
             # Plot sample predictions
-            if curr_iter == (len(val_loader) // 2):
+            if curr_iter == (len(val_loader) // 2) and self.is_main:
                 plt_title = "Validation Results Epoch " + str(epoch)
 
                 file_save_name = os.path.join(
@@ -254,7 +366,7 @@ class Trainer:
                     "Epoch_" + str(epoch) + "_Validations_Predictions.pdf",
                 )
 
-                plot_predictions(
+                self.plotter.plot_predictions(
                     images, labels, batch_output, plt_title, file_save_name
                 )
 
@@ -267,13 +379,34 @@ class Trainer:
             f"Validation epoch {epoch} finished in {time.time() - val_start:.04f} seconds"
         )
 
+        if self.distributed:
+            # Sum the measures of all processes (keyed by scale factor)
+            stats = {
+                key: np.concatenate(
+                    [
+                        ints_[key], unis_[key], accs[key],
+                        per_cls_counts_gt[key], per_cls_counts_pred[key],
+                        [val_loss_total[key], val_loss_dice[key], val_loss_ce[key]],
+                        [num_batches[key]],
+                    ]
+                )
+                for key in accs.keys()
+            }
+            for key, values in all_reduce_stats(stats, self.device).items():
+                (
+                    ints_[key], unis_[key], accs[key],
+                    per_cls_counts_gt[key], per_cls_counts_pred[key],
+                ) = np.split(values[:-4], 5)
+                val_loss_total[key], val_loss_dice[key], val_loss_ce[key] = values[-4:-1]
+                num_batches[key] = int(values[-1])
+
         # Get final measures and log them
         for key in accs.keys():
             ious = ints_[key] / unis_[key]
             miou += ious
-            val_loss_total[key] /= curr_iter + 1
-            val_loss_dice[key] /= curr_iter + 1
-            val_loss_ce[key] /= curr_iter + 1
+            val_loss_total[key] /= num_batches[key]
+            val_loss_dice[key] /= num_batches[key]
+            val_loss_ce[key] /= num_batches[key]
 
             # Log metrics
             logger.info(
@@ -288,13 +421,93 @@ class Trainer:
             logger.info(self.a.format(*self.class_names))
             logger.info(self.a.format(*ious))
 
+        if volume_confusion is not None:
+            cms = volume_confusion.finish()
+            if self.distributed:
+                # slices of a subject may be validated by different processes
+                cms = all_reduce_stats(cms, self.device)
+            return self._log_volume_dice(cms, subject_names, val_meter, epoch)
+
         return np.mean(np.mean(miou))
 
+    def _val_subject_names(self, val_loader: loader.DataLoader) -> list[str] | None:
+        """
+        Get the names of the validation subjects, if slices can be assigned to subjects.
+
+        Parameters
+        ----------
+        val_loader : loader.DataLoader
+            Validation loader.
+
+        Returns
+        -------
+        list[str], None
+            Subject names (None for hdf5 files without slice counts).
+        """
+        dataset = val_loader.dataset
+        # the validation set is split into Subsets in distributed training
+        dataset = getattr(dataset, "dataset", dataset)
+        if getattr(dataset, "slice_subjects", None) is None:
+            logger.warning(
+                "TRAIN.VOLUME_METRICS needs an hdf5 file with slice counts (recreate it "
+                "with generate_hdf5.py), validating on slices instead."
+            )
+            self.volume_metrics = False
+            return None
+        return [
+            s.decode() if isinstance(s, bytes) else str(s)
+            for s in dataset.get_subject_names()
+        ]
+
+    def _log_volume_dice(
+        self,
+        cms: dict[int, np.ndarray],
+        subject_names: list[str],
+        val_meter: Meter,
+        epoch: int,
+    ) -> float:
+        """
+        Log the dice of the volume of each subject and return the mean over subjects.
+
+        Parameters
+        ----------
+        cms : dict[int, np.ndarray]
+            Confusion matrix of each subject (by subject index).
+        subject_names : list[str]
+            Subject names.
+        val_meter : Meter
+            Meter for the values (its writer receives the mean).
+        epoch : int
+            Epoch of the validation.
+
+        Returns
+        -------
+        float
+            Mean over subjects of the mean dice over classes (except background).
+        """
+        subjects = sorted(cms.keys())
+        dice = np.stack([dice_score(cms[s]) for s in subjects])
+        subject_dice = np.nanmean(dice, axis=1)
+        mean_dice = float(np.mean(subject_dice))
+        worst = int(np.argmin(subject_dice))
+        logger.info(
+            f"[Epoch {epoch} stats]: Volume Dice: {mean_dice:.4f} (mean over "
+            f"{len(subjects)} subjects), min {subject_dice[worst]:.4f} "
+            f"({subject_names[subjects[worst]]})"
+        )
+        logger.info(self.a.format(*self.class_names))
+        logger.info(self.a.format(*np.nanmean(dice, axis=0)))
+        if val_meter.writer is not None:
+            val_meter.writer.add_scalar("val/mean_volume_dice", mean_dice, epoch)
+        return mean_dice
+
     def run(self):
         """
         Transfer the model to devices, create a tensor board summary writer and then perform the training loop.
         """
-        if self.cfg.NUM_GPUS > 1:
+        if self.distributed:
+            pass  # the model is wrapped by DistributedDataParallel on its device below
+        elif self.cfg.NUM_GPUS > 1:
             assert (
                 self.cfg.NUM_GPUS <= torch.cuda.device_count()
             ), "Cannot use more GPU devices than available"
@@ -307,7 +520,10 @@ class Trainer:
         update_num_steps(train_loader, self.cfg)
 
         # Transfer the model to device(s)
-        self.model = self.model.to(self.device)
+        self.model = self.model.to(self.device, memory_format=self.memory_format)
+        if self.distributed:
+            device_ids = [self.device.index] if self.device.type == "cuda" else None
+            self.model = DistributedDataParallel(self.model, device_ids=device_ids)
 
         optimizer = get_optimizer(self.model, self.cfg)
         scheduler = get_lr_scheduler(optimizer, self.cfg)
@@ -341,9 +557,11 @@ class Trainer:
             f"{sum(x.numel() for x in self.model.parameters())} parameters in total"
         )
 
-        # Create tensorboard summary writer
-
-        writer = SummaryWriter(self.cfg.SUMMARY_PATH, flush_secs=15)
+        # Create tensorboard summary writer (only in the main process)
+        if self.is_main:
+            writer = SummaryWriter(self.cfg.SUMMARY_PATH, flush_secs=15)
+        else:
+            writer = None
 
         train_meter = Meter(
             self.cfg,
@@ -380,7 +598,7 @@ class Trainer:
             else:
                 miou = self.eval(val_loader, val_meter, epoch=epoch)
 
-            if (epoch + 1) % self.cfg.TRAIN.CHECKPOINT_PERIOD == 0:
+            if (epoch + 1) % self.cfg.TRAIN.CHECKPOINT_PERIOD == 0 and self.is_main:
                 logger.info(f"Saving checkpoint at epoch {epoch+1}")
                 cp.save_checkpoint(
                     self.checkpoint_dir,
@@ -398,14 +616,18 @@ class Trainer:
                 logger.info(
                     f"New best checkpoint reached at epoch {epoch+1} with miou of {best_miou}\nSaving new best model."
                 )
-                cp.save_checkpoint(
-                    self.checkpoint_dir,
-                    epoch + 1,
-                    best_miou,
-                    self.cfg.NUM_GPUS,
-                    self.cfg,
-                    self.model,
-                    optimizer,
-                    scheduler,
-                    best=True,
-                )
+                if self.is_main:
+                    cp.save_checkpoint(
+                        self.checkpoint_dir,
+                        epoch + 1,
+                        best_miou,
+                        self.cfg.NUM_GPUS,
+                        self.cfg,
+                        self.model,
+                        optimizer,
+                        scheduler,
+                        best=True,
+                    )
+
+        self.plotter.close()
+        cleanup_distributed()
@@ -13,7 +13,11 @@
 # limitations under the License.
 
 # IMPORTS
+import hashlib
+import json
+import mmap
 import os
+import struct
 from collections.abc import MutableSequence
 from functools import lru_cache
 from pathlib import Path
@@ -38,6 +42,26 @@ LOGGER = logging.getLogger(__name__)
 # Defaults
 YAML_DEFAULT = FASTSURFER_ROOT / "FastSurferCNN/config/checkpoint_paths.yaml"
 
+# Inference checkpoints: the model weights only, stored as flat tensors after a json
+# header (the safetensors layout), so they can be memory-mapped instead of unpickled
+INFERENCE_SUFFIX = ".safetensors"
+_DTYPE_NAMES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+_DTYPES = {v: k for k, v in _DTYPE_NAMES.items()}
+
+# Quantized checkpoints: the state of the int8 model (see FastSurferCNN.quantize)
+QUANTIZED_SUFFIX = ".int8.pkl"
+
 
 class CheckpointConfigDict(TypedDict, total=False):
     url: list[str]
@@ -234,9 +258,21 @@ def load_from_checkpoint(
     loaded_epoch : int
         Epoch number.
     """
-    # WARNING: weights_only=False can cause unsafe code execution, but here the
-    # checkpoint can be considered to be from a safe source
-    checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+    inference_path = None
+    if optimizer is None and scheduler is None:
+        # only the model state is needed, prefer the memory-mappable export
+        inference_path = get_inference_checkpoint(checkpoint_path)
+    if inference_path is not None:
+        model_state, metadata = load_inference_checkpoint(inference_path)
+        checkpoint = {
+            "model_state": model_state,
+            "epoch": int(metadata.get("epoch", -1)),
+            "best_metric": json.loads(metadata.get("best_metric", "null")),
+        }
+    else:
+        # WARNING: weights_only=False can cause unsafe code execution, but here the
+        # checkpoint can be considered to be from a safe source
+        checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
 
     if drop_classifier:
         classifier_conv = ["classifier.conv.weight", "classifier.conv.bias"]
@@ -293,7 +329,8 @@ def save_checkpoint(
         Whether this was the best checkpoint so far (Default value = False).
     """
     save_name = f"Epoch_{epoch:05d}_training_state.pkl"
-    saving_model = model.module if num_gpus > 1 else model
+    # unwrap DataParallel and DistributedDataParallel models
+    saving_model = model.module if hasattr(model, "module") else model
     checkpoint = {
         "model_state": saving_model.state_dict(),
         "optimizer_state": optimizer.state_dict(),
@@ -398,7 +435,11 @@ def check_and_download_ckpts(checkpoint_path: Path | str, urls: list[str]) -> No
         download_checkpoint(checkpoint_path.name, checkpoint_path, urls)
 
 
-def get_checkpoints(*checkpoints: Path | str, urls: list[str]) -> None:
+def get_checkpoints(
+        *checkpoints: Path | str,
+        urls: list[str],
+        export_inference: bool = True,
+) -> None:
     """
     Check and download checkpoint files if not exist.
 
@@ -408,12 +449,407 @@ def get_checkpoints(*checkpoints: Path | str, urls: list[str]) -> None:
         Paths of the files in which the checkpoint will be saved.
     urls : Path, str
         URLs of checkpoint hosting sites.
+    export_inference : bool, default=True
+        Whether to also create (or update) the inference checkpoints next to the
+        checkpoints (see export_inference_checkpoint), which are preferred for
+        loading models for inference.
     """
     try:
         for file in map(Path, checkpoints):
             if not file.is_absolute() and file.parts[0] != ".":
                 file = FASTSURFER_ROOT / file
             check_and_download_ckpts(file, urls)
+            if export_inference and get_inference_checkpoint(file) is None:
+                try:
+                    export_inference_checkpoint(file)
+                except OSError as e:
+                    # e.g. a read-only checkpoint directory, load the checkpoint instead
+                    LOGGER.warning(f"Could not export an inference checkpoint: {e}")
     except requests.exceptions.HTTPError:
         LOGGER.error(f"Could not find nor download checkpoints from {urls}")
         raise
+
+
+def inference_checkpoint_path(checkpoint_path: Path | str) -> Path:
+    """
+    Get the path of the inference checkpoint exported from a checkpoint.
+
+    Parameters
+    ----------
+    checkpoint_path : Path, str
+        Path to the (training) checkpoint.
+
+    Returns
+    -------
+    Path
+        The path with the INFERENCE_SUFFIX.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    if checkpoint_path.suffix == INFERENCE_SUFFIX:
+        return checkpoint_path
+    return checkpoint_path.with_suffix(INFERENCE_SUFFIX)
+
+
+def _source_stamp(checkpoint_path: Path) -> str:
+    """
+    Identify the version of a checkpoint file by its size and modification time.
+    """
+    stat = checkpoint_path.stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def export_inference_checkpoint(
+        checkpoint_path: Path | str,
+        export_path: Path | str | None = None,
+) -> Path:
+    """
+    Export the model state of a checkpoint to a memory-mappable inference checkpoint.
+
+    The file has the safetensors layout: the length of the json header (8 bytes,
+    little endian), the json header with dtype, shape and data offsets of each tensor,
+    and then the tensor data. Tensors are sorted by their item size, so all of them
+    are aligned in the file. The metadata in the header contains a blake2b hash of
+    each tensor (see verify_inference_checkpoint), the epoch, the config and the
+    version of the source checkpoint.
+
+    Parameters
+    ----------
+    checkpoint_path : Path, str
+        Path to the (training) checkpoint.
+    export_path : Path, str, optional
+        Path of the exported file (default: checkpoint_path with INFERENCE_SUFFIX).
+
+    Returns
+    -------
+    Path
+        The path of the inference checkpoint.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    if export_path is None:
+        export_path = inference_checkpoint_path(checkpoint_path)
+    export_path = Path(export_path)
+    LOGGER.info(f"Exporting inference checkpoint {export_path}")
+    # WARNING: weights_only=False can cause unsafe code execution, but here the
+    # checkpoint can be considered to be from a safe source
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+    model_state = {
+        k: v.detach().contiguous() for k, v in checkpoint["model_state"].items()
+    }
+    names = sorted(model_state, key=lambda k: -model_state[k].element_size())
+
+    header, hashes, offset = {}, {}, 0
+    for name in names:
+        tensor = model_state[name]
+        if tensor.dtype not in _DTYPE_NAMES:
+            raise ValueError(f"Unsupported dtype {tensor.dtype} of {name}")
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": _DTYPE_NAMES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + nbytes],
+        }
+        hashes[name] = hashlib.blake2b(_tensor_bytes(tensor), digest_size=16).hexdigest()
+        offset += nbytes
+    config = checkpoint.get("config", "")
+    header["__metadata__"] = {
+        "format": "pt",
+        "epoch": str(checkpoint.get("epoch", -1)),
+        "best_metric": json.dumps(checkpoint.get("best_metric", None)),
+        "config": config if isinstance(config, str) else str(config),
+        "source": checkpoint_path.name,
+        "source_stamp": _source_stamp(checkpoint_path),
+        "hashes": json.dumps(hashes),
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    # pad the header with spaces, so the data starts at a multiple of 64 bytes
+    header_bytes += b" " * (-(len(header_bytes) + 8) % 64)
+
+    # write to a temporary file first, so concurrent processes never read partial files
+    tmp_path = export_path.with_name(f".{export_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(struct.pack("<Q", len(header_bytes)))
+            f.write(header_bytes)
+            for name in names:
+                f.write(_tensor_bytes(model_state[name]))
+        os.replace(tmp_path, export_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return export_path
+
+
+def _tensor_bytes(tensor: torch.Tensor) -> memoryview:
+    """
+    Get the raw bytes of a contiguous cpu tensor.
+    """
+    if tensor.numel() == 0:
+        return memoryview(b"")
+    return memoryview(tensor.reshape(-1).view(torch.uint8).numpy())
+
+
+def read_inference_header(inference_path: Path | str) -> tuple[dict, int]:
+    """
+    Read the json header of an inference checkpoint.
+
+    Parameters
+    ----------
+    inference_path : Path, str
+        Path to the inference checkpoint.
+
+    Returns
+    -------
+    dict
+        The header (tensor entries and "__metadata__").
+    int
+        Offset of the tensor data in the file.
+    """
+    with open(inference_path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    return header, 8 + header_size
+
+
+def get_inference_checkpoint(checkpoint_path: Path | str) -> Path | None:
+    """
+    Get the up-to-date inference checkpoint exported from a checkpoint.
+
+    Parameters
+    ----------
+    checkpoint_path : Path, str
+        Path to the (training) checkpoint or an inference checkpoint.
+
+    Returns
+    -------
+    Path, None
+        The path of the inference checkpoint, or None if it does not exist or was
+        exported from another version of the checkpoint.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    inference_path = inference_checkpoint_path(checkpoint_path)
+    if not inference_path.is_file():
+        return None
+    if inference_path == checkpoint_path or not checkpoint_path.exists():
+        return inference_path
+    try:
+        header, _ = read_inference_header(inference_path)
+    except (OSError, ValueError, struct.error):
+        return None
+    stamp = header.get("__metadata__", {}).get("source_stamp")
+    return inference_path if stamp == _source_stamp(checkpoint_path) else None
+
+
+def load_inference_checkpoint(
+        inference_path: Path | str,
+        verify: bool = False,
+) -> tuple[dict[str, torch.Tensor], dict[str, str]]:
+    """
+    Memory-map the model state of an inference checkpoint.
+
+    The tensors share the pages of the file (copy-on-write), so processes that load
+    the same checkpoint share its memory and no data is read before it is used.
+
+    Parameters
+    ----------
+    inference_path : Path, str
+        Path to the inference checkpoint.
+    verify : bool, default=False
+        Whether to check the hashes of all tensors (reads the whole file).
+
+    Returns
+    -------
+    dict[str, torch.Tensor]
+        The model state (cpu tensors).
+    dict[str, str]
+        The metadata of the checkpoint.
+
+    Raises
+    ------
+    ValueError
+        If verify is True and a tensor does not match its hash.
+    """
+    header, data_offset = read_inference_header(inference_path)
+    metadata = header.pop("__metadata__", {})
+    with open(inference_path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    model_state = {}
+    for name, info in header.items():
+        dtype = _DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if end == begin:
+            tensor = torch.empty(info["shape"], dtype=dtype)
+        else:
+            count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+            tensor = torch.frombuffer(
+                buffer, dtype=dtype, count=count, offset=data_offset + begin
+            ).reshape(info["shape"])
+        model_state[name] = tensor
+
+    if verify:
+        hashes = json.loads(metadata.get("hashes", "{}"))
+        for name, tensor in model_state.items():
+            digest = hashlib.blake2b(_tensor_bytes(tensor), digest_size=16).hexdigest()
+            if hashes.get(name) != digest:
+                raise ValueError(f"Tensor {name} in {inference_path} does not match its hash.")
+    return model_state, metadata
+
+
+def verify_inference_checkpoint(inference_path: Path | str) -> bool:
+    """
+    Check all tensors of an inference checkpoint against the hash index in its header.
+
+    Parameters
+    ----------
+    inference_path : Path, str
+        Path to the inference checkpoint.
+
+    Returns
+    -------
+    bool
+        Whether all tensors match.
+    """
+    try:
+        load_inference_checkpoint(inference_path, verify=True)
+    except ValueError as e:
+        LOGGER.error(str(e))
+        return False
+    return True
+
+
+def load_model_state(
+        checkpoint_path: Path | str,
+        map_location: str | torch.device = "cpu",
+) -> tuple[dict[str, torch.Tensor], bool]:
+    """
+    Load the model state of a checkpoint for inference.
+
+    An up-to-date inference checkpoint (see get_inference_checkpoint) is memory-mapped,
+    else the checkpoint is unpickled.
+
+    Parameters
+    ----------
+    checkpoint_path : Path, str
+        Path to the checkpoint.
+    map_location : str, torch.device, default="cpu"
+        Device to load the checkpoint to (ignored for inference checkpoints, which are
+        always memory-mapped on the cpu).
+
+    Returns
+    -------
+    dict[str, torch.Tensor]
+        The model state.
+    bool
+        Whether the state is memory-mapped (on the cpu).
+    """
+    inference_path = get_inference_checkpoint(checkpoint_path)
+    if inference_path is not None:
+        LOGGER.debug(f"Memory-mapping inference checkpoint {inference_path}")
+        return load_inference_checkpoint(inference_path)[0], True
+    # WARNING: weights_only=False can cause unsafe code execution, but here the
+    # checkpoint can be considered to be from a safe source
+    checkpoint = torch.load(checkpoint_path, map_location=map_location, weights_only=False)
+    return checkpoint["model_state"], False
+
+
+def quantized_checkpoint_path(checkpoint_path: Path | str) -> Path:
+    """
+    Get the path of the quantized checkpoint created from a checkpoint.
+
+    Parameters
+    ----------
+    checkpoint_path : Path, str
+        Path to the (float) checkpoint.
+
+    Returns
+    -------
+    Path
+        The path with the QUANTIZED_SUFFIX (next to the checkpoint).
+    """
+    checkpoint_path = Path(checkpoint_path)
+    if checkpoint_path.name.endswith(QUANTIZED_SUFFIX):
+        return checkpoint_path
+    return checkpoint_path.with_name(checkpoint_path.stem + QUANTIZED_SUFFIX)
+
+
+def save_quantized_checkpoint(
+        model_state: dict[str, torch.Tensor],
+        checkpoint_path: Path | str,
+        metadata: dict | None = None,
+) -> Path:
+    """
+    Save the state of a quantized model next to the float checkpoint it was created
+    from.
+
+    Parameters
+    ----------
+    model_state : dict[str, torch.Tensor]
+        The state dict of the quantized model.
+    checkpoint_path : Path, str
+        Path to the (float) checkpoint.
+    metadata : dict, optional
+        Additional information, e.g. calibration data and dice scores (must only
+        contain python builtins).
+
+    Returns
+    -------
+    Path
+        The path of the quantized checkpoint.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    quantized_path = quantized_checkpoint_path(checkpoint_path)
+    quantization = {
+        "backend": torch.backends.quantized.engine,
+        "source": checkpoint_path.name,
+        "source_stamp": _source_stamp(checkpoint_path),
+        **(metadata or {}),
+    }
+    tmp_path = quantized_path.with_name(quantized_path.name + ".tmp")
+    torch.save({"model_state": model_state, "quantization": quantization}, tmp_path)
+    os.replace(tmp_path, quantized_path)
+    LOGGER.info(f"Saved quantized checkpoint {quantized_path}")
+    return quantized_path
+
+
+def load_quantized_checkpoint(
+        checkpoint_path: Path | str,
+) -> tuple[dict[str, torch.Tensor], dict]:
+    """
+    Load the quantized checkpoint created from a checkpoint.
+
+    Parameters
+    ----------
+    checkpoint_path : Path, str
+        Path to the (float) checkpoint or the quantized checkpoint.
+
+    Returns
+    -------
+    dict[str, torch.Tensor]
+        The state dict of the quantized model (on the cpu).
+    dict
+        The quantization metadata.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the checkpoint was not quantized.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    quantized_path = quantized_checkpoint_path(checkpoint_path)
+    if not quantized_path.is_file():
+        raise FileNotFoundError(
+            f"Could not find the quantized checkpoint {quantized_path}, create it with "
+            f"FastSurferCNN/quantize.py."
+        )
+    checkpoint = torch.load(quantized_path, map_location="cpu", weights_only=True)
+    metadata = checkpoint["quantization"]
+    if (
+        quantized_path != checkpoint_path
+        and checkpoint_path.exists()
+        and metadata.get("source_stamp") != _source_stamp(checkpoint_path)
+    ):
+        LOGGER.warning(
+            f"The quantized checkpoint {quantized_path} was created from another version "
+            f"of {checkpoint_path}, consider recreating it."
+        )
+    return checkpoint["model_state"], metadata
@@ -1047,7 +1047,7 @@ class SubjectList:
         str
             The suffix the entries share.
         """
-        suffix = self._subjects[0]
+        suffix = str(self._subjects[0])
         for subject_path in self._subjects[1:]:
             subj = str(subject_path)
             if subj.endswith(suffix):
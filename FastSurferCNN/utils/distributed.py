@@ -0,0 +1,155 @@
+# Copyright 2024 Image Analysis Lab, German Center for Neurodegenerative Diseases (DZNE), Bonn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# IMPORTS
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import yacs.config
+
+from FastSurferCNN.utils import logging
+
+logger = logging.getLogger(__name__)
+
+
+def init_distributed(cfg: yacs.config.CfgNode) -> torch.device:
+    """
+    Initialize the default process group for distributed data-parallel training.
+
+    Rank and world size are read from the environment (RANK, WORLD_SIZE, LOCAL_RANK,
+    MASTER_ADDR and MASTER_PORT as set by torchrun).
+
+    Parameters
+    ----------
+    cfg : yacs.config.CfgNode
+        Configuration node (DISTRIBUTED.BACKEND and DISTRIBUTED.INIT_METHOD).
+
+    Returns
+    -------
+    torch.device
+        The device of this process (cuda:LOCAL_RANK or cpu).
+    """
+    backend = cfg.DISTRIBUTED.BACKEND
+    if backend == "auto":
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if backend == "nccl":
+        device = torch.device("cuda", local_rank)
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device("cpu")
+    if not is_distributed():
+        dist.init_process_group(backend=backend, init_method=cfg.DISTRIBUTED.INIT_METHOD)
+    logger.info(
+        f"Initialized process {get_rank()} of {get_world_size()} ({backend} on {device})"
+    )
+    return device
+
+
+def cleanup_distributed():
+    """
+    Destroy the default process group (if initialized).
+    """
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed() -> bool:
+    """
+    Check, whether the default process group is initialized.
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    """
+    Get the rank of this process (0, if not distributed).
+    """
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    """
+    Get the number of processes (1, if not distributed).
+    """
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    """
+    Check, whether this is the main process (rank 0), which logs and saves checkpoints.
+    """
+    return get_rank() == 0
+
+
+def all_reduce_sum(tensor: torch.Tensor) -> torch.Tensor:
+    """
+    Sum a tensor over all processes (in-place, no-op if not distributed).
+
+    Parameters
+    ----------
+    tensor : torch.Tensor
+        Tensor on the device of the process group's backend.
+
+    Returns
+    -------
+    torch.Tensor
+        The summed tensor.
+    """
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def all_reduce_stats(
+        stats: dict[float, np.ndarray], device: torch.device | None = None
+) -> dict[float, np.ndarray]:
+    """
+    Sum dictionaries of equally shaped statistics over all processes.
+
+    Keys missing in some processes count as zeros there, the result has the union of
+    the keys of all processes.
+
+    Parameters
+    ----------
+    stats : dict[float, np.ndarray]
+        Statistics of this process (keys must be hashable and picklable).
+    device : torch.device, optional
+        Device to reduce on (must be cuda for the nccl backend).
+
+    Returns
+    -------
+    dict[float, np.ndarray]
+        Statistics summed over all processes.
+    """
+    if not is_distributed():
+        return stats
+    key_lists = [None] * get_world_size()
+    dist.all_gather_object(key_lists, list(stats.keys()))
+    keys = sorted(set().union(*key_lists), key=repr)
+    if not keys:
+        return {}
+    shape = next(iter(stats.values())).shape if stats else None
+    shapes = [None] * get_world_size()
+    dist.all_gather_object(shapes, shape)
+    shape = next(s for s in shapes if s is not None)
+    values = torch.zeros((len(keys),) + shape, dtype=torch.float64, device=device)
+    for i, key in enumerate(keys):
+        if key in stats:
+            values[i] = torch.as_tensor(stats[key], dtype=torch.float64)
+    all_reduce_sum(values)
+    values = values.cpu().numpy()
+    return {key: values[i] for i, key in enumerate(keys)}
@@ -21,7 +21,7 @@ Date: Aug-19-2022
 import json
 import os.path
 from collections.abc import Callable, Collection, Hashable, Iterable, Iterator, Mapping, Sequence
-from functools import partial, partialmethod, reduce
+from functools import partialmethod
 from numbers import Integral, Number
 from typing import (
     Any,
@@ -29,7 +29,6 @@ from typing import (
     Literal,
     TextIO,
     TypeVar,
-    cast,
 )
 
 import numpy as np
@@ -63,6 +62,10 @@ logger = logging.getLogger(__name__)
 
 LabelImageType = TypeVar("LabelImageType", torch.Tensor, npt.NDArray[int])
 
+# integer mappers up to this max label are compiled to a dense lookup table, mappers
+# with larger labels to a sorted table of their keys (binary search)
+_DENSE_MAX_LABEL = 65535
+
 
 def is_int(a_object) -> bool:
     """
@@ -125,8 +128,8 @@ class Mapper(Generic[KT, VT]):
 
     _map_dict: dict[KT, npt.NDArray[VT]]
     _label_shape: tuple[int, ...]
-    _map_np: npt.NDArray[VT]
-    _map_torch: torch.Tensor
+    _sorted_table: tuple[npt.NDArray, npt.NDArray]
+    _compiled: dict[Any, tuple[AT | None, AT]]
     _max_label: int | None
     _name: str
 
@@ -226,12 +229,14 @@ class Mapper(Generic[KT, VT]):
         for key, value in iter(other):
             if overwrite or key not in self._map_dict:
                 self._map_dict[key] = value
+        if self._max_label is not None:
+            self._max_label = max(self._max_label, max(self._map_dict.keys()))
 
         # reset the internal numpy/pytorch mapping constructs
-        if hasattr(self, "_map_np"):
-            delattr(self, "_map_np")
-        if hasattr(self, "_map_torch"):
-            delattr(self, "_map_torch")
+        if hasattr(self, "_sorted_table"):
+            delattr(self, "_sorted_table")
+        if hasattr(self, "_compiled"):
+            delattr(self, "_compiled")
         return self
 
     __iadd__ = partialmethod(update, overwrite=True)
@@ -253,77 +258,108 @@ class Mapper(Generic[KT, VT]):
         AT
             Data after being mapped to the internal space.
         """
-        # torch sparse tensors can't index with images
-        # self._map = _b.torch.sparse_coo_tensor(src_labels, labels, (self._max_label,) + self._label_shape)
-
         out_type = image if out is None else out
 
         if self._max_label is None:
             # if we do not have numbers, we need to map all entries individually
             return self._map_py(image, out)
 
-        # the key is an integer
-        map_shape = (self._max_label + 1,) + self._label_shape
-        init_map = True
-
-        if isinstance(out_type, np.ndarray):
-            if not hasattr(self, "_map_np"):
-                if self._max_label > 4096:
-                    from scipy import sparse
-
-                    lil = (
-                        sparse.lil_array
-                        if hasattr(sparse, "lil_array")
-                        else sparse.lil_matrix
-                    )
-                    self._map_np = cast(npt.NDArray[VT], lil(map_shape))
-                else:
-                    self._map_np = np.zeros(map_shape, dtype=out_type.dtype)
-            else:
-                init_map = False
-            _map = self._map_np
-        elif torch.is_tensor(out_type):
-            if not hasattr(self, "_map_torch"):
-                self._map_torch = out_type.new_full(
-                    (self._max_label + 1,) + self._label_shape, fill_value=0
-                )
-            else:
-                init_map = False
-            _map = self._map_torch
-        else:
+        if not isinstance(out_type, np.ndarray) and not torch.is_tensor(out_type):
             raise TypeError("image or out are an invalid type.")
 
-        if init_map:
-            for k, v in self._map_dict.items():
-                _map[k] = to_same_type(v, type_hint=out_type)
-
+        # the key is an integer
+        keys, table = self._compile(out_type)
         try:
-            mapped = _map[image]
+            if keys is None:
+                mapped = table[image]
+            else:
+                mapped = self._map_sorted(image, keys, table)
         except IndexError as e:
-            map_unique = (
-                np.unique(_map) if isinstance(_map, np.ndarray) else _map.unique()
-            )
-            missing_keys = set(map_unique.tolist()) - set(self._map_dict.keys())
-            raise KeyError(f"Could not find the mapping of keys {missing_keys}.") from e
-
-        if torch.is_tensor(mapped) and (
-            hasattr(mapped, "is_sparse") and mapped.is_sparse
-        ):
-            mapped.to_dense()
-        try:
-            # noinspection PyUnresolvedReferences
-            from scipy import sparse
-
-            if isinstance(mapped, sparse.spmatrix):
-                mapped = mapped.toarray()
-        except ImportError:
-            pass
+            if torch.is_tensor(image):
+                unknown = image[image > self._max_label].unique().tolist()
+            else:
+                unknown = np.unique(image[image > self._max_label]).tolist()
+            raise KeyError(f"Could not find the mapping of keys {set(unknown)}.") from e
 
         if out is not None:
             out[:] = to_same_type(mapped, type_hint=out)
             return out
         return to_same_type(mapped, type_hint=image)
 
+    def sorted_table(self) -> tuple[npt.NDArray[KT], npt.NDArray[VT]]:
+        """
+        Return the compact representation of the mapping: the sorted keys and the values.
+
+        Returns
+        -------
+        keys : npt.NDArray[KT]
+            The sorted keys of the mapping.
+        values : npt.NDArray[VT]
+            The values of the keys (shape: (num_keys,) + label shape).
+        """
+        if not hasattr(self, "_sorted_table"):
+            keys = sorted(self._map_dict.keys())
+            values = np.asarray([self._map_dict[k] for k in keys])
+            self._sorted_table = np.asarray(keys), values
+        return self._sorted_table
+
+    def _compile(self, out_type: AT) -> tuple[AT | None, AT]:
+        """
+        Compile the integer mapping for the type (numpy/torch, dtype and device) of
+        out_type.
+
+        Mappings with a max label up to _DENSE_MAX_LABEL are compiled to a dense lookup
+        table (keys is None), larger mappings to the sorted keys and their values.
+        """
+        if not hasattr(self, "_compiled"):
+            self._compiled = {}
+        if torch.is_tensor(out_type):
+            cache_key = ("torch", out_type.dtype, out_type.device)
+        else:
+            cache_key = ("numpy", out_type.dtype)
+        if cache_key in self._compiled:
+            return self._compiled[cache_key]
+
+        keys, values = self.sorted_table()
+        if torch.is_tensor(out_type):
+            values = torch.as_tensor(values).to(out_type.device, out_type.dtype)
+            keys = torch.as_tensor(keys, dtype=torch.int64, device=out_type.device)
+        else:
+            values = values.astype(out_type.dtype)
+
+        if self._max_label <= _DENSE_MAX_LABEL:
+            # lookup table with zeros for labels without mapping
+            map_shape = (self._max_label + 1,) + self._label_shape
+            if torch.is_tensor(out_type):
+                table = out_type.new_zeros(map_shape)
+            else:
+                table = np.zeros(map_shape, dtype=out_type.dtype)
+            table[keys] = values
+            compiled = None, table
+        else:
+            compiled = keys, values
+        self._compiled[cache_key] = compiled
+        return compiled
+
+    def _map_sorted(self, image: AT, keys: AT, values: AT) -> AT:
+        """
+        Map image by binary search in the sorted keys (labels without mapping map to
+        zeros, labels larger than max_label raise an IndexError).
+        """
+        if (image > self._max_label).any():
+            raise IndexError(f"image contains labels larger than {self._max_label}.")
+        if torch.is_tensor(image):
+            index = torch.bucketize(image.to(keys.dtype), keys)
+            index.clamp_(max=len(keys) - 1)
+        else:
+            index = np.searchsorted(keys, image)
+            np.minimum(index, len(keys) - 1, out=index)
+        mapped = values[index]
+        missing = keys[index] != image
+        if missing.any():
+            mapped[missing] = 0
+        return mapped
+
     def _map_py(self, image: AT, out: AT | None = None) -> AT:
         """
         Map internally by python, for example for strings.
@@ -468,13 +504,20 @@ class Mapper(Generic[KT, VT]):
                 f"second mapper ({other_mapper.name}) does not map from:\n  "
                 + ", ".join(f"'{v}'" for v in target_space - other_mapper.source_space)
             )
-        return Mapper(
+        chained = Mapper(
             dict(
                 (in_key, other_mapper[out_key])
                 for in_key, out_key in self._map_dict.items()
             ),
             name=f"{self.name} -> {other_mapper.name}",
         )
+        if self._label_shape == ():
+            # fuse the sorted tables, so the chained mapper is compiled to one table
+            keys, values = self.sorted_table()
+            other_keys, other_values = other_mapper.sorted_table()
+            index = np.searchsorted(other_keys, values)
+            chained._sorted_table = keys, other_values[index]
+        return chained
 
     @classmethod
     def make_classmapper(
@@ -543,72 +586,68 @@ class Mapper(Generic[KT, VT]):
         if not is_int(self.source_space) or not is_int(self.target_space):
             raise ValueError("map_logits/map_probs requires a mapping from int to int.")
 
-        if mode == "logit":
-            reduce_func = (
-                np.multiply.reduce
-                if isinstance(logits, np.ndarray)
-                else partial(reduce, torch.mul)
-            )
-            spread_func = (
-                np.float_power if isinstance(logits, np.ndarray) else torch.pow
-            )
-        elif mode == "prob":
-            reduce_func = (
-                np.add.reduce
-                if isinstance(logits, np.ndarray)
-                else partial(reduce, torch.add)
-            )
-            spread_func = np.multiply if isinstance(logits, np.ndarray) else torch.mul
-        else:
+        if mode not in ("logit", "prob"):
             raise ValueError(
                 f"Unknown mode, should be in 'logit', 'prob', but was '{mode}'."
             )
 
-        from collections import defaultdict
-
-        data = defaultdict(list)
-        mappings = self._map_dict.items()
+        # mappings in the order of the mapping dict
+        sources = np.fromiter(self._map_dict.keys(), dtype=int, count=len(self._map_dict))
+        targets = np.fromiter(self._map_dict.values(), dtype=int, count=len(sources))
+        spread = None
         if reverse:
-            unique_target_classes = np.unique(
-                list(self._map_dict.values()), return_counts=True
-            )
-            cls_cts = {cls: cts for cls, cts in zip(*unique_target_classes, strict=False) if cts > 1}
-            mappings = ((v, k) for k, v in mappings)  # swap source and target mappings
+            # swap source and target mappings, spread classes mapped from multiple keys
+            sources, targets = targets, sources
+            _, inverse, counts = np.unique(sources, return_inverse=True, return_counts=True)
+            if np.any(counts > 1):
+                spread = 1.0 / counts[inverse]
+
+        is_numpy = isinstance(logits, np.ndarray)
+        axis = axis % logits.ndim
+        spread_shape = [1] * logits.ndim
+        spread_shape[axis] = -1
+        if is_numpy:
+            this_logits = np.take(logits, sources, axis=axis)
+            if spread is not None and mode == "logit":
+                this_logits = np.float_power(this_logits, spread.reshape(spread_shape))
+            elif spread is not None:
+                spread = spread.astype(this_logits.dtype, copy=False)
+                this_logits = this_logits * spread.reshape(spread_shape)
         else:
-            cls_cts = {}
-
+            index = torch.as_tensor(sources, device=logits.device)
+            this_logits = logits.index_select(axis, index)
+            if spread is not None:
+                spread = torch.as_tensor(spread, dtype=logits.dtype, device=logits.device)
+                spread_func = torch.pow if mode == "logit" else torch.mul
+                this_logits = spread_func(this_logits, spread.reshape(spread_shape))
+
+        # reduce the logits of each target class (product for logits, sum for probs)
+        num_classes = int(targets.max(initial=-1)) + 1
         shape = list(logits.shape)
-        ii = [slice(None) for _ in shape]
-        for source_dim, target_dim in mappings:
-            ii[axis] = source_dim
-            this_logit = logits[tuple(ii)]
-            cts = cls_cts.get(source_dim, 1)
-            if cts > 1:
-                this_logit = spread_func(this_logit, 1.0 / cts)
-            data[target_dim].append(this_logit)
-
-        stack = np.stack if isinstance(logits, np.ndarray) else torch.stack
-        labels = np.unique(np.asarray(list(data.keys())))
-        if not np.all(labels == np.arange(labels.size)):
-            shape[axis] = 1
-            alloc = (
-                partial(np.zeros, like=logits)
-                if isinstance(logits, np.ndarray)
-                else partial(logits.new_full, fill_value=0)
-            )
-            zeros = alloc(shape)
+        shape[axis] = num_classes
+        missing = np.setdiff1d(np.arange(num_classes), targets)
+        if is_numpy:
+            init = np.ones if mode == "logit" else np.zeros
+            data = init(shape, dtype=this_logits.dtype)
+            ufunc = np.multiply if mode == "logit" else np.add
+            ufunc.at(np.moveaxis(data, axis, 0), targets, np.moveaxis(this_logits, axis, 0))
+            np.moveaxis(data, axis, 0)[missing] = 0
         else:
-            zeros = None
-
-        data = {k: v[0] if len(v) == 1 else reduce_func(v) for k, v in data.items()}
-        return stack(
-            [
-                data[i] if i in labels else zeros
-                for i in range(labels.max(initial=-1) + 1)
-            ],
-            axis,
-            out=out,
-        )
+            index = torch.as_tensor(targets, device=logits.device)
+            if mode == "logit":
+                index = index.reshape(spread_shape).expand_as(this_logits)
+                data = this_logits.new_ones(shape)
+                data.scatter_reduce_(axis, index, this_logits, "prod")
+            else:
+                data = this_logits.new_zeros(shape).index_add_(axis, index, this_logits)
+            if missing.size > 0:
+                missing = torch.as_tensor(missing, device=logits.device)
+                data.index_fill_(axis, missing, 0)
+
+        if out is not None:
+            out[...] = data
+            return out
+        return data
 
     map_logits = partialmethod(_map_logits, mode="logit")
     map_probs = partialmethod(_map_logits, mode="prob")
@@ -17,9 +17,11 @@ import matplotlib.pyplot as plt
 
 # IMPORTS
 import numpy as np
+import torch
 import yacs.config
 
 from FastSurferCNN.utils import logging
+from FastSurferCNN.utils.distributed import all_reduce_sum, is_distributed
 from FastSurferCNN.utils.metrics import DiceScore
 from FastSurferCNN.utils.misc import plot_confusion_matrix
 
@@ -78,14 +80,58 @@ class Meter:
         self.global_iter = global_step
         self.total_iter_num = total_iter
         self.total_epochs = total_epoch
+        # losses are kept on the device until the next flush, if deferred
+        self.deferred = cfg.TRAIN.DEFERRED_METRICS
+        self._pending_losses = []
+        self._pending_summaries = []
+        # confusion matrix as of the last reduction over all processes
+        self._reduced_cm = None
 
     def reset(self):
         """
         Reset bach losses and dice scores.
         """
         self.batch_losses = []
+        self._pending_losses = []
+        self._pending_summaries = []
+        self._reduced_cm = None
         self.dice_score.reset()
 
+    def _reduce_confusion_matrix(self):
+        """
+        Add the confusion matrices of all processes (distributed training).
+
+        Only the counts since the last reduction are summed, so the accumulated
+        confusion matrix is the same in all processes.
+        """
+        cm = self.dice_score.cm
+        if self._reduced_cm is None:
+            self._reduced_cm = torch.zeros_like(cm)
+        new_counts = all_reduce_sum(cm - self._reduced_cm)
+        self.dice_score.cm = self._reduced_cm + new_counts
+        self._reduced_cm = self.dice_score.cm.clone()
+
+    def flush(self):
+        """
+        Copy the pending (deferred) losses to the host and write their summaries.
+
+        All pending values are transferred at once, so the device is only synchronized
+        once per flush.
+        """
+        if self._pending_losses:
+            losses = torch.stack(self._pending_losses).cpu().tolist()
+            self.batch_losses.extend(losses)
+            self._pending_losses = []
+        if self._pending_summaries:
+            values = torch.stack(
+                [torch.stack(tensors) for _, tensors, _ in self._pending_summaries]
+            ).cpu().tolist()
+            for (global_iter, _, lr), (loss_total, loss_ce, loss_dice) in zip(
+                self._pending_summaries, values, strict=True
+            ):
+                self._add_scalars(global_iter, loss_total, lr, loss_ce, loss_dice)
+            self._pending_summaries = []
+
     def enable_confusion_mat(self):
         """
         Enable confusion matrix.
@@ -103,7 +149,10 @@ class Meter:
         Update the statistics.
         """
         self.dice_score.update((pred, labels), self.confusion_mat)
-        self.batch_losses.append(batch_loss.item())
+        if self.deferred:
+            self._pending_losses.append(batch_loss.detach().float())
+        else:
+            self.batch_losses.append(batch_loss.item())
 
     def write_summary(self, loss_total, lr=None, loss_ce=None, loss_dice=None):
         """
@@ -120,22 +169,40 @@ class Meter:
         loss_dice : default = None
             Dice loss (Default value = None).
         """
-        self.writer.add_scalar(
-            f"{self.mode}/total_loss", loss_total.item(), self.global_iter
-        )
-        if self.mode == "Train":
-            self.writer.add_scalar("Train/lr", lr[0], self.global_iter)
-            if loss_ce:
-                self.writer.add_scalar(
-                    "Train/ce_loss", loss_ce.item(), self.global_iter
-                )
-            if loss_dice:
-                self.writer.add_scalar(
-                    "Train/dice_loss", loss_dice.item(), self.global_iter
-                )
+        if self.deferred:
+            # missing losses are stored as nan (and skipped when writing)
+            nan = loss_total.new_tensor(float("nan"))
+            tensors = [
+                x.detach().float() if x is not None else nan
+                for x in (loss_total, loss_ce, loss_dice)
+            ]
+            self._pending_summaries.append((self.global_iter, tensors, lr))
+        else:
+            self._add_scalars(
+                self.global_iter,
+                loss_total.item(),
+                lr,
+                loss_ce.item() if loss_ce else None,
+                loss_dice.item() if loss_dice else None,
+            )
 
         self.global_iter += 1
 
+    def _add_scalars(self, global_iter, loss_total, lr=None, loss_ce=None, loss_dice=None):
+        """
+        Add the (host) loss values of one iteration to the writer.
+        """
+        if self.writer is None:
+            # e.g. processes other than the main process in distributed training
+            return
+        self.writer.add_scalar(f"{self.mode}/total_loss", loss_total, global_iter)
+        if self.mode == "Train":
+            self.writer.add_scalar("Train/lr", lr[0], global_iter)
+            if loss_ce is not None and not np.isnan(loss_ce):
+                self.writer.add_scalar("Train/ce_loss", loss_ce, global_iter)
+            if loss_dice is not None and not np.isnan(loss_dice):
+                self.writer.add_scalar("Train/dice_loss", loss_dice, global_iter)
+
     def log_iter(self, cur_iter: int, cur_epoch: int):
         """
         Log the current iteration.
@@ -148,6 +215,7 @@ class Meter:
             Current epoch.
         """
         if (cur_iter + 1) % self._cfg.TRAIN.LOG_INTERVAL == 0:
+            self.flush()
             logger.info(
                 f"{self.mode} Epoch [{cur_epoch + 1}/{self.total_epochs}]" \
                 f" Iter [{cur_iter + 1}/{self.total_iter_num}]" \
@@ -163,6 +231,11 @@ class Meter:
         cur_epoch : int
             Current epoch.
         """
+        self.flush()
+        if is_distributed():
+            self._reduce_confusion_matrix()
+        if self.writer is None:
+            return
         dice_score = self.dice_score.compute_dsc()
         self.writer.add_scalar(f"{self.mode}/mean_dice_score", dice_score, cur_epoch)
         if self.confusion_mat:
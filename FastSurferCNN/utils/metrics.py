@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import queue
+import threading
 from typing import Any
 
 import numpy as np
@@ -24,6 +26,93 @@ from FastSurferCNN.utils import logging
 logger = logging.getLogger(__name__)
 
 
+def confusion_matrix(
+    pred_cls: torch.Tensor, true_cls: torch.Tensor, nclass: int = 79
+) -> torch.Tensor:
+    """
+    Compute the confusion matrix with a single bincount on the device of the inputs.
+
+    The computation does not synchronize the device with the host.
+    Both inputs should be categorical (as opposed to one-hot). Voxels with labels
+    outside of [0, nclass) are ignored.
+
+    Parameters
+    ----------
+    pred_cls : torch.Tensor
+        Network prediction (categorical).
+    true_cls : torch.Tensor
+        Ground truth (categorical).
+    nclass : int
+        Number of classes (Default value = 79).
+
+    Returns
+    -------
+    torch.Tensor
+        Matrix of shape (nclass, nclass) with the number of voxels of ground truth class
+        i (row) predicted as class j (column).
+    """
+    true_cls = true_cls.reshape(-1).long()
+    pred_cls = pred_cls.reshape(-1).long()
+    valid = (true_cls >= 0) & (true_cls < nclass) & (pred_cls >= 0) & (pred_cls < nclass)
+    # invalid voxels are counted in an extra bin, which is dropped (no masking, which
+    # would synchronize the device)
+    index = torch.where(valid, nclass * true_cls + pred_cls, nclass * nclass)
+    if index.is_cuda:
+        # bincount on cuda synchronizes to determine the number of bins
+        counts = torch.zeros(nclass * nclass + 1, dtype=torch.int64, device=index.device)
+        counts.index_add_(0, index, torch.ones_like(index))
+    else:
+        counts = torch.bincount(index, minlength=nclass * nclass + 1)
+    counts = counts[:nclass * nclass]
+    return counts.reshape(nclass, nclass)
+
+
+def iou_from_confusion(cm: torch.Tensor) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Derive intersection and union per class (except background) from a confusion matrix.
+
+    Parameters
+    ----------
+    cm : torch.Tensor
+        Confusion matrix (see confusion_matrix).
+
+    Returns
+    -------
+    np.ndarray
+        An array containing the intersection for each class.
+    np.ndarray
+        An array containing the union for each class.
+    """
+    cm = cm.cpu().numpy()
+    intersect = np.diagonal(cm)
+    union = cm.sum(axis=0) + cm.sum(axis=1) - intersect
+    return intersect[1:], union[1:]
+
+
+def precision_recall_from_confusion(
+    cm: torch.Tensor,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Derive the counts for precision and recall per class (except background).
+
+    Parameters
+    ----------
+    cm : torch.Tensor
+        Confusion matrix (see confusion_matrix).
+
+    Returns
+    -------
+    np.ndarray
+        An array containing the number of true positives for each class.
+    np.ndarray
+        An array containing the sum of true positives and false negatives for each class.
+    np.ndarray
+        An array containing the sum of true positives and false positives for each class.
+    """
+    cm = cm.cpu().numpy()
+    return np.diagonal(cm)[1:], cm.sum(axis=1)[1:], cm.sum(axis=0)[1:]
+
+
 def iou_score(
     pred_cls: torch.Tensor, true_cls: torch.Tensor, nclass: int = 79
 ) -> tuple[np.ndarray, np.ndarray]:
@@ -48,18 +137,7 @@ def iou_score(
     np.ndarray
         An array containing the union for each class.
     """
-    intersect_ = []
-    union_ = []
-
-    for i in range(1, nclass):
-        intersect = (
-            ((pred_cls == i).float() + (true_cls == i).float()).eq(2).sum().item()
-        )
-        union = ((pred_cls == i).float() + (true_cls == i).float()).ge(1).sum().item()
-        intersect_.append(intersect)
-        union_.append(union)
-
-    return np.array(intersect_), np.array(union_)
+    return iou_from_confusion(confusion_matrix(pred_cls, true_cls, nclass))
 
 
 def precision_recall(
@@ -86,25 +164,16 @@ def precision_recall(
     np.ndarray
         An array containing the sum of true positives and false positives for each class.
     """
-    tpos_fneg = []
-    tpos_fpos = []
-    tpos = []
-
-    for i in range(1, nclass):
-        all_pred = (pred_cls == i).float()
-        all_gt = (true_cls == i).float()
-
-        tpos.append((all_pred + all_gt).eq(2).sum().item())
-        tpos_fpos.append(all_pred.sum().item())
-        tpos_fneg.append(all_gt.sum().item())
-
-    return np.array(tpos), np.array(tpos_fneg), np.array(tpos_fpos)
+    return precision_recall_from_confusion(confusion_matrix(pred_cls, true_cls, nclass))
 
 
 class DiceScore:
     """
     Accumulate the component of the dice coefficient i.e. the union and intersection.
 
+    Only the confusion matrix is accumulated (one bincount per batch on the device),
+    intersection and union matrices are derived from it.
+
     Attributes
     ----------
     op : callable
@@ -134,18 +203,32 @@ class DiceScore:
         self._device = device
         self.out_transform = output_transform
         self.n_classes = num_classes
-        self.union = torch.zeros(self.n_classes, self.n_classes, device=device)
-        self.intersection = torch.zeros(self.n_classes, self.n_classes, device=device)
+        self.cm = torch.zeros(
+            self.n_classes, self.n_classes, dtype=torch.int64, device=device
+        )
 
     def reset(self):
         """
         Reset the union and intersection matrices to zero.
         """
-        self.union = torch.zeros(self.n_classes, self.n_classes, device=self._device)
-        self.intersection = torch.zeros(
-            self.n_classes, self.n_classes, device=self._device
+        self.cm = torch.zeros(
+            self.n_classes, self.n_classes, dtype=torch.int64, device=self._device
         )
 
+    @property
+    def intersection(self) -> torch.Tensor:
+        """
+        Intersection of ground truth class i (row) and predicted class j (column).
+        """
+        return self.cm.float()
+
+    @property
+    def union(self) -> torch.Tensor:
+        """
+        Sum of the sizes of ground truth class i (row) and predicted class j (column).
+        """
+        return (self.cm.sum(dim=1, keepdim=True) + self.cm.sum(dim=0, keepdim=True)).float()
+
     def _check_output_type(self, output):
         """
         Check the output type.
@@ -168,12 +251,8 @@ class DiceScore:
         labels_batch : torch.Tensor
             Label batch.
         """
-        for i in range(self.n_classes):
-            gt = (labels_batch == i).float()
-            for j in range(self.n_classes):
-                pred = (batch_output == j).float()
-                self.intersection[i, j] += torch.sum(torch.mul(gt, pred))
-                self.union[i, j] += torch.sum(gt) + torch.sum(pred)
+        cm = confusion_matrix(batch_output, labels_batch, self.n_classes)
+        self.cm += cm.to(self.cm.device)
 
     def _update_union_intersection(
         self, batch_output: torch.Tensor, labels_batch: torch.Tensor
@@ -181,17 +260,16 @@ class DiceScore:
         """
         Update the union intersection.
 
+        The full confusion matrix is as cheap as its diagonal, so this is the same as
+        _update_union_intersection_matrix.
+
         Parameters
         ----------
         batch_output : torch.Tensor
             Batch output (prediction, labels).
         labels_batch : torch.Tensor
         """
-        for i in range(self.n_classes):
-            gt = (labels_batch == i).float()
-            pred = (batch_output == i).float()
-            self.intersection[i, i] += torch.sum(torch.mul(gt, pred))
-            self.union[i, i] += torch.sum(gt) + torch.sum(pred)
+        self._update_union_intersection_matrix(batch_output, labels_batch)
 
     def update(self, output: tuple[Any, Any], cnf_mat: bool):
         """
@@ -270,8 +348,125 @@ class DiceScore:
         return dice_cnf_matrix
 
 
-def dice_score(cm):
+def dice_score(cm: torch.Tensor | np.ndarray) -> np.ndarray:
     """
-    [MISSING].
+    Compute the dice score per class (except background) from a confusion matrix.
+
+    Parameters
+    ----------
+    cm : torch.Tensor, np.ndarray
+        Confusion matrix (see confusion_matrix).
+
+    Returns
+    -------
+    np.ndarray
+        The dice score of each class, NaN for classes in neither ground truth nor
+        prediction.
     """
-    pass
+    if isinstance(cm, torch.Tensor):
+        cm = cm.cpu().numpy()
+    intersect = np.diagonal(cm)[1:].astype(float)
+    total = cm.sum(axis=0)[1:] + cm.sum(axis=1)[1:]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(total > 0, 2 * intersect / total, np.nan)
+
+
+class VolumeConfusion:
+    """
+    Accumulate confusion matrices of whole volumes from slices in a background thread.
+
+    Batches of slices are passed with the subject index of each slice. A worker thread
+    computes the confusion matrices (on the device of the batches) and adds them to
+    the matrix of each subject, so the caller never waits for the device.
+
+    Methods
+    -------
+    start
+        Reset the matrices and start the worker thread.
+    submit
+        Queue a batch of predictions.
+    finish
+        Wait for all queued batches and get the confusion matrix of each subject.
+    """
+
+    def __init__(self, num_classes: int, max_pending: int = 8):
+        """
+        Construct object.
+
+        Parameters
+        ----------
+        num_classes : int
+            Number of classes.
+        max_pending : int, default=8
+            Maximum number of queued batches (submit blocks, if the queue is full).
+        """
+        self.num_classes = num_classes
+        self.cms: dict[int, np.ndarray] = {}
+        self._queue = queue.Queue(max_pending)
+        self._thread = None
+        self._error = None
+
+    def start(self):
+        """
+        Reset the matrices and start the worker thread.
+        """
+        self.cms = {}
+        self._error = None
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def submit(self, pred_cls: torch.Tensor, true_cls: torch.Tensor, subjects: torch.Tensor):
+        """
+        Queue a batch of predictions.
+
+        Parameters
+        ----------
+        pred_cls : torch.Tensor
+            Network prediction (categorical) of shape (N, H, W).
+        true_cls : torch.Tensor
+            Ground truth (categorical) of shape (N, H, W).
+        subjects : torch.Tensor
+            Subject index of each of the N slices.
+        """
+        self._queue.put((pred_cls.detach(), true_cls.detach(), subjects))
+
+    def finish(self) -> dict[int, np.ndarray]:
+        """
+        Wait for all queued batches and stop the worker thread.
+
+        Returns
+        -------
+        dict[int, np.ndarray]
+            The confusion matrix of each subject (by subject index).
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self._error is not None:
+            raise self._error
+        return self.cms
+
+    def _work(self):
+        """
+        Add the confusion matrices of queued batches until finish is called.
+        """
+        while (item := self._queue.get()) is not None:
+            if self._error is not None:
+                continue
+            try:
+                pred_cls, true_cls, subjects = item
+                subjects = torch.as_tensor(subjects).cpu().numpy()
+                for subject in np.unique(subjects):
+                    if np.all(subjects == subject):
+                        cm = confusion_matrix(pred_cls, true_cls, self.num_classes)
+                    else:
+                        mask = torch.from_numpy(subjects == subject).to(pred_cls.device)
+                        cm = confusion_matrix(pred_cls[mask], true_cls[mask], self.num_classes)
+                    cm = cm.cpu().numpy()
+                    if subject in self.cms:
+                        self.cms[subject] += cm
+                    else:
+                        self.cms[int(subject)] = cm
+            except Exception as e:
+                # raised in finish
+                self._error = e
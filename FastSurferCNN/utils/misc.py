@@ -27,6 +27,9 @@ from skimage import color
 from torchvision import utils
 
 import FastSurferCNN.data_loader.loader
+from FastSurferCNN.utils import logging
+
+LOGGER = logging.getLogger(__name__)
 
 
 def plot_predictions(
@@ -52,32 +55,92 @@ def plot_predictions(
     file_save_name : str
         Name the plot should be saved tp.
     """
-    f = plt.figure(figsize=(20, 10))
+    # no pyplot state and no in-place operations on the inputs, so this can run in a
+    # background thread (see AsyncPlotter)
+    f = matplotlib.figure.Figure(figsize=(20, 10))
     n, c, h, w = images_batch.shape
     mid_slice = c // 2
     images_batch = torch.unsqueeze(images_batch[:, mid_slice, :, :], 1)
-    img_grid = utils.make_grid(images_batch.cpu(), nrow=4)
+    img_grid = utils.make_grid(images_batch.float().cpu(), nrow=4)
 
-    plt.subplot(211)
-    grid = utils.make_grid(labels_batch.unsqueeze_(1).cpu(), nrow=4)[0]
+    ax = f.add_subplot(211)
+    grid = utils.make_grid(labels_batch.unsqueeze(1).cpu(), nrow=4)[0]
     color_grid = color.label2rgb(grid.numpy(), bg_label=0)
-    plt.imshow(img_grid.numpy().transpose((1, 2, 0)))
-    plt.imshow(color_grid, alpha=0.5)
-    plt.title("Ground Truth")
+    ax.imshow(img_grid.numpy().transpose((1, 2, 0)))
+    ax.imshow(color_grid, alpha=0.5)
+    ax.set_title("Ground Truth")
 
-    grid = utils.make_grid(batch_output.unsqueeze_(1).cpu(), nrow=4)[0]
+    grid = utils.make_grid(batch_output.unsqueeze(1).cpu(), nrow=4)[0]
     color_grid = color.label2rgb(grid.numpy(), bg_label=0)
-    plt.subplot(212)
-    plt.imshow(img_grid.numpy().transpose((1, 2, 0)))
-    plt.imshow(color_grid, alpha=0.5)
-    plt.title("Prediction")
+    ax = f.add_subplot(212)
+    ax.imshow(img_grid.numpy().transpose((1, 2, 0)))
+    ax.imshow(color_grid, alpha=0.5)
+    ax.set_title("Prediction")
 
-    plt.suptitle(plt_title)
-    plt.tight_layout()
+    f.suptitle(plt_title)
+    f.tight_layout()
 
     f.savefig(file_save_name, bbox_inches="tight")
-    plt.close(f)
-    plt.gcf().clear()
+
+
+class AsyncPlotter:
+    """
+    Write plots of predictions in a background thread, off the critical path of training.
+
+    Methods
+    -------
+    plot_predictions
+        Queue a plot of predictions (see plot_predictions).
+    close
+        Wait for all queued plots.
+    """
+
+    def __init__(self):
+        """
+        Construct object.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        # a single thread, so plots are written in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="plot")
+
+    def plot_predictions(
+        self,
+        images_batch: torch.Tensor,
+        labels_batch: torch.Tensor,
+        batch_output: torch.Tensor,
+        plt_title: str,
+        file_save_name: str,
+    ):
+        """
+        Queue a plot of predictions, see plot_predictions for the parameters.
+
+        The tensors may stay on the device, they are copied to the host in the
+        background thread.
+        """
+        future = self._executor.submit(
+            plot_predictions,
+            images_batch.detach(),
+            labels_batch.detach(),
+            batch_output.detach(),
+            plt_title,
+            file_save_name,
+        )
+        future.add_done_callback(self._log_error)
+
+    @staticmethod
+    def _log_error(future):
+        """
+        Log the exception of a failed plot.
+        """
+        if future.exception() is not None:
+            LOGGER.error(f"Plotting predictions failed: {future.exception()}")
+
+    def close(self):
+        """
+        Wait for all queued plots and stop the background thread.
+        """
+        self._executor.shutdown(wait=True)
 
 
 def plot_confusion_matrix(
@@ -333,6 +333,40 @@ ALL_FLAGS = {
         help="Allow asynchronous file operations (default: off). Note, this may impact the order of messages in the "
              "log, but speed up the segmentation specifically for slow file systems.",
     ),
+    "engine": __arg(
+        "--engine",
+        dest="engine",
+        default="eager",
+        choices=["eager", "torchscript", "onnx"],
+        help="Inference engine for the networks (default: eager). torchscript and onnx "
+             "run exported graphs with batch normalization folded into the "
+             "convolutions, which is faster on the cpu. onnx requires the onnx and "
+             "onnxruntime packages.",
+    ),
+    "quantized": __arg(
+        "--quantized",
+        dest="quantized",
+        action="store_true",
+        help="Use the int8 models of the quantized checkpoints (default: off, cpu "
+             "only). Create the quantized checkpoints with FastSurferCNN/quantize.py, "
+             "CerebNet/quantize.py or HypVINN/quantize.py.",
+    ),
+    "inference_workers": __arg(
+        "--inference_workers",
+        dest="inference_workers",
+        type=int,
+        default=1,
+        help="Number of batches (of all planes) to run concurrently, each with an equal "
+             "share of the threads (default: 1, the planes run one after another). On "
+             "cpus with many cores, 2-3 workers improve the core utilization.",
+    ),
+    "pin_cores": __arg(
+        "--pin_cores",
+        dest="pin_cores",
+        action="store_true",
+        help="Pin each inference worker to a disjoint set of cores (default: off, "
+             "linux only).",
+    ),
 }
 
 T_AddArgs = TypeVar("T_AddArgs", bound=CanAddArguments)
@@ -173,13 +173,12 @@ def rescale_image(img_data: np.ndarray) -> np.ndarray:
     # Conform intensities
     # TODO move function to FastSurferCNN similar: CerebNet.datasets.utils.rescale_image
     src_min, scale = getscale(img_data, 0, 255)
-    mapped_data = img_data
 
     # this used to rescale, if the image was not uint8 and any intensity was > 255
     if not np.allclose([src_min, scale], [0, 1]):
-        mapped_data = scalecrop(img_data, 0, 255, src_min, scale)
+        return scalecrop(img_data, 0, 255, src_min, scale, dtype=np.uint8)
 
-    return np.uint8(np.rint(mapped_data))
+    return np.uint8(np.rint(img_data))
 
 
 def hypo_map_label2subseg(mapped_subseg: npt.NDArray[int]) -> npt.NDArray[int]:
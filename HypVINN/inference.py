@@ -24,6 +24,8 @@ from tqdm import tqdm
 
 import FastSurferCNN.utils.logging as logging
 from FastSurferCNN.data_loader.augmentation import ToTensorTest, ZeroPad2DTest
+from FastSurferCNN.models.quantization import build_quantized_model
+from FastSurferCNN.utils.checkpoint import load_model_state, load_quantized_checkpoint
 from FastSurferCNN.utils.common import find_device
 from HypVINN.data_loader.data_utils import hypo_map_prediction_sagittal2full
 from HypVINN.data_loader.dataset import HypVINNDataset
@@ -56,6 +58,7 @@ class Inference:
             async_io: bool = False,
             device: str = "auto",
             viewagg_device: str = "auto",
+            quantized: bool = False,
     ):
         """
         Initialize the Inference class.
@@ -76,6 +79,8 @@ class Inference:
             The device to use for computations. Can be 'auto', 'cpu', or 'cuda'. Default is 'auto'.
         viewagg_device : str, optional
             The device to use for view aggregation. Can be 'auto', 'cpu', or 'cuda'. Default is 'auto'.
+        quantized : bool, default=False
+            Whether to use the int8 models of the quantized checkpoints (cpu only, see HypVINN/quantize.py).
         """
         self._threads = threads
         torch.set_num_threads(self._threads)
@@ -92,6 +97,11 @@ class Inference:
 
         # Define device and transfer model
         self.device = find_device(device)
+        if quantized and self.device.type != "cpu":
+            logger.warning(f"Quantized models only run on the cpu, using the float model on {self.device}.")
+            quantized = False
+        self.quantized = quantized
+        self.quantization = None
 
         if self.device.type == "cpu" and viewagg_device == "auto":
             self.viewagg_device = self.device
@@ -180,11 +190,16 @@ class Inference:
             The path to the checkpoint file. The checkpoint file should be a .pth file containing a state dictionary
             of a model.
         """
+        if self.quantized:
+            model_state, self.quantization = load_quantized_checkpoint(ckpt)
+            logger.info(f"Loading quantized checkpoint of {ckpt} ({self.quantization['backend']} backend)")
+            self.model = build_quantized_model(self.model, model_state)
+            return
         logger.info(f"Loading checkpoint {ckpt}")
-        # WARNING: weights_only=False can cause unsafe code execution, but here the
-        # checkpoint can be considered to be from a safe source
-        model_state = torch.load(ckpt, map_location=self.device, weights_only=False)
-        self.model.load_state_dict(model_state["model_state"])
+        model_state, mapped = load_model_state(ckpt, map_location=self.device)
+        # memory-mapped weights are used in-place on the cpu (shared between processes)
+        assign = mapped and torch.device(self.device).type == "cpu"
+        self.model.load_state_dict(model_state, assign=assign)
 
     def get_modelname(self):
         """
@@ -346,6 +361,48 @@ class Inference:
 
         return pred_prob
 
+    def make_dataset(
+            self,
+            subject_name: str,
+            modalities,
+            orig_zoom,
+            mode: ModalityMode = "t1t2",
+    ) -> HypVINNDataset:
+        """
+        Create the dataset of the slices of the current plane of a subject.
+
+        Parameters
+        ----------
+        subject_name : str
+            The name of the subject.
+        modalities : ModalityDict
+            The modalities of the subject.
+        orig_zoom : npt.NDArray[float]
+            The original zoom of the subject.
+        mode : ModalityMode, default="t1t2"
+            The mode of the modalities.
+
+        Returns
+        -------
+        HypVINNDataset
+            The dataset (padded to the padded size of the model).
+        """
+        return HypVINNDataset(
+            subject_name,
+            modalities,
+            orig_zoom,
+            self.cfg,
+            mode=mode,
+            transforms=transforms.Compose(
+                [
+                    ZeroPad2DTest(
+                        (self.cfg.DATA.PADDED_SIZE, self.cfg.DATA.PADDED_SIZE),
+                    ),
+                    ToTensorTest(),
+                ],
+            ),
+        )
+
     def run(
             self,
             subject_name: str,
@@ -383,21 +440,13 @@ class Inference:
             The updated prediction probabilities.
         """
         # Set up DataLoader
-        test_dataset = HypVINNDataset(
-            subject_name,
-            modalities,
-            orig_zoom,
-            self.cfg,
-            mode=mode,
-            transforms=transforms.Compose(
-                [
-                    ZeroPad2DTest(
-                        (self.cfg.DATA.PADDED_SIZE, self.cfg.DATA.PADDED_SIZE),
-                    ),
-                    ToTensorTest(),
-                ],
-            ),
-        )
+        test_dataset = self.make_dataset(subject_name, modalities, orig_zoom, mode)
+        calibration_mode = (self.quantization or {}).get("mode", mode)
+        if self.quantized and calibration_mode != mode:
+            logger.warning(
+                f"The quantized model was calibrated with {calibration_mode} images, but runs on "
+                f"{mode} images, consider recalibrating it with HypVINN/quantize.py."
+            )
 
         test_data_loader = DataLoader(
             dataset=test_dataset,
@@ -0,0 +1,224 @@
+# Copyright 2024 Image Analysis Lab, German Center for Neurodegenerative Diseases (DZNE), Bonn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Static post-training quantization of the HypVINN networks (see
+FastSurferCNN/quantize.py).
+
+The networks are calibrated on slices of a few T1w (and registered T2w) images, the
+quantized checkpoints are saved next to the float checkpoints and are used by
+HypVINN/run_prediction.py with --quantized. The modality mode (t1 or t1t2) of the
+calibration images should match the mode the quantized networks are used with.
+Finally, the int8 segmentations of the images are compared to the float32
+segmentations (dice).
+
+Usage:
+`python3 HypVINN/quantize.py --t1 <T1w images> [--t2 <T2w images>] [--ckpt_cor <checkpoint> ...]`
+"""
+
+# IMPORTS
+import argparse
+import sys
+from collections.abc import Iterator, Sequence
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from FastSurferCNN.quantize import (
+    add_calibration_arguments,
+    calibration_indices,
+    quantize_checkpoint,
+    report_dice,
+)
+from FastSurferCNN.utils import PLANES, Plane, logging, parser_defaults
+from FastSurferCNN.utils.common import assert_no_root
+from HypVINN.inference import Inference
+from HypVINN.run_prediction import (
+    get_prediction,
+    load_volumes,
+    prepare_checkpoints,
+    set_up_cfgs,
+)
+from HypVINN.utils import ModalityDict, ModalityMode, ViewOperations
+from HypVINN.utils.checkpoint import YAML_DEFAULT as CHECKPOINT_PATHS_FILE
+
+LOGGER = logging.getLogger(__name__)
+
+Volume = tuple[str, ModalityDict, np.ndarray, tuple[int, int, int]]
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """
+    Create the argparse object.
+
+    Returns
+    -------
+    argparse.ArgumentParser
+        The parser object.
+    """
+    parser = argparse.ArgumentParser(
+        description="Static post-training quantization (int8) of the HypVINN networks "
+                    "for cpu inference."
+    )
+    parser.add_argument(
+        "--t1",
+        dest="t1",
+        type=Path,
+        nargs="+",
+        required=True,
+        help="T1w images (conformed) to calibrate the quantization with. The int8 and "
+             "float32 segmentations of these images are compared.",
+    )
+    parser.add_argument(
+        "--t2",
+        dest="t2",
+        type=Path,
+        nargs="+",
+        default=None,
+        help="T2w images registered to the T1w images (same order as --t1) to calibrate "
+             "the multi-modal (t1t2) mode with (default: calibrate the t1 mode).",
+    )
+    parser = add_calibration_arguments(parser)
+    parser = parser_defaults.add_arguments(parser, ["batch_size", "threads", "allow_root"])
+    files: dict[Plane, str | Path] = {k: "default" for k in PLANES}
+    parser = parser_defaults.add_plane_flags(
+        parser, "checkpoint", files, CHECKPOINT_PATHS_FILE,
+    )
+    parser = parser_defaults.add_plane_flags(
+        parser,
+        "config",
+        {
+            "coronal": Path("HypVINN/config/HypVINN_coronal_v1.1.0.yaml"),
+            "axial": Path("HypVINN/config/HypVINN_axial_v1.1.0.yaml"),
+            "sagittal": Path("HypVINN/config/HypVINN_sagittal_v1.1.0.yaml"),
+        },
+        CHECKPOINT_PATHS_FILE,
+    )
+    return parser
+
+
+def calibration_batches(
+        model: Inference,
+        volumes: Sequence[Volume],
+        mode: ModalityMode = "t1",
+        num_slices: int = 32,
+        batch_size: int = 1,
+) -> Iterator[tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+    """
+    Yield batches of evenly spaced, non-empty slices of the volumes.
+
+    Parameters
+    ----------
+    model : Inference
+        The inference object with the model of the plane to calibrate.
+    volumes : Sequence[tuple[str, ModalityDict, np.ndarray, tuple[int, int, int]]]
+        The name, modalities, zoom and size of the images.
+    mode : ModalityMode, default="t1"
+        The modality mode.
+    num_slices : int, default=32
+        The number of slices per volume.
+    batch_size : int, default=1
+        The batch size.
+
+    Yields
+    ------
+    tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+        Batches of images, scale factors and weight factors (of the modalities).
+    """
+    for name, modalities, zoom, _ in volumes:
+        dataset = model.make_dataset(name, modalities, zoom, mode)
+        indices = calibration_indices(dataset.images, num_slices)
+        LOGGER.info(f"Calibrating {model.get_plane()} on {len(indices)} slices of {name}")
+        for batch in DataLoader(Subset(dataset, indices), batch_size=batch_size):
+            yield (
+                batch["image"],
+                batch["scale_factor"],
+                batch["weight_factor"].to(torch.float32),
+            )
+
+
+def main(
+        *,
+        t1: list[Path],
+        ckpt_ax: Path,
+        ckpt_cor: Path,
+        ckpt_sag: Path,
+        cfg_ax: Path,
+        cfg_cor: Path,
+        cfg_sag: Path,
+        t2: list[Path] | None = None,
+        calibration_slices: int = 32,
+        dice: bool = True,
+        batch_size: int = 1,
+        threads: int = 1,
+        allow_root: bool = False,
+) -> int | str:
+    allow_root or assert_no_root()
+
+    mode: ModalityMode = "t1" if t2 is None else "t1t2"
+    if t2 is not None and len(t2) != len(t1):
+        return f"Pass one T2w image per T1w image, got {len(t1)} T1w and {len(t2)} T2w images."
+    prepare_checkpoints(ckpt_ax, ckpt_cor, ckpt_sag)
+    view_ops: ViewOperations = {
+        plane: {"cfg": set_up_cfgs(cfg, None, batch_size), "ckpt": ckpt}
+        for plane, cfg, ckpt in zip(
+            PLANES, (cfg_ax, cfg_cor, cfg_sag), (ckpt_ax, ckpt_cor, ckpt_sag), strict=True,
+        )
+    }
+    try:
+        volumes = []
+        for i, t1_path in enumerate(t1):
+            t2_path = None if t2 is None else t2[i]
+            modalities, _, _, zoom, size = load_volumes(mode, t1_path, t2_path)
+            volumes.append((str(t1_path), modalities, zoom, size))
+    except (OSError, RuntimeError, ValueError) as e:
+        return e.args[0] if e.args else repr(e)
+
+    model = Inference(view_ops["coronal"]["cfg"], threads=threads, device="cpu", viewagg_device="cpu")
+    for plane, opts in view_ops.items():
+        LOGGER.info(f"Quantizing the {plane} network {opts['ckpt']}")
+        model.set_model(opts["cfg"])
+        model.load_checkpoint(opts["ckpt"])
+        batches = calibration_batches(model, volumes, mode, calibration_slices, batch_size)
+        names = [name for name, *_ in volumes]
+        quantize_checkpoint(model.model, batches, opts["ckpt"], names, calibration_slices, mode=mode)
+
+    if not dice:
+        return 0
+
+    int8_model = Inference(
+        view_ops["coronal"]["cfg"], threads=threads, device="cpu", viewagg_device="cpu",
+        quantized=True,
+    )
+    report_dice(
+        (
+            name,
+            get_prediction(name, modalities, zoom, int8_model, size, view_ops, mode=mode),
+            get_prediction(name, modalities, zoom, model, size, view_ops, mode=mode),
+        )
+        for name, modalities, zoom, size in volumes
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    parser = make_parser()
+    _args = parser.parse_args()
+
+    from FastSurferCNN.utils.logging import setup_logging
+    setup_logging(None)
+
+    sys.exit(main(**vars(_args)))
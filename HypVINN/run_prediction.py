@@ -24,6 +24,7 @@ from numpy import typing as npt
 if TYPE_CHECKING:
     import yacs.config
     from nibabel.filebasedimages import FileBasedHeader
+    from nibabel.spatialimages import SpatialImage
 
 from FastSurferCNN.utils import PLANES, Plane, logging, parser_defaults
 from FastSurferCNN.utils.checkpoint import (
@@ -135,7 +136,10 @@ def option_parse() -> argparse.ArgumentParser:
     advanced = parser.add_argument_group(title="Advanced options")
     parser_defaults.add_arguments(
         advanced,
-        ["device", "viewagg_device", "threads", "batch_size", "async_io", "allow_root"],
+        [
+            "device", "viewagg_device", "threads", "batch_size", "async_io", "allow_root",
+            "quantized",
+        ],
     )
 
     files: dict[Plane, str | Path] = {k: "default" for k in PLANES}
@@ -193,6 +197,7 @@ def main(
         async_io: bool = False,
         device: str = "auto",
         viewagg_device: str = "auto",
+        quantized: bool = False,
 ) -> int | str:
     """
     Main function of the hypothalamus segmentation module.
@@ -240,6 +245,8 @@ def main(
     viewagg_device : str, default="auto"
         The view aggregation device to use. Default is "auto", which automatically 
         selects the device.
+    quantized : bool, default=False
+        Whether to use the int8 models of the quantized checkpoints (cpu only).
 
     Returns
     -------
@@ -340,6 +347,7 @@ def main(
             threads=threads,
             viewagg_device=viewagg_device,
             device=device,
+            quantized=quantized,
         )
 
         logger.info('----' * 30)
@@ -449,8 +457,8 @@ def prepare_checkpoints(ckpt_ax, ckpt_cor, ckpt_sag):
 
 def load_volumes(
         mode: ModalityMode,
-        t1_path: Path | None = None,
-        t2_path: Path | None = None,
+        t1_path: "Path | SpatialImage | None" = None,
+        t2_path: "Path | SpatialImage | None" = None,
 ) -> tuple[
     ModalityDict,
     npt.NDArray[float],
@@ -469,10 +477,10 @@ def load_volumes(
     ----------
     mode : ModalityMode
         The mode of operation. Can be 't1', 't2', or 't1t2'.
-    t1_path : Path, optional
-        The path to the T1 image. Default is None.
-    t2_path : Path, optional
-        The path to the T2 image. Default is None.
+    t1_path : Path, SpatialImage, optional
+        The path to the T1 image (or the loaded T1 image). Default is None.
+    t2_path : Path, SpatialImage, optional
+        The path to the T2 image (or the loaded T2 image). Default is None.
 
     Returns
     -------
@@ -495,6 +503,7 @@ def load_volumes(
         If the mode is 't1t2' but the T1 and T2 images have different resolutions or sizes.
     """
     import nibabel as nib
+    from nibabel.spatialimages import SpatialImage
     modalities: ModalityDict = {}
 
     t1_size = ()
@@ -506,10 +515,14 @@ def load_volumes(
     zoom: tuple[float, float, float] = (0.0, 0.0, 0.0)
     size: tuple[int, ...] = (0, 0, 0)
 
-    if t1_path:
-        logger.info(f'Loading T1 image from : {t1_path}')
-        t1 = nib.load(t1_path)
-        t1 = nib.as_closest_canonical(t1)
+    def _load(image: "Path | SpatialImage", name: str) -> "SpatialImage":
+        if isinstance(image, SpatialImage):
+            return image
+        logger.info(f"Loading {name} image from : {image}")
+        return nib.load(image)
+
+    if t1_path is not None:
+        t1 = nib.as_closest_canonical(_load(t1_path, "T1"))
         if mode in ('t1t2', 't1'):
             affine = t1.affine
             header = t1.header
@@ -521,10 +534,8 @@ def load_volumes(
         modalities["t1"] = rescale_image(np.asarray(t1.dataobj))
         t1_size: tuple[int, ...] = modalities["t1"].shape
         size = t1_size
-    if t2_path:
-        logger.info(f"Loading T2 image from {t2_path}")
-        t2 = nib.load(t2_path)
-        t2 = nib.as_closest_canonical(t2)
+    if t2_path is not None:
+        t2 = nib.as_closest_canonical(_load(t2_path, "T2"))
         t2_zoom = t2.header.get_zooms()
         if mode == "t2":
             affine = t2.affine
@@ -47,7 +47,7 @@ def img2axcodes(img: nib.Nifti1Image) -> tuple:
 
 def save_segmentation(
         prediction: np.ndarray,
-        orig_path: Path,
+        orig_path: Path | nib.spatialimages.SpatialImage,
         ras_affine: npt.NDArray[float],
         ras_header: nib.nifti1.Nifti1Header | nib.nifti2.Nifti2Header | nib.freesurfer.mghformat.MGHHeader,
         subject_dir: Path,
@@ -65,8 +65,8 @@ def save_segmentation(
     ----------
     prediction : np.ndarray
         The prediction results.
-    orig_path : Path
-        The path to the original image.
+    orig_path : Path, nib.spatialimages.SpatialImage
+        The path to the original image (or the loaded original image).
     ras_affine : npt.NDArray[float]
         The affine transformation of the RAS orientation.
     ras_header : nibabel header object
@@ -93,7 +93,10 @@ def save_segmentation(
     pred_arr, labels_cc = get_clean_labels(np.array(prediction, dtype=np.uint8))
     # Mapped HypVINN labelst to FreeSurfer Hypvinn Labels
     pred_arr = hypo_map_subseg_2_fsseg(pred_arr)
-    orig_img = nib.load(orig_path)
+    if isinstance(orig_path, nib.spatialimages.SpatialImage):
+        orig_img = orig_path
+    else:
+        orig_img = nib.load(orig_path)
     LOGGER.info(f"Orig data orientation : {img2axcodes(orig_img)}")
 
     if save_mask:
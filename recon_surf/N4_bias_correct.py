@@ -17,6 +17,7 @@
 # IMPORTS
 # Group 1: Python native modules
 import argparse
+import hashlib
 import logging
 import sys
 from collections.abc import Callable
@@ -81,6 +82,23 @@ brainmask.
 
 One of --mask, --tal, --aseg must be passed to achieve rescaling.
 
+
+Fast mode (--fast) and bias field cache (--biasfield_cache <file.npz>):
+
+With --fast, N4 is run coarse-to-fine: first all but the finest fitting level on
+an image shrunk by twice the shrink factor, then only the finest level on the
+pre-corrected image shrunk by the shrink factor. Each level stops early, once the
+convergence threshold is reached (defaults to 1e-4 in this mode). The log bias
+field is estimated at the shrunken resolution and linearly interpolated to the
+input resolution.
+
+With --biasfield_cache, the log bias field is saved to the passed file together
+with a hash of the input image, the mask and the N4 parameters. If the file exists
+and matches, N4 is skipped entirely and the cached bias field is applied, e.g. when
+rerunning with different normalization settings. Without --fast, the bias field is
+cached at the input resolution, so the result is the same as without the cache;
+with --fast, the cached bias field is the (smaller) shrunken one.
+
 Original Author: Martin Reuter
 Date: Mar-18-2022
 
@@ -99,9 +117,12 @@ HELP_ASEG = "optional: path to aseg or aseg+dkt image to find the white matter m
 HELP_SHRINK_FACTOR = "<int> shrink factor, default: 4"
 HELP_LEVELS = "<int> number of fitting levels, default: 4"
 HELP_NUM_ITER = "<int> max number of iterations per level, default: 50"
-HELP_THRESHOLD = "<float> convergence threshold, default: 0.0"
+HELP_THRESHOLD = "<float> convergence threshold, default: 0.0 (1e-4 with --fast)"
 HELP_TALAIRACH = "<Path> file name of talairach.xfm if using this for finding origin"
 HELP_THREADS = "<int> number of threads, default: 1"
+HELP_FAST = "coarse-to-fine N4 with early stopping (see above)"
+HELP_BIASFIELD_CACHE = "optional: <Path> to an .npz file to cache the log bias field"
+FAST_THRESHOLD = 1e-4
 LiteralSkipRescaling = Literal["skip rescaling"]
 SKIP_RESCALING: LiteralSkipRescaling = "skip rescaling"
 LiteralDoNotSave = Literal["do not save"]
@@ -208,7 +229,7 @@ def options_parse():
         "--thres",
         dest="thres",
         help=HELP_THRESHOLD,
-        default=0.0,
+        default=None,
         type=float,
     )
     parser.add_argument(
@@ -225,6 +246,20 @@ def options_parse():
         default=1,
         type=int,
     )
+    parser.add_argument(
+        "--fast",
+        dest="fast",
+        help=HELP_FAST,
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--biasfield_cache",
+        dest="biasfield_cache",
+        help=HELP_BIASFIELD_CACHE,
+        default=None,
+        type=Path,
+    )
     parser.add_argument(
         "--version",
         action="version",
@@ -240,6 +275,7 @@ def itk_n4_bfcorrection(
         levels: int = 4,
         numiter: int = 50,
         thres: float = 0.0,
+        threads: int | None = None,
 ) -> sitk.Image:
     """
     Perform the bias field correction.
@@ -258,6 +294,8 @@ def itk_n4_bfcorrection(
         Maximum number if iterations. Defaults 50.
     thres : float
         Convergence threshold. Defaults to 0.0.
+    threads : int, optional
+        Number of threads for the N4 filter (default: ITK's global default).
 
     Returns
     -------
@@ -285,6 +323,8 @@ def itk_n4_bfcorrection(
     corrector = sitk.N4BiasFieldCorrectionImageFilter()
     corrector.SetMaximumNumberOfIterations([numiter] * levels)
     corrector.SetConvergenceThreshold(thres)
+    if threads is not None:
+        corrector.SetNumberOfThreads(threads)
 
     # bias correct image
     sitk.ProcessObject.SetGlobalDefaultCoordinateTolerance(1e-04)
@@ -301,6 +341,209 @@ def itk_n4_bfcorrection(
     return itk_bfcorr_image
 
 
+def _binary_mask(itk_image: sitk.Image, itk_mask: sitk.Image | None) -> sitk.Image:
+    """Binarize the mask or create a mask of ones."""
+    if itk_mask:
+        return itk_mask > 0
+    itk_mask = sitk.Abs(itk_image) >= 0
+    itk_mask.CopyInformation(itk_image)
+    return itk_mask
+
+
+def itk_n4_log_bias_field(
+        itk_image: sitk.Image,
+        itk_mask: sitk.Image | None = None,
+        shrink: int = 4,
+        levels: int = 4,
+        numiter: int = 50,
+        thres: float = FAST_THRESHOLD,
+        threads: int | None = None,
+        coarse_to_fine: bool = True,
+        reference: sitk.Image | None = None,
+) -> sitk.Image:
+    """
+    Estimate the log bias field (coarse-to-fine).
+
+    If coarse_to_fine, all but the finest fitting level are fitted on the image
+    shrunk by 2 * shrink. The finest level is then fitted on the image shrunk by
+    shrink, after the coarse bias field has been removed, so it usually converges
+    after few iterations. Else, all levels are fitted on the image shrunk by shrink.
+
+    Parameters
+    ----------
+    itk_image : sitk.Image
+        N-dimensional image.
+    itk_mask : sitk.Image, optional
+        Image mask. Defaults to None.
+    shrink : int
+        Shrink factor of the finest level. Defaults to 4.
+    levels : int
+        Number of fitting levels. Defaults to 4.
+    numiter : int
+        Maximum number of iterations per level. Defaults 50.
+    thres : float
+        Convergence threshold for early stopping in each level. Defaults to 1e-4.
+    threads : int, optional
+        Number of threads for the N4 filter (default: ITK's global default).
+    coarse_to_fine : bool, default=True
+        Whether to fit the coarse levels on a further shrunken image.
+    reference : sitk.Image, optional
+        The image whose grid to evaluate the log bias field on (only if not
+        coarse_to_fine), e.g. itk_image for the same result as itk_n4_bfcorrection.
+
+    Returns
+    -------
+    sitk.Image
+        The log bias field on the grid of reference (default: the image shrunk by
+        shrink).
+    """
+    _logger = logging.getLogger(__name__ + ".itk_n4_log_bias_field")
+    itk_mask = _binary_mask(itk_image, itk_mask)
+    sitk.ProcessObject.SetGlobalDefaultCoordinateTolerance(1e-04)
+
+    def n4(image, mask, n_levels, control_points=None):
+        corrector = sitk.N4BiasFieldCorrectionImageFilter()
+        corrector.SetMaximumNumberOfIterations([numiter] * n_levels)
+        corrector.SetConvergenceThreshold(thres)
+        if control_points is not None:
+            corrector.SetNumberOfControlPoints([control_points] * image.GetDimension())
+        if threads is not None:
+            corrector.SetNumberOfThreads(threads)
+        corrector.Execute(image, mask)
+        _logger.info(f"- {corrector.GetElapsedIterations()} iterations in the last level "
+                     f"(convergence {corrector.GetCurrentConvergenceMeasurement():.2e})")
+        return corrector
+
+    def shrink_by(image, factor):
+        return sitk.Shrink(image, [factor] * image.GetDimension()) if factor > 1 else image
+
+    itk_fine, itk_fine_mask = shrink_by(itk_image, shrink), shrink_by(itk_mask, shrink)
+    if levels < 2 or not coarse_to_fine:
+        corrector = n4(itk_fine, itk_fine_mask, levels)
+        return corrector.GetLogBiasFieldAsImage(itk_fine if reference is None else reference)
+
+    _logger.info(f"- coarse levels 1 to {levels - 1} (shrink {2 * shrink})")
+    coarse = n4(shrink_by(itk_image, 2 * shrink), shrink_by(itk_mask, 2 * shrink), levels - 1)
+    log_bias_coarse = coarse.GetLogBiasFieldAsImage(itk_fine)
+    # the finest level has the control points of the default (4 per dimension) after
+    # levels - 1 refinements (spline order 3)
+    _logger.info(f"- fine level {levels} (shrink {shrink})")
+    fine = n4(itk_fine / sitk.Exp(log_bias_coarse), itk_fine_mask, 1, 2 ** (levels - 1) + 3)
+    return log_bias_coarse + fine.GetLogBiasFieldAsImage(itk_fine)
+
+
+def apply_log_bias_field(itk_image: sitk.Image, log_bias_field: sitk.Image) -> sitk.Image:
+    """
+    Remove the bias field from the image (log bias field is interpolated linearly).
+
+    Parameters
+    ----------
+    itk_image : sitk.Image
+        N-dimensional image.
+    log_bias_field : sitk.Image
+        Log bias field, e.g. on the grid of the shrunken image.
+
+    Returns
+    -------
+    sitk.Image
+        Bias field corrected image.
+    """
+    if log_bias_field.GetSize() != itk_image.GetSize():
+        log_bias_field = sitk.Resample(
+            log_bias_field, itk_image, sitk.Transform(), sitk.sitkLinear, 0.0, sitk.sitkFloat32
+        )
+    else:
+        log_bias_field.CopyInformation(itk_image)
+    return itk_image / sitk.Exp(log_bias_field)
+
+
+def biasfield_cache_key(itk_image: sitk.Image, itk_mask: sitk.Image | None, **params) -> str:
+    """
+    Compute a hash of the image, the mask and the N4 parameters.
+
+    Parameters
+    ----------
+    itk_image : sitk.Image
+        Input image.
+    itk_mask : sitk.Image, optional
+        Image mask.
+    **params
+        N4 parameters.
+
+    Returns
+    -------
+    str
+        Hex digest of the hash.
+    """
+    key = hashlib.blake2b(digest_size=20)
+    key.update(repr(sorted(params.items())).encode())
+    for img in (itk_image, itk_mask):
+        if img is not None:
+            key.update(repr((img.GetSize(), img.GetOrigin(), img.GetSpacing())).encode())
+            key.update(sitk.GetArrayViewFromImage(img).tobytes())
+    return key.hexdigest()
+
+
+def read_biasfield_cache(cache_file: Path, key: str) -> sitk.Image | None:
+    """
+    Read the cached log bias field, if it exists and was created with the same key.
+
+    Parameters
+    ----------
+    cache_file : Path
+        Path to the cache file (.npz).
+    key : str
+        The key as returned by biasfield_cache_key.
+
+    Returns
+    -------
+    sitk.Image, optional
+        The cached log bias field or None.
+    """
+    _logger = logging.getLogger(__name__ + ".read_biasfield_cache")
+    if not cache_file.is_file():
+        return None
+    try:
+        with np.load(cache_file) as cache:
+            if str(cache["key"]) != key:
+                _logger.info(f"cached bias field {cache_file} does not match the input, ignoring it")
+                return None
+            log_bias_field = sitk.GetImageFromArray(cache["log_bias_field"])
+            log_bias_field.SetOrigin(cache["origin"].tolist())
+            log_bias_field.SetSpacing(cache["spacing"].tolist())
+            log_bias_field.SetDirection(cache["direction"].tolist())
+    except (OSError, KeyError, ValueError) as e:
+        _logger.warning(f"could not read cached bias field {cache_file}: {e}")
+        return None
+    _logger.info(f"using cached bias field {cache_file}")
+    return log_bias_field
+
+
+def write_biasfield_cache(cache_file: Path, key: str, log_bias_field: sitk.Image) -> None:
+    """
+    Write the log bias field and its key to the cache file.
+
+    Parameters
+    ----------
+    cache_file : Path
+        Path to the cache file (.npz).
+    key : str
+        The key as returned by biasfield_cache_key.
+    log_bias_field : sitk.Image
+        The log bias field.
+    """
+    logger.info(f"writing bias field cache {cache_file}")
+    with open(cache_file, "wb") as f:
+        np.savez_compressed(
+            f,
+            key=np.array(key),
+            log_bias_field=sitk.GetArrayFromImage(log_bias_field).astype(np.float32),
+            origin=np.asarray(log_bias_field.GetOrigin()),
+            spacing=np.asarray(log_bias_field.GetSpacing()),
+            direction=np.asarray(log_bias_field.GetDirection()),
+        )
+
+
 def normalize_wm_mask_ball(
         itk_image: sitk.Image,
         itk_mask: sitk.Image | None = None,
@@ -560,7 +803,9 @@ def print_options(options: dict):
            "- number iterations: {numiter}",
            "- convergence threshold: {thres}",
            "- talairach: {tal}" if options.get("tal") else None,
-           "- threads: {threads}")
+           "- threads: {threads}",
+           "- fast (coarse-to-fine) mode" if options.get("fast") else None,
+           "- bias field cache: {biasfield_cache}" if options.get("biasfield_cache") else None)
 
     _logger = logging.getLogger(__name__ + ".print_options")
     for m in msg:
@@ -617,6 +862,159 @@ def get_brain_centroid(itk_mask: sitk.Image) -> np.ndarray:
     return itk_mask.TransformPhysicalPointToIndex(centroid_world)
 
 
+def n4_bias_correct(
+        itk_image: sitk.Image,
+        itk_mask: sitk.Image | None = None,
+        shrink: int = 4,
+        levels: int = 4,
+        numiter: int = 50,
+        thres: float | None = None,
+        threads: int = 1,
+        fast: bool = False,
+        biasfield_cache: Path | None = None,
+) -> sitk.Image:
+    """
+    Remove the bias field from an image with N4 (see main for the options).
+
+    Parameters
+    ----------
+    itk_image : sitk.Image
+        N-dimensional float image.
+    itk_mask : sitk.Image, optional
+        Binary image mask. Defaults to None.
+    shrink : int
+        Shrink factor. Defaults to 4.
+    levels : int
+        Number of fitting levels. Defaults to 4.
+    numiter : int
+        Maximum number of iterations per level. Defaults to 50.
+    thres : float, optional
+        Convergence threshold. Defaults to 0.0 (1e-4, if fast).
+    threads : int
+        Number of threads. Defaults to 1.
+    fast : bool, default=False
+        Whether to fit the bias field coarse-to-fine with early stopping.
+    biasfield_cache : Path, optional
+        File to cache the log bias field in (shrunken, if fast).
+
+    Returns
+    -------
+    sitk.Image
+        The bias field corrected image.
+    """
+    _logger = logging.getLogger(__name__ + ".n4_bias_correct")
+    if thres is None:
+        thres = FAST_THRESHOLD if fast else 0.0
+
+    log_bias_field, cache_key = None, None
+    if biasfield_cache is not None:
+        cache_key = biasfield_cache_key(
+            itk_image, itk_mask, shrink=shrink, levels=levels, numiter=numiter, thres=thres, fast=fast,
+        )
+        log_bias_field = read_biasfield_cache(Path(biasfield_cache), cache_key)
+
+    if log_bias_field is None and (fast or biasfield_cache is not None):
+        # call N4 correct, with fast the log bias field is estimated at the shrunken
+        # resolution, else it is evaluated at the input resolution (like
+        # itk_n4_bfcorrection), so caching does not change the result
+        _logger.info("executing N4 correction" + (" (coarse-to-fine) ..." if fast else " ..."))
+        log_bias_field = itk_n4_log_bias_field(
+            itk_image, itk_mask, shrink, levels, numiter, thres, threads, coarse_to_fine=fast,
+            reference=None if fast else itk_image,
+        )
+        if biasfield_cache is not None:
+            write_biasfield_cache(Path(biasfield_cache), cache_key, log_bias_field)
+
+    if log_bias_field is not None:
+        return apply_log_bias_field(itk_image, log_bias_field)
+    # call N4 correct
+    _logger.info("executing N4 correction ...")
+    return itk_n4_bfcorrection(
+        itk_image,
+        itk_mask,
+        shrink,
+        levels,
+        numiter,
+        thres,
+        threads,
+    )
+
+
+def normalize_wm(
+        itk_bfcorr_image: sitk.Image,
+        itk_mask: sitk.Image | None = None,
+        itk_aseg: sitk.Image | None = None,
+        tal: Path | None = None,
+) -> sitk.Image:
+    """
+    Rescale the bias field corrected image, so the white matter has a fixed intensity
+    (105, if the white matter is found from the aseg, else 110) and convert to uchar.
+
+    Parameters
+    ----------
+    itk_bfcorr_image : sitk.Image
+        The bias field corrected image.
+    itk_mask : sitk.Image, optional
+        Binary image mask.
+    itk_aseg : sitk.Image, optional
+        Aseg-like segmentation image to find the white matter.
+    tal : Path, optional
+        The talairach.xfm file to find the white matter around the talairach origin
+        (if no aseg is passed).
+
+    Returns
+    -------
+    sitk.Image
+        The rescaled uchar image.
+
+    Raises
+    ------
+    ValueError
+        If neither aseg, tal nor mask are passed.
+    """
+    _logger = logging.getLogger(__name__ + ".normalize_wm")
+    target_wm = 110.
+    # do some rescaling
+
+    if itk_aseg is not None:  # has aseg
+        # used to be 110, but we found experimentally, that freesurfer wm-normalized
+        # intensity inside the WM mask is closer to 105 (but also quite inconsistent).
+        # So when we have a WM mask, we need to use 105 and not 110 as for the
+        # percentile approach above.
+        target_wm = 105.
+
+        _logger.info(f"normalize WM to {target_wm:.1f} (find WM from aseg)")
+        # only grab the white matter
+        itk_bfcorr_image = normalize_wm_aseg(
+            itk_bfcorr_image,
+            itk_mask,
+            itk_aseg,
+            target_wm=target_wm
+        )
+    else:
+        _logger.info(f"normalize WM to {target_wm:.1f} (find WM from mask & talairach)")
+        if tal:
+            talairach_center = read_talairach_xfm(tal)
+            brain_centroid = get_tal_origin_voxel(talairach_center, itk_bfcorr_image)
+        elif itk_mask is not None:
+            brain_centroid = get_brain_centroid(itk_mask)
+        else:
+            raise ValueError("Neither --tal, --mask, nor --aseg are passed, but "
+                             "rescaling is requested.")
+
+        itk_bfcorr_image = normalize_wm_mask_ball(
+            itk_bfcorr_image,
+            itk_mask,
+            centroid=brain_centroid,
+            target_wm=target_wm
+        )
+
+    _logger.info("converting rescaled to UCHAR")
+    return sitk.Cast(
+        sitk.Clamp(itk_bfcorr_image, lowerBound=0, upperBound=255), sitk.sitkUInt8
+    )
+
+
 def main(
     invol: Path,
     outvol: LiteralDoNotSave | Path = DO_NOT_SAVE,
@@ -628,9 +1026,11 @@ def main(
     shrink: int = 4,
     levels: int = 4,
     numiter: int = 50,
-    thres: float = 0.0,
+    thres: float | None = None,
     tal: Path | None = None,
     verbosity: int = -1,
+    fast: bool = False,
+    biasfield_cache: Path | None = None,
 ) -> int | str:
     if rescalevol == "skip rescaling" and outvol == DO_NOT_SAVE:
         return (
@@ -664,15 +1064,16 @@ def main(
     else:
         itk_mask = None
 
-    # call N4 correct
-    logger.info("executing N4 correction ...")
-    itk_bfcorr_image = itk_n4_bfcorrection(
+    itk_bfcorr_image = n4_bias_correct(
         itk_image,
         itk_mask,
-        shrink,
-        levels,
-        numiter,
-        thres,
+        shrink=shrink,
+        levels=levels,
+        numiter=numiter,
+        thres=thres,
+        threads=threads,
+        fast=fast,
+        biasfield_cache=biasfield_cache,
     )
 
     if outvol != DO_NOT_SAVE:
@@ -720,48 +1121,11 @@ def main(
     if rescalevol == SKIP_RESCALING:
         logger.info("Skipping WM normalization, ignoring talairach and aseg inputs")
     else:
-        target_wm = 110.
-        # do some rescaling
-
-        if aseg:  # has aseg
-            # used to be 110, but we found experimentally, that freesurfer wm-normalized
-            # intensity inside the WM mask is closer to 105 (but also quite inconsistent).
-            # So when we have a WM mask, we need to use 105 and not 110 as for the
-            # percentile approach above.
-            target_wm = 105.
-
-            logger.info(f"normalize WM to {target_wm:.1f} (find WM from aseg)")
-            # only grab the white matter
-            itk_aseg = iio.readITKimage(str(aseg), with_header=False)
-
-            itk_bfcorr_image = normalize_wm_aseg(
-                itk_bfcorr_image,
-                itk_mask,
-                itk_aseg,
-                target_wm=target_wm
-            )
-        else:
-            logger.info(f"normalize WM to {target_wm:.1f} (find WM from mask & talairach)")
-            if tal:
-                talairach_center = read_talairach_xfm(tal)
-                brain_centroid = get_tal_origin_voxel(talairach_center, itk_image)
-            elif has_mask:
-                brain_centroid = get_brain_centroid(itk_mask)
-            else:
-                return ("Neither --tal, --mask, nor --aseg are passed, but "
-                        "rescaling is requested.")
-
-            itk_bfcorr_image = normalize_wm_mask_ball(
-                itk_bfcorr_image,
-                itk_mask,
-                centroid=brain_centroid,
-                target_wm=target_wm
-            )
-
-        logger.info("converting rescaled to UCHAR")
-        itk_bfcorr_image = sitk.Cast(
-            sitk.Clamp(itk_bfcorr_image, lowerBound=0, upperBound=255), sitk.sitkUInt8
-        )
+        itk_aseg = iio.readITKimage(str(aseg), with_header=False) if aseg else None
+        try:
+            itk_bfcorr_image = normalize_wm(itk_bfcorr_image, itk_mask, itk_aseg, tal)
+        except ValueError as e:
+            return e.args[0]
 
         # write image
         logger.info(f"writing {type(rescalevol).__name__}: {rescalevol}")
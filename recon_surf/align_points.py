@@ -20,6 +20,9 @@
 # - find_rotation
 # - find_rigid
 # - find_affine
+# and to compute the paired points (label centroids)
+# - label_centroids
+# - select_labels
 
 # IMPORTS
 
@@ -204,3 +207,102 @@ def find_affine(p_mov: npt.NDArray, p_dst: npt.NDArray) -> np.ndarray:
     L, _, _, _ = np.linalg.lstsq(A, p_dst, rcond=None)
     T = np.vstack([np.transpose(L), np.array((0.0, 0.0, 0.0, 1.0))])
     return T
+
+
+def label_centroids(
+        labels: npt.ArrayLike,
+        coords: npt.ArrayLike | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the centroids of all labels with one weighted bincount per axis.
+
+    Works for labeled points (e.g. surface vertices and an annotation) as well as
+    label volumes. The cost is linear in the number of points or voxels and does not
+    depend on the number of labels.
+
+    Parameters
+    ----------
+    labels : npt.ArrayLike
+        Integer labels, either of shape (n,) for points or a label volume.
+    coords : npt.ArrayLike, optional
+        Point coordinates of shape (n, d). If None, labels is a volume and the
+        centroids are returned as (continuous) voxel indices in array axis order.
+
+    Returns
+    -------
+    ids : np.ndarray
+        Sorted array of all label ids present.
+    centroids : np.ndarray
+        Array of shape (len(ids), d) with the centroid of each label.
+    """
+    labels = np.asarray(labels)
+    flat = labels.ravel()
+    lmin = int(flat.min())
+    if int(flat.max()) - lmin < 2 ** 24:
+        # dense labels (the usual case): offset instead of sorting
+        codes = flat.astype(np.intp) - lmin
+        counts = np.bincount(codes)
+        present = np.flatnonzero(counts)
+        ids = present + lmin
+    else:
+        ids, codes = np.unique(flat, return_inverse=True)
+        counts = np.bincount(codes)
+        present = np.arange(ids.size)
+    counts = counts[present]
+    if coords is not None:
+        coords = np.asarray(coords)
+        weights = (coords[:, k] for k in range(coords.shape[1]))
+        ndim = coords.shape[1]
+    else:
+        # voxel index along axis k, broadcast over the other axes
+        shape = labels.shape
+        ndim = len(shape)
+        weights = (
+            np.broadcast_to(
+                np.arange(n, dtype=np.float64).reshape(
+                    [-1 if i == k else 1 for i in range(ndim)]
+                ),
+                shape,
+            ).ravel()
+            for k, n in enumerate(shape)
+        )
+    centroids = np.empty((ids.size, ndim))
+    for k, w in enumerate(weights):
+        centroids[:, k] = np.bincount(codes, weights=w, minlength=present[-1] + 1)[present]
+    centroids /= counts[:, np.newaxis]
+    return ids, centroids
+
+
+def select_labels(
+        ids: npt.NDArray,
+        values: npt.NDArray,
+        label_ids: npt.ArrayLike
+) -> np.ndarray:
+    """
+    Select the rows of values (e.g. centroids) that belong to label_ids.
+
+    Parameters
+    ----------
+    ids : npt.NDArray
+        Sorted label ids, one per row of values (as returned by label_centroids).
+    values : npt.NDArray
+        Per-label values.
+    label_ids : npt.ArrayLike
+        Label ids to select.
+
+    Returns
+    -------
+    np.ndarray
+        Rows of values in the order of label_ids.
+
+    Raises
+    ------
+    ValueError
+        If a label id is not present.
+    """
+    label_ids = np.asarray(label_ids)
+    idx = np.minimum(np.searchsorted(ids, label_ids), ids.size - 1)
+    missing = ids[idx] != label_ids
+    if np.any(missing):
+        raise ValueError(f"Labels not present: {label_ids[missing]}")
+    return values[idx]
@@ -100,6 +100,48 @@ def options_parse():
     return options
 
 
+def get_label_centroids(seg: sitk.Image) -> tuple[npt.NDArray, npt.NDArray]:
+    """
+    Compute the centroids of all labels of a segmentation in one pass.
+
+    Parameters
+    ----------
+    seg : sitk.Image
+        Segmentation image.
+
+    Returns
+    -------
+    ids
+        Sorted array of the label ids present in seg.
+    centroids
+        Array of the label centroids as (continuous) sitk indices (x, y, z).
+    """
+    # the view avoids a copy of the voxel buffer, sitk arrays are in z, y, x order
+    ids, centroids = align.label_centroids(sitk.GetArrayViewFromImage(seg))
+    return ids, centroids[:, ::-1]
+
+
+def index_to_physical(seg: sitk.Image, index: npt.NDArray) -> npt.NDArray:
+    """
+    Convert continuous sitk indices to physical points (vectorized).
+
+    Parameters
+    ----------
+    seg : sitk.Image
+        Image defining the index to physical mapping.
+    index : npt.NDArray
+        Array of shape (n, 3) with continuous indices (x, y, z).
+
+    Returns
+    -------
+    npt.NDArray
+        Array of shape (n, 3) with physical points.
+    """
+    direction = np.reshape(seg.GetDirection(), (3, 3))
+    scaled = index * np.asarray(seg.GetSpacing())
+    return np.asarray(seg.GetOrigin()) + scaled @ direction.T
+
+
 def get_seg_centroids(
         seg_mov: sitk.Image,
         seg_dst: sitk.Image,
@@ -124,32 +166,22 @@ def get_seg_centroids(
     centroids_dst
         List of centroids of target segmentation.
     """
+    # extract centroids of all segmentation labels, the label ids of these
+    # statistics also determine the common labels
+    ids_mov, index_mov = get_label_centroids(seg_mov)
+    ids_dst, index_dst = get_label_centroids(seg_dst)
     if label_ids is None:
         # use all joint labels except -1 and 0:
-        nda1 = sitk.GetArrayFromImage(seg_mov)
-        nda2 = sitk.GetArrayFromImage(seg_dst)
-        lids = np.intersect1d(nda1, nda2)
+        lids = np.intersect1d(ids_mov, ids_dst)
         lids = lids[(lids > 0)]
     else:
-        lids = label_ids
-    # extract centroids from segmentation labels
-    label_stats_mov = sitk.LabelShapeStatisticsImageFilter()
-    label_stats_mov.Execute(seg_mov)
-    label_stats_dst = sitk.LabelShapeStatisticsImageFilter()
-    label_stats_dst.Execute(seg_dst)
-    counter = 0
-    centroids_mov = np.empty([lids.size, 3])
-    centroids_dst = np.empty([lids.size, 3])
-    # print(lids)
-    for label in lids:
-        label = int(label)
-        centroids_mov[counter] = label_stats_mov.GetCentroid(label)
-        centroids_dst[counter] = label_stats_dst.GetCentroid(label)
-        # print("centroid physical: {}".format(centroid_world))
-        # centroidf = itkmask.TransformPhysicalPointToContinuousIndex(centroid_world)
-        # print("centroid voxel: {}".format(centroidf))
-        # centroid  = itkmask.TransformPhysicalPointToIndex(centroid_world)
-        counter = counter + 1
+        lids = np.asarray(label_ids)
+    centroids_mov = index_to_physical(
+        seg_mov, align.select_labels(ids_mov, index_mov, lids)
+    )
+    centroids_dst = index_to_physical(
+        seg_dst, align.select_labels(ids_dst, index_dst, lids)
+    )
     # FreeSurfer seems to have different RAS than sITK physical space
     # so we flip the axis accordingly (will ensure the return matrix
     # of a registration is RAS2RAS)
@@ -311,17 +343,9 @@ def align_flipped(seg: sitk.Image, mid_slice: float | None = None) -> npt.NDArra
         ]
     )
     ls = lhids.size
-    label_stats = sitk.LabelShapeStatisticsImageFilter()
-    label_stats.Execute(seg)
-    centroids = np.empty([2 * lhids.size, 3])
-    centroidsras = np.empty([2 * lhids.size, 3])
-    counter = 0
-    for label in np.concatenate((lhids, rhids)):
-        label = int(label)
-        centroidsras[counter] = label_stats.GetCentroid(label)
-        # convert to vox coord:
-        centroids[counter] = seg.TransformPhysicalPointToContinuousIndex(centroidsras[counter])
-        counter = counter + 1
+    # centroids in voxel coordinates
+    ids, index = get_label_centroids(seg)
+    centroids = align.select_labels(ids, index, np.concatenate((lhids, rhids)))
 
     # compute vox2ras matrix from image information
     vox2ras = get_vox2ras(seg)
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+
+
+# Copyright 2024 Image Analysis Lab, German Center for Neurodegenerative Diseases (DZNE), Bonn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# IMPORTS
+import getpass
+import optparse
+import os.path
+import platform
+import sys
+import time
+
+import nibabel.freesurfer.io as fs
+import numpy as np
+from lapy import TriaMesh
+from numpy import typing as npt
+
+HELPTEXT = """
+Script to compute per-parcel surface statistics (replacement for FreeSurfer's
+mris_anatomical_stats) for one or more annotations of a hemisphere.
+
+anatomical_stats.py --sid <subject id> --sd <subjects_dir> --hemi <lh or rh>
+                    --annot <annot file> [--annot <annot file> ...]
+                    --stats <stats file> [--stats <stats file> ...]
+                    [--ctab <ctab file> ...] [--surf <surf name>]
+
+Dependencies:
+    Python 3.8+
+    numpy, nibabel, lapy
+
+Description:
+The surfaces (white and pial) and the thickness file are read only once and
+per-vertex measures (area, gray matter volume, thickness, curvatures and curvature
+index contributions) are computed in one pass. Statistics of all parcels of all
+passed annotations are then aggregated with np.bincount and written in the
+FreeSurfer .stats table format:
+- NumVert:  number of vertices in the parcel
+- SurfArea: sum of vertex areas (1/3 of adjacent triangle areas) on the white surface
+- GrayVol:  sum of vertex volumes, where each triangle prism between white and pial
+            is split into 3 tetrahedra (like mris_anatomical_stats -th3)
+- ThickAvg, ThickStd: mean and standard deviation of the thickness at the vertices
+- MeanCurv, GausCurv: area-weighted mean of the rectified mean and Gaussian curvature
+- FoldInd, CurvInd: folding and intrinsic curvature index
+Note, curvatures are estimated with lapy (curvature tensor), not with FreeSurfer's
+quadratic fit, so MeanCurv, GausCurv, FoldInd and CurvInd differ slightly from
+mris_anatomical_stats.
+"""
+
+h_sid = "subject id (name of directory within the subject directory)"
+h_sd = "subject directory path"
+h_hemi = '"lh" or "rh"'
+h_annot = "path to annotation file, can be passed multiple times"
+h_stats = "path to output stats file, one for each --annot"
+h_ctab = "optional: path to output color table, one for each --annot"
+h_surf = "optional: surface to compute stats on (default white)"
+
+STATS_COLUMNS = [
+    ("StructName", "Structure Name", "NA"),
+    ("NumVert", "Number of Vertices", "unitless"),
+    ("SurfArea", "Surface Area", "mm^2"),
+    ("GrayVol", "Gray Matter Volume", "mm^3"),
+    ("ThickAvg", "Average Thickness", "mm"),
+    ("ThickStd", "Thickness StdDev", "mm"),
+    ("MeanCurv", "Integrated Rectified Mean Curvature", "mm^-1"),
+    ("GausCurv", "Integrated Rectified Gaussian Curvature", "mm^-2"),
+    ("FoldInd", "Folding Index", "unitless"),
+    ("CurvInd", "Intrinsic Curvature Index", "unitless"),
+]
+
+
+def options_parse():
+    """
+    Create a command line interface and return command line options.
+
+    Returns
+    -------
+    options : argparse.Namespace
+        Namespace object holding options.
+    """
+    parser = optparse.OptionParser(
+        version="%prog 1.0",
+        usage=HELPTEXT,
+    )
+    parser.add_option("--sid", dest="sid", help=h_sid)
+    parser.add_option("--sd", dest="sd", help=h_sd)
+    parser.add_option("--hemi", dest="hemi", help=h_hemi)
+    parser.add_option("--annot", dest="annot", help=h_annot, action="append")
+    parser.add_option("--stats", dest="stats", help=h_stats, action="append")
+    parser.add_option("--ctab", dest="ctab", help=h_ctab, action="append")
+    parser.add_option("--surf", dest="surf", help=h_surf, default="white")
+
+    (options, args) = parser.parse_args()
+
+    if options.sid is None or options.sd is None or options.hemi is None:
+        sys.exit("\nERROR: Please specify --sid, --sd and --hemi !\n   Use --help to see all options.\n")
+    if options.annot is None or options.stats is None or len(options.annot) != len(options.stats):
+        sys.exit("\nERROR: Please specify one --stats file for each --annot file !\n")
+    if options.ctab is not None and len(options.ctab) != len(options.annot):
+        sys.exit("\nERROR: Please specify one --ctab file for each --annot file !\n")
+
+    return options
+
+
+def prism_volumes(
+        white: npt.NDArray[float],
+        pial: npt.NDArray[float],
+        tria: npt.NDArray[int],
+) -> npt.NDArray[float]:
+    """
+    Compute the volume of the prisms spanned by white and pial triangles.
+
+    Each (oblique, truncated) prism is split into 3 tetrahedra.
+
+    Parameters
+    ----------
+    white : np.ndarray
+        Array (n, 3) of white surface vertex coordinates.
+    pial : np.ndarray
+        Array (n, 3) of pial surface vertex coordinates (same topology).
+    tria : np.ndarray
+        Array (m, 3) of triangle indices.
+
+    Returns
+    -------
+    np.ndarray
+        Array (m,) of prism volumes.
+    """
+    w0, w1, w2 = (white[tria[:, i]] for i in range(3))
+    p0, p1, p2 = (pial[tria[:, i]] for i in range(3))
+
+    def tet_vol(a, b, c, d):
+        return np.abs(np.einsum("ij,ij->i", np.cross(b - a, c - a), d - a)) / 6.0
+
+    return tet_vol(w0, w1, w2, p0) + tet_vol(w1, w2, p0, p1) + tet_vol(w2, p0, p1, p2)
+
+
+def vertex_measures(
+        surf_file: str,
+        pial_file: str,
+        thickness_file: str,
+) -> dict[str, npt.NDArray[float]]:
+    """
+    Read surfaces and thickness once and compute all per-vertex measures.
+
+    Parameters
+    ----------
+    surf_file : str
+        Path to the surface on which area and curvature are computed (white).
+    pial_file : str
+        Path to the pial surface.
+    thickness_file : str
+        Path to the thickness file.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Dictionary of per-vertex measures with keys area, grayvol, thickness,
+        mean_curv, gauss_curv (area-weighted and rectified), fold_ind and curv_ind
+        (contributions to folding and intrinsic curvature index).
+    """
+    mesh = TriaMesh.read_fssurf(surf_file)
+    pial = TriaMesh.read_fssurf(pial_file)
+    if pial.v.shape != mesh.v.shape:
+        raise ValueError(f"Surfaces {surf_file} and {pial_file} have different number of vertices!")
+    thickness = fs.read_morph_data(thickness_file)
+    if thickness.shape[0] != mesh.v.shape[0]:
+        raise ValueError(f"Thickness {thickness_file} does not match surface {surf_file}!")
+
+    area = mesh.vertex_areas()
+    # distribute the prism volume equally to the three vertices of each triangle
+    vol3 = np.repeat(prism_volumes(mesh.v, pial.v, mesh.t)[:, np.newaxis] / 3.0, 3, axis=1)
+    grayvol = np.bincount(mesh.t.reshape(-1), vol3.reshape(-1), minlength=mesh.v.shape[0])
+
+    _, _, k2, k1, curv_mean, curv_gauss, _ = mesh.curvature()
+    abs_k1 = np.abs(k1)
+    return {
+        "area": area,
+        "grayvol": grayvol,
+        "thickness": thickness.astype(np.float64),
+        "mean_curv": area * np.abs(curv_mean),
+        "gauss_curv": area * np.abs(curv_gauss),
+        "fold_ind": area * np.abs(abs_k1 * (abs_k1 - np.abs(k2))) / (4.0 * np.pi),
+        "curv_ind": np.where(curv_gauss > 0, area * curv_gauss, 0.0) / (4.0 * np.pi),
+    }
+
+
+def parcel_stats(
+        measures: dict[str, npt.NDArray[float]],
+        labels: npt.NDArray[int],
+        n_labels: int,
+) -> dict[str, npt.NDArray]:
+    """
+    Aggregate per-vertex measures for all parcels at once.
+
+    Parameters
+    ----------
+    measures : dict[str, np.ndarray]
+        Per-vertex measures as returned by vertex_measures.
+    labels : np.ndarray
+        Array (n,) of parcel indices (0 to n_labels-1) per vertex, negative for
+        vertices not assigned to a parcel (as returned by nibabel read_annot).
+    n_labels : int
+        Number of parcels (entries in the color table).
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Dictionary mapping the column names of the stats table (excluding
+        StructName) to arrays (n_labels,) of parcel values.
+    """
+    mask = labels >= 0
+    idx = labels[mask]
+
+    def _sum(values):
+        return np.bincount(idx, values[mask], minlength=n_labels)
+
+    num = np.bincount(idx, minlength=n_labels)
+    nonzero = np.maximum(num, 1)
+    area = _sum(measures["area"])
+    nonzero_area = np.where(area > 0, area, 1.0)
+    thick_avg = _sum(measures["thickness"]) / nonzero
+    thick_var = _sum(measures["thickness"] ** 2) / nonzero - thick_avg ** 2
+    return {
+        "NumVert": num,
+        "SurfArea": area,
+        "GrayVol": _sum(measures["grayvol"]),
+        "ThickAvg": thick_avg,
+        "ThickStd": np.sqrt(np.maximum(thick_var, 0.0)),
+        "MeanCurv": _sum(measures["mean_curv"]) / nonzero_area,
+        "GausCurv": _sum(measures["gauss_curv"]) / nonzero_area,
+        "FoldInd": _sum(measures["fold_ind"]),
+        "CurvInd": _sum(measures["curv_ind"]),
+    }
+
+
+def format_table(names: list[str], stats: dict[str, npt.NDArray]) -> list[str]:
+    """
+    Format the rows of the stats table (skipping parcels without vertices).
+
+    Parameters
+    ----------
+    names : list[str]
+        Names of the parcels.
+    stats : dict[str, np.ndarray]
+        Parcel statistics as returned by parcel_stats.
+
+    Returns
+    -------
+    list[str]
+        Lines of the table.
+    """
+    lines = []
+    for i, name in enumerate(names):
+        if stats["NumVert"][i] == 0:
+            continue
+        lines.append(
+            f"{name:<40s} {stats['NumVert'][i]:5d} {stats['SurfArea'][i]:5.0f} "
+            f"{stats['GrayVol'][i]:5.0f} {stats['ThickAvg'][i]:5.3f} {stats['ThickStd'][i]:5.3f} "
+            f"{stats['MeanCurv'][i]:8.3f} {stats['GausCurv'][i]:8.3f} "
+            f"{int(round(stats['FoldInd'][i])):4d} {stats['CurvInd'][i]:4.1f}"
+        )
+    return lines
+
+
+def write_ctab(ctab_file: str, ctab: npt.NDArray[int], names: list[str]) -> None:
+    """
+    Write the color table of an annotation in FreeSurfer's LUT format.
+
+    Parameters
+    ----------
+    ctab_file : str
+        Path to the output color table.
+    ctab : np.ndarray
+        Color table (n, 5) as returned by nibabel read_annot.
+    names : list[str]
+        Names of the labels.
+    """
+    with open(ctab_file, "w") as f:
+        for i, (name, col) in enumerate(zip(names, ctab, strict=True)):
+            f.write(f"{i:3d}  {name:<30s}  {col[0]:3d} {col[1]:3d} {col[2]:3d}  {col[3]:3d}\n")
+
+
+def _timestamp(filename: str) -> str:
+    return time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(os.path.getmtime(filename)))
+
+
+def write_stats(
+        stats_file: str,
+        names: list[str],
+        stats: dict[str, npt.NDArray],
+        measures: dict[str, npt.NDArray[float]],
+        header: dict[str, str],
+        brainvol_stats: str | None = None,
+) -> None:
+    """
+    Write a stats file in the format of mris_anatomical_stats.
+
+    Parameters
+    ----------
+    stats_file : str
+        Path to the output stats file.
+    names : list[str]
+        Names of the parcels.
+    stats : dict[str, np.ndarray]
+        Parcel statistics as returned by parcel_stats.
+    measures : dict[str, np.ndarray]
+        Per-vertex measures as returned by vertex_measures (for the global measures).
+    header : dict[str, str]
+        Ordered key-value pairs written to the header (subjectname, hemi, ...).
+    brainvol_stats : str, optional
+        Path to brainvol.stats, whose measures are copied into the header if it exists.
+    """
+    lines = [
+        "# Table of FreeSurfer cortical parcellation anatomical statistics ",
+        "# ",
+        f"# CreationTime {time.strftime('%Y/%m/%d-%H:%M:%S-GMT', time.gmtime())}",
+        f"# generating_program {os.path.basename(sys.argv[0])}",
+        f"# cmdline {' '.join(sys.argv)}",
+        f"# sysname  {platform.system()}",
+        f"# hostname {platform.node()}",
+        f"# machine  {platform.machine()}",
+        f"# user     {getpass.getuser()}",
+        "# ",
+    ]
+    lines.extend(f"# {key} {value}" for key, value in header.items())
+    n_vert = measures["area"].shape[0]
+    lines.extend([
+        f"# Measure Cortex, NumVert, Number of Vertices, {n_vert:d}, unitless",
+        f"# Measure Cortex, WhiteSurfArea, White Surface Total Area, {measures['area'].sum():g}, mm^2",
+        f"# Measure Cortex, MeanThickness, Mean Thickness, {measures['thickness'].mean():g}, mm",
+    ])
+    if brainvol_stats is not None and os.path.isfile(brainvol_stats):
+        lines.append("# BrainVolStatsFixed see surfer.nmr.mgh.harvard.edu/fswiki/BrainVolStatsFixed")
+        with open(brainvol_stats) as f:
+            lines.extend(line.rstrip() for line in f if line.startswith("# Measure "))
+    lines.append(f"# NTableCols {len(STATS_COLUMNS)}")
+    for i, (col, field, unit) in enumerate(STATS_COLUMNS, start=1):
+        lines.extend([
+            f"# TableCol {i:2d} ColHeader {col}",
+            f"# TableCol {i:2d} FieldName {field}",
+            f"# TableCol {i:2d} Units     {unit}",
+        ])
+    lines.append("# ColHeaders " + " ".join(col for col, _, _ in STATS_COLUMNS))
+    lines.extend(format_table(names, stats))
+    with open(stats_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def anatomical_stats(
+        subject_dir: str,
+        hemi: str,
+        annots: list[str],
+        stats_files: list[str],
+        ctab_files: list[str] | None = None,
+        surf: str = "white",
+        measures: dict[str, npt.NDArray[float]] | None = None,
+) -> dict[str, npt.NDArray[float]]:
+    """
+    Compute and write surface stats for multiple annotations of one hemisphere.
+
+    (Main function)
+
+    Parameters
+    ----------
+    subject_dir : str
+        Path to the subject directory.
+    hemi : str
+        Hemisphere "lh" or "rh".
+    annots : list[str]
+        Paths to the annotation files.
+    stats_files : list[str]
+        Paths to the output stats files (one per annotation).
+    ctab_files : list[str], optional
+        Paths to output color tables (one per annotation).
+    surf : str, default="white"
+        Name of the surface to compute area and curvature on.
+    measures : dict[str, np.ndarray], optional
+        Precomputed per-vertex measures (as returned by vertex_measures), are read
+        and computed if not passed.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        The per-vertex measures, so they can be reused for further annotations.
+    """
+    surfdir = os.path.join(subject_dir, "surf")
+    if measures is None:
+        print(f"Computing vertex measures for {hemi}.{surf} ...")
+        measures = vertex_measures(
+            os.path.join(surfdir, f"{hemi}.{surf}"),
+            os.path.join(surfdir, f"{hemi}.pial"),
+            os.path.join(surfdir, f"{hemi}.thickness"),
+        )
+    if ctab_files is None:
+        ctab_files = [None] * len(annots)
+    brainvol = os.path.join(subject_dir, "stats", "brainvol.stats")
+    for annot, stats_file, ctab_file in zip(annots, stats_files, ctab_files, strict=True):
+        print(f"Computing {stats_file} ...")
+        labels, ctab, names = fs.read_annot(annot)
+        if labels.shape[0] != measures["area"].shape[0]:
+            raise ValueError(f"Annotation {annot} does not match {hemi}.{surf}!")
+        names = [n.decode() if isinstance(n, bytes) else n for n in names]
+        stats = parcel_stats(measures, labels, len(names))
+        header = {
+            "SUBJECTS_DIR": os.path.dirname(os.path.abspath(subject_dir)),
+            "anatomy_type": "surface",
+            "subjectname": os.path.basename(os.path.abspath(subject_dir)),
+            "hemi": hemi,
+            "AnnotationFile": annot,
+            "AnnotationFileTimeStamp": _timestamp(annot),
+        }
+        if ctab_file is not None:
+            write_ctab(ctab_file, ctab, names)
+            header["ColorTable"] = ctab_file
+        write_stats(stats_file, names, stats, measures, header, brainvol)
+        print("\n".join(format_table(names, stats)))
+    return measures
+
+
+if __name__ == "__main__":
+    # Command Line options are error checking done here
+    options = options_parse()
+
+    anatomical_stats(
+        os.path.join(options.sd, options.sid),
+        options.hemi,
+        options.annot,
+        options.stats,
+        options.ctab,
+        options.surf,
+    )
+
+    sys.exit(0)
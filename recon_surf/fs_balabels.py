@@ -23,6 +23,7 @@ import os.path
 import sys
 
 import numpy as np
+from anatomical_stats import anatomical_stats
 from create_annotation import (
     build_annot,
     map_multiple_labels,
@@ -38,7 +39,7 @@ Grill-Spector labels into annotations and produce statistics on some.
 fs_balabels.py --sid <subject id> --sd <subjects_dir> 
 
 Optional flags:
-               --fsaverage <fsaverage dir> --hemi <lh or rh>
+               --fsaverage <fsaverage dir> --hemi <lh or rh> --python_stats
 
 Dependencies:
     Python 3.8+
@@ -55,8 +56,10 @@ hemisphere it will:
 2. map BA_exvivo.thresh labels
 3. map Grill-Spector labels 
 4. create annotations for each of those 
-5. compute surface stats files for the BA_exvivo labels (currently still using
-   FreeSurfer's mris_anatomical_stats via command line execution)
+5. compute surface stats files for the BA_exvivo labels (with FreeSurfer's
+   mris_anatomical_stats via command line, or in python from a single read of white,
+   pial and thickness if --python_stats is passed, see anatomical_stats.py; the
+   curvature columns differ slightly from mris_anatomical_stats)
 Note, this script needs to be updated if FreeSurfer introduces changes into the -balabel 
 block of recon-all. Currently this is based on FreeSurfer 7.3.2.
 
@@ -70,6 +73,10 @@ h_hemi = 'optional: "lh" or "rh" (default run both hemispheres)'
 h_fsaverage = (
     "optional: path to fsaverage (default is $FREESURFER_HOME/subjects/fsaverage)"
 )
+h_python_stats = (
+    "optional: compute stats in python instead of with FreeSurfer's "
+    "mris_anatomical_stats (curvature columns differ slightly)"
+)
 
 
 def options_parse():
@@ -89,6 +96,9 @@ def options_parse():
     parser.add_option("--sd", dest="sd", help=h_sd)
     parser.add_option("--hemi", dest="hemi", help=h_hemi)
     parser.add_option("--fsaverage", dest="fsaverage", help=h_fsaverage)
+    parser.add_option(
+        "--python_stats", dest="python_stats", help=h_python_stats, action="store_true", default=False
+    )
 
     (options, args) = parser.parse_args()
 
@@ -250,6 +260,7 @@ if __name__ == "__main__":
         # merge labels into annot
         pos = 0  # 0,1,2
         start = 0  # to corresponding blocks from all_labels and all_values
+        stats_annots, stats_files, stats_ctabs = [], [], []
         # print("Debug length all labels: {}".format(len(all_labels)))
         for annot in annotnames:
             # print("Debug length labelids pos {}".format(len(label_ids[pos])))
@@ -271,19 +282,32 @@ if __name__ == "__main__":
             write_annot(
                 annot_ids, label_names[pos], colnames[pos], annotout, colappend[pos]
             )
-            # now call annatomical stats from command line (only for BA_exvivo)
+            # collect annotations for anatomical stats (only for BA_exvivo)
             if pos < 2:
-                print("Computing " + hemi + "." + annot + ".stats ...")
-                stats = os.path.join(
+                stats_annots.append(annotout)
+                stats_files.append(os.path.join(
                     options.sd, options.sid, "stats", hemi + "." + annot + ".stats"
-                )
-                ctab = os.path.join(options.sd, options.sid, "label", annot + ".ctab")
+                ))
+                stats_ctabs.append(os.path.join(options.sd, options.sid, "label", annot + ".ctab"))
+            start = stop
+            pos = pos + 1
+        if options.python_stats:
+            # all annotations of this hemisphere from one read of white, pial and thickness
+            anatomical_stats(
+                os.path.join(options.sd, options.sid),
+                hemi,
+                stats_annots,
+                stats_files,
+                stats_ctabs,
+            )
+        else:
+            # call anatomical stats from command line
+            for annotout, stats, ctab in zip(stats_annots, stats_files, stats_ctabs, strict=True):
+                print("Computing " + stats + " ...")
                 cmd = f"mris_anatomical_stats -mgz -f {stats} -b -a {annotout} -c {ctab} \
                        {options.sid} {hemi} white"
                 print("Debug cmd: " + cmd)
                 stream = os.popen(cmd)
                 print(stream.read())
-            start = stop
-            pos = pos + 1
 
     print("...done\n")
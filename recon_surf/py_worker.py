@@ -0,0 +1,611 @@
+#!/usr/bin/env python3
+
+
+# Copyright 2024 Image Analysis Lab, German Center for Neurodegenerative Diseases (DZNE), Bonn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# IMPORTS
+# Note: only import modules of the standard library at the top of this file, the client
+# (py_worker.py run) has to start fast, heavy modules are imported by the server only.
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+HELPTEXT = """
+Persistent python worker for the python helper scripts of recon-surf.sh.
+
+py_worker.py serve --socket <socket> [--parent_pid <pid>] [--cache_mb <mb>]
+py_worker.py ping  [--timeout <seconds>]
+py_worker.py run   <script.py> [script args ...]
+py_worker.py stop
+
+Description:
+The server (serve) imports numpy, scipy, nibabel, SimpleITK, lapy, etc. once and
+listens on a unix socket. For each client request it forks a child process (the
+imports are shared copy-on-write), which takes over the stdin/stdout/stderr, the
+working directory, the environment and the command line arguments of the client and
+runs the script as __main__. The exit code of the script is returned to the client.
+Decompressed compressed volumes (.mgz, .nii.gz) loaded by scripts via nibabel.load
+are cached in the server (LRU, keyed by path, modification time and size), so later
+scripts that load the same (unchanged) files skip decompression. The server fills the
+cache in chunks between requests, so requests do not wait for the decompression.
+
+The client (run) only uses the standard library. The socket is read from the
+environment variable FASTSURFER_PY_WORKER. If it is not set or the server cannot
+be reached, the client falls back to running the script in a new interpreter, so
+'python3 py_worker.py run' can replace 'python3' in any command line.
+
+Note, numerical libraries read their thread settings (e.g. OMP_NUM_THREADS) when
+they are imported, i.e. from the environment of the server.
+
+If the environment variable FSTIME_JSON of the client is set, the resources used by
+each script are appended to that file (see telemetry.py).
+"""
+
+SOCKET_ENV = "FASTSURFER_PY_WORKER"
+COMPRESSED_EXT = (".mgz", ".nii.gz")
+DEFAULT_PRELOAD = [
+    "numpy",
+    "scipy.ndimage",
+    "scipy.sparse",
+    "nibabel",
+    "SimpleITK",
+    "lapy",
+    "skimage.measure",
+    "pandas",
+    "yaml",
+]
+_HEADER = struct.Struct("!Q")
+_EXIT = struct.Struct("!i")
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """
+    Create a command line interface.
+
+    Returns
+    -------
+    argparse.ArgumentParser
+        The parser object.
+    """
+    parser = argparse.ArgumentParser(
+        description=HELPTEXT,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve = subparsers.add_parser("serve", help="start the worker server")
+    serve.add_argument(
+        "--socket",
+        default=os.environ.get(SOCKET_ENV),
+        help=f"path of the unix socket (default: ${SOCKET_ENV})",
+    )
+    serve.add_argument(
+        "--parent_pid",
+        type=int,
+        default=None,
+        help="shut down the server, once the process with this pid has terminated",
+    )
+    serve.add_argument(
+        "--idle_timeout",
+        type=float,
+        default=None,
+        help="shut down the server after this many seconds without requests",
+    )
+    serve.add_argument(
+        "--cache_mb",
+        type=float,
+        default=2048.,
+        help="maximum size of the volume cache in MB (default: 2048, 0 to disable)",
+    )
+    serve.add_argument(
+        "--preload",
+        nargs="*",
+        default=DEFAULT_PRELOAD,
+        help="modules to import in the server (default: %(default)s)",
+    )
+    ping = subparsers.add_parser("ping", help="wait until the server accepts requests")
+    ping.add_argument(
+        "--timeout",
+        type=float,
+        default=60.,
+        help="seconds to wait for the server (default: 60)",
+    )
+    subparsers.add_parser("stop", help="shut down the server")
+    # the arguments of run are not parsed (see main)
+    subparsers.add_parser("run", help="run a script in the server: run <script.py> [args ...]")
+    return parser
+
+
+def _connect(socket_path: str | None) -> socket.socket | None:
+    """Connect to the server or return None, if that fails."""
+    if not socket_path:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def _send_request(sock: socket.socket, request: dict, fds: list[int] = ()) -> None:
+    """Send a length-prefixed json request (and pass file descriptors along)."""
+    payload = json.dumps(request).encode()
+    socket.send_fds(sock, [_HEADER.pack(len(payload))], list(fds))
+    sock.sendall(payload)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    """Receive exactly size bytes (or less, if the connection is closed)."""
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_request(sock: socket.socket) -> tuple[dict, list[int]]:
+    """Receive a length-prefixed json request and the passed file descriptors."""
+    header, fds, _, _ = socket.recv_fds(sock, _HEADER.size, 3)
+    if len(header) < _HEADER.size:
+        header += _recv_exactly(sock, _HEADER.size - len(header))
+    (size,) = _HEADER.unpack(header)
+    return json.loads(_recv_exactly(sock, size)), fds
+
+
+def run_client(args: list[str]) -> int:
+    """
+    Run a script in the server, fall back to a new interpreter if unavailable.
+
+    Parameters
+    ----------
+    args : list[str]
+        The script and its arguments (like for the python interpreter).
+
+    Returns
+    -------
+    int
+        The exit code of the script.
+    """
+    sock = _connect(os.environ.get(SOCKET_ENV))
+    if sock is None or not args or args[0].startswith("-"):
+        # no server (or interpreter options), run in a fresh interpreter
+        if sock is not None:
+            sock.close()
+        os.execv(sys.executable, [sys.executable] + args)
+    with sock:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        request = {
+            "command": "run",
+            "argv": args,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+        }
+        _send_request(sock, request, [0, 1, 2])
+        status = _recv_exactly(sock, _EXIT.size)
+    if len(status) < _EXIT.size:
+        print("ERROR: py_worker terminated before the script finished!", file=sys.stderr)
+        return 1
+    return _EXIT.unpack(status)[0]
+
+
+def ping(timeout: float) -> int:
+    """
+    Wait until the server accepts connections.
+
+    Parameters
+    ----------
+    timeout : float
+        Maximum time to wait in seconds.
+
+    Returns
+    -------
+    int
+        0, if the server is available, else 1.
+    """
+    end = time.monotonic() + timeout
+    while True:
+        sock = _connect(os.environ.get(SOCKET_ENV))
+        if sock is not None:
+            with sock:
+                _send_request(sock, {"command": "ping"})
+            return 0
+        if time.monotonic() > end:
+            print(f"ERROR: py_worker at ${SOCKET_ENV} not available after {timeout} seconds.", file=sys.stderr)
+            return 1
+        time.sleep(0.1)
+
+
+def stop() -> int:
+    """
+    Shut down the server.
+
+    Returns
+    -------
+    int
+        0, if the server was stopped, 1 if it was not reachable.
+    """
+    sock = _connect(os.environ.get(SOCKET_ENV))
+    if sock is None:
+        return 1
+    with sock:
+        _send_request(sock, {"command": "stop"})
+    return 0
+
+
+class VolumeCache:
+    """
+    LRU cache of decompressed volume files, keyed by path, modification time and size.
+
+    Files are decompressed incrementally (see fill), so the server can handle requests
+    while the cache is filled.
+
+    Attributes
+    ----------
+    max_bytes : int
+        Maximum total size of the cached data.
+    chunk_size : int
+        Maximum number of bytes to decompress per call of fill.
+    """
+
+    def __init__(self, max_bytes: int, chunk_size: int = 4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._pending = OrderedDict()
+        self._filling = None
+
+    @staticmethod
+    def key(path: str) -> tuple[str, int, int] | None:
+        """Return the cache key of path or None, if path does not exist."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return path, stat.st_mtime_ns, stat.st_size
+
+    @property
+    def pending(self) -> bool:
+        """Whether files are scheduled to be decompressed."""
+        return self._filling is not None or bool(self._pending)
+
+    def get(self, path: str):
+        """Return an image object of the cached file (or None, if not cached)."""
+        entry = self._entries.get(self.key(path))
+        if entry is None:
+            return None
+        klass, data = entry
+        return klass.from_bytes(data)
+
+    def add(self, path: str) -> None:
+        """Schedule path to be decompressed into the cache (or mark it as recently used)."""
+        if self.max_bytes <= 0:
+            return
+        key = self.key(path)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        elif key is not None:
+            self._pending[path] = None
+            self._pending.move_to_end(path)
+
+    def fill(self) -> None:
+        """Decompress the next chunk (at most chunk_size bytes) of the scheduled files."""
+        if self._filling is None:
+            if not self._pending:
+                return
+            path, _ = self._pending.popitem(last=False)
+            self._filling = self._decompress(path)
+        try:
+            next(self._filling)
+        except StopIteration:
+            self._filling = None
+
+    def _decompress(self, path: str):
+        """Decompress path into the cache, yielding after each chunk."""
+        key = self.key(path)
+        if key is None or key in self._entries:
+            return
+        import gzip
+
+        import nibabel as nib
+
+        # drop outdated versions of this file
+        for old in [k for k in self._entries if k[0] == path]:
+            self._size -= len(self._entries.pop(old)[1])
+        chunks, size = [], 0
+        try:
+            # like nibabel.load, but only sniff the header (loading an mgz reads the
+            # footer, i.e. decompresses the whole file)
+            klass, sniff = None, None
+            for image_klass in nib.all_image_classes:
+                is_valid, sniff = image_klass.path_maybe_image(path, sniff)
+                if is_valid:
+                    klass = image_klass
+                    break
+            if not hasattr(klass, "from_bytes"):
+                return
+            with gzip.open(path, "rb") as f:
+                while chunk := f.read(self.chunk_size):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        return
+                    chunks.append(chunk)
+                    yield
+        except Exception as e:
+            print(f"WARNING: Could not cache {path}: {e}")
+            return
+        if self.key(path) != key:
+            # the file was changed while decompressing
+            return
+        data = b"".join(chunks)
+        self._entries[key] = (klass, data)
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, (_, old_data) = self._entries.popitem(last=False)
+            self._size -= len(old_data)
+
+
+def _patch_nibabel_load(cache: VolumeCache, loaded: list[str]) -> None:
+    """Make nibabel.load read from cache and record all loaded compressed volumes."""
+    import nibabel as nib
+    import nibabel.loadsave
+
+    original_load = nibabel.loadsave.load
+
+    def load(filename, **kwargs):
+        if isinstance(filename, str | os.PathLike):
+            path = os.path.abspath(os.fspath(filename))
+            if path.endswith(COMPRESSED_EXT):
+                loaded.append(path)
+                img = None if kwargs else cache.get(path)
+                if img is not None:
+                    return img
+        return original_load(filename, **kwargs)
+
+    load.__doc__ = original_load.__doc__
+    nib.load = load
+    nibabel.loadsave.load = load
+
+
+def _run_script(request: dict, fds: list[int], cache: VolumeCache, report_fd: int) -> int:
+    """
+    Run the requested script in this (forked) process.
+
+    Parameters
+    ----------
+    request : dict
+        The request with argv, cwd and env of the client.
+    fds : list[int]
+        The stdin, stdout and stderr file descriptors of the client.
+    cache : VolumeCache
+        The volume cache (inherited from the server).
+    report_fd : int
+        File descriptor to report the loaded volumes back to the server.
+
+    Returns
+    -------
+    int
+        Exit code of the script.
+    """
+    import runpy
+    import signal
+    import traceback
+
+    # import before sys.path is replaced (telemetry.py is next to this file)
+    import telemetry
+
+    start, wall_start = time.time(), time.perf_counter()
+    # the memory inherited from the server is not used by the script
+    start_rss_kb = telemetry.status_kb()
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.stdout.reconfigure(line_buffering=True)
+    os.environ.clear()
+    os.environ.update(request["env"])
+    os.chdir(request["cwd"])
+    script = request["argv"][0]
+    sys.argv = list(request["argv"])
+    # sys.path like for "python script.py": script directory, PYTHONPATH, site paths
+    pythonpath = [p for p in os.environ.get("PYTHONPATH", "").split(os.pathsep) if p]
+    sys.path[:] = [os.path.dirname(os.path.abspath(script))] + pythonpath + _BASE_SYS_PATH
+    loaded = []
+    _patch_nibabel_load(cache, loaded)
+    try:
+        runpy.run_path(script, run_name="__main__")
+        code = 0
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with os.fdopen(report_fd, "w") as report:
+            json.dump(loaded, report)
+        # the client is not the process doing the work, so fs_time leaves the record
+        # of the resources used to the worker
+        if os.environ.get(telemetry.RECORD_ENV):
+            record = telemetry.python_record(
+                request["argv"], start, time.perf_counter() - wall_start, code, start_rss_kb,
+            )
+            telemetry.write_record(os.environ[telemetry.RECORD_ENV], record)
+    return code
+
+
+def serve(
+        socket_path: str,
+        parent_pid: int | None = None,
+        idle_timeout: float | None = None,
+        cache_mb: float = 2048.,
+        preload: list[str] = DEFAULT_PRELOAD,
+) -> None:
+    """
+    Run the worker server until stopped.
+
+    (Main function)
+
+    Parameters
+    ----------
+    socket_path : str
+        Path of the unix socket to listen on.
+    parent_pid : int, optional
+        Shut down, once the process with this pid has terminated.
+    idle_timeout : float, optional
+        Shut down after this many seconds without requests.
+    cache_mb : float, default=2048
+        Maximum size of the volume cache in MB.
+    preload : list[str]
+        Modules to import.
+    """
+    import importlib
+    import selectors
+    import signal
+
+    if not socket_path:
+        sys.exit(f"ERROR: Please specify --socket or set ${SOCKET_ENV}!")
+    start = time.perf_counter()
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print(f"WARNING: Could not preload {module}: {e}")
+    print(f"py_worker: imported {', '.join(preload)} in {time.perf_counter() - start:.2f} seconds")
+    # children are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    cache = VolumeCache(int(cache_mb * 1024 * 1024))
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    server.listen(16)
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ, None)
+    reports = {}
+    last_request = time.monotonic()
+    print(f"py_worker: listening on {socket_path}")
+    try:
+        while True:
+            # do not wait while the cache is filled (one chunk per iteration)
+            for key, _ in selector.select(timeout=0. if cache.pending else 5.):
+                if key.data is not None:
+                    # a child reports its loaded volumes
+                    chunk = os.read(key.fd, 1 << 16)
+                    if chunk:
+                        reports[key.fd] += chunk
+                        continue
+                    selector.unregister(key.fd)
+                    os.close(key.fd)
+                    try:
+                        loaded = json.loads(reports.pop(key.fd) or b"[]")
+                    except json.JSONDecodeError:
+                        loaded = []
+                    for path in dict.fromkeys(loaded):
+                        cache.add(path)
+                    continue
+                conn, _ = server.accept()
+                last_request = time.monotonic()
+                with conn:
+                    try:
+                        request, fds = _recv_request(conn)
+                    except (OSError, ValueError) as e:
+                        print(f"WARNING: invalid request: {e}")
+                        continue
+                    command = request.get("command")
+                    if command == "stop":
+                        return
+                    if command != "run" or len(fds) != 3:
+                        for fd in fds:
+                            os.close(fd)
+                        continue
+                    print(f"py_worker: {' '.join(request['argv'])}")
+                    sys.stdout.flush()
+                    report_r, report_w = os.pipe()
+                    pid = os.fork()
+                    if pid == 0:
+                        # child
+                        code = 1
+                        try:
+                            selector.close()
+                            server.close()
+                            os.close(report_r)
+                            for fd in reports:
+                                os.close(fd)
+                            code = _run_script(request, fds, cache, report_w)
+                            conn.sendall(_EXIT.pack(code))
+                        finally:
+                            os._exit(code)
+                    for fd in fds:
+                        os.close(fd)
+                    os.close(report_w)
+                    reports[report_r] = b""
+                    selector.register(report_r, selectors.EVENT_READ, pid)
+            cache.fill()
+            if parent_pid is not None:
+                try:
+                    os.kill(parent_pid, 0)
+                except ProcessLookupError:
+                    print(f"py_worker: parent process {parent_pid} terminated")
+                    return
+            if idle_timeout is not None and not reports and time.monotonic() - last_request > idle_timeout:
+                print(f"py_worker: idle for {idle_timeout} seconds")
+                return
+    finally:
+        print("py_worker: shutting down")
+        selector.close()
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+# sys.path of the server without the directory of this script
+_BASE_SYS_PATH = [p for p in sys.path[1:]]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "run":
+        # do not parse the arguments of the script
+        sys.exit(run_client(sys.argv[2:]))
+    opts = make_parser().parse_args()
+    if opts.command == "serve":
+        serve(opts.socket, opts.parent_pid, opts.idle_timeout, opts.cache_mb, opts.preload)
+    elif opts.command == "ping":
+        sys.exit(ping(opts.timeout))
+    elif opts.command == "stop":
+        sys.exit(stop())
+    else:
+        make_parser().print_help()
+        sys.exit(1)
@@ -27,6 +27,7 @@ fsqsphere=0           # run inflate1 and qsphere (FSway), if 0 run spectral proj
 fsaparc=0             # run FS aparc (and cortical ribbon), if 0 map aparc from asegdkt_segfile
 fssurfreg=1           # run FS surface registration to fsaverage, if 0 omit this step
 python="python3.10"   # python version
+py_worker=0           # if 1, run python helper scripts in a persistent python worker
 DoParallel=0          # if 1, run hemispheres in parallel
 threads="1"           # number of threads to use for running FastSurfer
 allow_root=""         # flag for allowing execution as root user
@@ -37,6 +38,7 @@ segstats_legacy="false" # flag to enable segstats legacy mode
 base=0                # flag for longitudinal template (base) run
 long=0                # flag for longitudinal time point run
 baseid=""             # baseid for logitudinal time point run
+fast_biasfield=0      # flag for the coarse-to-fine N4 bias field correction
 
 # Dev flags default
 check_version=1       # Check for supported FreeSurfer version (terminate if not detected)
@@ -105,7 +107,12 @@ FLAGS:
                             eTIV estimates for 3T MR images, default: 1.5T atlas).
   --parallel              Run both hemispheres in parallel
   --threads <int>         Set openMP and ITK threads to <int>
+  --fast_biasfield        Estimate the bias field coarse-to-fine with early
+                            stopping (faster, but results differ slightly)
   --py <python_cmd>       Command for python, default ${python}
+  --py_worker             Run the python helper scripts in one persistent python
+                            process (py_worker.py) instead of starting a new
+                            interpreter for each script (saves import and load time)
   --fs_license <license>  Path to FreeSurfer license key file. Register at
                             https://surfer.nmr.mgh.harvard.edu/registration.html
                             for free to obtain it if you do not have FreeSurfer
@@ -188,7 +195,9 @@ case $key in
   --3t) atlas3T="true" ;;
   --parallel) DoParallel=1 ;;
   --threads) threads="$1" ; shift ;;
+  --fast_biasfield) fast_biasfield=1 ;;
   --py) python="$1" ; shift ;;
+  --py_worker) py_worker=1 ;;
   --fs_license)
     if [ -f "$1" ]; then
       export FS_LICENSE="$1"
@@ -383,6 +392,12 @@ DoneFile="$SUBJECTS_DIR/$subject/scripts/recon-surf.done"
 if [ "$DoneFile" != /dev/null ] ; then  rm -f "$DoneFile" ; fi
 LF="$SUBJECTS_DIR/$subject/scripts/recon-surf.log"
 if [ "$LF" != /dev/null ] ; then  rm -f "$LF" ; fi
+# resources of each step as json-lines (see fs_time, telemetry.py and utils/summarize_telemetry.py)
+if [[ -z "$FSTIME_JSON" ]]
+then
+  export FSTIME_JSON="$SUBJECTS_DIR/$subject/scripts/recon-surf_telemetry.jsonl"
+  rm -f "$FSTIME_JSON"
+fi
 echo "Log file for recon-surf.sh" >> "$LF"
 { # all output tee -a "$LF"
   date 2>&1
@@ -421,6 +436,24 @@ echo "Log file for recon-surf.sh" >> "$LF"
   echo "Checking Input Segmentation Quality ..."
 } | tee -a "$LF"
 
+if [ "$py_worker" == "1" ]
+then
+  # start the persistent python worker, all "$python <script>" calls below are run in it
+  export FASTSURFER_PY_WORKER
+  FASTSURFER_PY_WORKER="$(mktemp -u "${TMPDIR:-/tmp}/fastsurfer_py_worker.XXXXXX")"
+  $python "${binpath}py_worker.py" serve --parent_pid $$ \
+    >> "$SUBJECTS_DIR/$subject/scripts/py_worker.log" 2>&1 &
+  # stop the worker with the python interpreter (not the client) on exit
+  trap "$python \"${binpath}py_worker.py\" stop" EXIT
+  $python "${binpath}py_worker.py" ping --timeout 120 2>&1 | tee -a "$LF"
+  if [ "${PIPESTATUS[0]}" -eq 0 ]
+  then
+    python="$python ${binpath}py_worker.py run"
+  else
+    echo "WARNING: Could not start the python worker, running scripts in separate processes." | tee -a "$LF"
+  fi
+fi
+
 cmd="$python $FASTSURFER_HOME/FastSurferCNN/quick_qc.py --asegdkt_segfile $asegdkt_segfile"
 RunIt "$cmd" "$LF"
 echo "" | tee -a "$LF"
@@ -542,7 +575,9 @@ if [ ! -f "$mdir/orig_nu.mgz" ] ; then
   # stream can be changed to avoid it.
   pushd "$mdir" > /dev/null || ( echo "Cannot change to $mdir" ; exit 1 )
     #cmd="mri_nu_correct.mni --no-rescale --i $mdir/orig.mgz --o $mdir/orig_nu.mgz --n 1 --proto-iters 1000 --distance 50 --mask $mdir/mask.mgz"
-    cmd="$python ${binpath}/N4_bias_correct.py --in $mdir/orig.mgz --rescale $mdir/orig_nu.mgz --aseg $mdir/aparc.DKTatlas+aseg.orig.mgz --threads $threads"
+    # the bias field is cached (like in run_fastsurfer.sh), so reruns skip N4
+    cmd="$python ${binpath}/N4_bias_correct.py --in $mdir/orig.mgz --rescale $mdir/orig_nu.mgz --aseg $mdir/aparc.DKTatlas+aseg.orig.mgz --threads $threads --biasfield_cache $mdir/orig_nu_biasfield.npz"
+    if [[ "$fast_biasfield" == "1" ]] ; then cmd="$cmd --fast" ; fi
     RunIt "$cmd" "$LF"
   popd > /dev/null || (echo "Could not popd" ; exit 1)
 fi
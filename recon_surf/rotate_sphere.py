@@ -135,20 +135,17 @@ def align_aparc_centroids(
     # lids=np.array([8,9,22,24,31])
     # lids=np.array([8,22,24])
 
+    # compute all centroids at once for each surface
+    ids_mov, all_centroids_mov = align.label_centroids(labels_mov, v_mov)
+    ids_dst, all_centroids_dst = align.label_centroids(labels_dst, v_dst)
     if label_ids is None:
         # use all joint labels except -1 and 0:
-        lids = np.intersect1d(labels_mov, labels_dst)
+        lids = np.intersect1d(ids_mov, ids_dst)
         lids = lids[(lids > 0)]
     else:
-        lids = label_ids
-    # compute mean for each label id
-    counter = 0
-    centroids_mov = np.empty([lids.size, 3])
-    centroids_dst = np.empty([lids.size, 3])
-    for id in lids:
-        centroids_mov[counter] = np.mean(v_mov[(labels_mov == id), :], axis=0)
-        centroids_dst[counter] = np.mean(v_dst[(labels_dst == id), :], axis=0)
-        counter = counter + 1
+        lids = np.asarray(label_ids)
+    centroids_mov = align.select_labels(ids_mov, all_centroids_mov, lids)
+    centroids_dst = align.select_labels(ids_dst, all_centroids_dst, lids)
     # map back to sphere of radius 100
     centroids_mov = (100 / np.sqrt(np.sum(centroids_mov * centroids_mov, axis=1)))[
         :, np.newaxis
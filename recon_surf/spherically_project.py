@@ -16,13 +16,18 @@
 # IMPORTS
 import math
 import optparse
+import os.path
 import sys
+import time
+from contextlib import contextmanager
 
 import nibabel.freesurfer.io as fs
 import numpy as np
 from lapy import TriaMesh
 from lapy.diffgeo import tria_mean_curvature_flow
 from lapy.solver import Solver
+from scipy.sparse.linalg import LinearOperator, lobpcg, splu
+from scipy.spatial import cKDTree
 
 HELPTEXT = """
 Script to compute ShapeDNA using linear FEM matrices. 
@@ -34,6 +39,20 @@ atlas used for FreeSurfer surface registion.
 
 USAGE:
 spherically_project  -i <input_surface> -o <output_surface>
+                     [--fast] [--template <basis.npz>] [--save_basis <basis.npz>]
+                     [--benchmark]
+
+Fast mode (--fast):
+The eigenfunctions are computed with LOBPCG instead of a cold-started ARPACK
+shift-invert run. LOBPCG is preconditioned with a single sparse LU factorization
+of the shifted stiffness matrix and warm-started from a basis that is already
+close to the solution: the coordinate functions by default or, if --template is
+passed, the eigenbasis of a template surface (e.g. the other hemisphere or
+fsaverage, saved with --save_basis) mapped by nearest neighbor. The mean
+curvature flow then factorizes its system matrix only once and uses this
+factorization as the preconditioner of a conjugate gradient solve in the later
+iterations. If LOBPCG does not converge, the standard eigensolver is used.
+--benchmark prints the run time of each step.
 
 
 References:
@@ -69,6 +88,13 @@ Date: Jan-18-2016
 
 h_input = "path to input surface"
 h_output = "path to output surface, spherically projected"
+h_fast = "use the warm-started LOBPCG eigensolver and a factorization-reusing flow"
+h_template = "optional: eigenbasis (.npz) of a template surface to warm-start --fast"
+h_save_basis = "optional: save the eigenbasis (.npz) for use as --template"
+h_benchmark = "print the run time of each step"
+
+# relative residual tolerance of the fast eigensolver and the flow solves
+FAST_TOL = 1e-8
 
 
 def options_parse():
@@ -86,6 +112,15 @@ def options_parse():
     )
     parser.add_option("--input", "-i", dest="input_surf", help=h_input)
     parser.add_option("--output", "-o", dest="output_surf", help=h_output)
+    parser.add_option(
+        "--fast", dest="fast", help=h_fast, action="store_true", default=False
+    )
+    parser.add_option("--template", dest="template", help=h_template)
+    parser.add_option("--save_basis", dest="save_basis", help=h_save_basis)
+    parser.add_option(
+        "--benchmark", dest="benchmark", help=h_benchmark, action="store_true",
+        default=False
+    )
     (options, args) = parser.parse_args()
 
     if options.input_surf is None or options.output_surf is None:
@@ -94,11 +129,250 @@ def options_parse():
     return options
 
 
+@contextmanager
+def step_timer(timings: dict[str, float] | None, step: str):
+    """Add the wall time spent inside the context to ``timings[step]``.
+
+    Parameters
+    ----------
+    timings : dict[str, float], None
+        Dictionary of step run times in seconds, nothing is recorded if None.
+    step : str
+        Name of the step.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[step] = timings.get(step, 0.0) + time.perf_counter() - start
+
+
+def read_eigenbasis(basis_file: str, tria: TriaMesh) -> np.ndarray:
+    """Map a saved template eigenbasis onto the vertices of tria.
+
+    Both meshes are centered and scaled to unit area and the basis is transferred by
+    nearest neighbor. If the template lies on the other side of the midsagittal plane
+    (other hemisphere), it is mirrored along x first. The result is only used as the
+    starting block of LOBPCG, so a rough correspondence is sufficient.
+
+    Parameters
+    ----------
+    basis_file : str
+        Path to a .npz file written by write_eigenbasis.
+    tria : TriaMesh
+        Triangle Mesh to map the basis to.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (n_vertices, k) with the mapped basis.
+    """
+    with np.load(basis_file) as data:
+        tv = data["v"].astype(np.float64)
+        tarea = float(data["area"])
+        evecs = data["evecs"].astype(np.float64)
+    centroid, area = tria.centroid()
+    tcentroid = np.mean(tv, axis=0)
+    tv = (tv - tcentroid) * math.sqrt(area / tarea)
+    if tcentroid[0] * centroid[0] < 0:
+        tv[:, 0] = -tv[:, 0]
+    return evecs[cKDTree(tv).query(tria.v - centroid)[1]]
+
+
+def write_eigenbasis(basis_file: str, tria: TriaMesh, evecs: np.ndarray) -> None:
+    """Save vertices and eigenbasis of tria as a template for read_eigenbasis.
+
+    Parameters
+    ----------
+    basis_file : str
+        Path to the output .npz file.
+    tria : TriaMesh
+        Triangle Mesh the eigenbasis was computed on.
+    evecs : np.ndarray
+        Eigenvectors of shape (n_vertices, k).
+    """
+    np.savez(
+        basis_file,
+        v=tria.v.astype(np.float32),
+        area=tria.area(),
+        evecs=evecs.astype(np.float32),
+    )
+
+
+def fast_eigs(
+        fem: Solver,
+        tria: TriaMesh,
+        k: int = 4,
+        init: np.ndarray | None = None,
+        tol: float = FAST_TOL,
+        maxiter: int = 100,
+        timings: dict[str, float] | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Compute the k smallest eigenpairs of the FEM problem A x = lambda M x with LOBPCG.
+
+    A single sparse LU factorization of the (positive definite) shifted matrix
+    A + sigma M serves as the preconditioner, which makes LOBPCG converge in a few
+    dozen iterations when it is started from a good block, e.g. the coordinate
+    functions (the default) or a mapped template eigenbasis (see read_eigenbasis).
+
+    Parameters
+    ----------
+    fem : Solver
+        Solver holding stiffness and mass matrix.
+    tria : TriaMesh
+        Triangle Mesh the solver was set up on.
+    k : int
+        Number of eigenpairs. Defaults to 4.
+    init : np.ndarray, optional
+        Starting block of shape (n_vertices, k), defaults to the constant and the
+        coordinate functions (padded with random vectors for k > 4).
+    tol : float
+        Residual tolerance relative to the scale of the mesh. Defaults to FAST_TOL.
+    maxiter : int
+        Maximum number of LOBPCG iterations. Defaults to 100.
+    timings : dict[str, float], optional
+        Dictionary to add the run times of the steps to.
+
+    Returns
+    -------
+    evals : np.ndarray
+        Array of the k smallest eigenvalues.
+    evecs : np.ndarray
+        Array of shape (n_vertices, k) with the M-normalized eigenvectors.
+
+    Raises
+    ------
+    RuntimeError
+        If LOBPCG did not converge.
+    """
+    a_mat, m_mat = fem.stiffness, fem.mass
+    # eigenvalues scale with 1 / area, the residuals of M-normalized eigenvectors
+    # with 1 / sqrt(area)
+    area = tria.area()
+    if init is None:
+        init = np.column_stack((np.ones(tria.v.shape[0]), tria.v - tria.centroid()[0]))
+        if k > init.shape[1]:
+            rng = np.random.default_rng(0)
+            init = np.column_stack((init, rng.random((init.shape[0], k - 4))))
+        init = init[:, :k]
+    with step_timer(timings, "factorization"):
+        lu = splu((a_mat + (1.0 / area) * m_mat).tocsc())
+    precond = LinearOperator(
+        a_mat.shape, matvec=lu.solve, matmat=lu.solve, dtype=a_mat.dtype
+    )
+    with step_timer(timings, "eigensolver"):
+        evals, evecs, res = lobpcg(
+            a_mat, init, B=m_mat, M=precond, largest=False,
+            tol=tol / math.sqrt(area), maxiter=maxiter,
+            retResidualNormsHistory=True,
+        )
+    if np.any(np.asarray(res[-1]) > tol / math.sqrt(area)):
+        raise RuntimeError(f"LOBPCG did not converge in {maxiter} iterations")
+    order = np.argsort(evals)
+    return evals[order], evecs[:, order]
+
+
+def _block_pcg(mat, rhs, precond, x0, tol, maxiter=50):
+    """Solve mat x = rhs column-wise with preconditioned conjugate gradients.
+
+    Returns the solution and whether all columns reached the relative tolerance.
+    """
+    x = x0.copy()
+    r = rhs - mat.dot(x)
+    z = precond(r)
+    p = z.copy()
+    rz = np.sum(r * z, axis=0)
+    bound = tol * np.linalg.norm(rhs, axis=0)
+    for _ in range(maxiter):
+        if np.all(np.linalg.norm(r, axis=0) <= bound):
+            return x, True
+        q = mat.dot(p)
+        pq = np.sum(p * q, axis=0)
+        alpha = np.divide(rz, pq, out=np.zeros_like(rz), where=pq != 0)
+        x += alpha * p
+        r -= alpha * q
+        z = precond(r)
+        rz_new = np.sum(r * z, axis=0)
+        beta = np.divide(rz_new, rz, out=np.zeros_like(rz), where=rz != 0)
+        p = z + beta * p
+        rz = rz_new
+    return x, bool(np.all(np.linalg.norm(r, axis=0) <= bound))
+
+
+def fast_mean_curvature_flow(
+        tria: TriaMesh,
+        max_iter: int = 30,
+        stop_eps: float = 1e-13,
+        step: float = 1.0,
+        tol: float = FAST_TOL,
+        timings: dict[str, float] | None = None,
+) -> TriaMesh:
+    """Flow a triangle mesh along the mean curvature normal (Kazhdan 2012).
+
+    Same algorithm as lapy.diffgeo.tria_mean_curvature_flow (fixed stiffness, updated
+    lumped mass, normalization to unit area), but the system matrix M + step * A is
+    only factorized in the first iteration. As the mass matrix changes little between
+    iterations, the later ones solve with conjugate gradients preconditioned by that
+    factorization, which needs only a few iterations. If CG does not converge, the
+    system matrix is factorized again.
+
+    Parameters
+    ----------
+    tria : TriaMesh
+        Triangle Mesh.
+    max_iter : int
+        Maximal number of steps. Defaults to 30.
+    stop_eps : float
+        Stopping threshold. Defaults to 1e-13.
+    step : float
+        Euler step size. Defaults to 1.0.
+    tol : float
+        Relative residual tolerance of the CG solves. Defaults to FAST_TOL.
+    timings : dict[str, float], optional
+        Dictionary to add the run times of the steps to.
+
+    Returns
+    -------
+    TriaMesh
+        Triangle Mesh after flow.
+    """
+    trianorm = TriaMesh(tria.v, tria.t)
+    trianorm.normalize_()
+    a_mat = Solver(trianorm, lump=True, use_cholmod=False).stiffness
+    lu = None
+    for x in range(max_iter):
+        with step_timer(timings, f"flow iteration {x + 1}"):
+            vlast = trianorm.v
+            mass = Solver.fem_tria_mass(trianorm, lump=True)
+            mass_v = mass.dot(trianorm.v)
+            sys_mat = (mass + step * a_mat).tocsc()
+            converged = False
+            if lu is not None:
+                v, converged = _block_pcg(
+                    sys_mat, mass_v, lu.solve, lu.solve(mass_v), tol
+                )
+            if not converged:
+                lu = splu(sys_mat)
+                v = lu.solve(mass_v)
+            trianorm.v = v
+            trianorm.normalize_()
+            dv = trianorm.v - vlast
+            diff = np.trace(np.square(np.matmul(np.transpose(dv), mass.dot(dv))))
+        if diff < stop_eps:
+            break
+    return trianorm
+
+
 def tria_spherical_project(
         tria: TriaMesh,
         flow_iter: int = 3,
         debug: bool = False,
-        use_cholmod: bool = True
+        use_cholmod: bool = True,
+        fast: bool = False,
+        template: str | None = None,
+        save_basis: str | None = None,
+        timings: dict[str, float] | None = None,
 ) -> TriaMesh:
     """Compute the first three sphere-projected non-constant eigenfunctions.
 
@@ -120,6 +394,15 @@ def tria_spherical_project(
         Whether to print EV info to the file debug.ev. Defaults to False
     use_cholmod : bool
         Try to use the Cholesky decomposition from the cholmod. Defaults to True
+    fast : bool
+        Use the warm-started LOBPCG eigensolver and the factorization-reusing mean
+        curvature flow (see fast_eigs and fast_mean_curvature_flow). Defaults to False
+    template : str, optional
+        Path to a template eigenbasis to warm-start the fast eigensolver
+    save_basis : str, optional
+        Path to save the eigenbasis to, e.g. for use as template of the other hemisphere
+    timings : dict[str, float], optional
+        Dictionary to add the run times of the steps to
 
     Returns
     -------
@@ -144,8 +427,24 @@ def tria_spherical_project(
         area = np.sum(areas[np.where(spatvol < 0)])
         return area
 
-    fem = Solver(tria, lump=False, use_cholmod=use_cholmod)
-    evals, evecs = fem.eigs(k=4)
+    with step_timer(timings, "fem assembly"):
+        fem = Solver(tria, lump=False, use_cholmod=use_cholmod)
+    evecs = None
+    if fast:
+        init = None
+        if template is not None and os.path.isfile(template):
+            with step_timer(timings, "template mapping"):
+                init = read_eigenbasis(template, tria)
+        try:
+            evals, evecs = fast_eigs(fem, tria, k=4, init=init, timings=timings)
+        except (RuntimeError, np.linalg.LinAlgError) as e:
+            print(f"WARNING: fast eigensolver failed ({e}), using standard solver")
+            evecs = None
+    if evecs is None:
+        with step_timer(timings, "eigensolver"):
+            evals, evecs = fem.eigs(k=4)
+    if save_basis is not None:
+        write_eigenbasis(save_basis, tria, evecs)
 
     if debug:
         data = dict()
@@ -264,11 +563,17 @@ def tria_spherical_project(
 
     # do a few mean curvature flow euler steps to make more convex
     # three should be sufficient
-    if flow_iter > 0:
-        tflow = tria_mean_curvature_flow(
-            TriaMesh(vn, tria.t), max_iter=flow_iter, use_cholmod=use_cholmod
+    if flow_iter > 0 and fast:
+        tflow = fast_mean_curvature_flow(
+            TriaMesh(vn, tria.t), max_iter=flow_iter, timings=timings
         )
         vn = tflow.v
+    elif flow_iter > 0:
+        with step_timer(timings, "mean curvature flow"):
+            tflow = tria_mean_curvature_flow(
+                TriaMesh(vn, tria.t), max_iter=flow_iter, use_cholmod=use_cholmod
+            )
+        vn = tflow.v
 
     # project to sphere and scaled to have the same scale/origin as FS:
     dist = np.sqrt(np.sum(vn * vn, axis=1))
@@ -306,7 +611,11 @@ def tria_spherical_project(
 def spherically_project_surface(
         insurf: str,
         outsurf: str,
-        use_cholmod: bool = True
+        use_cholmod: bool = True,
+        fast: bool = False,
+        template: str | None = None,
+        save_basis: str | None = None,
+        benchmark: bool = False,
 ) -> None:
     """Take path to insurf, spherically projects it, outputs it to outsurf.
 
@@ -318,13 +627,36 @@ def spherically_project_surface(
         Path to output surface file
     use_cholmod : bool
         Try to use the Cholesky decomposition from the cholmod. Defaults to True
+    fast : bool
+        Use the fast eigensolver and mean curvature flow. Defaults to False
+    template : str, optional
+        Path to a template eigenbasis to warm-start the fast eigensolver
+    save_basis : str, optional
+        Path to save the eigenbasis to
+    benchmark : bool
+        Print the run time of each step. Defaults to False
 
     """
-    surf = fs.read_geometry(insurf, read_metadata=True)
+    timings = {} if benchmark else None
+    start = time.perf_counter()
+    with step_timer(timings, "read surface"):
+        surf = fs.read_geometry(insurf, read_metadata=True)
     projected = tria_spherical_project(
-        TriaMesh(surf[0], surf[1]), flow_iter=3, use_cholmod=use_cholmod
+        TriaMesh(surf[0], surf[1]),
+        flow_iter=3,
+        use_cholmod=use_cholmod,
+        fast=fast,
+        template=template,
+        save_basis=save_basis,
+        timings=timings,
     )
-    fs.write_geometry(outsurf, projected.v, projected.t, volume_info=surf[2])
+    with step_timer(timings, "write surface"):
+        fs.write_geometry(outsurf, projected.v, projected.t, volume_info=surf[2])
+    if benchmark:
+        print("Run time per step:")
+        for step, seconds in timings.items():
+            print(f"  {step:<24s} {seconds:8.2f} s")
+        print(f"  {'total':<24s} {time.perf_counter() - start:8.2f} s")
 
 
 if __name__ == "__main__":
@@ -335,7 +667,15 @@ if __name__ == "__main__":
 
     print(f"Reading in surface: {surf_to_project} ...")
     # switching cholmod off will be slower, but does not require scikit sparse cholmod
-    spherically_project_surface(surf_to_project, projected_surf, use_cholmod=False)
+    spherically_project_surface(
+        surf_to_project,
+        projected_surf,
+        use_cholmod=False,
+        fast=options.fast,
+        template=options.template,
+        save_basis=options.save_basis,
+        benchmark=options.benchmark,
+    )
     print(f"Outputting spherically projected surface: {projected_surf}")
 
     sys.exit(0)
@@ -130,6 +130,8 @@ if __name__ == "__main__":
         + opts.hemi
         + ".qsphere.nofix"
     )
+    # warm-started eigensolver and flow, falls back to the standard solver below
+    cmd0 = cmd1 + " --fast"
 
     if opts.threads > 1:
         threading = (
@@ -150,4 +152,6 @@ if __name__ == "__main__":
     from os import environ
     env = dict(environ)
     env.setdefault("USERNAME", "UNKNOWN")
-    spherical_wrapper(cmd1, cmd2, env=env)
+    if spherical_wrapper(cmd0, cmd1, env=env) != 0:
+        print(f"Command {cmd1} failed.\nRunning fallback command: {cmd2}")
+        call(cmd2, env=env)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+
+# Copyright 2024 Image Analysis Lab, German Center for Neurodegenerative Diseases (DZNE), Bonn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Structured resource records of the steps of recon-surf.sh.
+
+If the environment variable FSTIME_JSON is set to a file, fs_time appends one json
+object per line (json-lines) to that file for each command it runs. Python scripts run
+in the python worker (py_worker.py) are not child processes of fs_time, so the worker
+writes their records with python_record. Each record has the fields:
+
+- time: local time at the start of the step (%Y-%m-%dT%H:%M:%S)
+- command: the command (or python script), relative to FASTSURFER_HOME
+- nargs: the number of arguments of the command
+- exit_code: the exit code of the command
+- wall_s: elapsed (wall clock) time in seconds
+- user_s, sys_s: cpu time in user and kernel mode in seconds
+- max_rss_kb: maximum resident set size in kilobytes (for python worker steps without
+  the memory inherited from the worker, null if that cannot be measured)
+- read_bytes, write_bytes: file system input and output in bytes
+- threads: the number of threads the step may use (OMP_NUM_THREADS)
+
+See recon_surf/utils/summarize_telemetry.py to aggregate the records of many runs.
+"""
+
+# IMPORTS
+# Note: only the standard library, this module is imported by the python worker
+import json
+import os
+import resource
+import time
+
+RECORD_ENV = "FSTIME_JSON"
+# rusage reports file system input and output in blocks of 512 bytes
+BLOCK_SIZE = 512
+
+
+def command_name(command: str) -> str:
+    """
+    Shorten a command like fs_time (relative to FASTSURFER_HOME).
+
+    Parameters
+    ----------
+    command : str
+        The command or script.
+
+    Returns
+    -------
+    str
+        The shortened command.
+    """
+    home = os.environ.get("FASTSURFER_HOME", "")
+    if home and command.startswith(home):
+        command = command[len(home):].lstrip("/")
+    return command
+
+
+def threads() -> int:
+    """
+    Get the number of threads steps may use (OMP_NUM_THREADS, default 1).
+    """
+    omp_num_threads = os.environ.get("OMP_NUM_THREADS", "")
+    return int(omp_num_threads) if omp_num_threads.isdigit() else 1
+
+
+def status_kb(field: str = "VmRSS") -> int | None:
+    """
+    Read a memory field of this process from /proc/self/status (linux only).
+
+    Parameters
+    ----------
+    field : str, default="VmRSS"
+        The field, e.g. VmRSS (resident set size) or VmHWM (its peak).
+
+    Returns
+    -------
+    int, None
+        The value in kilobytes or None, if it is not available.
+    """
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def python_record(
+        argv: list[str],
+        start: float,
+        wall: float,
+        exit_code: int,
+        start_rss_kb: int | None,
+) -> dict:
+    """
+    Create the record of a python script that was run in this process.
+
+    The resources of this process and its (terminated) child processes are included,
+    so the process should only run this script, e.g. a child forked by the python
+    worker.
+
+    A forked process starts with the memory of its parent, which ru_maxrss includes.
+    Therefore, the memory of this process is its peak resident set size (VmHWM) minus
+    the resident set size at the start of the script, and max_rss_kb is None, if either
+    is not available.
+
+    Parameters
+    ----------
+    argv : list[str]
+        The script and its arguments.
+    start : float
+        The start time of the script (seconds since the epoch).
+    wall : float
+        The elapsed time in seconds.
+    exit_code : int
+        The exit code of the script.
+    start_rss_kb : int, None
+        The resident set size at the start of the script (status_kb() right after the
+        fork), None if it is not available.
+
+    Returns
+    -------
+    dict
+        The record.
+    """
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    peak_rss_kb = status_kb("VmHWM")
+    max_rss_kb = None
+    if start_rss_kb is not None and peak_rss_kb is not None:
+        # on linux, ru_maxrss is in kilobytes
+        max_rss_kb = max(peak_rss_kb - start_rss_kb, usage[1].ru_maxrss)
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start)),
+        "command": command_name(argv[0]),
+        "nargs": len(argv) - 1,
+        "exit_code": exit_code,
+        "wall_s": round(wall, 2),
+        "user_s": round(sum(u.ru_utime for u in usage), 2),
+        "sys_s": round(sum(u.ru_stime for u in usage), 2),
+        "max_rss_kb": max_rss_kb,
+        "read_bytes": sum(u.ru_inblock for u in usage) * BLOCK_SIZE,
+        "write_bytes": sum(u.ru_oublock for u in usage) * BLOCK_SIZE,
+        "threads": threads(),
+    }
+
+
+def write_record(filename: str, record: dict) -> None:
+    """
+    Append a record to a json-lines file.
+
+    The line is written with a single call in append mode, so the processing of both
+    hemispheres in parallel can write to the same file.
+
+    Parameters
+    ----------
+    filename : str
+        The json-lines file.
+    record : dict
+        The record.
+    """
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
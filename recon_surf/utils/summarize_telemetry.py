@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+
+# Copyright 2024 Image Analysis Lab, German Center for Neurodegenerative Diseases (DZNE), Bonn
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Summarize the resource records (recon-surf_telemetry.jsonl, see recon_surf/fs_time
+and recon_surf/telemetry.py) of a cohort of recon-surf runs per stage and compare
+them to a baseline.
+"""
+
+# IMPORTS
+import argparse
+import json
+import statistics
+import sys
+from collections import defaultdict
+from collections.abc import Iterable, Sequence
+from pathlib import Path
+
+RECORDS_NAME = "scripts/recon-surf_telemetry.jsonl"
+TOTAL = "TOTAL"
+# the per-subject metrics of each stage
+METRICS = ("wall_s", "cpu_s", "max_rss_kb", "read_bytes", "write_bytes")
+
+Summary = dict[str, dict]
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """
+    Create the argparse object.
+
+    Returns
+    -------
+    argparse.ArgumentParser
+        The parser object.
+    """
+    parser = argparse.ArgumentParser(
+        description="Summarize the resource records of recon-surf runs per stage "
+                    "(command) and flag regressions against a baseline.",
+    )
+    parser.add_argument(
+        "records",
+        type=Path,
+        nargs="+",
+        help=f"Records files or subject directories (reads <subject dir>/{RECORDS_NAME}).",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        default=None,
+        help="Save the summary (incl. histograms) as json.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=None,
+        help="Summary json (see --save_baseline) to compare to.",
+    )
+    parser.add_argument(
+        "--save_baseline",
+        type=Path,
+        default=None,
+        help="Save the summary as the baseline for future comparisons.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative increase of the median wall time, cpu time or maximum memory "
+             "of a stage that is flagged as a regression (default: 0.2, i.e. 20%%).",
+    )
+    parser.add_argument(
+        "--min_seconds",
+        type=float,
+        default=5.,
+        help="Minimum absolute increase of the median wall or cpu time in seconds "
+             "that is flagged as a regression (default: 5).",
+    )
+    parser.add_argument(
+        "--min_memory",
+        type=float,
+        default=100.,
+        help="Minimum absolute increase of the median maximum memory in MB that is "
+             "flagged as a regression (default: 100).",
+    )
+    parser.add_argument(
+        "--bins",
+        type=int,
+        default=10,
+        help="Number of bins of the wall time histograms (default: 10).",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=25,
+        help="Print the top stages by median wall time (default: 25, 0 for all).",
+    )
+    parser.add_argument(
+        "--fail_on_regression",
+        action="store_true",
+        help="Exit with code 1, if regressions are flagged.",
+    )
+    return parser
+
+
+def read_records(paths: Iterable[Path]) -> dict[str, list[dict]]:
+    """
+    Read the records of each run.
+
+    Parameters
+    ----------
+    paths : Iterable[Path]
+        Records files or subject directories.
+
+    Returns
+    -------
+    dict[str, list[dict]]
+        The records for each subject (the name of the subject directory).
+    """
+    runs = defaultdict(list)
+    for path in paths:
+        if path.is_dir():
+            path = path / RECORDS_NAME
+        subject = path.parent.parent.name if path.parent.name == "scripts" else path.stem
+        with open(path) as fp:
+            for i, line in enumerate(fp, start=1):
+                try:
+                    runs[subject].append(json.loads(line))
+                except json.JSONDecodeError:
+                    # e.g. the last line of an aborted run
+                    print(f"WARNING: Skipping invalid record in {path}:{i}.")
+    return dict(runs)
+
+
+def stage_totals(records: Iterable[dict]) -> dict[str, dict]:
+    """
+    Sum the resources of the records of one run per stage.
+
+    Times and file system io are summed over all calls of a stage (e.g. both
+    hemispheres), the memory is the maximum (None, if no call has a memory record).
+
+    Parameters
+    ----------
+    records : Iterable[dict]
+        The records of one run.
+
+    Returns
+    -------
+    dict[str, dict]
+        The metrics, calls, failures and threads of each stage (and the TOTAL).
+    """
+    stages = defaultdict(
+        lambda: dict.fromkeys(METRICS + ("calls", "failed", "threads"), 0) | {"max_rss_kb": None}
+    )
+    for record in records:
+        for stage in (record["command"], TOTAL):
+            totals = stages[stage]
+            totals["wall_s"] += record["wall_s"]
+            totals["cpu_s"] += record["user_s"] + record["sys_s"]
+            # python worker steps may not have a memory record (see telemetry.py)
+            if record.get("max_rss_kb") is not None:
+                totals["max_rss_kb"] = max(totals["max_rss_kb"] or 0, record["max_rss_kb"])
+            totals["read_bytes"] += record["read_bytes"]
+            totals["write_bytes"] += record["write_bytes"]
+            totals["calls"] += 1
+            totals["failed"] += record["exit_code"] != 0
+            totals["threads"] = max(totals["threads"], record.get("threads", 1))
+    return dict(stages)
+
+
+def histogram(values: Sequence[float], bins: int = 10) -> dict[str, list]:
+    """
+    Count values in equally spaced bins between their minimum and maximum.
+
+    Parameters
+    ----------
+    values : Sequence[float]
+        The values.
+    bins : int, default=10
+        The number of bins.
+
+    Returns
+    -------
+    dict[str, list]
+        The edges (bins + 1) and the counts (bins).
+    """
+    low, high = min(values), max(values)
+    width = (high - low) / bins or 1.
+    counts = [0] * bins
+    for value in values:
+        counts[min(int((value - low) / width), bins - 1)] += 1
+    return {"edges": [low + i * width for i in range(bins + 1)], "counts": counts}
+
+
+def quantile(values: Sequence[float], q: float) -> float:
+    """
+    Get the q-quantile of values (linear interpolation).
+    """
+    values = sorted(values)
+    position = q * (len(values) - 1)
+    i = int(position)
+    if i + 1 >= len(values):
+        return values[-1]
+    return values[i] + (position - i) * (values[i + 1] - values[i])
+
+
+def summarize(runs: dict[str, list[dict]], bins: int = 10) -> Summary:
+    """
+    Summarize the stages of a cohort of runs.
+
+    Parameters
+    ----------
+    runs : dict[str, list[dict]]
+        The records of each run (see read_records).
+    bins : int, default=10
+        The number of bins of the wall time histograms.
+
+    Returns
+    -------
+    Summary
+        For each stage: the number of runs, calls and failures, the median, 90th
+        percentile and maximum of each metric over runs (over the runs with records
+        of the metric, None if there are none) and the histogram of the wall time.
+    """
+    per_stage = defaultdict(list)
+    for records in runs.values():
+        for stage, totals in stage_totals(records).items():
+            per_stage[stage].append(totals)
+
+    summary = {}
+    for stage, totals in per_stage.items():
+        summary[stage] = {
+            "runs": len(totals),
+            "calls": sum(t["calls"] for t in totals),
+            "failed": sum(t["failed"] for t in totals),
+            "threads": max(t["threads"] for t in totals),
+        }
+        for metric in METRICS:
+            values = [t[metric] for t in totals if t[metric] is not None]
+            if not values:
+                summary[stage][metric] = None
+                continue
+            summary[stage][metric] = {
+                "median": statistics.median(values),
+                "p90": quantile(values, 0.9),
+                "max": max(values),
+            }
+        summary[stage]["wall_s"]["histogram"] = histogram(
+            [t["wall_s"] for t in totals], bins,
+        )
+    return summary
+
+
+def find_regressions(
+        summary: Summary,
+        baseline: Summary,
+        tolerance: float = 0.2,
+        min_seconds: float = 5.,
+        min_memory: float = 100.,
+) -> list[dict]:
+    """
+    Compare the median wall time, cpu time and maximum memory of each stage to the
+    baseline.
+
+    Parameters
+    ----------
+    summary : Summary
+        The summary of the cohort.
+    baseline : Summary
+        The summary of the baseline cohort.
+    tolerance : float, default=0.2
+        The relative increase to flag.
+    min_seconds : float, default=5
+        The minimum absolute increase of times to flag (short stages are noisy).
+    min_memory : float, default=100
+        The minimum absolute increase of the memory to flag in MB.
+
+    Returns
+    -------
+    list[dict]
+        The stage, metric, baseline and current median and their ratio of each
+        regression (sorted by the absolute increase).
+    """
+    regressions = []
+    for stage, stats in summary.items():
+        if stage not in baseline:
+            continue
+        thresholds = (("wall_s", min_seconds), ("cpu_s", min_seconds), ("max_rss_kb", min_memory * 1024))
+        for metric, min_increase in thresholds:
+            # e.g. memory of python worker steps without memory records
+            if stats[metric] is None or baseline[stage].get(metric) is None:
+                continue
+            before = baseline[stage][metric]["median"]
+            after = stats[metric]["median"]
+            if after > before * (1 + tolerance) and after - before > min_increase:
+                regressions.append({
+                    "stage": stage,
+                    "metric": metric,
+                    "baseline": before,
+                    "median": after,
+                    "ratio": after / before if before > 0 else float("inf"),
+                })
+    return sorted(regressions, key=lambda r: r["median"] - r["baseline"], reverse=True)
+
+
+def format_summary(summary: Summary, top: int = 25) -> str:
+    """
+    Format the summary as a table sorted by the median wall time.
+    """
+    blocks = " ▁▂▃▄▅▆▇█"
+    stages = sorted(summary, key=lambda s: summary[s]["wall_s"]["median"], reverse=True)
+    if top > 0:
+        # TOTAL is the first stage
+        stages = stages[:top + 1]
+    width = max(len(s) for s in stages)
+    lines = [
+        f"{'stage':<{width}}  runs  calls  wall median/p90 [s]  cpu median [s]  "
+        f"rss max [MB]  io median [MB]  histogram (wall)"
+    ]
+    for stage in stages:
+        stats = summary[stage]
+        counts = stats["wall_s"]["histogram"]["counts"]
+        most = max(counts)
+        hist = "".join(blocks[-(-8 * c // most)] for c in counts)
+        io = (stats["read_bytes"]["median"] + stats["write_bytes"]["median"]) / 2 ** 20
+        rss = "-" if stats["max_rss_kb"] is None else f"{stats['max_rss_kb']['max'] / 1024:.0f}"
+        lines.append(
+            f"{stage:<{width}}  {stats['runs']:>4}  {stats['calls']:>5}  "
+            f"{stats['wall_s']['median']:>9.1f}/{stats['wall_s']['p90']:<9.1f}  "
+            f"{stats['cpu_s']['median']:>14.1f}  {rss:>12}  "
+            f"{io:>14.1f}  {hist}"
+        )
+    return "\n".join(lines)
+
+
+def main(
+        records: list[Path],
+        output: Path | None = None,
+        baseline: Path | None = None,
+        save_baseline: Path | None = None,
+        tolerance: float = 0.2,
+        min_seconds: float = 5.,
+        min_memory: float = 100.,
+        bins: int = 10,
+        top: int = 25,
+        fail_on_regression: bool = False,
+) -> int:
+    runs = read_records(records)
+    if not runs:
+        print("ERROR: No records found!")
+        return 1
+    summary = summarize(runs, bins)
+    print(f"Summary of {len(runs)} runs:")
+    print(format_summary(summary, top))
+    for path in (output, save_baseline):
+        if path is not None:
+            with open(path, "w") as fp:
+                json.dump(summary, fp, indent=2)
+
+    regressions = []
+    if baseline is not None:
+        with open(baseline) as fp:
+            regressions = find_regressions(
+                summary, json.load(fp), tolerance, min_seconds, min_memory,
+            )
+        print(f"\n{len(regressions)} regressions against the baseline {baseline}:")
+        for r in regressions:
+            print(
+                f"  {r['stage']}: median {r['metric']} {r['baseline']:.1f} -> "
+                f"{r['median']:.1f} ({r['ratio']:.2f}x)"
+            )
+    return 1 if regressions and fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    args = make_parser().parse_args()
+    sys.exit(main(**vars(args)))
@@ -62,6 +62,7 @@ device="auto"
 batch_size="1"
 run_seg_pipeline="1"
 run_biasfield="1"
+fast_biasfield="0"
 run_surf_pipeline="1"
 surf_flags=()
 vox_size="min"
@@ -159,6 +160,10 @@ SEGMENTATION PIPELINE:
   --norm_name             Name of the biasfield corrected image
                             Default location:
                             \$SUBJECTS_DIR/\$sid/mri/orig_nu.mgz
+  --fast_biasfield        Estimate the bias field coarse-to-fine with early
+                            stopping (faster, but results differ slightly).
+                            The bias field is cached next to the biasfield
+                            corrected image, so reruns skip the estimation.
   --tal_reg               Perform the talairach registration for eTIV estimates
                             in --seg_only stream and stats files (is affected by
                             the --3T flag, see below).
@@ -259,6 +264,9 @@ Resource Options:
                             cross-subject correspondence), Not recommended, but
                             speeds up processing if you e.g. just need the
                             segmentation stats!
+  --py_worker             Run the python helper scripts of the surface pipeline
+                            in one persistent python process (see
+                            recon_surf/py_worker.py).
   --allow_root            Allow execution as root user.
 
  Longitudinal Flags (non-expert users should use long_fastsurfers.sh for
@@ -395,6 +403,7 @@ case $key in
   #=============================================================
   --surf_only) run_seg_pipeline="0" ;;
   --no_biasfield) run_biasfield="0" ;;
+  --fast_biasfield) fast_biasfield="1" ; surf_flags+=("--fast_biasfield") ;;
   --tal_reg) run_talairach_registration="true" ;;
   --device) device="$1" ; shift ;;
   --batch) batch_size="$1" ; shift ;;
@@ -463,7 +472,7 @@ case $key in
   ##############################################################
   --seg_only) run_surf_pipeline="0" ;;
   # several flag options that are *just* passed through to recon-surf.sh
-  --fstess|--fsqsphere|--fsaparc|--no_surfreg|--parallel|--ignore_fs_version) surf_flags+=("$key") ;;
+  --fstess|--fsqsphere|--fsaparc|--no_surfreg|--parallel|--ignore_fs_version|--py_worker) surf_flags+=("$key") ;;
   --no_fs_t1) surf_flags+=("--no_fs_T1") ;;
 
   # temporary segstats development flag
@@ -817,7 +826,9 @@ then
     {
       # this will always run, since norm_name is set to subject_dir/mri/orig_nu.mgz, if it is not passed/empty
       cmd=($python "${reconsurfdir}/N4_bias_correct.py" "--in" "$conformed_name"
-           --rescale "$norm_name" --aseg "$aseg_segfile" --threads "$threads")
+           --rescale "$norm_name" --aseg "$aseg_segfile" --threads "$threads"
+           --biasfield_cache "$(dirname "$norm_name")/orig_nu_biasfield.npz")
+      if [[ "$fast_biasfield" == "1" ]] ; then cmd+=(--fast) ; fi
       echo "INFO: Running N4 bias-field correction..."
       echo_quoted "${cmd[@]}"
       "${cmd[@]}" 2>&1
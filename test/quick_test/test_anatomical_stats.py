@@ -0,0 +1,114 @@
+import sys
+from logging import getLogger
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from .common import load_test_subjects
+
+logger = getLogger(__name__)
+
+# recon_surf is not a package
+RECON_SURF = str(Path(__file__).parents[2] / "recon_surf")
+if RECON_SURF not in sys.path:
+    sys.path.append(RECON_SURF)
+
+from anatomical_stats import anatomical_stats  # noqa: E402
+
+# relative tolerance of the columns, the stats of recon-surf.sh are computed without
+# -th3, so GrayVol is a different estimate than the tetrahedra split of anatomical_stats
+TOLERANCES = {
+    "SurfArea": 0.01,
+    "GrayVol": 0.05,
+    "ThickAvg": 0.01,
+}
+
+
+def read_stats_table(file_path: Path) -> pd.DataFrame:
+    """
+    Read the table of a surface stats file (FreeSurfer format).
+
+    Parameters
+    ----------
+    file_path : Path
+        Path to the stats file.
+
+    Returns
+    -------
+    table : pandas.DataFrame
+        Table of the stats file indexed by StructName.
+    """
+    columns = []
+    table_start = 0
+    with open(file_path) as file:
+        for i, line in enumerate(file, 1):
+            if line.startswith("# ColHeaders"):
+                table_start = i
+                columns = line.removeprefix("# ColHeaders").split()
+
+    table = pd.read_table(file_path, skiprows=table_start, sep=r"\s+", header=None)
+    table.columns = columns
+    return table.set_index("StructName")
+
+
+@pytest.mark.parametrize("hemi", ["lh", "rh"])
+@pytest.mark.parametrize("annot", ["BA_exvivo", "BA_exvivo.thresh"])
+@pytest.mark.parametrize("test_subject", load_test_subjects())
+def test_anatomical_stats(
+        subjects_dir: Path, test_dir: Path, test_subject: Path, annot: str, hemi: str, tmp_path: Path
+):
+    """
+    Test the python anatomical stats against the stats of mris_anatomical_stats.
+
+    Parameters
+    ----------
+    subjects_dir : Path
+        Path to the subjects directory.
+    test_dir : Path
+        Name of the test directory.
+    test_subject : Path
+        Name of the test subject.
+    annot : str
+        Name of the annotation.
+    hemi : str
+        Hemisphere.
+    tmp_path : Path
+        Temporary directory for the python stats file.
+
+    Raises
+    ------
+    AssertionError
+        If the area, volume or thickness of a parcel is not within the tolerance.
+    """
+    subject_dir = subjects_dir / test_dir / test_subject
+    stats_file = tmp_path / f"{hemi}.{annot}.stats"
+    anatomical_stats(
+        str(subject_dir),
+        hemi,
+        [str(subject_dir / "label" / f"{hemi}.{annot}.annot")],
+        [str(stats_file)],
+    )
+
+    test_table = read_stats_table(stats_file)
+    ref_table = read_stats_table(subject_dir / "stats" / f"{hemi}.{annot}.stats")
+
+    missing = set(ref_table.index) - set(test_table.index)
+    assert not missing, f"Parcels missing in the python stats: {missing}"
+
+    variations = {}
+    for struct in ref_table.index:
+        for column, tolerance in TOLERANCES.items():
+            ref_value = ref_table.loc[struct, column]
+            if ref_value == 0:
+                continue
+            variation = abs(test_table.loc[struct, column] / ref_value - 1)
+            if variation > tolerance:
+                variations.setdefault(struct, {})[column] = variation
+
+    if variations:
+        logger.debug("\nVariations greater than tolerance:")
+        for key, value in variations.items():
+            logger.debug(f"{key}: {value}")
+
+    assert not variations, f"Variations greater than tolerance found: {variations}"
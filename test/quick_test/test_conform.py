@@ -0,0 +1,151 @@
+from logging import getLogger
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from FastSurferCNN.data_loader import conform as conform_module
+from FastSurferCNN.data_loader.conform import Criteria, conform, getscale, map_image, scalecrop
+
+logger = getLogger(__name__)
+
+DTYPES = ["int8", "int16", "uint8", "uint16", ">i2", ">u2", "float32", ">f8"]
+
+
+def _baseline_getscale(data, dst_min, dst_max, f_low=0.0, f_high=0.999):
+    """
+    The previous getscale (statistics and histogram of the whole image).
+    """
+    data_min = np.min(data)
+    data_max = np.max(data)
+    if f_low == 0.0 and f_high == 1.0:
+        return data_min, 1.0
+    num_nonzero_voxels = (np.abs(data) >= 1e-15).sum()
+    num_total_voxels = data.shape[0] * data.shape[1] * data.shape[2]
+    hist, bin_edges = np.histogram(data, bins=1000, range=(data_min, data_max))
+    cum_hist = np.concatenate(([0], np.cumsum(hist)))
+    lower_cutoff = int(f_low * num_total_voxels)
+    binindex_lt_low_cutoff = np.flatnonzero(cum_hist < lower_cutoff)
+    lower_binedge_index = 0
+    if len(binindex_lt_low_cutoff) > 0:
+        lower_binedge_index = binindex_lt_low_cutoff[-1] + 1
+    src_min = bin_edges[lower_binedge_index].item()
+    upper_cutoff = num_total_voxels - int((1.0 - f_high) * num_nonzero_voxels)
+    binindex_ge_up_cutoff = np.flatnonzero(cum_hist >= upper_cutoff)
+    if len(binindex_ge_up_cutoff) > 0:
+        upper_binedge_index = binindex_ge_up_cutoff[0] - 2
+    else:
+        upper_binedge_index = -1
+    src_max = bin_edges[upper_binedge_index].item()
+    if src_min == src_max:
+        return src_min, 1.0
+    return src_min, (dst_max - dst_min) / (src_max - src_min)
+
+
+def _baseline_scalecrop(data, dst_min, dst_max, src_min, scale):
+    """
+    The previous scalecrop (float copy of the whole image).
+    """
+    return np.clip(dst_min + scale * (data - src_min), dst_min, dst_max)
+
+
+def _baseline_conform_data(img, mapped_data):
+    """
+    The data of the previous conform from the resampled data (the header and the
+    resampling are unchanged).
+    """
+    if img.get_data_dtype() != np.dtype(np.uint8):
+        src_min, scale = _baseline_getscale(np.asanyarray(img.dataobj), 0, 255)
+        scaled_data = _baseline_scalecrop(mapped_data, 0, 255, src_min, scale)
+        scaled_data[mapped_data == 0] = 0
+        mapped_data = scaled_data
+    return np.uint8(np.clip(np.rint(mapped_data), 0, 255))
+
+
+def _synthetic_image(dtype, shape=(30, 34, 26), seed=0):
+    """
+    An image with zero background, a brain-like intensity distribution and outliers.
+    """
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        low, high = -5.0, 4000.0
+    else:
+        info = np.iinfo(dtype)
+        low, high = max(info.min, -20), info.max
+    grid = np.indices(shape, dtype=float)
+    dist = sum(((g - s / 2) / (s / 3)) ** 2 for g, s in zip(grid, shape, strict=True))
+    data = np.where(dist < 1, rng.normal(0.4, 0.15, shape), 0.0)
+    data = np.clip(data, 0, 1) * 0.8 * high
+    # a few negative values and bright outliers
+    data.flat[rng.integers(0, data.size, 20)] = low
+    data.flat[rng.integers(0, data.size, 20)] = high
+    return data.astype(dtype)
+
+
+@pytest.fixture(params=[None, 1000], ids=["one_chunk", "chunks"])
+def chunk_size(request, monkeypatch):
+    """
+    Process the images in one or in multiple chunks.
+    """
+    if request.param is not None:
+        monkeypatch.setattr(conform_module, "CHUNK_SIZE", request.param)
+    return request.param
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_getscale(dtype, threads, chunk_size):
+    """
+    Test getscale is identical to the previous implementation.
+    """
+    data = _synthetic_image(dtype)
+    expected = _baseline_getscale(data, 0, 255)
+    assert getscale(data, 0, 255, threads=threads) == expected
+    # robust cropping at both ends
+    expected = _baseline_getscale(data, 0, 255, 0.1, 0.99)
+    assert getscale(data, 0, 255, 0.1, 0.99, threads=threads) == expected
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_scalecrop(dtype, threads, chunk_size):
+    """
+    Test scalecrop (also scaling directly to uint8) is identical to the previous
+    implementation.
+    """
+    data = _synthetic_image(dtype)
+    src_min, scale = _baseline_getscale(data, 0, 255)
+    expected = _baseline_scalecrop(data, 0, 255, src_min, scale)
+    scaled = scalecrop(data, 0, 255, src_min, scale, threads=threads)
+    assert scaled.dtype == expected.dtype
+    assert np.array_equal(scaled, expected)
+
+    expected[data == 0] = 0
+    expected = np.clip(np.rint(expected), 0, 255).astype(np.uint8)
+    scaled = scalecrop(
+        data, 0, 255, src_min, scale, dtype=np.uint8, zero_background=True, threads=threads,
+    )
+    assert scaled.dtype == np.uint8
+    assert np.array_equal(scaled, expected)
+
+
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_conform(dtype, chunk_size, monkeypatch):
+    """
+    Test the data of conform is identical to the previous implementation.
+    """
+    resampled = []
+
+    def _map_image(*args, **kwargs):
+        resampled.append(map_image(*args, **kwargs))
+        return resampled[-1].copy()
+
+    monkeypatch.setattr(conform_module, "map_image", _map_image)
+    data = _synthetic_image(dtype)
+    # RAS with anisotropic voxels, so the image is reoriented and resampled
+    img = nib.Nifti1Image(data, np.diag([1.2, 1.0, 1.5, 1.0]))
+    conformed = conform(img, criteria={Criteria.FORCE_LIA, Criteria.FORCE_ISO_VOX})
+    expected = _baseline_conform_data(img, resampled[0])
+    assert conformed.get_data_dtype() == np.dtype(np.uint8)
+    assert np.array_equal(np.asanyarray(conformed.dataobj), expected)
@@ -0,0 +1,89 @@
+from logging import getLogger
+
+import pytest
+import torch
+
+from FastSurferCNN.config.defaults import get_cfg_defaults
+from FastSurferCNN.models.engine import ExportedModel, prepare_model
+from FastSurferCNN.models.networks import build_model
+
+logger = getLogger(__name__)
+
+
+@pytest.fixture(scope="module")
+def vinn():
+    """
+    A small FastSurferVINN with random weights and batch normalization statistics.
+    """
+    torch.manual_seed(0)
+    cfg = get_cfg_defaults()
+    cfg.MODEL.MODEL_NAME = "FastSurferVINN"
+    cfg.MODEL.NUM_CLASSES = 8
+    cfg.MODEL.NUM_FILTERS = 16
+    cfg.MODEL.HEIGHT = cfg.MODEL.WIDTH = 64
+    cfg.MODEL.OUT_TENSOR_HEIGHT = cfg.MODEL.OUT_TENSOR_WIDTH = 80
+    model = build_model(cfg).eval()
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.1, 0.1)
+            module.running_var.uniform_(0.5, 2.0)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.1, 0.1)
+    return model
+
+
+def _reference(model, x, scale_factor):
+    """
+    Run the eager model in float32 and float64.
+    """
+    with torch.no_grad():
+        ref = model(x, scale_factor.clone())
+        ref64 = model.double()(x.double(), scale_factor.clone())
+        model.float()
+    return ref, ref64
+
+
+def _assert_parity(out, ref, ref64):
+    """
+    Compare an engine's output to the eager model.
+
+    Random networks amplify rounding differences, so the logits are compared to the
+    float64 result (with the float32 eager error as reference) and the labels to the
+    float32 result.
+    """
+    tolerance = max(2 * (ref.double() - ref64).abs().max().item(), 1e-3)
+    error = (out.double() - ref64).abs().max().item()
+    agreement = (out.argmax(1) == ref.argmax(1)).float().mean().item()
+    logger.info(f"max error {error} (tolerance {tolerance}), agreement {agreement}")
+    assert error <= tolerance
+    assert agreement >= 0.999
+
+
+@pytest.mark.parametrize("scale", [1.0, 0.8])
+def test_folded_batchnorm(vinn, scale):
+    x = torch.randn(2, 7, 64, 64)
+    sf = torch.tensor([[scale, scale]] * 2)
+    ref, ref64 = _reference(vinn, x, sf)
+    folded = prepare_model(vinn)
+    # only the input normalizations (bn0) have no preceding convolution
+    remaining = [n for n, m in folded.named_modules() if isinstance(m, torch.nn.BatchNorm2d)]
+    assert all(n.endswith(".bn0") for n in remaining)
+    with torch.no_grad():
+        _assert_parity(folded(x, sf.clone()), ref, ref64)
+
+
+@pytest.mark.parametrize("engine", ["torchscript", "onnx"])
+@pytest.mark.parametrize("scale", [1.0, 0.8])
+def test_engine_parity(vinn, engine, scale):
+    if engine == "onnx":
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+    x = torch.randn(3, 7, 64, 64)
+    sf = torch.tensor([[scale, scale]] * 3)
+    ref, ref64 = _reference(vinn, x, sf)
+    model = ExportedModel(vinn, engine)
+    out = model(x, sf)
+    assert out.shape == ref.shape
+    _assert_parity(out, ref, ref64)
+    # smaller batches are padded to the traced batch size
+    assert torch.allclose(model(x[:1], sf[:1]), out[:1], atol=1e-5)
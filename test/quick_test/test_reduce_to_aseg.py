@@ -0,0 +1,205 @@
+from logging import getLogger
+
+import numpy as np
+import pytest
+import scipy.ndimage
+from skimage.filters import gaussian
+from skimage.measure import label
+
+from FastSurferCNN.reduce_to_aseg import _hemisphere_vote, create_mask, flip_wm_islands
+
+logger = getLogger(__name__)
+
+
+def _baseline_create_mask(aseg_data, dnum, enum):
+    """
+    The previous create_mask (scipy binary dilation and erosion of the whole image).
+    """
+    frontal_mask = np.isin(aseg_data, (1012, 1019, 2012, 2019))
+    datab = aseg_data > 0
+    datab[frontal_mask] = 0
+    datab = scipy.ndimage.binary_dilation(datab, np.ones((3, 3, 3)), iterations=dnum)
+    datab = scipy.ndimage.binary_erosion(datab, np.ones((3, 3, 3)), iterations=enum)
+    labels = label(datab)
+    if labels.max() > 1:
+        datab = labels == np.argmax(np.bincount(labels.flat)[1:]) + 1
+    datab[frontal_mask] = 1
+    return datab
+
+
+def _synthetic_aparc(shape, center, radius, seed=0):
+    """
+    A noisy ellipsoidal aparc+aseg with a frontal region, holes and a small island.
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.indices(shape, dtype=float)
+    dist = sum(((g - c) / r) ** 2 for g, c, r in zip(grid, center, radius, strict=True))
+    noise = scipy.ndimage.gaussian_filter(rng.normal(size=shape), 2) * 4
+    aseg = np.zeros(shape, dtype=np.int16)
+    brain = dist + noise < 1
+    aseg[brain] = rng.choice([2, 3, 41, 42, 1028, 2028], size=int(brain.sum()))
+    # holes inside the brain
+    aseg[brain & (rng.random(shape) < 0.02)] = 0
+    # frontal region sticking out of the brain (eye nerve)
+    front = (dist > 0.8) & (dist < 1.6) & (grid[0] > center[0] + 0.5 * radius[0])
+    aseg[front & (np.abs(grid[1] - center[1]) < 3)] = 1012
+    aseg[front & (np.abs(grid[2] - center[2]) < 2)] = 2019
+    # small island away from the brain
+    aseg[1:3, 1:3, -3:-1] = 41
+    return aseg
+
+
+@pytest.mark.parametrize("dnum, enum", [(5, 4), (2, 3), (1, 1)])
+@pytest.mark.parametrize(
+    "center, radius",
+    [
+        ((24, 22, 20), (14, 12, 10)),
+        # brain touching (and cut by) the image border
+        ((34, 4, 20), (14, 12, 10)),
+    ],
+    ids=["inside", "border"],
+)
+def test_create_mask(center, radius, dnum, enum):
+    """
+    Test create_mask is identical to the previous scipy implementation.
+    """
+    aseg = _synthetic_aparc((40, 36, 32), center, radius)
+    expected = _baseline_create_mask(aseg.copy(), dnum, enum)
+    original = aseg.copy()
+    mask = create_mask(aseg, dnum, enum)
+    logger.info(f"mask voxels {int(mask.sum())}")
+    assert np.array_equal(aseg, original), "create_mask modified its input."
+    assert mask.dtype == np.uint8
+    assert np.array_equal(mask.astype(bool), expected)
+
+
+def _baseline_flip_wm_islands(aseg_data):
+    """
+    The previous flip_wm_islands (one labeling per hemisphere, smoothing of the whole
+    image in double precision).
+    """
+    islands = []
+    for wm in (2, 41):
+        labels = label(aseg_data == wm, background=0)
+        largest = np.argmax(np.bincount(labels.flat)[1:]) + 1
+        islands.append((labels != largest) & (labels > 0))
+    lhmask = (aseg_data == 2) | (aseg_data == 3)
+    rhmask = (aseg_data == 41) | (aseg_data == 42)
+    ii = gaussian(lhmask.astype(float) * (-1) + rhmask.astype(float), sigma=1.5)
+    flip_data = aseg_data.copy()
+    flip_data[islands[1] & (ii < 0.0)] = 2
+    flip_data[islands[0] & (ii > 0.0)] = 41
+    return flip_data
+
+
+def _add_balanced_island(aseg, center, wm, gm, overshoot):
+    """
+    Add a one voxel WM island surrounded by GM of the other hemisphere, whose vote
+    (nearly) cancels the island's vote.
+
+    The GM voxels are chosen greedily by their kernel weight, so that the vote at the
+    island is a tiny positive (overshoot=False) or negative (overshoot=True) number
+    (times the sign of the island's hemisphere).
+    """
+    radius = 6
+    delta = np.zeros((2 * radius + 1,) * 3)
+    delta[(radius,) * 3] = 1
+    weights = gaussian(delta, sigma=1.5)
+    remaining = weights[(radius,) * 3]
+    order = np.argsort(weights, axis=None, kind="stable")[::-1]
+    chosen = np.zeros(weights.size, dtype=bool)
+    for index in order[1:]:
+        if weights.flat[index] <= remaining:
+            chosen[index] = True
+            remaining -= weights.flat[index]
+    if overshoot:
+        chosen[order[1:][~chosen[order[1:]]][-1]] = True
+    window = tuple(slice(c - radius, c + radius + 1) for c in center)
+    aseg[window][chosen.reshape(weights.shape)] = gm
+    aseg[center] = wm
+
+
+def _synthetic_aseg():
+    """
+    Two hemispheres (lh at low, rh at high x) with WM islands at the image border, two
+    equally large lh WM components (in the lh and in the rh) and islands with votes
+    close to 0.
+    """
+    aseg = np.zeros((60, 48, 80), dtype=np.uint8)
+    # hemispheres touching the image border, GM shell around a WM core
+    aseg[0:29, 2:46, 2:44] = 3
+    aseg[0:26, 5:43, 5:41] = 2
+    aseg[31:60, 2:46, 2:44] = 42
+    aseg[34:60, 5:43, 5:41] = 41
+    # two lh WM components of equal size, the second in the rh (the first in raster
+    # order is kept, the second is an island)
+    aseg[0:26, 23:43, 5:41] = 3
+    aseg[34:60, 25:43, 5:41] = 2
+    # islands at the image border in the other hemisphere and outside the brain
+    aseg[0:2, 30:32, 10:12] = 41
+    aseg[58:60, 10:12, 20:22] = 2
+    aseg[20:22, 0:2, 79] = 41
+    aseg[45, 47, 50:52] = 2
+    # islands with votes close to 0
+    _add_balanced_island(aseg, (15, 12, 60), 41, 3, overshoot=False)
+    _add_balanced_island(aseg, (15, 34, 60), 41, 3, overshoot=True)
+    _add_balanced_island(aseg, (45, 12, 60), 2, 42, overshoot=False)
+    _add_balanced_island(aseg, (45, 34, 60), 2, 42, overshoot=True)
+    return aseg
+
+
+def test_flip_wm_islands_near_zero_votes():
+    """
+    Test the synthetic segmentation has island votes below the float32 threshold.
+    """
+    aseg = _synthetic_aseg()
+    vote = gaussian(np.isin(aseg, (41, 42)) - np.isin(aseg, (2, 3)).astype(float), sigma=1.5)
+    centers = (15, 15, 45, 45), (12, 34, 12, 34), (60,) * 4
+    logger.info(f"votes {vote[centers]}")
+    assert np.all(np.abs(vote[centers]) < 1e-5)
+
+
+def test_hemisphere_vote():
+    """
+    Test the windowed vote is bit-identical to smoothing the whole image in double
+    precision (including exact zeros far from the brain and values close to 0) and
+    has the same sign in single precision above the threshold of flip_wm_islands.
+    """
+    aseg = _synthetic_aseg()
+    vote = gaussian(np.isin(aseg, (41, 42)) - np.isin(aseg, (2, 3)).astype(float), sigma=1.5)
+    rng = np.random.default_rng(2)
+    voxels = tuple(rng.integers(0, size, 2000) for size in aseg.shape)
+    voxels = tuple(
+        np.concatenate([v, c]) for v, c in zip(voxels, np.nonzero(np.isin(aseg, (2, 41))), strict=True)
+    )
+    assert np.any(vote[voxels] == 0.0)
+
+    vote64 = _hemisphere_vote(aseg, voxels, np.float64)
+    assert vote64.dtype == np.float64
+    assert np.array_equal(vote64, vote[voxels])
+    # a single voxel (smallest possible window at the border of the image)
+    for corner in ((0, 0, 0), (59, 47, 79), (15, 34, 60)):
+        single = tuple(np.array([c]) for c in corner)
+        assert np.array_equal(_hemisphere_vote(aseg, single, np.float64), vote[single])
+
+    vote32 = _hemisphere_vote(aseg, voxels, np.float32)
+    assert vote32.dtype == np.float32
+    certain = np.abs(vote32) >= 1e-5
+    assert np.array_equal(np.sign(vote32[certain]), np.sign(vote[voxels][certain]))
+    assert _hemisphere_vote(aseg, (np.zeros(0, dtype=int),) * 3, np.float32).size == 0
+
+
+@pytest.mark.parametrize("noise", [0.0, 0.01, 0.05])
+def test_flip_wm_islands(noise):
+    """
+    Test flip_wm_islands is bit-identical to the previous implementation.
+    """
+    aseg = _synthetic_aseg()
+    rng = np.random.default_rng(1)
+    aseg[rng.random(aseg.shape) < noise] = 2
+    aseg[rng.random(aseg.shape) < noise] = 41
+    expected = _baseline_flip_wm_islands(aseg)
+    flipped = flip_wm_islands(aseg)
+    logger.info(f"flipped voxels {int((expected != aseg).sum())}")
+    assert flipped.dtype == expected.dtype
+    assert np.array_equal(flipped, expected)
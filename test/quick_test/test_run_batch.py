@@ -0,0 +1,194 @@
+import threading
+import time
+from logging import getLogger
+
+import pytest
+
+from FastSurferCNN.run_batch import BatchScheduler, BatchStatus, Resources
+from FastSurferCNN.utils.common import SubjectDirectory
+
+logger = getLogger(__name__)
+
+STAGES = ("asegdkt", "seg", "surf")
+REQUIREMENTS = {
+    "asegdkt": Resources(1, 2.0),
+    "seg": Resources(2, 2.0),
+    # more than the budget, capped by the scheduler
+    "surf": Resources(16, 64.0),
+}
+
+
+class StubRunners:
+    """
+    Runners of all stages, that record the jobs and the resources in use.
+    """
+
+    def __init__(self, budget: Resources, failing: set[tuple[str, str]] = frozenset()):
+        self.budget = budget
+        self.failing = failing
+        self.calls = []
+        self._lock = threading.Lock()
+        self._in_use = Resources(0, 0.0)
+        self._running = dict.fromkeys(STAGES, 0)
+        self.max_running = dict.fromkeys(STAGES, 0)
+
+    def _run(self, stage, subject, resources):
+        with self._lock:
+            self.calls.append((subject.id, stage))
+            self._in_use += resources
+            assert self.budget.fits(self._in_use), "The budget is exceeded."
+            self._running[stage] += 1
+            self.max_running[stage] = max(self.max_running[stage], self._running[stage])
+        try:
+            time.sleep(0.02)
+            if (subject.id, stage) in self.failing:
+                raise RuntimeError(f"{stage} of {subject.id} failed")
+        finally:
+            with self._lock:
+                self._in_use -= resources
+                self._running[stage] -= 1
+
+    def runners(self):
+        def _runner(stage):
+            return lambda subject, resources: self._run(stage, subject, resources)
+
+        return {stage: _runner(stage) for stage in STAGES}
+
+    def stages_of(self, sid):
+        return [stage for _sid, stage in self.calls if _sid == sid]
+
+
+@pytest.fixture
+def subjects(tmp_path):
+    """
+    Four subjects in a temporary subjects directory.
+    """
+    return [SubjectDirectory(id=f"sub-{i}", subject_dir=tmp_path) for i in range(4)]
+
+
+@pytest.fixture
+def status_file(tmp_path):
+    """
+    A temporary SQLite file for the batch status.
+    """
+    return tmp_path / "batch_status.sqlite"
+
+
+def _run_batch(subjects, status_file, stub, **kwargs):
+    status = BatchStatus(status_file)
+    try:
+        scheduler = BatchScheduler(
+            subjects, status, stub.budget, REQUIREMENTS, stub.runners(), **kwargs
+        )
+        return scheduler.run()
+    finally:
+        status.close()
+
+
+def test_status_resume(status_file):
+    """
+    Test running stages are pending, when the status database is opened again.
+    """
+    status = BatchStatus(status_file)
+    assert status.get("sub-0", "asegdkt") == "pending"
+    status.set("sub-0", "asegdkt", "done")
+    status.set("sub-0", "seg", "running")
+    status.set("sub-1", "asegdkt", "failed", "error")
+    status.close()
+
+    status = BatchStatus(status_file)
+    assert status.get("sub-0", "asegdkt") == "done"
+    assert status.get("sub-0", "seg") == "pending"
+    assert status.get("sub-1", "asegdkt") == "failed"
+    assert status.summary() == {
+        ("asegdkt", "done"): 1,
+        ("seg", "pending"): 1,
+        ("asegdkt", "failed"): 1,
+    }
+    status.close()
+
+
+def test_run_all(subjects, status_file):
+    """
+    Test all stages of all subjects run in order within the budget.
+    """
+    stub = StubRunners(Resources(4, 8.0))
+    assert _run_batch(subjects, status_file, stub) == 0
+    for subject in subjects:
+        assert stub.stages_of(subject.id) == list(STAGES)
+    # the stages of different subjects overlap
+    assert stub.max_running["asegdkt"] > 1
+
+    status = BatchStatus(status_file)
+    assert status.summary() == {(stage, "done"): len(subjects) for stage in STAGES}
+    status.close()
+
+    # a finished batch does not run anything again
+    stub = StubRunners(Resources(4, 8.0))
+    assert _run_batch(subjects, status_file, stub) == 0
+    assert stub.calls == []
+
+
+def test_max_jobs(subjects, status_file):
+    """
+    Test the number of concurrent jobs of a stage is limited by max_jobs.
+    """
+    stub = StubRunners(Resources(4, 8.0))
+    assert _run_batch(subjects, status_file, stub, max_jobs={"asegdkt": 1}) == 0
+    assert stub.max_running["asegdkt"] == 1
+    assert len(stub.calls) == len(subjects) * len(STAGES)
+
+
+def test_no_job_fits(subjects, status_file):
+    """
+    Test the scheduler raises an error, if no job can be started.
+    """
+    stub = StubRunners(Resources(4, 8.0))
+    with pytest.raises(RuntimeError, match="No job fits into the resource budget"):
+        _run_batch(subjects, status_file, stub, max_jobs={"asegdkt": 0})
+    assert stub.calls == []
+
+
+def test_resume_interrupted(subjects, status_file):
+    """
+    Test a resumed batch continues with the stages, that were running or pending.
+    """
+    status = BatchStatus(status_file)
+    for subject in subjects:
+        status.set(subject.id, "asegdkt", "done")
+    status.set("sub-0", "seg", "done")
+    status.set("sub-0", "surf", "running")
+    status.set("sub-1", "seg", "running")
+    status.close()
+
+    stub = StubRunners(Resources(4, 8.0))
+    assert _run_batch(subjects, status_file, stub) == 0
+    assert stub.stages_of("sub-0") == ["surf"]
+    assert stub.stages_of("sub-1") == ["seg", "surf"]
+    assert stub.stages_of("sub-2") == ["seg", "surf"]
+
+
+def test_failed_stage(subjects, status_file):
+    """
+    Test a failed stage stops its subject and is only rerun with retry_failed.
+    """
+    stub = StubRunners(Resources(4, 8.0), failing={("sub-2", "seg")})
+    assert _run_batch(subjects, status_file, stub) == 1
+    assert stub.stages_of("sub-2") == ["asegdkt", "seg"]
+    for sid in ("sub-0", "sub-1", "sub-3"):
+        assert stub.stages_of(sid) == list(STAGES)
+
+    status = BatchStatus(status_file)
+    assert status.get("sub-2", "seg") == "failed"
+    assert status.get("sub-2", "surf") == "pending"
+    status.close()
+
+    # resumed without retry_failed, the failed subject is skipped
+    stub = StubRunners(Resources(4, 8.0))
+    assert _run_batch(subjects, status_file, stub) == 0
+    assert stub.calls == []
+
+    # resumed with retry_failed, the failed stage and the following stages run
+    stub = StubRunners(Resources(4, 8.0))
+    assert _run_batch(subjects, status_file, stub, retry_failed=True) == 0
+    assert stub.calls == [("sub-2", "seg"), ("sub-2", "surf")]
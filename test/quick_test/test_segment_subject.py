@@ -0,0 +1,71 @@
+from logging import getLogger
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from FastSurferCNN.run_prediction import segment_subject
+from FastSurferCNN.utils.common import SubjectDirectory
+
+logger = getLogger(__name__)
+
+
+class StubModel:
+    """
+    A model returning a synthetic asegdkt segmentation, that records the saved images.
+    """
+
+    def __init__(self, prediction: np.ndarray):
+        self.prediction = prediction
+        self.saved = {}
+
+    def get_prediction(self, orig_name, data_array, zoom):
+        return self.prediction.copy()
+
+    def async_save_img(self, filename, data, orig_img, dtype=None):
+        # the image would be written in the background, keep the array (not a copy)
+        self.saved[str(filename)] = data
+        return None
+
+
+@pytest.fixture
+def asegdkt():
+    """
+    A synthetic asegdkt segmentation with WM, cortex and subcortical labels.
+    """
+    seg = np.zeros((40, 40, 40), dtype=np.int16)
+    # cortex around the white matter of each hemisphere
+    seg[5:19, 5:35, 5:35] = 1028
+    seg[8:16, 8:32, 8:32] = 2
+    seg[21:35, 5:35, 5:35] = 2028
+    seg[24:32, 8:32, 8:32] = 41
+    # subcortical structures
+    seg[10:14, 18:22, 18:22] = 10
+    seg[26:30, 18:22, 18:22] = 49
+    return seg
+
+
+def test_segment_subject(asegdkt, tmp_path):
+    """
+    Test segment_subject returns and saves the asegdkt segmentation unchanged
+    (reducing to the aseg must not modify it).
+    """
+    model = StubModel(asegdkt)
+    subject = SubjectDirectory(
+        id="sub-0",
+        subject_dir=tmp_path,
+        orig_name="mri/orig/001.mgz",
+        segfile="mri/aparc.DKTatlas+aseg.deep.mgz",
+    )
+    orig_img = nib.MGHImage(np.zeros(asegdkt.shape, dtype=np.uint8), np.eye(4))
+    segmentation = segment_subject(model, subject, orig_img, np.asanyarray(orig_img.dataobj))
+
+    assert np.array_equal(segmentation.asegdkt, asegdkt)
+    assert np.any(segmentation.asegdkt >= 1000)
+    assert np.array_equal(model.saved[str(subject.segfile)], asegdkt)
+
+    # the aseg is reduced (no cortical parcels) and masked
+    assert segmentation.aseg is not None and segmentation.brainmask is not None
+    assert not np.any(segmentation.aseg >= 1000)
+    assert np.any(segmentation.aseg == 3) and np.any(segmentation.aseg == 42)
+    assert not np.any(segmentation.aseg[segmentation.brainmask == 0])